@@ -0,0 +1,178 @@
+"""
+Benchmark of the access paths of the aggregation table, before and after
+creating the indexes from the 3.8.0-3.9.0 upgrade script.
+
+Synthetic aggregated data is loaded into uraggregated_data, and the plans and
+timings of update_uraggregate, the query engine query, and the machine view
+and admin manifest queries are reported without and with the indexes.
+
+Usage: python -m benchmarks.bench_aggregationindex [rows] [machines]
+
+Everything is done in a single transaction, which is rolled back at the end,
+so the database is left unchanged.
+"""
+
+import os
+import re
+import sys
+import time
+import datetime
+
+from sgas.queryengine import builder
+from sgas.viewengine import machineview, adminmanifest
+
+from benchmarks import benchutils
+
+
+
+UPGRADE_SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'datafiles', 'share', 'postgresql',
+                              'sgas-postgres-3.8.0-3.9.0-upgrade.sql')
+
+MACHINE_PREFIX = 'bench-aggregation-machine'
+DAYS = 3 * 365
+
+INSERT_MACHINES = '''INSERT INTO machinename (machine_name)
+                     SELECT %s || s FROM generate_series(0, %s - 1) AS s'''
+
+# rows are generated in insert time order, as the updater inserts them,
+# jobs are executed up to a week before they are inserted
+INSERT_ROWS = '''
+INSERT INTO uraggregated_data
+    (execution_time, insert_time, machine_name_id, queue_id, global_user_name_id, local_user_id,
+     vo_information_id, project_name_id, runtime_environments_id, status_id, insert_host_id,
+     n_jobs, cputime, walltime, generate_time)
+SELECT
+    current_date - (s * %(days)s / %(rows)s) - (s %% 7),
+    current_date - (s * %(days)s / %(rows)s),
+    m.id, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL,
+    1 + s %% 50, 3600 * (s %% 13), 3600 * (s %% 17), now()
+FROM generate_series(0, %(rows)s - 1) AS s
+JOIN (SELECT id, row_number() OVER (ORDER BY id) - 1 AS n FROM machinename WHERE machine_name LIKE %(prefix)s) AS m
+    ON (m.n = s %% %(machines)s)
+'''
+
+UPDATE_AGGREGATE = [
+    'DELETE FROM uraggregated_update',
+    'INSERT INTO uraggregated_update (insert_time, machine_name_id) ' + \
+    'SELECT current_date - 30, id FROM machinename WHERE machine_name = %s',
+    'SELECT update_uraggregate()'
+]
+
+
+
+def indexStatements():
+    # the uraggregated indexes from the upgrade script
+    statements = []
+    for line in open(UPGRADE_SCRIPT):
+        if line.startswith('CREATE INDEX uraggregated'):
+            name = line.split()[2]
+            statements.append( (name, line.strip()) )
+    return statements
+
+
+def queries(machine):
+
+    start_date = datetime.date.today() - datetime.timedelta(days=60)
+    end_date   = datetime.date.today() - datetime.timedelta(days=30)
+
+    qe_machine, qe_machine_args = builder.buildQuery({'machine_name': [machine], 'start_date': start_date,
+                                                      'end_date': end_date, 'time_resolution': 'day'})
+    qe_all, qe_all_args = builder.buildQuery({'start_date': start_date, 'end_date': end_date,
+                                              'time_resolution': 'collapse'})
+    return [
+        ('queryengine (machine)',       qe_machine,                                 qe_machine_args),
+        ('queryengine (all machines)',  qe_all,                                     qe_all_args),
+        ('machineview manifest',        machineview.QUERY_MACHINE_MANIFEST,         (machine,)),
+        ('machineview jobs per day',    machineview.QUERY_EXECUTED_JOBS_PER_DAY,    (machine,)),
+        ('machineview top projects',    machineview.QUERY_TOP10_PROJECTS,           (machine, start_date, end_date)),
+        ('adminmanifest inserts',       adminmanifest.INSERTS_PER_DAY,              ()),
+        ('adminmanifest stale',         adminmanifest.STALE_MACHINES_TWO_MONTHS,    ())
+    ]
+
+
+
+def scanNodes(cur, query, args):
+    # the scan nodes of the query plan, which is what the indexes change
+    cur.execute('EXPLAIN ' + query, args)
+    nodes = []
+    for (line,) in cur.fetchall():
+        if 'uraggregated_data' in line and 'Scan' in line:
+            nodes.append(re.sub(r'\s+\(cost=.*', '', line.replace('->', '').strip()))
+    return nodes
+
+
+def timeQuery(cur, query, args):
+
+    def run():
+        cur.execute(query, args)
+        return cur.fetchall()
+
+    dt, _ = benchutils.timeit(run)
+    return dt
+
+
+def timeUpdate(cur, machine):
+
+    def run():
+        cur.execute('SAVEPOINT bench')
+        cur.execute(UPDATE_AGGREGATE[0])
+        cur.execute(UPDATE_AGGREGATE[1], (machine,))
+        cur.execute(UPDATE_AGGREGATE[2])
+        cur.execute('ROLLBACK TO SAVEPOINT bench')
+
+    dt, _ = benchutils.timeit(run)
+    return dt
+
+
+def report(cur, title, machine):
+
+    print '-- %s' % title
+    dt = timeUpdate(cur, machine)
+    print '%-30s %9.2f ms' % ('update_uraggregate', dt * 1000)
+    print '    %s' % ', '.join(scanNodes(cur, 'DELETE FROM uraggregated_data WHERE insert_time = current_date - 30 ' + \
+                                          'AND machine_name_id = (SELECT id FROM machinename WHERE machine_name = %s)',
+                                          (machine,)))
+    for name, query, args in queries(machine):
+        dt = timeQuery(cur, query, args)
+        print '%-30s %9.2f ms' % (name, dt * 1000)
+        print '    %s' % ', '.join(scanNodes(cur, query, args))
+
+
+
+def main():
+
+    n_rows     = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    n_machines = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    conn = benchutils.connect(benchutils.getDatabaseURL())
+    cur = conn.cursor()
+    machine = MACHINE_PREFIX + '0'
+    try:
+        indexes = indexStatements()
+        for name, _ in indexes:
+            cur.execute('DROP INDEX IF EXISTS %s' % name)
+
+        t0 = time.time()
+        cur.execute(INSERT_MACHINES, (MACHINE_PREFIX, n_machines))
+        cur.execute(INSERT_ROWS, {'days': DAYS, 'rows': n_rows, 'machines': n_machines, 'prefix': MACHINE_PREFIX + '%'})
+        cur.execute('ANALYZE uraggregated_data')
+        print 'Loaded %i aggregated rows for %i machines in %.1f s' % (n_rows, n_machines, time.time() - t0)
+
+        report(cur, 'without indexes', machine)
+
+        t0 = time.time()
+        for _, stm in indexes:
+            cur.execute(stm)
+        cur.execute('ANALYZE uraggregated_data')
+        print 'Created %i indexes in %.1f s' % (len(indexes), time.time() - t0)
+
+        report(cur, 'with indexes', machine)
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+
+if __name__ == '__main__':
+    main()
+
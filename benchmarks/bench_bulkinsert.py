@@ -0,0 +1,123 @@
+"""
+Benchmark of usage record insertion, one urcreate (or urcreate_ids) call per
+record compared to copying the records into the staging table and calling
+urcreate_bulk. Run it with different batch sizes to see where the bulk
+insertion starts to pay off (BULK_INSERT_THRESHOLD in jobinsertresource).
+
+The records inserted with both methods are compared afterwards, to check
+that the two methods give the same result.
+
+Usage: python -m benchmarks.bench_bulkinsert [batch size] [batches]
+
+Inserted records are deleted again after the run.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor, defer
+
+from sgas.database.postgresql import database
+from sgas.usagerecord import urconverter
+
+from benchmarks import benchutils
+
+
+
+RECORD_ID_PREFIX = 'bench-bulkinsert-'
+
+COMPARE_QUERY = '''SELECT * FROM usagerecords WHERE record_id LIKE %s ORDER BY record_id'''
+TRANSFER_QUERY = '''SELECT count(*) FROM jobtransferdata, usagedata
+                    WHERE usage_data_id = usagedata.id AND record_id LIKE %s'''
+
+DELETE_STATEMENTS = [
+    'DELETE FROM runtimeenvironment_usagedata WHERE usagedata_id IN (SELECT id FROM usagedata WHERE record_id LIKE %s)',
+    'DELETE FROM jobtransferdata WHERE usage_data_id IN (SELECT id FROM usagedata WHERE record_id LIKE %s)',
+    'DELETE FROM uraggregated_delta WHERE usagedata_id IN (SELECT id FROM usagedata WHERE record_id LIKE %s)',
+    'DELETE FROM usagedata WHERE record_id LIKE %s'
+]
+
+
+
+@defer.inlineCallbacks
+def insert(title, insert_func, prefix, batch_size, n_batches):
+
+    batches = []
+    for b in range(n_batches):
+        docs = benchutils.createUsageRecordDocs(batch_size, '%s%s-%i-' % (RECORD_ID_PREFIX, prefix, b))
+        batches.append(urconverter.createInsertArguments(docs))
+
+    t0 = time.time()
+    for arg_list in batches:
+        yield insert_func(arg_list)
+    total = time.time() - t0
+
+    # inserting again should just return the existing rows
+    t1 = time.time()
+    id_dict = yield insert_func(batches[0])
+    again = time.time() - t1
+    assert len(id_dict) == batch_size, 'Reinsert returned %i ids, expected %i' % (len(id_dict), batch_size)
+
+    n_records = batch_size * n_batches
+    print '%-20s %6i records in %6.2f s (%6.0f records/s), reinsert of %i records: %.2f s' % \
+          (title, n_records, total, n_records / total, batch_size, again)
+
+
+
+@defer.inlineCallbacks
+def compare(db):
+
+    rows = {}
+    for prefix in ('single', 'ids', 'bulk'):
+        pattern = '%s%s-%%' % (RECORD_ID_PREFIX, prefix)
+        result = yield db.pool_proxy.dbpool.runQuery(COMPARE_QUERY, (pattern,))
+        # skip the columns which differ (record id, global job id, and insert time).
+        # the arrays (e.g., runtime environments) are aggregated in no particular order
+        rows[prefix] = [ tuple( sorted(v) if type(v) is list else v for v in r[1:8] + r[9:-1] ) for r in result ]
+        transfers = yield db.pool_proxy.dbpool.runQuery(TRANSFER_QUERY, (pattern,))
+        rows[prefix].append(transfers[0][0])
+
+    if rows['single'] == rows['ids'] == rows['bulk']:
+        print 'Records inserted by all methods are identical'
+    else:
+        print 'ERROR: Records inserted by the methods differ'
+
+
+
+@defer.inlineCallbacks
+def run(batch_size, n_batches):
+
+    db = database.PostgreSQLDatabase(benchutils.getDatabaseURL())
+    db.registerDimensions(urconverter.DIMENSION_ARGS)
+
+    single = lambda arg_list : db.recordInserter('usage', 'urcreate', arg_list)
+    ids    = lambda arg_list : db.recordInserter('usage', 'urcreate_ids', arg_list, dimensions=urconverter.DIMENSION_ARGS)
+    bulk   = lambda arg_list : db.bulkRecordInserter('usage', urconverter.STAGING_TABLE, urconverter.STAGING_COLUMNS,
+                                                     'urcreate_bulk', arg_list)
+    try:
+        yield insert('urcreate', single, 'single', batch_size, n_batches)
+        yield insert('urcreate_ids', ids, 'ids', batch_size, n_batches)
+        yield insert('urcreate_bulk', bulk, 'bulk', batch_size, n_batches)
+        yield compare(db)
+    finally:
+        for stm in DELETE_STATEMENTS:
+            yield db.pool_proxy.dbpool.runOperation(stm, (RECORD_ID_PREFIX + '%',))
+        db.pool_proxy.dbpool.close()
+
+
+
+def main():
+
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_batches  = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    d = run(batch_size, n_batches)
+    d.addErrback(lambda f : f.printTraceback())
+    d.addBoth(lambda _ : reactor.stop())
+    reactor.run()
+
+
+
+if __name__ == '__main__':
+    main()
+
@@ -0,0 +1,128 @@
+"""
+Benchmark of reactor latency while inserting usage records.
+
+A LoopingCall ticks every 10 ms and records how late each tick is, while a
+number of concurrent batches are inserted. This is done both with the old way
+of inserting records (an adbapi transaction driven from the reactor thread,
+blocking in each callproc), and with the recordInserter from the database
+layer, which runs the whole transaction in a pool thread.
+
+Usage: python -m benchmarks.bench_insertlatency [records per batch] [concurrent batches]
+
+Inserted records are deleted again after the run.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor, defer, task
+from twisted.enterprise import adbapi
+
+from sgas.database.postgresql import database
+from sgas.usagerecord import ursplitter, urparser, urconverter
+
+from test import ursampledata
+from benchmarks import benchutils
+
+
+
+TICK_INTERVAL = 0.01
+RECORD_ID_PREFIX = 'bench-insertlatency-'
+
+
+
+def createArgumentLists(n_batches, batch_size):
+
+    template = urparser.xmlToDict(ursplitter.splitURDocument(ursampledata.UR1)[0],
+                                  insert_identity='/CN=bench', insert_hostname='bench.example.org',
+                                  insert_time=time.gmtime())
+    batches = []
+    for b in range(n_batches):
+        docs = []
+        for i in range(batch_size):
+            doc = template.copy()
+            doc['record_id'] = doc['global_job_id'] = '%s%i-%i-%f' % (RECORD_ID_PREFIX, b, i, time.time())
+            docs.append(doc)
+        batches.append(urconverter.createInsertArguments(docs))
+    return batches
+
+
+
+@defer.inlineCallbacks
+def inlineInserter(db, proc, arg_list):
+    # the previous insert approach, kept here for comparison
+    id_dict = {}
+    conn = adbapi.Connection(db.pool_proxy.dbpool)
+    try:
+        trans = adbapi.Transaction(db, conn)
+        for args in arg_list:
+            yield trans.callproc(proc, args)
+            r = yield trans.fetchall()
+            record_id, row_id = r[0][0]
+            id_dict[record_id] = str(row_id)
+        trans.close()
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    defer.returnValue(id_dict)
+
+
+
+@defer.inlineCallbacks
+def measure(title, insert, batches):
+
+    lateness = []
+    state = { 'last' : time.time() }
+
+    def tick():
+        now = time.time()
+        lateness.append(max(0, now - state['last'] - TICK_INTERVAL))
+        state['last'] = now
+
+    ticker = task.LoopingCall(tick)
+    ticker.start(TICK_INTERVAL)
+
+    t0 = time.time()
+    yield defer.DeferredList([ insert(arg_list) for arg_list in batches ], fireOnOneErrback=True)
+    total = time.time() - t0
+
+    ticker.stop()
+    tick() # catch a reactor which was blocked until the end
+    n_records = sum( [ len(b) for b in batches ] )
+    print '%s: %i records in %.2f s (%.0f records/s)' % (title, n_records, total, n_records / total)
+    benchutils.report('  reactor tick lateness', lateness)
+
+
+
+@defer.inlineCallbacks
+def run(batch_size, n_batches):
+
+    db = database.PostgreSQLDatabase(benchutils.getDatabaseURL())
+
+    try:
+        yield measure('inline (reactor thread)', lambda a : inlineInserter(db, 'urcreate', a),
+                      createArgumentLists(n_batches, batch_size))
+        yield measure('recordInserter (pool thread)', lambda a : db.recordInserter('usage', 'urcreate', a),
+                      createArgumentLists(n_batches, batch_size))
+    finally:
+        yield db.pool_proxy.dbpool.runOperation('DELETE FROM usagedata WHERE record_id LIKE %s', (RECORD_ID_PREFIX + '%',))
+        db.pool_proxy.dbpool.close()
+
+
+
+def main():
+
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    n_batches  = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    d = run(batch_size, n_batches)
+    d.addErrback(lambda f : f.printTraceback())
+    d.addBoth(lambda _ : reactor.stop())
+    reactor.run()
+
+
+
+if __name__ == '__main__':
+    main()
+
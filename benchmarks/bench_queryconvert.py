@@ -0,0 +1,96 @@
+"""
+Benchmark of the conversion of query results into plain values.
+
+Large synthetic result sets, with the columns of a WLCG query (text, integer
+and numeric columns), and of a query engine query (with a date column), are
+fetched and converted the way PostgreSQLDatabase.query used to (numeric
+values as Decimal, and every value checked and converted), and the way it
+does now (numeric values converted by the typecaster, and only columns
+which are not of a plain type converted). The time of fetching and converting
+is reported for both, and the results are compared.
+
+Usage: python -m benchmarks.bench_queryconvert [rows]
+"""
+
+import sys
+import types
+import decimal
+
+from sgas.database.postgresql import typecast
+
+from benchmarks import benchutils
+
+
+
+WLCG_QUERY = '''
+    SELECT 2011 AS year, (s %% 12) + 1 AS month, 'host' || (s %% 50) || '.example.org' AS machine_name,
+           'vo' || (s %% 7) AS vo_name, NULL::varchar AS vo_group, 'role' || (s %% 3) AS vo_role,
+           'user' || s AS user_identity, (s %% 1000)::bigint AS n_jobs,
+           (s * 1.25)::numeric AS cputime, (s * 3600)::numeric AS walltime,
+           s * 1.5 AS cputime_scaled, s * 4.5 AS walltime_scaled
+    FROM generate_series(1, %(rows)s) AS s'''
+
+QUERYENGINE_QUERY = '''
+    SELECT '2011-01-01'::date + (s %% 365) AS execution_time, 'host' || (s %% 50) || '.example.org' AS machine_name,
+           (s %% 1000) AS n_jobs, (s * 1.25)::numeric AS cputime, (s * 3600)::numeric AS walltime
+    FROM generate_series(1, %(rows)s) AS s'''
+
+
+
+def buildValue(value):
+    # the conversion previously done for every value
+    if type(value) in (unicode, str, int, long, float, bool, types.NoneType):
+        return value
+    if isinstance(value, decimal.Decimal):
+        sv = str(value)
+        return int(sv) if sv.isalnum() else float(sv)
+    return str(value)
+
+
+def fetchBefore(conn, query, params):
+    cur = conn.cursor()
+    cur.execute(query, params)
+    results = []
+    for row in cur.fetchall():
+        results.append( [ buildValue(e) for e in row ] )
+    return results
+
+
+def fetchAfter(conn, query, params):
+    cur = conn.cursor()
+    cur.execute(query, params)
+    rows = cur.fetchall()
+    return typecast.convertRows(rows, typecast.columnConverters(cur.description))
+
+
+
+def main():
+
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    params = { 'rows': n_rows }
+
+    db_url = benchutils.getDatabaseURL()
+    before_conn = benchutils.connect(db_url)
+    after_conn = benchutils.connect(db_url)
+    typecast.registerTypecasters(after_conn)
+
+    try:
+        for title, query in (('wlcg query', WLCG_QUERY), ('query engine query', QUERYENGINE_QUERY)):
+            # the time of the query itself, without creating any python values
+            cur = after_conn.cursor()
+            query_time, _ = benchutils.timeit(cur.execute, 'SELECT count(*) FROM (%s) AS q' % query, params)
+
+            before_time, before_rows = benchutils.timeit(fetchBefore, before_conn, query, params)
+            after_time, after_rows = benchutils.timeit(fetchAfter, after_conn, query, params)
+            identical = map(list, after_rows) == before_rows
+            print '%-20s %7i rows: query %6.0f ms, before %6.0f ms, after %6.0f ms (%4.1fx), %s' % \
+                  (title, n_rows, query_time * 1000, before_time * 1000, after_time * 1000,
+                   before_time / after_time, 'identical' if identical else 'DIFFER')
+    finally:
+        before_conn.close()
+        after_conn.close()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark of the compiled record parsers (see sgas.generic.recordspec)
+compared to the xmlToDict parsers followed by createInsertArguments.
+
+The arguments created by both parsers are compared, to check that they give
+the same result.
+
+Usage: python -m benchmarks.bench_recordparser [repeats]
+
+No database is needed.
+"""
+
+import sys
+import time
+
+from sgas.usagerecord import ursplitter, urparser, urconverter
+from sgas.storagerecord import srsplitter, srparser, srconverter
+
+from test import ursampledata, srsampledata
+from benchmarks import benchutils
+
+
+
+UR_DOCUMENTS = [ ursampledata.UR1, ursampledata.UR2, ursampledata.CUR, ursampledata.URT,
+                 ursampledata.UR_LONGHOST, ursampledata.UR_BAD_LOCAL_JOB_ID, ursampledata.UR_BAD_EXIT_CODE ]
+
+SR_DOCUMENTS = [ srsampledata.SR_0, srsampledata.SR_1, srsampledata.SRS ]
+
+INSERT_TIME = time.gmtime()
+
+
+
+def comparable(arg_list):
+    # memory objects do not compare by value
+    return [ [ [ m.getcomposite() for m in a ] if type(a) is list and a and hasattr(a[0], 'getcomposite') else a
+               for a in args ] for args in arg_list ]
+
+
+def urDictParse(elements):
+    docs = [ urparser.xmlToDict(e, '/CN=bench', 'bench.example.org', INSERT_TIME) for e in elements ]
+    return urconverter.createInsertArguments(docs)
+
+
+def urSpecParse(elements):
+    arg_list = []
+    insert_time = time.strftime(urparser.JSON_DATETIME_FORMAT, INSERT_TIME)
+    for e in elements:
+        args = urconverter.RECORD_PARSER.parse(e)
+        args[urconverter.INSERT_IDENTITY_IDX] = '/CN=bench'
+        args[urconverter.INSERT_HOSTNAME_IDX] = 'bench.example.org'
+        args[urconverter.INSERT_TIME_IDX] = insert_time
+        arg_list.append(urconverter.fixInsertArguments(args))
+    return arg_list
+
+
+def srDictParse(elements):
+    docs = [ srparser.xmlToDict(e, '/CN=bench', 'bench.example.org', INSERT_TIME) for e in elements ]
+    return srconverter.createInsertArguments(docs)
+
+
+def srSpecParse(elements):
+    arg_list = []
+    insert_time = time.strftime(srparser.JSON_DATETIME_FORMAT, INSERT_TIME)
+    for e in elements:
+        args = srconverter.RECORD_PARSER.parse(e)
+        args[srconverter.INSERT_IDENTITY_IDX] = '/CN=bench'
+        args[srconverter.INSERT_HOSTNAME_IDX] = 'bench.example.org'
+        args[srconverter.INSERT_TIME_IDX] = insert_time
+        arg_list.append(args)
+    return arg_list
+
+
+
+def bench(title, elements, dict_parse, spec_parse, repeats):
+
+    elements = elements * repeats
+    dict_time, dict_args = benchutils.timeit(dict_parse, elements)
+    spec_time, spec_args = benchutils.timeit(spec_parse, elements)
+
+    n = len(elements)
+    print '%-16s %6i records: xmlToDict %6.1f us/record, compiled %6.1f us/record (%.1fx)' % \
+          (title, n, dict_time / n * 1e6, spec_time / n * 1e6, dict_time / spec_time)
+    if comparable(dict_args) == comparable(spec_args):
+        print '  Arguments created by both parsers are identical'
+    else:
+        print '  ERROR: Arguments created by the two parsers differ'
+
+
+
+def main():
+
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    ur_elements = []
+    for doc in UR_DOCUMENTS:
+        ur_elements += ursplitter.splitURDocument(doc)
+    sr_elements = []
+    for doc in SR_DOCUMENTS:
+        sr_elements += srsplitter.splitSRDocument(doc)
+
+    bench('usage records', ur_elements, urDictParse, urSpecParse, repeats)
+    bench('storage records', sr_elements, srDictParse, srSpecParse, repeats)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark of the datetime and duration parsing in valueparser, compared to
+parsing everything with isodate (as was done previously).
+
+The values are typical for a batch of usage records: each record has a create,
+start, and end time and a wall and cpu duration, some of which are shared
+between the records in the batch.
+
+Usage: python -m benchmarks.bench_valueparser [records]
+
+No database is needed.
+"""
+
+import sys
+import time
+
+from sgas.ext import isodate
+from sgas.generic import valueparser
+
+from benchmarks import benchutils
+
+
+
+def isodateDateTime(value):
+    dt = isodate.parse_datetime(value)
+    return time.strftime(valueparser.JSON_DATETIME_FORMAT, dt.utctimetuple())
+
+
+def isodateDuration(value):
+    td = isodate.parse_duration(value)
+    return (td.days * 3600*24) + td.seconds
+
+
+
+def createValues(n_records):
+
+    t0 = 1262304000 # 2010-01-01
+    datetimes = []
+    durations = []
+    for i in range(n_records):
+        end = t0 + i * 7
+        # create times are often shared, as loggers create records in batches
+        create = t0 + (i / 100) * 3600
+        for t in (create, end - 3600 - i % 60, end):
+            datetimes.append(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t)))
+        durations.append('PT%iS' % (3600 + i % 60))
+        durations.append('PT%i.%iS' % (i % 3600, i % 10))
+    return datetimes, durations
+
+
+
+def parseAll(parse_datetime, parse_duration, datetimes, durations, clear_memo=False):
+    if clear_memo:
+        valueparser._datetime_memo.clear()
+        valueparser._duration_memo.clear()
+    return [ parse_datetime(v) for v in datetimes ] + [ parse_duration(v) for v in durations ]
+
+
+
+def main():
+
+    n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    datetimes, durations = createValues(n_records)
+
+    old_time, old_result = benchutils.timeit(parseAll, isodateDateTime, isodateDuration, datetimes, durations)
+    new_time, new_result = benchutils.timeit(parseAll, valueparser.parseISODateTime, valueparser.parseISODuration,
+                                             datetimes, durations, True)
+    memo_time, _ = benchutils.timeit(parseAll, valueparser.parseISODateTime, valueparser.parseISODuration,
+                                     datetimes, durations)
+
+    for title, t in (('isodate', old_time), ('valueparser', new_time), ('valueparser (warm memo)', memo_time)):
+        print '%-25s %6i records in %6.3f s (%6.1f us/record)' % (title, n_records, t, t / n_records * 1e6)
+
+    if old_result == new_result:
+        print 'Both parsers give the same values'
+    else:
+        print 'ERROR: The parsers give different values'
+
+
+
+if __name__ == '__main__':
+    main()
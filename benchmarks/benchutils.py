@@ -0,0 +1,95 @@
+"""
+Utilities for the benchmark scripts in this directory.
+
+The benchmarks are not unit tests, so they are kept out of the test package.
+They are run by hand from the top directory, e.g.:
+python -m benchmarks.bench_insertlatency
+
+Benchmarks that require a database use the same ~/.sgas-test file as the
+database tests, e.g.: {"postgresql.url": "localhost::sgas-test:sgas:secret:"}
+"""
+
+import os
+import sys
+import time
+
+from sgas.ext.python import json
+
+
+
+SGAS_TEST_FILE = os.path.join(os.path.expanduser('~'), '.sgas-test')
+
+
+
+def getDatabaseURL():
+
+    if not os.path.exists(SGAS_TEST_FILE):
+        print >> sys.stderr, 'Benchmark requires a test database, see %s' % __file__
+        sys.exit(1)
+
+    config = json.load(file(SGAS_TEST_FILE))
+    return config['postgresql.url']
+
+
+def connect(db_url):
+
+    import psycopg2
+    args = [ e or None for e in db_url.split(':') ]
+    host, port, database, user, password = args[:5]
+    return psycopg2.connect(host=host, port=port or 5432, database=database, user=user, password=password)
+
+
+def timeit(f, *args, **kwargs):
+    # returns the best of a few runs (in seconds) and the result of the last run
+    best = None
+    for _ in range(kwargs.pop('repeat', 3)):
+        t0 = time.time()
+        result = f(*args)
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+    return best, result
+
+
+def percentile(values, pct):
+
+    if not values:
+        return 0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def report(title, values, unit='ms', scale=1000.0):
+
+    print '%-30s n=%-6i avg=%8.2f%s p50=%8.2f%s p99=%8.2f%s max=%8.2f%s' % \
+          (title, len(values),
+           sum(values) / max(1, len(values)) * scale, unit,
+           percentile(values, 50) * scale, unit,
+           percentile(values, 99) * scale, unit,
+           max(values or [0]) * scale, unit)
+
+
+
+def createUsageRecordDocs(n_records, record_id_prefix, template=None, n_machines=10):
+    # creates usage record dicts based on a sample record, with varying record
+    # ids, machine names, users, runtime environments, and memory information
+    from sgas.usagerecord import ursplitter, urparser
+    from sgas.usagerecord.memory import SgasMemory
+    from test import ursampledata
+
+    ur_element = ursplitter.splitURDocument(template or ursampledata.URT)[0]
+    base_doc = urparser.xmlToDict(ur_element, insert_identity='/CN=bench',
+                                  insert_hostname='bench.example.org', insert_time=time.gmtime())
+    docs = []
+    for i in range(n_records):
+        doc = base_doc.copy()
+        doc['record_id'] = '%s%i' % (record_id_prefix, i)
+        doc['global_job_id'] = 'gsiftp://bench.example.org:2811/jobs/%s%i' % (record_id_prefix, i)
+        doc['machine_name'] = 'machine%i.bench.example.org' % (i % n_machines)
+        doc['local_user_id'] = 'benchuser%i' % (i % 37)
+        doc['runtime_environments'] = [ 'ENV/BENCH-%i' % (i % 5), 'APPS/BENCH' ]
+        doc['memory'] = [ SgasMemory(i, 'KB', 'max', 'physical') ]
+        docs.append(doc)
+    return docs
+
@@ -0,0 +1,351 @@
+-- logic for upgrading the SGAS PostgreSQL schema from version 3.8.0 to 3.9.0
+-- SGAS should be stopped when performing this upgrade
+-- After running this script, the functions should be reloaded from
+-- sgas-postgres-functions.sql
+
+BEGIN;
+
+-- staging table for bulk insertion of usage records
+-- rows are copied into this table by the server and then moved into the
+-- usagedata table by the urcreate_bulk function. The table is unlogged as the
+-- content only lives for the duration of the inserting transaction
+CREATE SEQUENCE usagedata_staging_batch_seq;
+
+CREATE UNLOGGED TABLE usagedata_staging (
+    batch_id                bigint          NOT NULL,
+    record_id               varchar,
+    create_time             timestamp,
+    global_job_id           varchar,
+    local_job_id            varchar,
+    local_user              varchar,
+    global_user_name        varchar,
+    vo_type                 varchar,
+    vo_issuer               varchar,
+    vo_name                 varchar,
+    vo_attributes           varchar[][],
+    machine_name            varchar,
+    job_name                varchar,
+    charge                  integer,
+    status                  varchar,
+    queue                   varchar,
+    host                    varchar,
+    node_count              integer,
+    processors              integer,
+    project_name            varchar,
+    submit_host             varchar,
+    start_time              timestamp,
+    end_time                timestamp,
+    submit_time             timestamp,
+    cpu_duration            bigint,
+    wall_duration           integer,
+    user_time               integer,
+    kernel_time             integer,
+    major_page_faults       integer,
+    runtime_environments    varchar[],
+    exit_code               integer,
+    downloads               varchar[],
+    uploads                 varchar[],
+    insert_host             varchar,
+    insert_identity         varchar,
+    insert_time             timestamp,
+    memory                  sgas_memory[]
+);
+
+CREATE INDEX usagedata_staging_batch_id_idx ON usagedata_staging (batch_id);
+
+-- indexes for the access paths of the aggregation table
+-- (insert_time, machine_name_id) is used when updating the aggregation and by
+-- the admin manifest, (machine_name_id, execution_time) by the machine view and
+-- the query engine, and the brin index for execution time ranges in general
+CREATE INDEX uraggregated_data_insert_time_machine_name_idx ON uraggregated_data (insert_time, machine_name_id);
+CREATE INDEX uraggregated_data_machine_name_execution_time_idx ON uraggregated_data (machine_name_id, execution_time);
+CREATE INDEX uraggregated_data_execution_time_brin_idx ON uraggregated_data USING BRIN (execution_time);
+
+CREATE INDEX uraggregated_update_insert_time_machine_name_idx ON uraggregated_update (insert_time, machine_name_id);
+CREATE INDEX uraggregated_update_machine_name_insert_time_idx ON uraggregated_update (machine_name_id, insert_time);
+
+CREATE TABLE uraggregated_delta (
+    usagedata_id        integer         PRIMARY KEY,
+    insert_time         date,
+    machine_name_id     integer
+);
+
+CREATE INDEX uraggregated_delta_machine_name_insert_time_idx ON uraggregated_delta (machine_name_id, insert_time);
+
+-- state of a rebuild of the aggregation table
+-- the aggregation of insert dates before the cutoff date is rebuilt into
+-- uraggregated_data_rebuild, one insert date (partition) at a time
+CREATE TABLE uraggregated_rebuild (
+    cutoff_date         date,
+    start_time          timestamp
+);
+
+CREATE TABLE uraggregated_rebuild_partition (
+    insert_date         date            PRIMARY KEY,
+    n_records           bigint,
+    build_time          timestamp
+);
+
+-- pairs recomputed by the updater while a rebuild is in progress, these are
+-- recomputed again when the rebuilt table is swapped in
+CREATE TABLE uraggregated_rebuild_dirty (
+    insert_time         date,
+    machine_name_id     integer
+);
+
+-- monthly and yearly rollups of the aggregation table, used by the query
+-- engine for queries which do not need daily resolution. only the dimensions
+-- of the uraggregated_monthly/yearly views are kept. the hours are rounded
+-- per aggregated row before they are summed, so sums over the rollups are the
+-- same as sums over the uraggregated view. execution_period is the first day
+-- of the month / year. records without a machine name are not rolled up
+CREATE TABLE uraggregated_monthly_data (
+    execution_period        date,
+    machine_name_id         integer,
+    global_user_name_id     integer,
+    local_user_id           integer,
+    vo_information_id       integer,
+    project_name_id         integer,
+    min_execution_time      date,
+    max_execution_time      date,
+    n_jobs                  integer,
+    cputime                 numeric,
+    walltime                numeric
+);
+
+CREATE INDEX uraggregated_monthly_data_machine_name_period_idx ON uraggregated_monthly_data (machine_name_id, execution_period);
+CREATE INDEX uraggregated_monthly_data_period_idx ON uraggregated_monthly_data (execution_period);
+
+CREATE TABLE uraggregated_yearly_data (
+    execution_period        date,
+    machine_name_id         integer,
+    global_user_name_id     integer,
+    local_user_id           integer,
+    vo_information_id       integer,
+    project_name_id         integer,
+    min_execution_time      date,
+    max_execution_time      date,
+    n_jobs                  integer,
+    cputime                 numeric,
+    walltime                numeric
+);
+
+CREATE INDEX uraggregated_yearly_data_machine_name_period_idx ON uraggregated_yearly_data (machine_name_id, execution_period);
+CREATE INDEX uraggregated_yearly_data_period_idx ON uraggregated_yearly_data (execution_period);
+
+-- months of machines where the rollups must be updated, as the aggregation
+-- table has changed
+CREATE TABLE uraggregated_rollup_update (
+    execution_period    date,
+    machine_name_id     integer,
+    PRIMARY KEY (machine_name_id, execution_period)
+);
+
+-- build the rollups of the existing aggregation, they are kept up to date by the updater
+INSERT INTO uraggregated_monthly_data
+    (execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+     min_execution_time, max_execution_time, n_jobs, cputime, walltime)
+SELECT
+    date_trunc('month', execution_time)::date AS s_execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+    min(execution_time), max(execution_time), sum(n_jobs), sum(ROUND(cputime / 3600.0, 2)), sum(ROUND(walltime / 3600.0, 2))
+FROM uraggregated_data
+WHERE machine_name_id IS NOT NULL
+GROUP BY s_execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id;
+
+INSERT INTO uraggregated_yearly_data
+    (execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+     min_execution_time, max_execution_time, n_jobs, cputime, walltime)
+SELECT
+    date_trunc('year', execution_period)::date AS s_execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+    min(min_execution_time), max(max_execution_time), sum(n_jobs), sum(cputime), sum(walltime)
+FROM uraggregated_monthly_data
+GROUP BY s_execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id;
+
+-- views of the rollups, as in sgas-postgres-view.sql
+CREATE VIEW uraggregated_monthly AS
+SELECT
+    execution_period                                                                AS execution_period,
+    min_execution_time                                                              AS min_execution_time,
+    max_execution_time                                                              AS max_execution_time,
+    machinename.machine_name                                                        AS machine_name,
+    CASE WHEN global_user_name_id IS NOT NULL THEN globalusername.global_user_name
+        ELSE machine_name || ':' || localuser.local_user
+    END                                                                             AS user_identity,
+    CASE WHEN vo_information_id IS NOT NULL THEN
+        CASE WHEN voinformation.vo_name LIKE '/%' THEN NULL
+             ELSE voinformation.vo_name
+        END
+        ELSE machine_name || ':' || projectname.project_name
+    END                                                                             AS vo_name,
+    n_jobs                                                                          AS n_jobs,
+    cputime                                                                         AS cputime,
+    walltime                                                                        AS walltime
+FROM
+    uraggregated_monthly_data
+LEFT OUTER JOIN machinename         ON (uraggregated_monthly_data.machine_name_id     = machinename.id)
+LEFT OUTER JOIN globalusername      ON (uraggregated_monthly_data.global_user_name_id = globalusername.id)
+LEFT OUTER JOIN localuser           ON (uraggregated_monthly_data.local_user_id       = localuser.id)
+LEFT OUTER JOIN voinformation       ON (uraggregated_monthly_data.vo_information_id   = voinformation.id)
+LEFT OUTER JOIN projectname         ON (uraggregated_monthly_data.project_name_id     = projectname.id)
+;
+
+
+CREATE VIEW uraggregated_yearly AS
+SELECT
+    execution_period                                                                AS execution_period,
+    min_execution_time                                                              AS min_execution_time,
+    max_execution_time                                                              AS max_execution_time,
+    machinename.machine_name                                                        AS machine_name,
+    CASE WHEN global_user_name_id IS NOT NULL THEN globalusername.global_user_name
+        ELSE machine_name || ':' || localuser.local_user
+    END                                                                             AS user_identity,
+    CASE WHEN vo_information_id IS NOT NULL THEN
+        CASE WHEN voinformation.vo_name LIKE '/%' THEN NULL
+             ELSE voinformation.vo_name
+        END
+        ELSE machine_name || ':' || projectname.project_name
+    END                                                                             AS vo_name,
+    n_jobs                                                                          AS n_jobs,
+    cputime                                                                         AS cputime,
+    walltime                                                                        AS walltime
+FROM
+    uraggregated_yearly_data
+LEFT OUTER JOIN machinename         ON (uraggregated_yearly_data.machine_name_id     = machinename.id)
+LEFT OUTER JOIN globalusername      ON (uraggregated_yearly_data.global_user_name_id = globalusername.id)
+LEFT OUTER JOIN localuser           ON (uraggregated_yearly_data.local_user_id       = localuser.id)
+LEFT OUTER JOIN voinformation       ON (uraggregated_yearly_data.vo_information_id   = voinformation.id)
+LEFT OUTER JOIN projectname         ON (uraggregated_yearly_data.project_name_id     = projectname.id)
+;
+
+-- used when recomputing the storage snapshots of a day and storage system
+CREATE INDEX storagedata_storage_system_end_time_idx ON storagedata (storage_system_id, end_time);
+
+-- daily snapshots of the storage records. for each day, storage system,
+-- share, media, class, group and insert host, the last snapshot of the day
+-- (the records with the latest end time) is kept. the capacity of records
+-- with the same end time (e.g., per user or directory) is summed, and
+-- insert_time is the latest insert time of the records of the day. the
+-- views and the monitor read this instead of storagedata
+CREATE TABLE sraggregated_data (
+    snapshot_date           date            NOT NULL,
+    storage_system_id       integer         NOT NULL,
+    storage_share_id        integer,
+    storage_media_id        integer,
+    storage_class_id        integer,
+    group_identity_id       integer,
+    insert_host_id          integer,
+    start_time              timestamp       NOT NULL,
+    end_time                timestamp       NOT NULL,
+    file_count              bigint,
+    resource_capacity_used  bigint          NOT NULL,
+    logical_capacity_used   bigint,
+    n_records               integer         NOT NULL,
+    insert_time             timestamp,
+    generate_time           timestamp
+);
+
+CREATE INDEX sraggregated_data_storage_system_snapshot_date_idx ON sraggregated_data (storage_system_id, snapshot_date);
+CREATE INDEX sraggregated_data_snapshot_date_idx ON sraggregated_data (snapshot_date);
+
+-- (snapshot date, storage system) pairs where the snapshots must be
+-- recomputed, as storage records have been inserted (see update_sraggregate)
+CREATE TABLE sraggregated_update (
+    snapshot_date           date,
+    storage_system_id       integer,
+    PRIMARY KEY (storage_system_id, snapshot_date)
+);
+
+-- build the storage snapshots of the existing records, they are kept up to date by the updater
+INSERT INTO sraggregated_data
+    (snapshot_date, storage_system_id, storage_share_id, storage_media_id, storage_class_id, group_identity_id, insert_host_id,
+     start_time, end_time, file_count, resource_capacity_used, logical_capacity_used, n_records, insert_time, generate_time)
+SELECT
+    snapshot_date, storage_system_id, storage_share_id, storage_media_id, storage_class_id, group_identity_id, insert_host_id,
+    min(start_time), end_time, sum(file_count), sum(resource_capacity_used), sum(logical_capacity_used), count(*),
+    max(day_insert_time), now()
+FROM (
+    SELECT
+        end_time::date AS snapshot_date, storage_system_id, storage_share_id, storage_media_id, storage_class_id,
+        group_identity_id, insert_host_id, start_time, end_time, file_count, resource_capacity_used, logical_capacity_used,
+        rank() OVER latest AS snapshot_rank,
+        max(insert_time) OVER snapshot AS day_insert_time
+    FROM storagedata
+    WINDOW snapshot AS (PARTITION BY end_time::date, storage_system_id, storage_share_id, storage_media_id,
+                                     storage_class_id, group_identity_id, insert_host_id),
+           latest AS (snapshot ORDER BY end_time DESC)
+) AS records
+WHERE snapshot_rank = 1
+GROUP BY
+    snapshot_date, storage_system_id, storage_share_id, storage_media_id, storage_class_id, group_identity_id, insert_host_id, end_time;
+
+-- view of the storage snapshots, as in sgas-postgres-view.sql
+CREATE VIEW sraggregated AS
+SELECT
+        snapshot_date                   AS snapshot_date,
+        storagesystem.storage_system    AS storage_system,
+        storageshare.storage_share      AS storage_share,
+        storagemedia.storage_media      AS storage_media,
+        storageclass.storage_class      AS storage_class,
+        groupidentity.group_identity    AS group_identity,
+        groupidentity.group_attribute   AS group_attribute,
+        inserthost.insert_host          AS insert_host,
+        start_time                      AS start_time,
+        end_time                        AS end_time,
+        file_count                      AS file_count,
+        resource_capacity_used          AS resource_capacity_used,
+        logical_capacity_used           AS logical_capacity_used,
+        n_records                       AS n_records,
+        insert_time                     AS insert_time,
+        generate_time                   AS generate_time
+FROM
+    sraggregated_data
+LEFT OUTER JOIN storagesystem   ON (sraggregated_data.storage_system_id   = storagesystem.id)
+LEFT OUTER JOIN storageshare    ON (sraggregated_data.storage_share_id    = storageshare.id)
+LEFT OUTER JOIN storagemedia    ON (sraggregated_data.storage_media_id    = storagemedia.id)
+LEFT OUTER JOIN storageclass    ON (sraggregated_data.storage_class_id    = storageclass.id)
+LEFT OUTER JOIN groupidentity   ON (sraggregated_data.group_identity_id   = groupidentity.id)
+LEFT OUTER JOIN inserthost      ON (sraggregated_data.insert_host_id      = inserthost.id)
+;
+
+-- the WLCG view data per month, with the HS06 / KSI2K scaling of the WLCG
+-- configuration applied. The table is maintained by the server (see
+-- sgas.viewengine.wlcgmonthly), as the scaling is done by the wlcgsgas
+-- library
+CREATE TABLE wlcg_monthly (
+    execution_period        date            NOT NULL,
+    machine_name            varchar,
+    vo_name                 varchar,
+    vo_group                varchar,
+    vo_role                 varchar,
+    user_identity           varchar,
+    n_jobs                  double precision,
+    cputime                 double precision,
+    walltime                double precision,
+    ksi2k_cputime           double precision,
+    ksi2k_walltime          double precision,
+    hs06_cputime            double precision,
+    hs06_walltime           double precision
+);
+
+CREATE INDEX wlcg_monthly_period_idx ON wlcg_monthly (execution_period);
+
+-- months in wlcg_monthly, and the digest of the WLCG configuration they were
+-- computed with
+CREATE TABLE wlcg_monthly_period (
+    execution_period        date            PRIMARY KEY,
+    config_digest           varchar         NOT NULL,
+    generate_time           timestamp       NOT NULL
+);
+
+-- months where wlcg_monthly must be recomputed, as their monthly rollup has
+-- changed (see update_uraggregate_rollup)
+CREATE TABLE wlcg_monthly_update (
+    execution_period        date            PRIMARY KEY
+);
+
+-- wlcg_monthly is filled by the server, which marks the months that are not
+-- in it when started
+
+COMMIT;
+
+-- End of file
@@ -8,6 +8,10 @@
 -- clear the aggregation tables
 TRUNCATE TABLE uraggregated_data;
 TRUNCATE TABLE uraggregated_update;
+TRUNCATE TABLE uraggregated_delta;
+TRUNCATE TABLE uraggregated_monthly_data;
+TRUNCATE TABLE uraggregated_yearly_data;
+TRUNCATE TABLE uraggregated_rollup_update;
 
 -- update all aggregation combinations
 INSERT INTO uraggregated_update SELECT DISTINCT insert_time::DATE, machine_name_id FROM usagedata;
@@ -36,7 +40,35 @@ SELECT uraggregated_upate_all();
 
 DROP FUNCTION uraggregated_upate_all();
 
+-- build the rollups of the rebuilt aggregation
+-- (update_uraggregate marks the months for rollup update, which are built here instead)
+TRUNCATE TABLE uraggregated_rollup_update;
 
+INSERT INTO uraggregated_monthly_data
+    (execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+     min_execution_time, max_execution_time, n_jobs, cputime, walltime)
+SELECT
+    date_trunc('month', execution_time)::date AS s_execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+    min(execution_time), max(execution_time), sum(n_jobs), sum(ROUND(cputime / 3600.0, 2)), sum(ROUND(walltime / 3600.0, 2))
+FROM uraggregated_data
+WHERE machine_name_id IS NOT NULL
+GROUP BY s_execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id;
 
+INSERT INTO uraggregated_yearly_data
+    (execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+     min_execution_time, max_execution_time, n_jobs, cputime, walltime)
+SELECT
+    date_trunc('year', execution_period)::date AS s_execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+    min(min_execution_time), max(max_execution_time), sum(n_jobs), sum(cputime), sum(walltime)
+FROM uraggregated_monthly_data
+GROUP BY s_execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id;
+
+-- rebuild the storage snapshots
+TRUNCATE TABLE sraggregated_data;
+TRUNCATE TABLE sraggregated_update;
+
+INSERT INTO sraggregated_update SELECT DISTINCT end_time::date, storage_system_id FROM storagedata;
+
+SELECT update_sraggregate(NULL);
 
 
@@ -1,26 +1,40 @@
 -- SGAS PostgreSQL functions
 
-CREATE OR REPLACE FUNCTION urcreate (
+CREATE OR REPLACE FUNCTION uraggregated_lock_key ( )
+RETURNS integer AS $lock_key$
+    -- first key of the advisory locks on the aggregation of a machine, the
+    -- second key is the machine name id. usage record inserts take the lock
+    -- shared when marking a machine for update, and the aggregation update
+    -- functions take it exclusive while updating the aggregation of the machine.
+    -- the key does not depend on the table oid, as the table is replaced when
+    -- the aggregation is rebuilt
+    SELECT hashtext('uraggregated_data');
+$lock_key$
+LANGUAGE sql IMMUTABLE;
+
+
+
+CREATE OR REPLACE FUNCTION urcreate_ids (
     in_record_id               varchar,
     in_create_time             timestamp,
     in_global_job_id           varchar,
     in_local_job_id            varchar,
-    in_local_user              varchar,
-    in_global_user_name        varchar,
+    in_local_user_id           integer,
+    in_global_user_name_id     integer,
     in_vo_type                 varchar,
     in_vo_issuer               varchar,
     in_vo_name                 varchar,
     in_vo_attributes           varchar[][],
-    in_machine_name            varchar,
+    in_machine_name_id         integer,
     in_job_name                varchar,
     in_charge                  integer,
-    in_status                  varchar,
-    in_queue                   varchar,
-    in_host                    varchar,
+    in_status_id               integer,
+    in_queue_id                integer,
+    in_host_id                 integer,
     in_node_count              integer,
     in_processors              integer,
-    in_project_name            varchar,
-    in_submit_host             varchar,
+    in_project_name_id         integer,
+    in_submit_host_id          integer,
     in_start_time              timestamp,
     in_end_time                timestamp,
     in_submit_time             timestamp,
@@ -29,30 +43,19 @@ CREATE OR REPLACE FUNCTION urcreate (
     in_user_time               integer,
     in_kernel_time             integer,
     in_major_page_faults       integer,
-    in_runtime_environments    varchar[],
+    in_runtime_environment_ids integer[],
     in_exit_code               integer,
     in_downloads               varchar[],
     in_uploads                 varchar[],
-    in_insert_host             varchar,
-    in_insert_identity         varchar,
+    in_insert_host_id          integer,
+    in_insert_identity_id      integer,
     in_insert_time             timestamp,
     in_memory                  sgas_memory[]
 )
 RETURNS varchar[] AS $recordid_rowid$
 
 DECLARE
-    local_user_fid          integer;
-    globalusername_id       integer;
     voinformation_id        integer;
-    machinename_id          integer;
-    status_fid              integer;
-    queue_fid               integer;
-    host_fid                integer;
-    project_name_fid        integer;
-    submit_host_fid         integer;
-    inserthost_id           integer;
-    insertidentity_id       integer;
-    runtime_environment_id  integer;
     jobtransferurl_id       integer;
 
     ur_id                   integer;
@@ -62,6 +65,10 @@ DECLARE
 
     result                  varchar[];
 BEGIN
+    -- this is the same as urcreate, except that the dimensions (except vo
+    -- information and transfer urls) are given as ids instead of values
+    -- the ids are typically resolved and cached by the server
+
     -- first check that we do not have the record already
     SELECT usagedata.id, global_job_id, machine_name_id, insert_time::date
            INTO ur_id, ur_global_job_id, ur_machine_name_id, ur_insert_time
@@ -87,6 +94,7 @@ BEGIN
             -- however records coming from the LRMS does not contain these, so if an error
             -- occurs here it usally due to an ARC/Grid bug.
             DELETE FROM usagedata WHERE record_id = in_record_id;
+            PERFORM pg_advisory_xact_lock_shared(uraggregated_lock_key(), ur_machine_name_id);
             PERFORM * FROM uraggregated_update WHERE insert_time = ur_insert_time::date AND machine_name_id = ur_machine_name_id;
             IF NOT FOUND THEN
                 INSERT INTO uraggregated_update (insert_time, machine_name_id) VALUES (ur_insert_time, ur_machine_name_id);
@@ -94,6 +102,199 @@ BEGIN
         END IF;
     END IF;
 
+    -- vo information
+    IF in_vo_name is NULL THEN
+        voinformation_id = NULL;
+    ELSE
+        SELECT INTO voinformation_id id
+               FROM voinformation
+               WHERE vo_type        IS NOT DISTINCT FROM in_vo_type AND
+                     vo_issuer      IS NOT DISTINCT FROM in_vo_issuer AND
+                     vo_name        IS NOT DISTINCT FROM in_vo_name AND
+                     vo_attributes  IS NOT DISTINCT FROM in_vo_attributes;
+        IF NOT FOUND THEN
+            INSERT INTO voinformation (vo_type, vo_issuer, vo_name, vo_attributes)
+                   VALUES (in_vo_type, in_vo_issuer, in_vo_name, in_vo_attributes) RETURNING id INTO voinformation_id;
+        END IF;
+    END IF;
+
+    INSERT INTO usagedata (
+                        record_id,
+                        create_time,
+                        global_user_name_id,
+                        vo_information_id,
+                        machine_name_id,
+                        global_job_id,
+                        local_job_id,
+                        local_user_id,
+                        job_name,
+                        charge,
+                        status_id,
+                        queue_id,
+                        host_id,
+                        node_count,
+                        processors,
+                        project_name_id,
+                        submit_host_id,
+                        start_time,
+                        end_time,
+                        submit_time,
+                        cpu_duration,
+                        wall_duration,
+                        user_time,
+                        kernel_time,
+                        major_page_faults,
+                        exit_code,
+                        insert_host_id,
+                        insert_identity_id,
+                        insert_time,
+                        memory
+                    )
+            VALUES (
+                        in_record_id,
+                        in_create_time,
+                        in_global_user_name_id,
+                        voinformation_id,
+                        in_machine_name_id,
+                        in_global_job_id,
+                        in_local_job_id,
+                        in_local_user_id,
+                        in_job_name,
+                        in_charge,
+                        in_status_id,
+                        in_queue_id,
+                        in_host_id,
+                        in_node_count::smallint,
+                        in_processors,
+                        in_project_name_id,
+                        in_submit_host_id,
+                        in_start_time,
+                        in_end_time,
+                        in_submit_time,
+                        in_cpu_duration,
+                        in_wall_duration,
+                        in_user_time,
+                        in_kernel_time,
+                        in_major_page_faults,
+                        in_exit_code::smallint,
+                        in_insert_host_id,
+                        in_insert_identity_id,
+                        in_insert_time,
+                        in_memory
+                    )
+            RETURNING id into ur_id;
+
+    -- runtime environments
+    IF in_runtime_environment_ids IS NOT NULL THEN
+        INSERT INTO runtimeenvironment_usagedata (usagedata_id, runtimeenvironments_id)
+            SELECT DISTINCT ur_id, re_id FROM unnest(in_runtime_environment_ids) AS re_id;
+    END IF;
+
+    -- create rows for file transfers
+    IF in_downloads IS NOT NULL THEN
+        FOR i IN array_lower(in_downloads, 1) .. array_upper(in_downloads, 1) LOOP
+            -- check if url exists, insert if it does not
+            SELECT INTO jobtransferurl_id id FROM jobtransferurl WHERE url = in_downloads[i][1];
+            IF NOT FOUND THEN
+                INSERT INTO jobtransferurl (url) VALUES (in_downloads[i][1]) RETURNING id INTO jobtransferurl_id;
+            END IF;
+            -- insert download
+            INSERT INTO jobtransferdata (usage_data_id, job_transfer_url_id, transfer_type,
+                                         size, start_time, end_time, bypass_cache, retrieved_from_cache)
+                   VALUES (ur_id, jobtransferurl_id, 'download',
+                           in_downloads[i][2]::bigint, in_downloads[i][3]::timestamp, in_downloads[i][4]::timestamp,
+                           in_downloads[i][5]::boolean, in_downloads[i][6]::boolean);
+        END LOOP;
+    END IF;
+
+    IF in_uploads IS NOT NULL THEN
+        FOR i IN array_lower(in_uploads, 1) .. array_upper(in_uploads, 1) LOOP
+            -- check if url exists, insert if it does not
+            SELECT INTO jobtransferurl_id id FROM jobtransferurl WHERE url = in_uploads[i][1];
+            IF NOT FOUND THEN
+                INSERT INTO jobtransferurl (url) VALUES (in_uploads[i][1]) RETURNING id INTO jobtransferurl_id;
+            END IF;
+            -- insert upload
+            INSERT INTO jobtransferdata (usage_data_id, job_transfer_url_id, transfer_type, size, start_time, end_time)
+                   VALUES (ur_id, jobtransferurl_id, 'upload',
+                           in_uploads[i][2]::bigint, in_uploads[i][3]::timestamp, in_uploads[i][4]::timestamp);
+        END LOOP;
+    END IF;
+
+    -- finally we register the record for being added to the aggregated information,
+    -- and notify the aggregation updaters listening (delivered once per transaction)
+    PERFORM pg_advisory_xact_lock_shared(uraggregated_lock_key(), in_machine_name_id);
+    INSERT INTO uraggregated_delta (usagedata_id, insert_time, machine_name_id) VALUES (ur_id, in_insert_time::date, in_machine_name_id);
+    PERFORM pg_notify('sgas_aggregation', '');
+
+    result[0] = in_record_id;
+    result[1] = ur_id;
+    RETURN result;
+
+END;
+$recordid_rowid$
+LANGUAGE plpgsql;
+
+
+
+CREATE OR REPLACE FUNCTION urcreate (
+    in_record_id               varchar,
+    in_create_time             timestamp,
+    in_global_job_id           varchar,
+    in_local_job_id            varchar,
+    in_local_user              varchar,
+    in_global_user_name        varchar,
+    in_vo_type                 varchar,
+    in_vo_issuer               varchar,
+    in_vo_name                 varchar,
+    in_vo_attributes           varchar[][],
+    in_machine_name            varchar,
+    in_job_name                varchar,
+    in_charge                  integer,
+    in_status                  varchar,
+    in_queue                   varchar,
+    in_host                    varchar,
+    in_node_count              integer,
+    in_processors              integer,
+    in_project_name            varchar,
+    in_submit_host             varchar,
+    in_start_time              timestamp,
+    in_end_time                timestamp,
+    in_submit_time             timestamp,
+    in_cpu_duration            bigint,
+    in_wall_duration           integer,
+    in_user_time               integer,
+    in_kernel_time             integer,
+    in_major_page_faults       integer,
+    in_runtime_environments    varchar[],
+    in_exit_code               integer,
+    in_downloads               varchar[],
+    in_uploads                 varchar[],
+    in_insert_host             varchar,
+    in_insert_identity         varchar,
+    in_insert_time             timestamp,
+    in_memory                  sgas_memory[]
+)
+RETURNS varchar[] AS $recordid_rowid$
+
+DECLARE
+    local_user_fid          integer;
+    globalusername_id       integer;
+    machinename_id          integer;
+    status_fid              integer;
+    queue_fid               integer;
+    host_fid                integer;
+    project_name_fid        integer;
+    submit_host_fid         integer;
+    inserthost_id           integer;
+    insertidentity_id       integer;
+    runtime_environment_id  integer;
+    runtime_environment_ids integer[];
+BEGIN
+    -- resolve the dimension values into ids, and pass them on to urcreate_ids
+    -- which does the actual insertion (vo information and transfer urls are
+    -- resolved by urcreate_ids)
+
     -- local user name
     IF in_local_user IS NULL THEN
         local_user_fid = NULL;
@@ -117,22 +318,6 @@ BEGIN
         END IF;
     END IF;
 
-    -- vo information
-    IF in_vo_name is NULL THEN
-        voinformation_id = NULL;
-    ELSE
-        SELECT INTO voinformation_id id
-               FROM voinformation
-               WHERE vo_type        IS NOT DISTINCT FROM in_vo_type AND
-                     vo_issuer      IS NOT DISTINCT FROM in_vo_issuer AND
-                     vo_name        IS NOT DISTINCT FROM in_vo_name AND
-                     vo_attributes  IS NOT DISTINCT FROM in_vo_attributes;
-        IF NOT FOUND THEN
-            INSERT INTO voinformation (vo_type, vo_issuer, vo_name, vo_attributes)
-                   VALUES (in_vo_type, in_vo_issuer, in_vo_name, in_vo_attributes) RETURNING id INTO voinformation_id;
-        END IF;
-    END IF;
-
     -- machine name
     IF in_machine_name IS NULL THEN
         machinename_id = NULL;
@@ -219,6 +404,177 @@ BEGIN
         END IF;
     END IF;
 
+    -- runtime environments
+    IF in_runtime_environments IS NOT NULL THEN
+        FOR i IN array_lower(in_runtime_environments, 1) .. array_upper(in_runtime_environments, 1) LOOP
+            -- check if re exists, isert if it does not
+            SELECT INTO runtime_environment_id id FROM runtimeenvironment WHERE runtime_environment = in_runtime_environments[i];
+            IF NOT FOUND THEN
+                INSERT INTO runtimeenvironment (runtime_environment) VALUES (in_runtime_environments[i]) RETURNING id INTO runtime_environment_id;
+            END IF;
+            runtime_environment_ids = array_append(runtime_environment_ids, runtime_environment_id);
+        END LOOP;
+    END IF;
+
+    RETURN urcreate_ids(
+                        in_record_id,
+                        in_create_time,
+                        in_global_job_id,
+                        in_local_job_id,
+                        local_user_fid,
+                        globalusername_id,
+                        in_vo_type,
+                        in_vo_issuer,
+                        in_vo_name,
+                        in_vo_attributes,
+                        machinename_id,
+                        in_job_name,
+                        in_charge,
+                        status_fid,
+                        queue_fid,
+                        host_fid,
+                        in_node_count,
+                        in_processors,
+                        project_name_fid,
+                        submit_host_fid,
+                        in_start_time,
+                        in_end_time,
+                        in_submit_time,
+                        in_cpu_duration,
+                        in_wall_duration,
+                        in_user_time,
+                        in_kernel_time,
+                        in_major_page_faults,
+                        runtime_environment_ids,
+                        in_exit_code,
+                        in_downloads,
+                        in_uploads,
+                        inserthost_id,
+                        insertidentity_id,
+                        in_insert_time,
+                        in_memory
+                    );
+
+END;
+$recordid_rowid$
+LANGUAGE plpgsql;
+
+
+
+CREATE OR REPLACE FUNCTION urcreate_bulk (
+    in_batch_id                bigint
+)
+RETURNS TABLE (
+    out_record_id              varchar,
+    out_row_id                 integer
+) AS $recordid_rowid$
+
+BEGIN
+    -- set based version of urcreate, for inserting all the records in a batch
+    -- of the usagedata_staging table in one go, instead of record by record
+    -- duplicates within the batch must have been removed by the caller
+
+    -- records which already exists, and should not be replaced (see urcreate for the rules)
+    RETURN QUERY
+        SELECT s.record_id, u.id
+        FROM usagedata_staging s JOIN usagedata u ON (s.record_id = u.record_id)
+        WHERE s.batch_id = in_batch_id AND
+              (s.global_job_id = u.global_job_id OR s.global_job_id = s.record_id);
+
+    DELETE FROM usagedata_staging s USING usagedata u
+        WHERE s.batch_id = in_batch_id AND s.record_id = u.record_id AND
+              (s.global_job_id = u.global_job_id OR s.global_job_id = s.record_id);
+
+    -- records which should be replaced, mark update and delete the existing records
+    PERFORM pg_advisory_xact_lock_shared(uraggregated_lock_key(), m.machine_name_id)
+        FROM (SELECT DISTINCT u.machine_name_id
+              FROM usagedata_staging s JOIN usagedata u ON (s.record_id = u.record_id)
+              WHERE s.batch_id = in_batch_id ORDER BY 1) AS m;
+
+    INSERT INTO uraggregated_update (insert_time, machine_name_id)
+        SELECT DISTINCT u.insert_time::date, u.machine_name_id
+        FROM usagedata_staging s JOIN usagedata u ON (s.record_id = u.record_id)
+        WHERE s.batch_id = in_batch_id AND
+              NOT EXISTS (SELECT * FROM uraggregated_update
+                          WHERE insert_time = u.insert_time::date AND machine_name_id = u.machine_name_id);
+
+    DELETE FROM usagedata u USING usagedata_staging s
+        WHERE s.batch_id = in_batch_id AND s.record_id = u.record_id;
+
+    -- create missing dimension rows
+    INSERT INTO localuser (local_user)
+        SELECT DISTINCT local_user FROM usagedata_staging
+        WHERE batch_id = in_batch_id AND local_user IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO globalusername (global_user_name)
+        SELECT DISTINCT global_user_name FROM usagedata_staging
+        WHERE batch_id = in_batch_id AND global_user_name IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO voinformation (vo_type, vo_issuer, vo_name, vo_attributes)
+        SELECT DISTINCT vo_type, vo_issuer, vo_name, vo_attributes FROM usagedata_staging s
+        WHERE batch_id = in_batch_id AND vo_name IS NOT NULL AND
+              NOT EXISTS (SELECT * FROM voinformation
+                          WHERE vo_type        IS NOT DISTINCT FROM s.vo_type AND
+                                vo_issuer      IS NOT DISTINCT FROM s.vo_issuer AND
+                                vo_name        IS NOT DISTINCT FROM s.vo_name AND
+                                vo_attributes  IS NOT DISTINCT FROM s.vo_attributes);
+
+    INSERT INTO machinename (machine_name)
+        SELECT DISTINCT machine_name FROM usagedata_staging
+        WHERE batch_id = in_batch_id AND machine_name IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO jobstatus (status)
+        SELECT DISTINCT status FROM usagedata_staging
+        WHERE batch_id = in_batch_id AND status IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO jobqueue (queue)
+        SELECT DISTINCT queue FROM usagedata_staging
+        WHERE batch_id = in_batch_id AND queue IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO host (host)
+        SELECT DISTINCT host FROM usagedata_staging
+        WHERE batch_id = in_batch_id AND host IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO projectname (project_name)
+        SELECT DISTINCT project_name FROM usagedata_staging
+        WHERE batch_id = in_batch_id AND project_name IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO submithost (submit_host)
+        SELECT DISTINCT submit_host FROM usagedata_staging
+        WHERE batch_id = in_batch_id AND submit_host IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO inserthost (insert_host)
+        SELECT DISTINCT insert_host FROM usagedata_staging
+        WHERE batch_id = in_batch_id AND insert_host IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO insertidentity (insert_identity)
+        SELECT DISTINCT insert_identity FROM usagedata_staging
+        WHERE batch_id = in_batch_id AND insert_identity IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO runtimeenvironment (runtime_environment)
+        SELECT DISTINCT re FROM usagedata_staging, unnest(runtime_environments) AS re
+        WHERE batch_id = in_batch_id AND re IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    INSERT INTO jobtransferurl (url)
+        SELECT downloads[i][1] FROM usagedata_staging, generate_subscripts(downloads, 1) AS i
+        WHERE batch_id = in_batch_id AND downloads[i][1] IS NOT NULL
+        UNION
+        SELECT uploads[i][1] FROM usagedata_staging, generate_subscripts(uploads, 1) AS i
+        WHERE batch_id = in_batch_id AND uploads[i][1] IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+    -- insert the records, with all dimensions resolved by joins
     INSERT INTO usagedata (
                         record_id,
                         create_time,
@@ -246,101 +602,111 @@ BEGIN
                         kernel_time,
                         major_page_faults,
                         exit_code,
-                        insert_host_id,
-                        insert_identity_id,
-                        insert_time,
-			memory
-                    )
-            VALUES (
-                        in_record_id,
-                        in_create_time,
-                        globalusername_id,
-                        voinformation_id,
-                        machinename_id,
-                        in_global_job_id,
-                        in_local_job_id,
-                        local_user_fid,
-                        in_job_name,
-                        in_charge,
-                        status_fid,
-                        queue_fid,
-                        host_fid,
-                        in_node_count::smallint,
-                        in_processors,
-                        project_name_fid,
-                        submit_host_fid,
-                        in_start_time,
-                        in_end_time,
-                        in_submit_time,
-                        in_cpu_duration,
-                        in_wall_duration,
-                        in_user_time,
-                        in_kernel_time,
-                        in_major_page_faults,
-                        in_exit_code::smallint,
-                        inserthost_id,
-                        insertidentity_id,
-                        in_insert_time,
-			in_memory
+                        insert_host_id,
+                        insert_identity_id,
+                        insert_time,
+                        memory
                     )
-            RETURNING id into ur_id;
+        SELECT
+                        s.record_id,
+                        s.create_time,
+                        globalusername.id,
+                        vo.id,
+                        machinename.id,
+                        s.global_job_id,
+                        s.local_job_id,
+                        localuser.id,
+                        s.job_name,
+                        s.charge,
+                        jobstatus.id,
+                        jobqueue.id,
+                        host.id,
+                        s.node_count::smallint,
+                        s.processors,
+                        projectname.id,
+                        submithost.id,
+                        s.start_time,
+                        s.end_time,
+                        s.submit_time,
+                        s.cpu_duration,
+                        s.wall_duration,
+                        s.user_time,
+                        s.kernel_time,
+                        s.major_page_faults,
+                        s.exit_code::smallint,
+                        inserthost.id,
+                        insertidentity.id,
+                        s.insert_time,
+                        s.memory
+        FROM usagedata_staging s
+        LEFT OUTER JOIN localuser       ON (s.local_user        = localuser.local_user)
+        LEFT OUTER JOIN globalusername  ON (s.global_user_name  = globalusername.global_user_name)
+        LEFT OUTER JOIN machinename     ON (s.machine_name      = machinename.machine_name)
+        LEFT OUTER JOIN jobstatus       ON (s.status            = jobstatus.status)
+        LEFT OUTER JOIN jobqueue        ON (s.queue             = jobqueue.queue)
+        LEFT OUTER JOIN host            ON (s.host              = host.host)
+        LEFT OUTER JOIN projectname     ON (s.project_name      = projectname.project_name)
+        LEFT OUTER JOIN submithost      ON (s.submit_host       = submithost.submit_host)
+        LEFT OUTER JOIN inserthost      ON (s.insert_host       = inserthost.insert_host)
+        LEFT OUTER JOIN insertidentity  ON (s.insert_identity   = insertidentity.insert_identity)
+        LEFT OUTER JOIN LATERAL (SELECT voinformation.id FROM voinformation
+                                 WHERE s.vo_name IS NOT NULL AND
+                                       vo_type        IS NOT DISTINCT FROM s.vo_type AND
+                                       vo_issuer      IS NOT DISTINCT FROM s.vo_issuer AND
+                                       vo_name        IS NOT DISTINCT FROM s.vo_name AND
+                                       vo_attributes  IS NOT DISTINCT FROM s.vo_attributes
+                                 LIMIT 1) vo ON (true)
+        WHERE s.batch_id = in_batch_id;
 
     -- runtime environments
-    IF in_runtime_environments IS NOT NULL THEN
-        FOR i IN array_lower(in_runtime_environments, 1) .. array_upper(in_runtime_environments, 1) LOOP
-            -- check if re exists, isert if it does not
-            SELECT INTO runtime_environment_id id FROM runtimeenvironment WHERE runtime_environment = in_runtime_environments[i];
-            IF NOT FOUND THEN
-                INSERT INTO runtimeenvironment (runtime_environment) VALUES (in_runtime_environments[i]) RETURNING id INTO runtime_environment_id;
-            END IF;
-            -- insert record ur usage, perform duplicate check first though
-            PERFORM * FROM runtimeenvironment_usagedata WHERE usagedata_id = ur_id AND runtime_environment_id = runtimeenvironments_id;
-            IF NOT FOUND THEN
-                INSERT INTO runtimeenvironment_usagedata (usagedata_id, runtimeenvironments_id) VALUES (ur_id, runtime_environment_id);
-            END IF;
-        END LOOP;
-    END IF;
+    INSERT INTO runtimeenvironment_usagedata (usagedata_id, runtimeenvironments_id)
+        SELECT DISTINCT u.id, runtimeenvironment.id
+        FROM usagedata_staging s
+        JOIN usagedata u ON (s.record_id = u.record_id)
+        CROSS JOIN unnest(s.runtime_environments) AS re
+        JOIN runtimeenvironment ON (runtimeenvironment.runtime_environment = re)
+        WHERE s.batch_id = in_batch_id;
 
-    -- create rows for file transfers
-    IF in_downloads IS NOT NULL THEN
-        FOR i IN array_lower(in_downloads, 1) .. array_upper(in_downloads, 1) LOOP
-            -- check if url exists, insert if it does not
-            SELECT INTO jobtransferurl_id id FROM jobtransferurl WHERE url = in_downloads[i][1];
-            IF NOT FOUND THEN
-                INSERT INTO jobtransferurl (url) VALUES (in_downloads[i][1]) RETURNING id INTO jobtransferurl_id;
-            END IF;
-            -- insert download
-            INSERT INTO jobtransferdata (usage_data_id, job_transfer_url_id, transfer_type,
-                                         size, start_time, end_time, bypass_cache, retrieved_from_cache)
-                   VALUES (ur_id, jobtransferurl_id, 'download',
-                           in_downloads[i][2]::bigint, in_downloads[i][3]::timestamp, in_downloads[i][4]::timestamp,
-                           in_downloads[i][5]::boolean, in_downloads[i][6]::boolean);
-        END LOOP;
-    END IF;
+    -- file transfers
+    INSERT INTO jobtransferdata (usage_data_id, job_transfer_url_id, transfer_type,
+                                 size, start_time, end_time, bypass_cache, retrieved_from_cache)
+        SELECT u.id, jobtransferurl.id, 'download',
+               s.downloads[i][2]::bigint, s.downloads[i][3]::timestamp, s.downloads[i][4]::timestamp,
+               s.downloads[i][5]::boolean, s.downloads[i][6]::boolean
+        FROM usagedata_staging s
+        JOIN usagedata u ON (s.record_id = u.record_id)
+        CROSS JOIN generate_subscripts(s.downloads, 1) AS i
+        JOIN jobtransferurl ON (jobtransferurl.url = s.downloads[i][1])
+        WHERE s.batch_id = in_batch_id;
 
-    IF in_uploads IS NOT NULL THEN
-        FOR i IN array_lower(in_uploads, 1) .. array_upper(in_uploads, 1) LOOP
-            -- check if url exists, insert if it does not
-            SELECT INTO jobtransferurl_id id FROM jobtransferurl WHERE url = in_uploads[i][1];
-            IF NOT FOUND THEN
-                INSERT INTO jobtransferurl (url) VALUES (in_uploads[i][1]) RETURNING id INTO jobtransferurl_id;
-            END IF;
-            -- insert upload
-            INSERT INTO jobtransferdata (usage_data_id, job_transfer_url_id, transfer_type, size, start_time, end_time)
-                   VALUES (ur_id, jobtransferurl_id, 'upload',
-                           in_uploads[i][2]::bigint, in_uploads[i][3]::timestamp, in_uploads[i][4]::timestamp);
-        END LOOP;
-    END IF;
+    INSERT INTO jobtransferdata (usage_data_id, job_transfer_url_id, transfer_type, size, start_time, end_time)
+        SELECT u.id, jobtransferurl.id, 'upload',
+               s.uploads[i][2]::bigint, s.uploads[i][3]::timestamp, s.uploads[i][4]::timestamp
+        FROM usagedata_staging s
+        JOIN usagedata u ON (s.record_id = u.record_id)
+        CROSS JOIN generate_subscripts(s.uploads, 1) AS i
+        JOIN jobtransferurl ON (jobtransferurl.url = s.uploads[i][1])
+        WHERE s.batch_id = in_batch_id;
 
-    -- finally we update the table describing what aggregated information should be updated
-    PERFORM * FROM uraggregated_update WHERE insert_time = in_insert_time::date AND machine_name_id = machinename_id;
-    IF NOT FOUND THEN
-        INSERT INTO uraggregated_update (insert_time, machine_name_id) VALUES (in_insert_time::date, machinename_id);
-    END IF;
+    -- register the records for being added to the aggregated information
+    PERFORM pg_advisory_xact_lock_shared(uraggregated_lock_key(), m.id)
+        FROM (SELECT DISTINCT machinename.id
+              FROM usagedata_staging s JOIN machinename ON (s.machine_name = machinename.machine_name)
+              WHERE s.batch_id = in_batch_id ORDER BY 1) AS m;
 
-    result[0] = in_record_id;
-    result[1] = ur_id;
-    RETURN result;
+    INSERT INTO uraggregated_delta (usagedata_id, insert_time, machine_name_id)
+        SELECT u.id, u.insert_time::date, u.machine_name_id
+        FROM usagedata_staging s JOIN usagedata u ON (s.record_id = u.record_id)
+        WHERE s.batch_id = in_batch_id;
+
+    PERFORM pg_notify('sgas_aggregation', '');
+
+    RETURN QUERY
+        SELECT s.record_id, u.id
+        FROM usagedata_staging s JOIN usagedata u ON (s.record_id = u.record_id)
+        WHERE s.batch_id = in_batch_id;
+
+    DELETE FROM usagedata_staging WHERE batch_id = in_batch_id;
 
 END;
 $recordid_rowid$
@@ -369,10 +735,18 @@ BEGIN
         RETURN result;
     END IF;
 
-    -- delete aggregation update row
+    -- delete aggregation update row, and the records of the pair waiting to be added
     DELETE FROM uraggregated_update WHERE insert_time = q_insert_date AND machine_name_id = q_machine_name_id;
-    -- delete existing aggregated rows that will be updated
-    DELETE FROM uraggregated_data WHERE insert_time = q_insert_date AND machine_name_id = q_machine_name_id;
+    DELETE FROM uraggregated_delta WHERE insert_time = q_insert_date AND machine_name_id = q_machine_name_id;
+    -- delete existing aggregated rows that will be updated, and mark their months for rollup
+    WITH deleted AS (
+        DELETE FROM uraggregated_data WHERE insert_time = q_insert_date AND machine_name_id = q_machine_name_id
+        RETURNING execution_time, machine_name_id
+    )
+    INSERT INTO uraggregated_rollup_update (execution_period, machine_name_id)
+        SELECT DISTINCT date_trunc('month', execution_time)::date, machine_name_id FROM deleted
+        WHERE machine_name_id IS NOT NULL
+    ON CONFLICT (machine_name_id, execution_period) DO UPDATE SET execution_period = EXCLUDED.execution_period;
 
     INSERT INTO uraggregated_data
         (execution_time, insert_time, machine_name_id, queue_id,
@@ -405,6 +779,11 @@ BEGIN
         s_global_user_name_id, s_local_user_id, s_vo_information_id, s_project_name_id,
         s_runtime_environments, s_status_id, s_insert_host_id;
 
+    INSERT INTO uraggregated_rollup_update (execution_period, machine_name_id)
+        SELECT DISTINCT date_trunc('month', execution_time)::date, machine_name_id FROM uraggregated_data
+        WHERE insert_time = q_insert_date AND machine_name_id = q_machine_name_id
+    ON CONFLICT (machine_name_id, execution_period) DO UPDATE SET execution_period = EXCLUDED.execution_period;
+
     result[0] = q_insert_date::varchar;
     result[1] = q_machine_name_id;
     RETURN result;
@@ -415,6 +794,626 @@ LANGUAGE plpgsql;
 
 
 
+CREATE OR REPLACE FUNCTION update_uraggregate_pairs (
+    in_insert_dates         date[],
+    in_machine_name_ids     integer[]
+)
+RETURNS void AS $pairs$
+
+BEGIN
+    -- recomputes the aggregation for the given (insert date, machine) pairs,
+    -- the pairs are given as two arrays of the same length. the caller is
+    -- responsible for removing the pairs from uraggregated_update
+
+    -- the recomputation includes all records of the pairs, so records waiting
+    -- to be added to the aggregation should not be added afterwards. records
+    -- are registered in the same transaction as they are inserted, so exactly
+    -- the registrations of the records seen below are deleted
+    DELETE FROM uraggregated_delta
+    USING unnest(in_insert_dates, in_machine_name_ids) AS pairs (insert_time, machine_name_id)
+    WHERE uraggregated_delta.insert_time     = pairs.insert_time AND
+          uraggregated_delta.machine_name_id = pairs.machine_name_id;
+
+    -- while the aggregation is being rebuilt, the pairs may already have been
+    -- built in the rebuilt table, so they are recomputed again when the
+    -- rebuilt table is swapped in
+    INSERT INTO uraggregated_rebuild_dirty (insert_time, machine_name_id)
+        SELECT pairs.insert_time, pairs.machine_name_id
+        FROM unnest(in_insert_dates, in_machine_name_ids) AS pairs (insert_time, machine_name_id), uraggregated_rebuild
+        WHERE pairs.insert_time < uraggregated_rebuild.cutoff_date;
+
+    -- delete existing aggregated rows that will be updated. the months of the
+    -- deleted and the inserted rows are marked for update of the rollups.
+    -- the marks are upserted, so a mark which is being claimed by
+    -- update_uraggregate_rollup is waited for, and then inserted again
+    WITH deleted AS (
+        DELETE FROM uraggregated_data
+        USING unnest(in_insert_dates, in_machine_name_ids) AS pairs (insert_time, machine_name_id)
+        WHERE uraggregated_data.insert_time     = pairs.insert_time AND
+              uraggregated_data.machine_name_id = pairs.machine_name_id
+        RETURNING uraggregated_data.execution_time, uraggregated_data.machine_name_id
+    )
+    INSERT INTO uraggregated_rollup_update (execution_period, machine_name_id)
+        SELECT DISTINCT date_trunc('month', execution_time)::date, machine_name_id FROM deleted
+        WHERE machine_name_id IS NOT NULL
+    ON CONFLICT (machine_name_id, execution_period) DO UPDATE SET execution_period = EXCLUDED.execution_period;
+
+    -- the statement is executed dynamically, so it is planned for the actual
+    -- pairs each time. the insert date condition lets the planner use the
+    -- insert date index, instead of scanning usagedata. a cached generic plan
+    -- would typically scan the whole table
+    EXECUTE '
+    INSERT INTO uraggregated_data
+        (execution_time, insert_time, machine_name_id, queue_id,
+         global_user_name_id, local_user_id, vo_information_id, project_name_id,
+         runtime_environments_id, status_id, insert_host_id, n_jobs, cputime, walltime, generate_time)
+    SELECT
+        COALESCE(end_time::DATE, create_time::DATE)                             AS s_execute_time,
+        usagedata.insert_time::DATE                                             AS s_insert_time,
+        usagedata.machine_name_id                                               AS s_machine_name_id,
+        queue_id                                                                AS s_queue_id,
+        global_user_name_id                                                     AS s_global_user_name_id,
+        CASE WHEN global_user_name_id IS NULL THEN local_user_id ELSE NULL END  AS s_local_user_id,
+        vo_information_id                                                       AS s_vo_information_id,
+        CASE WHEN vo_information_id IS NULL THEN project_name_id ELSE NULL END  AS s_project_name_id,
+        ARRAY(SELECT runtimeenvironment_usagedata.runtimeenvironments_id
+              FROM runtimeenvironment_usagedata
+              WHERE usagedata.id = runtimeenvironment_usagedata.usagedata_id)   AS s_runtime_environments,
+        status_id                                                               AS s_status_id,
+        insert_host_id                                                          AS s_insert_host_id,
+        count(*)                                                                AS s_n_jobs,
+        SUM(COALESCE(cpu_duration::bigint,0))                                   AS s_cputime,
+        SUM(COALESCE(wall_duration::bigint,0) * COALESCE(processors,1))         AS s_walltime,
+        now()                                                                   AS s_generate_time
+    FROM
+        usagedata
+    JOIN unnest($1, $2) AS pairs (insert_time, machine_name_id)
+        ON (usagedata.insert_time::date = pairs.insert_time AND usagedata.machine_name_id = pairs.machine_name_id)
+    WHERE
+        usagedata.insert_time::date = ANY ($1)
+    GROUP BY
+        s_execute_time, s_insert_time, s_machine_name_id, s_queue_id,
+        s_global_user_name_id, s_local_user_id, s_vo_information_id, s_project_name_id,
+        s_runtime_environments, s_status_id, s_insert_host_id'
+    USING in_insert_dates, in_machine_name_ids;
+
+    INSERT INTO uraggregated_rollup_update (execution_period, machine_name_id)
+        SELECT DISTINCT date_trunc('month', uraggregated_data.execution_time)::date, uraggregated_data.machine_name_id
+        FROM uraggregated_data
+        JOIN unnest(in_insert_dates, in_machine_name_ids) AS pairs (insert_time, machine_name_id)
+            ON (uraggregated_data.insert_time = pairs.insert_time AND uraggregated_data.machine_name_id = pairs.machine_name_id)
+    ON CONFLICT (machine_name_id, execution_period) DO UPDATE SET execution_period = EXCLUDED.execution_period;
+
+END;
+$pairs$
+LANGUAGE plpgsql;
+
+
+
+CREATE OR REPLACE FUNCTION update_uraggregate_batch (
+    in_max_pairs        integer
+)
+RETURNS integer AS $n_pairs$
+
+DECLARE
+    q_insert_date       date;
+    q_insert_dates      date[];
+    q_machine_name_id   integer;
+    q_machine_name_ids  integer[];
+BEGIN
+    -- updates the aggregation for up to in_max_pairs (insert date, machine)
+    -- pairs in one go, or for all pairs of the oldest insert date if
+    -- in_max_pairs is null. returns the number of updated pairs, 0 if there is
+    -- nothing to update. like update_uraggregate_machine this should be called
+    -- in a read committed transaction, and it locks the machines of the pairs
+    -- in the same way
+
+    IF in_max_pairs IS NULL THEN
+        SELECT min(insert_time) INTO q_insert_date FROM uraggregated_update;
+    END IF;
+
+    SELECT array_agg(DISTINCT machine_name_id) INTO q_machine_name_ids
+    FROM (SELECT machine_name_id FROM uraggregated_update
+          WHERE in_max_pairs IS NOT NULL OR insert_time = q_insert_date
+          ORDER BY insert_time LIMIT in_max_pairs) AS pairs;
+
+    IF q_machine_name_ids IS NULL THEN
+        -- nothing to update
+        RETURN 0;
+    END IF;
+
+    -- the machines are locked in order, so concurrent updaters do not deadlock
+    FOREACH q_machine_name_id IN ARRAY q_machine_name_ids LOOP
+        PERFORM pg_advisory_xact_lock(uraggregated_lock_key(), q_machine_name_id);
+    END LOOP;
+
+    -- delete the aggregation update rows, and get the pairs to update. only
+    -- pairs of the locked machines are updated
+    WITH deleted AS (
+        DELETE FROM uraggregated_update
+        WHERE (insert_time, machine_name_id) IN
+            (SELECT insert_time, machine_name_id FROM uraggregated_update
+             WHERE (in_max_pairs IS NOT NULL OR insert_time = q_insert_date) AND
+                   machine_name_id = ANY(q_machine_name_ids)
+             ORDER BY insert_time LIMIT in_max_pairs)
+        RETURNING insert_time, machine_name_id
+    )
+    SELECT array_agg(insert_time ORDER BY insert_time, machine_name_id),
+           array_agg(machine_name_id ORDER BY insert_time, machine_name_id)
+        INTO q_insert_dates, q_machine_name_ids
+    FROM (SELECT DISTINCT insert_time, machine_name_id FROM deleted) AS pairs;
+
+    IF q_insert_dates IS NULL THEN
+        -- nothing to update
+        RETURN 0;
+    END IF;
+
+    PERFORM update_uraggregate_pairs(q_insert_dates, q_machine_name_ids);
+
+    RETURN array_length(q_insert_dates, 1);
+
+END;
+$n_pairs$
+LANGUAGE plpgsql;
+
+
+
+CREATE OR REPLACE FUNCTION update_uraggregate_machine (
+    in_machine_name_id  integer,
+    in_max_pairs        integer
+)
+RETURNS integer AS $n_pairs$
+
+DECLARE
+    q_insert_dates      date[];
+BEGIN
+    -- like update_uraggregate_batch, but only updates pairs of the given
+    -- machine. this allows updating the aggregation of different machines in
+    -- parallel, as they never touch the same aggregated rows.
+    -- this function should be called in a read committed transaction.
+    -- instead of relying on serializable isolation, the machine is locked
+    -- against concurrent inserts marking it for update. inserts which committed before the lock was taken are seen
+    -- by the statements below, and inserts which are waiting for the lock
+    -- will mark the machine for update again
+
+    PERFORM pg_advisory_xact_lock(uraggregated_lock_key(), in_machine_name_id);
+
+    WITH deleted AS (
+        DELETE FROM uraggregated_update
+        WHERE machine_name_id = in_machine_name_id AND insert_time IN
+            (SELECT insert_time FROM uraggregated_update
+             WHERE machine_name_id = in_machine_name_id
+             ORDER BY insert_time LIMIT in_max_pairs)
+        RETURNING insert_time
+    )
+    SELECT array_agg(DISTINCT insert_time) INTO q_insert_dates FROM deleted;
+
+    IF q_insert_dates IS NULL THEN
+        -- nothing to update
+        RETURN 0;
+    END IF;
+
+    PERFORM update_uraggregate_pairs(q_insert_dates, array_fill(in_machine_name_id, ARRAY[array_length(q_insert_dates, 1)]));
+
+    RETURN array_length(q_insert_dates, 1);
+
+END;
+$n_pairs$
+LANGUAGE plpgsql;
+
+
+
+CREATE OR REPLACE FUNCTION update_uraggregate_delta (
+    in_machine_name_id  integer,
+    in_max_records      integer
+)
+RETURNS integer AS $n_records$
+
+DECLARE
+    q_n_records         integer;
+BEGIN
+    -- adds up to in_max_records newly inserted records of the given machine to
+    -- the aggregation table, by adding their jobs and times to the existing
+    -- aggregated rows (or inserting new rows), instead of recomputing the
+    -- (insert date, machine) pairs of the records. returns the number of
+    -- records added, 0 if there is nothing to add.
+    -- like update_uraggregate_machine this should be called in a read
+    -- committed transaction, and it locks the machine in the same way.
+    -- records of pairs which are marked for update in uraggregated_update are
+    -- left alone, they are added by the recomputation of the pair
+
+    PERFORM pg_advisory_xact_lock(uraggregated_lock_key(), in_machine_name_id);
+
+    WITH claimed AS (
+        DELETE FROM uraggregated_delta
+        WHERE usagedata_id IN
+            (SELECT usagedata_id FROM uraggregated_delta d
+             WHERE machine_name_id = in_machine_name_id AND
+                   NOT EXISTS (SELECT * FROM uraggregated_update
+                               WHERE insert_time = d.insert_time AND machine_name_id = d.machine_name_id)
+             LIMIT in_max_records)
+        RETURNING usagedata_id
+    ),
+    delta AS (
+        SELECT
+            row_number() OVER ()                                                    AS delta_id,
+            COALESCE(end_time::DATE, create_time::DATE)                             AS s_execute_time,
+            insert_time::DATE                                                       AS s_insert_time,
+            machine_name_id                                                         AS s_machine_name_id,
+            queue_id                                                                AS s_queue_id,
+            global_user_name_id                                                     AS s_global_user_name_id,
+            CASE WHEN global_user_name_id IS NULL THEN local_user_id ELSE NULL END  AS s_local_user_id,
+            vo_information_id                                                       AS s_vo_information_id,
+            CASE WHEN vo_information_id IS NULL THEN project_name_id ELSE NULL END  AS s_project_name_id,
+            ARRAY(SELECT runtimeenvironment_usagedata.runtimeenvironments_id
+                  FROM runtimeenvironment_usagedata
+                  WHERE usagedata.id = runtimeenvironment_usagedata.usagedata_id)   AS s_runtime_environments,
+            status_id                                                               AS s_status_id,
+            insert_host_id                                                          AS s_insert_host_id,
+            count(*)                                                                AS s_n_jobs,
+            SUM(COALESCE(cpu_duration::bigint,0))                                   AS s_cputime,
+            SUM(COALESCE(wall_duration::bigint,0) * COALESCE(processors,1))         AS s_walltime
+        FROM
+            usagedata
+        JOIN claimed ON (usagedata.id = claimed.usagedata_id)
+        GROUP BY
+            s_execute_time, s_insert_time, s_machine_name_id, s_queue_id,
+            s_global_user_name_id, s_local_user_id, s_vo_information_id, s_project_name_id,
+            s_runtime_environments, s_status_id, s_insert_host_id
+    ),
+    -- the grouping columns can be null, and there is no unique constraint to
+    -- do an upsert on, so existing rows are updated first, and the rest inserted
+    updated AS (
+        UPDATE uraggregated_data a
+        SET n_jobs        = a.n_jobs + delta.s_n_jobs,
+            cputime       = a.cputime + delta.s_cputime,
+            walltime      = a.walltime + delta.s_walltime,
+            generate_time = now()
+        FROM delta
+        WHERE a.machine_name_id = delta.s_machine_name_id AND
+              a.insert_time     = delta.s_insert_time AND
+              a.execution_time  = delta.s_execute_time AND
+              a.queue_id                IS NOT DISTINCT FROM delta.s_queue_id AND
+              a.global_user_name_id     IS NOT DISTINCT FROM delta.s_global_user_name_id AND
+              a.local_user_id           IS NOT DISTINCT FROM delta.s_local_user_id AND
+              a.vo_information_id       IS NOT DISTINCT FROM delta.s_vo_information_id AND
+              a.project_name_id         IS NOT DISTINCT FROM delta.s_project_name_id AND
+              a.runtime_environments_id IS NOT DISTINCT FROM delta.s_runtime_environments AND
+              a.status_id               IS NOT DISTINCT FROM delta.s_status_id AND
+              a.insert_host_id          IS NOT DISTINCT FROM delta.s_insert_host_id
+        RETURNING delta.delta_id
+    ),
+    inserted AS (
+        INSERT INTO uraggregated_data
+            (execution_time, insert_time, machine_name_id, queue_id,
+             global_user_name_id, local_user_id, vo_information_id, project_name_id,
+             runtime_environments_id, status_id, insert_host_id, n_jobs, cputime, walltime, generate_time)
+        SELECT
+            s_execute_time, s_insert_time, s_machine_name_id, s_queue_id,
+            s_global_user_name_id, s_local_user_id, s_vo_information_id, s_project_name_id,
+            s_runtime_environments, s_status_id, s_insert_host_id, s_n_jobs, s_cputime, s_walltime, now()
+        FROM delta
+        WHERE delta_id NOT IN (SELECT delta_id FROM updated)
+    ),
+    -- see update_uraggregate_pairs
+    dirty AS (
+        INSERT INTO uraggregated_rebuild_dirty (insert_time, machine_name_id)
+        SELECT DISTINCT s_insert_time, s_machine_name_id
+        FROM delta, uraggregated_rebuild
+        WHERE s_insert_time < uraggregated_rebuild.cutoff_date
+    ),
+    -- see update_uraggregate_pairs
+    rollup AS (
+        INSERT INTO uraggregated_rollup_update (execution_period, machine_name_id)
+        SELECT DISTINCT date_trunc('month', s_execute_time)::date, s_machine_name_id
+        FROM delta
+        WHERE s_machine_name_id IS NOT NULL
+        ON CONFLICT (machine_name_id, execution_period) DO UPDATE SET execution_period = EXCLUDED.execution_period
+    )
+    SELECT count(*) INTO q_n_records FROM claimed;
+
+    RETURN q_n_records;
+
+END;
+$n_records$
+LANGUAGE plpgsql;
+
+
+
+CREATE OR REPLACE FUNCTION update_uraggregate_rollup (
+    in_machine_name_id  integer,
+    in_max_months       integer
+)
+RETURNS integer AS $n_months$
+
+DECLARE
+    q_periods           date[];
+    q_years             date[];
+BEGIN
+    -- recomputes the monthly and yearly rollups of up to in_max_months months
+    -- of the given machine, which are marked in uraggregated_rollup_update.
+    -- returns the number of recomputed months, 0 if there is nothing to do.
+    -- this should be called in a read committed transaction. the marks are
+    -- claimed in their own statement, so the recomputation below sees the
+    -- aggregation of every change whose mark was claimed
+
+    WITH claimed AS (
+        DELETE FROM uraggregated_rollup_update
+        WHERE machine_name_id = in_machine_name_id AND execution_period IN
+            (SELECT execution_period FROM uraggregated_rollup_update
+             WHERE machine_name_id = in_machine_name_id
+             ORDER BY execution_period LIMIT in_max_months)
+        RETURNING execution_period
+    )
+    SELECT array_agg(execution_period) INTO q_periods FROM claimed;
+
+    IF q_periods IS NULL THEN
+        -- nothing to update
+        RETURN 0;
+    END IF;
+
+    SELECT array_agg(DISTINCT date_trunc('year', period)::date) INTO q_years FROM unnest(q_periods) AS period;
+
+    DELETE FROM uraggregated_monthly_data
+    WHERE machine_name_id = in_machine_name_id AND execution_period = ANY (q_periods);
+
+    -- the hours are rounded per aggregated row, like in the uraggregated view.
+    -- the months are joined as ranges, so the execution time index is used
+    INSERT INTO uraggregated_monthly_data
+        (execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+         min_execution_time, max_execution_time, n_jobs, cputime, walltime)
+    SELECT
+        periods.execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+        min(execution_time), max(execution_time), sum(n_jobs),
+        sum(ROUND(cputime / 3600.0, 2)), sum(ROUND(walltime / 3600.0, 2))
+    FROM uraggregated_data
+    JOIN unnest(q_periods) AS periods (execution_period)
+        ON (execution_time >= periods.execution_period AND execution_time < periods.execution_period + interval '1 month')
+    WHERE machine_name_id = in_machine_name_id
+    GROUP BY
+        periods.execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id;
+
+    -- the years of the months are recomputed from the monthly rollup
+    DELETE FROM uraggregated_yearly_data
+    WHERE machine_name_id = in_machine_name_id AND execution_period = ANY (q_years);
+
+    INSERT INTO uraggregated_yearly_data
+        (execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+         min_execution_time, max_execution_time, n_jobs, cputime, walltime)
+    SELECT
+        years.execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id,
+        min(min_execution_time), max(max_execution_time), sum(n_jobs), sum(cputime), sum(walltime)
+    FROM uraggregated_monthly_data
+    JOIN unnest(q_years) AS years (execution_period)
+        ON (uraggregated_monthly_data.execution_period >= years.execution_period AND
+            uraggregated_monthly_data.execution_period < years.execution_period + interval '1 year')
+    WHERE machine_name_id = in_machine_name_id
+    GROUP BY
+        years.execution_period, machine_name_id, global_user_name_id, local_user_id, vo_information_id, project_name_id;
+
+    -- the WLCG monthly data of the months must be recomputed (by the server)
+    INSERT INTO wlcg_monthly_update (execution_period)
+    SELECT DISTINCT period FROM unnest(q_periods) AS period
+    ON CONFLICT DO NOTHING;
+    PERFORM pg_notify('sgas_wlcg_monthly', '');
+
+    RETURN array_length(q_periods, 1);
+
+END;
+$n_months$
+LANGUAGE plpgsql;
+
+
+
+CREATE OR REPLACE FUNCTION rebuild_uraggregate_start ( )
+RETURNS integer AS $n_partitions$
+
+BEGIN
+    -- starts a rebuild of the aggregation table, or resumes a rebuild which
+    -- was interrupted. returns the number of partitions left to build.
+    -- the aggregation is rebuilt into the uraggregated_data_rebuild table,
+    -- one insert date at a time (see rebuild_uraggregate_partition). insert
+    -- dates from the start date onwards are not rebuilt, but taken from the
+    -- live table when the rebuilt table is swapped in
+
+    LOCK TABLE uraggregated_rebuild IN EXCLUSIVE MODE;
+
+    PERFORM * FROM uraggregated_rebuild;
+    IF NOT FOUND THEN
+        -- the indexes are created when all partitions have been built
+        CREATE TABLE uraggregated_data_rebuild (LIKE uraggregated_data INCLUDING DEFAULTS);
+
+        INSERT INTO uraggregated_rebuild (cutoff_date, start_time) VALUES (current_date, now());
+        DELETE FROM uraggregated_rebuild_partition;
+        DELETE FROM uraggregated_rebuild_dirty;
+        INSERT INTO uraggregated_rebuild_partition (insert_date)
+            SELECT DISTINCT date(insert_time) FROM usagedata WHERE insert_time < current_date;
+    END IF;
+
+    RETURN (SELECT count(*) FROM uraggregated_rebuild_partition WHERE build_time IS NULL);
+
+END;
+$n_partitions$
+LANGUAGE plpgsql;
+
+
+
+CREATE OR REPLACE FUNCTION rebuild_uraggregate_partition ( )
+RETURNS TABLE (
+    out_insert_date     date,
+    out_n_records       bigint,
+    out_n_rows          bigint
+) AS $partition$
+
+DECLARE
+    q_insert_date       date;
+    q_n_records         bigint;
+    q_n_rows            bigint;
+BEGIN
+    -- builds the aggregation of the next partition (insert date) of a rebuild
+    -- in progress. returns the insert date, and the number of records and
+    -- aggregated rows of the partition, or no rows when all partitions have
+    -- been built. partitions being built by other connections are skipped, so
+    -- several connections can build partitions in parallel. the partition is
+    -- checkpointed in the same transaction as it is built
+
+    SELECT insert_date INTO q_insert_date FROM uraggregated_rebuild_partition
+        WHERE build_time IS NULL ORDER BY insert_date LIMIT 1
+        FOR UPDATE SKIP LOCKED;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    WITH inserted AS (
+        INSERT INTO uraggregated_data_rebuild
+            (execution_time, insert_time, machine_name_id, queue_id,
+             global_user_name_id, local_user_id, vo_information_id, project_name_id,
+             runtime_environments_id, status_id, insert_host_id, n_jobs, cputime, walltime, generate_time)
+        SELECT
+            COALESCE(end_time::DATE, create_time::DATE)                             AS s_execute_time,
+            insert_time::DATE                                                       AS s_insert_time,
+            machine_name_id                                                         AS s_machine_name_id,
+            queue_id                                                                AS s_queue_id,
+            global_user_name_id                                                     AS s_global_user_name_id,
+            CASE WHEN global_user_name_id IS NULL THEN local_user_id ELSE NULL END  AS s_local_user_id,
+            vo_information_id                                                       AS s_vo_information_id,
+            CASE WHEN vo_information_id IS NULL THEN project_name_id ELSE NULL END  AS s_project_name_id,
+            ARRAY(SELECT runtimeenvironment_usagedata.runtimeenvironments_id
+                  FROM runtimeenvironment_usagedata
+                  WHERE usagedata.id = runtimeenvironment_usagedata.usagedata_id)   AS s_runtime_environments,
+            status_id                                                               AS s_status_id,
+            insert_host_id                                                          AS s_insert_host_id,
+            count(*)                                                                AS s_n_jobs,
+            SUM(COALESCE(cpu_duration::bigint,0))                                   AS s_cputime,
+            SUM(COALESCE(wall_duration::bigint,0) * COALESCE(processors,1))         AS s_walltime,
+            now()                                                                   AS s_generate_time
+        FROM
+            usagedata
+        WHERE
+            date(insert_time) = q_insert_date
+        GROUP BY
+            s_execute_time, s_insert_time, s_machine_name_id, s_queue_id,
+            s_global_user_name_id, s_local_user_id, s_vo_information_id, s_project_name_id,
+            s_runtime_environments, s_status_id, s_insert_host_id
+        RETURNING n_jobs
+    )
+    SELECT COALESCE(sum(n_jobs), 0), count(*) INTO q_n_records, q_n_rows FROM inserted;
+
+    UPDATE uraggregated_rebuild_partition SET n_records = q_n_records, build_time = now()
+        WHERE insert_date = q_insert_date;
+
+    RETURN QUERY SELECT q_insert_date, q_n_records, q_n_rows;
+
+END;
+$partition$
+LANGUAGE plpgsql;
+
+
+
+CREATE OR REPLACE FUNCTION rebuild_uraggregate_swap ( )
+RETURNS integer AS $n_pairs$
+
+DECLARE
+    q_cutoff_date       date;
+    q_index             record;
+    q_view_names        name[];
+    q_view_defs         text[];
+    q_n_pairs           integer;
+BEGIN
+    -- swaps the rebuilt aggregation table in, when all partitions have been
+    -- built. returns the number of pairs which are marked for update, as they
+    -- could have changed after their partition was built
+
+    SELECT cutoff_date INTO q_cutoff_date FROM uraggregated_rebuild;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'No rebuild of the aggregation table in progress';
+    END IF;
+    PERFORM * FROM uraggregated_rebuild_partition WHERE build_time IS NULL;
+    IF FOUND THEN
+        RAISE EXCEPTION 'Not all partitions of the aggregation table have been rebuilt';
+    END IF;
+
+    -- create the indexes of the aggregation table, before locking anything
+    FOR q_index IN SELECT indexname, indexdef FROM pg_indexes
+                   WHERE schemaname = current_schema() AND tablename = 'uraggregated_data' LOOP
+        EXECUTE regexp_replace(q_index.indexdef, 'INDEX (\S+) ON (\S+\.)?uraggregated_data ',
+                                                 'INDEX \1_rebuild ON uraggregated_data_rebuild ');
+    END LOOP;
+
+    -- stop the updater and the inserters from changing the aggregation while
+    -- swapping. the tables are locked in the same order as the updater uses them
+    LOCK TABLE uraggregated_update, uraggregated_delta, uraggregated_rebuild_dirty, uraggregated_data IN EXCLUSIVE MODE;
+
+    -- insert dates after the rebuild started are taken from the live table
+    INSERT INTO uraggregated_data_rebuild SELECT * FROM uraggregated_data WHERE insert_time >= q_cutoff_date;
+
+    -- records waiting to be added could already be included in their
+    -- partition, so their pairs are recomputed instead
+    INSERT INTO uraggregated_rebuild_dirty (insert_time, machine_name_id)
+        SELECT DISTINCT insert_time, machine_name_id FROM uraggregated_delta WHERE insert_time < q_cutoff_date;
+    DELETE FROM uraggregated_delta WHERE insert_time < q_cutoff_date;
+
+    INSERT INTO uraggregated_update (insert_time, machine_name_id)
+        SELECT DISTINCT insert_time, machine_name_id FROM uraggregated_rebuild_dirty d
+        WHERE NOT EXISTS (SELECT * FROM uraggregated_update
+                          WHERE insert_time = d.insert_time AND machine_name_id = d.machine_name_id);
+    GET DIAGNOSTICS q_n_pairs = ROW_COUNT;
+
+    -- views on the aggregation table must be recreated, in order to use the new table
+    SELECT array_agg(c.relname), array_agg(pg_get_viewdef(c.oid)) INTO q_view_names, q_view_defs
+    FROM (SELECT DISTINCT r.ev_class FROM pg_depend d JOIN pg_rewrite r ON (d.objid = r.oid)
+          WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = 'uraggregated_data'::regclass AND
+                r.ev_class <> 'uraggregated_data'::regclass) AS v
+    JOIN pg_class c ON (c.oid = v.ev_class);
+
+    FOR i IN 1 .. COALESCE(array_length(q_view_names, 1), 0) LOOP
+        EXECUTE 'DROP VIEW ' || quote_ident(q_view_names[i]);
+    END LOOP;
+
+    DROP TABLE uraggregated_data;
+    ALTER TABLE uraggregated_data_rebuild RENAME TO uraggregated_data;
+    FOR q_index IN SELECT indexname FROM pg_indexes
+                   WHERE schemaname = current_schema() AND tablename = 'uraggregated_data' LOOP
+        EXECUTE 'ALTER INDEX ' || quote_ident(q_index.indexname) ||
+                ' RENAME TO ' || quote_ident(regexp_replace(q_index.indexname, '_rebuild$', ''));
+    END LOOP;
+
+    FOR i IN 1 .. COALESCE(array_length(q_view_names, 1), 0) LOOP
+        EXECUTE 'CREATE VIEW ' || quote_ident(q_view_names[i]) || ' AS ' || q_view_defs[i];
+    END LOOP;
+
+    -- the rollups are recomputed from the rebuilt table
+    INSERT INTO uraggregated_rollup_update (execution_period, machine_name_id)
+        SELECT DISTINCT date_trunc('month', execution_time)::date, machine_name_id FROM uraggregated_data
+        WHERE machine_name_id IS NOT NULL
+    ON CONFLICT (machine_name_id, execution_period) DO NOTHING;
+
+    DELETE FROM uraggregated_rebuild;
+    DELETE FROM uraggregated_rebuild_partition;
+    DELETE FROM uraggregated_rebuild_dirty;
+
+    RETURN q_n_pairs;
+
+END;
+$n_pairs$
+LANGUAGE plpgsql;
+
+
+
+CREATE OR REPLACE FUNCTION rebuild_uraggregate_abort ( )
+RETURNS void AS $abort$
+
+BEGIN
+    -- aborts a rebuild in progress, and removes the partially rebuilt table
+    DROP TABLE IF EXISTS uraggregated_data_rebuild;
+    DELETE FROM uraggregated_rebuild;
+    DELETE FROM uraggregated_rebuild_partition;
+    DELETE FROM uraggregated_rebuild_dirty;
+END;
+$abort$
+LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION srcreate (
     in_record_id            varchar,
     in_create_time          timestamp,
@@ -634,6 +1633,14 @@ BEGIN
                     )
             RETURNING id INTO sr_key;
 
+    -- mark the day of the snapshot for update of the storage aggregation. the
+    -- mark is updated on conflict, so an updater claiming it waits for this
+    -- transaction, and sees the record when recomputing the day
+    INSERT INTO sraggregated_update (snapshot_date, storage_system_id)
+        VALUES (in_end_time::date, storage_system_key)
+        ON CONFLICT (storage_system_id, snapshot_date) DO UPDATE SET snapshot_date = EXCLUDED.snapshot_date;
+    PERFORM pg_notify('sgas_storage_aggregation', '');
+
     result[0] = in_record_id;
     result[1] = sr_key;
     RETURN result;
@@ -642,3 +1649,78 @@ END;
 $recordid_rowid$
 LANGUAGE plpgsql;
 
+
+
+CREATE OR REPLACE FUNCTION update_sraggregate (
+    in_max_pairs        integer
+)
+RETURNS integer AS $n_pairs$
+
+DECLARE
+    q_snapshot_dates        date[];
+    q_storage_system_ids    integer[];
+BEGIN
+    -- recomputes the daily storage snapshots of up to in_max_pairs (snapshot
+    -- date, storage system) pairs marked in sraggregated_update, or all marked
+    -- pairs if in_max_pairs is null. returns the number of recomputed pairs,
+    -- 0 if there is nothing to do. this should be called in a read committed
+    -- transaction. the marks are claimed in their own statement, so the
+    -- recomputation sees every record whose mark was claimed. concurrent
+    -- updaters are serialized by an advisory lock
+
+    PERFORM pg_advisory_xact_lock(hashtext('sraggregated_data'));
+
+    WITH claimed AS (
+        DELETE FROM sraggregated_update
+        WHERE (storage_system_id, snapshot_date) IN
+            (SELECT storage_system_id, snapshot_date FROM sraggregated_update
+             ORDER BY snapshot_date LIMIT in_max_pairs)
+        RETURNING snapshot_date, storage_system_id
+    )
+    SELECT array_agg(snapshot_date), array_agg(storage_system_id)
+        INTO q_snapshot_dates, q_storage_system_ids
+    FROM claimed;
+
+    IF q_snapshot_dates IS NULL THEN
+        -- nothing to update
+        RETURN 0;
+    END IF;
+
+    DELETE FROM sraggregated_data
+    USING unnest(q_snapshot_dates, q_storage_system_ids) AS pairs (snapshot_date, storage_system_id)
+    WHERE sraggregated_data.snapshot_date = pairs.snapshot_date AND
+          sraggregated_data.storage_system_id = pairs.storage_system_id;
+
+    -- the records of a day are joined as an end time range, so the
+    -- (storage_system_id, end_time) index is used
+    INSERT INTO sraggregated_data
+        (snapshot_date, storage_system_id, storage_share_id, storage_media_id, storage_class_id, group_identity_id, insert_host_id,
+         start_time, end_time, file_count, resource_capacity_used, logical_capacity_used, n_records, insert_time, generate_time)
+    SELECT
+        snapshot_date, storage_system_id, storage_share_id, storage_media_id, storage_class_id, group_identity_id, insert_host_id,
+        min(start_time), end_time, sum(file_count), sum(resource_capacity_used), sum(logical_capacity_used), count(*),
+        max(day_insert_time), now()
+    FROM (
+        SELECT
+            pairs.snapshot_date, storagedata.storage_system_id, storage_share_id, storage_media_id, storage_class_id,
+            group_identity_id, insert_host_id, start_time, end_time, file_count, resource_capacity_used, logical_capacity_used,
+            rank() OVER latest AS snapshot_rank,
+            max(insert_time) OVER snapshot AS day_insert_time
+        FROM storagedata
+        JOIN unnest(q_snapshot_dates, q_storage_system_ids) AS pairs (snapshot_date, storage_system_id)
+            ON (storagedata.storage_system_id = pairs.storage_system_id AND
+                storagedata.end_time >= pairs.snapshot_date AND storagedata.end_time < pairs.snapshot_date + 1)
+        WINDOW snapshot AS (PARTITION BY pairs.snapshot_date, storagedata.storage_system_id, storage_share_id, storage_media_id,
+                                         storage_class_id, group_identity_id, insert_host_id),
+               latest AS (snapshot ORDER BY end_time DESC)
+    ) AS records
+    WHERE snapshot_rank = 1
+    GROUP BY
+        snapshot_date, storage_system_id, storage_share_id, storage_media_id, storage_class_id, group_identity_id, insert_host_id, end_time;
+
+    RETURN array_length(q_snapshot_dates, 1);
+
+END;
+$n_pairs$
+LANGUAGE plpgsql;
+
@@ -2,8 +2,13 @@
 -- drop statement to clear the database
 
 DROP VIEW usagerecords;
+DROP VIEW uraggregated_monthly;
+DROP VIEW uraggregated_yearly;
+DROP VIEW sraggregated;
 
 DROP TABLE usagedata;
+DROP TABLE usagedata_staging;
+DROP SEQUENCE usagedata_staging_batch_seq;
 DROP TABLE insertidentity;
 DROP TABLE machinename;
 DROP TABLE voinformation;
@@ -11,6 +16,19 @@ DROP TABLE globalusername;
 
 DROP TABLE uraggregated;
 DROP TABLE uraggregated_update;
+DROP TABLE uraggregated_delta;
+DROP TABLE uraggregated_rebuild;
+DROP TABLE uraggregated_rebuild_partition;
+DROP TABLE uraggregated_rebuild_dirty;
+DROP TABLE IF EXISTS uraggregated_data_rebuild;
+DROP TABLE uraggregated_monthly_data;
+DROP TABLE uraggregated_yearly_data;
+DROP TABLE uraggregated_rollup_update;
+DROP TABLE sraggregated_data;
+DROP TABLE sraggregated_update;
+DROP TABLE wlcg_monthly;
+DROP TABLE wlcg_monthly_period;
+DROP TABLE wlcg_monthly_update;
 
 DROP FUNCTION urcreate ( character varying, timestamp without time zone, character varying, character varying, character varying, character varying, character varying, character varying, character varying, character varying[], character varying, character varying, numeric, character varying, character varying, character varying, integer, character varying, character varying, timestamp without time zone, timestamp without time zone, timestamp without time zone, numeric, numeric, numeric, numeric, integer, integer, integer, character varying[], integer, character varying, character varying, timestamp without time zone) ;
 
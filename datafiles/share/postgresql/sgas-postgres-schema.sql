@@ -161,6 +161,14 @@ CREATE TABLE uraggregated_data (
     generate_time           timestamp
 );
 
+-- indexes for the access paths of the aggregation table
+-- (insert_time, machine_name_id) is used when updating the aggregation and by
+-- the admin manifest, (machine_name_id, execution_time) by the machine view and
+-- the query engine, and the brin index for execution time ranges in general
+CREATE INDEX uraggregated_data_insert_time_machine_name_idx ON uraggregated_data (insert_time, machine_name_id);
+CREATE INDEX uraggregated_data_machine_name_execution_time_idx ON uraggregated_data (machine_name_id, execution_time);
+CREATE INDEX uraggregated_data_execution_time_brin_idx ON uraggregated_data USING BRIN (execution_time);
+
 -- this table is used for storing information about which parts
 -- of the aggregartion table that needs to be updated
 CREATE TABLE uraggregated_update (
@@ -168,6 +176,137 @@ CREATE TABLE uraggregated_update (
     machine_name_id     integer
 );
 
+CREATE INDEX uraggregated_update_insert_time_machine_name_idx ON uraggregated_update (insert_time, machine_name_id);
+CREATE INDEX uraggregated_update_machine_name_insert_time_idx ON uraggregated_update (machine_name_id, insert_time);
+
+-- records which have been inserted, but not yet added to the aggregation table
+-- the aggregated rows of these records are updated by adding the records to
+-- them, instead of recomputing the (insert date, machine) pair of the record
+CREATE TABLE uraggregated_delta (
+    usagedata_id        integer         PRIMARY KEY,
+    insert_time         date,
+    machine_name_id     integer
+);
+
+CREATE INDEX uraggregated_delta_machine_name_insert_time_idx ON uraggregated_delta (machine_name_id, insert_time);
+
+-- state of a rebuild of the aggregation table (see rebuild_uraggregate_start)
+-- the aggregation of insert dates before the cutoff date is rebuilt into
+-- uraggregated_data_rebuild, one insert date (partition) at a time
+CREATE TABLE uraggregated_rebuild (
+    cutoff_date         date,
+    start_time          timestamp
+);
+
+CREATE TABLE uraggregated_rebuild_partition (
+    insert_date         date            PRIMARY KEY,
+    n_records           bigint,
+    build_time          timestamp
+);
+
+-- pairs recomputed by the updater while a rebuild is in progress, these are
+-- recomputed again when the rebuilt table is swapped in
+CREATE TABLE uraggregated_rebuild_dirty (
+    insert_time         date,
+    machine_name_id     integer
+);
+
+-- monthly and yearly rollups of the aggregation table, used by the query
+-- engine for queries which do not need daily resolution. only the dimensions
+-- of the uraggregated_monthly/yearly views are kept. the hours are rounded
+-- per aggregated row before they are summed, so sums over the rollups are the
+-- same as sums over the uraggregated view. execution_period is the first day
+-- of the month / year. records without a machine name are not rolled up
+CREATE TABLE uraggregated_monthly_data (
+    execution_period        date,
+    machine_name_id         integer,
+    global_user_name_id     integer,
+    local_user_id           integer,
+    vo_information_id       integer,
+    project_name_id         integer,
+    min_execution_time      date,
+    max_execution_time      date,
+    n_jobs                  integer,
+    cputime                 numeric,
+    walltime                numeric
+);
+
+CREATE INDEX uraggregated_monthly_data_machine_name_period_idx ON uraggregated_monthly_data (machine_name_id, execution_period);
+CREATE INDEX uraggregated_monthly_data_period_idx ON uraggregated_monthly_data (execution_period);
+
+CREATE TABLE uraggregated_yearly_data (
+    execution_period        date,
+    machine_name_id         integer,
+    global_user_name_id     integer,
+    local_user_id           integer,
+    vo_information_id       integer,
+    project_name_id         integer,
+    min_execution_time      date,
+    max_execution_time      date,
+    n_jobs                  integer,
+    cputime                 numeric,
+    walltime                numeric
+);
+
+CREATE INDEX uraggregated_yearly_data_machine_name_period_idx ON uraggregated_yearly_data (machine_name_id, execution_period);
+CREATE INDEX uraggregated_yearly_data_period_idx ON uraggregated_yearly_data (execution_period);
+
+-- months of machines where the rollups must be updated, as the aggregation
+-- table has changed
+CREATE TABLE uraggregated_rollup_update (
+    execution_period    date,
+    machine_name_id     integer,
+    PRIMARY KEY (machine_name_id, execution_period)
+);
+
+-- staging table for bulk insertion of usage records
+-- rows are copied into this table by the server and then moved into the
+-- usagedata table by the urcreate_bulk function. The table is unlogged as the
+-- content only lives for the duration of the inserting transaction
+CREATE SEQUENCE usagedata_staging_batch_seq;
+
+CREATE UNLOGGED TABLE usagedata_staging (
+    batch_id                bigint          NOT NULL,
+    record_id               varchar,
+    create_time             timestamp,
+    global_job_id           varchar,
+    local_job_id            varchar,
+    local_user              varchar,
+    global_user_name        varchar,
+    vo_type                 varchar,
+    vo_issuer               varchar,
+    vo_name                 varchar,
+    vo_attributes           varchar[][],
+    machine_name            varchar,
+    job_name                varchar,
+    charge                  integer,
+    status                  varchar,
+    queue                   varchar,
+    host                    varchar,
+    node_count              integer,
+    processors              integer,
+    project_name            varchar,
+    submit_host             varchar,
+    start_time              timestamp,
+    end_time                timestamp,
+    submit_time             timestamp,
+    cpu_duration            bigint,
+    wall_duration           integer,
+    user_time               integer,
+    kernel_time             integer,
+    major_page_faults       integer,
+    runtime_environments    varchar[],
+    exit_code               integer,
+    downloads               varchar[],
+    uploads                 varchar[],
+    insert_host             varchar,
+    insert_identity         varchar,
+    insert_time             timestamp,
+    memory                  sgas_memory[]
+);
+
+CREATE INDEX usagedata_staging_batch_id_idx ON usagedata_staging (batch_id);
+
 
 -- storage schema
 
@@ -249,3 +388,77 @@ CREATE TABLE storagedata (
     insert_time             timestamp
 );
 
+-- used when recomputing the storage snapshots of a day and storage system
+CREATE INDEX storagedata_storage_system_end_time_idx ON storagedata (storage_system_id, end_time);
+
+-- daily snapshots of the storage records. for each day, storage system,
+-- share, media, class, group and insert host, the last snapshot of the day
+-- (the records with the latest end time) is kept. the capacity of records
+-- with the same end time (e.g., per user or directory) is summed, and
+-- insert_time is the latest insert time of the records of the day. the
+-- views and the monitor read this instead of storagedata
+CREATE TABLE sraggregated_data (
+    snapshot_date           date            NOT NULL,
+    storage_system_id       integer         NOT NULL,
+    storage_share_id        integer,
+    storage_media_id        integer,
+    storage_class_id        integer,
+    group_identity_id       integer,
+    insert_host_id          integer,
+    start_time              timestamp       NOT NULL,
+    end_time                timestamp       NOT NULL,
+    file_count              bigint,
+    resource_capacity_used  bigint          NOT NULL,
+    logical_capacity_used   bigint,
+    n_records               integer         NOT NULL,
+    insert_time             timestamp,
+    generate_time           timestamp
+);
+
+CREATE INDEX sraggregated_data_storage_system_snapshot_date_idx ON sraggregated_data (storage_system_id, snapshot_date);
+CREATE INDEX sraggregated_data_snapshot_date_idx ON sraggregated_data (snapshot_date);
+
+-- (snapshot date, storage system) pairs where the snapshots must be
+-- recomputed, as storage records have been inserted (see update_sraggregate)
+CREATE TABLE sraggregated_update (
+    snapshot_date           date,
+    storage_system_id       integer,
+    PRIMARY KEY (storage_system_id, snapshot_date)
+);
+
+-- the WLCG view data per month, with the HS06 / KSI2K scaling of the WLCG
+-- configuration applied. The table is maintained by the server (see
+-- sgas.viewengine.wlcgmonthly), as the scaling is done by the wlcgsgas
+-- library
+CREATE TABLE wlcg_monthly (
+    execution_period        date            NOT NULL,
+    machine_name            varchar,
+    vo_name                 varchar,
+    vo_group                varchar,
+    vo_role                 varchar,
+    user_identity           varchar,
+    n_jobs                  double precision,
+    cputime                 double precision,
+    walltime                double precision,
+    ksi2k_cputime           double precision,
+    ksi2k_walltime          double precision,
+    hs06_cputime            double precision,
+    hs06_walltime           double precision
+);
+
+CREATE INDEX wlcg_monthly_period_idx ON wlcg_monthly (execution_period);
+
+-- months in wlcg_monthly, and the digest of the WLCG configuration they were
+-- computed with
+CREATE TABLE wlcg_monthly_period (
+    execution_period        date            PRIMARY KEY,
+    config_digest           varchar         NOT NULL,
+    generate_time           timestamp       NOT NULL
+);
+
+-- months where wlcg_monthly must be recomputed, as their monthly rollup has
+-- changed (see update_uraggregate_rollup)
+CREATE TABLE wlcg_monthly_update (
+    execution_period        date            PRIMARY KEY
+);
+
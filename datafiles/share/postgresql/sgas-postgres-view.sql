@@ -135,6 +135,63 @@ LEFT OUTER JOIN inserthost          ON (uraggregated_data.insert_host_id      =
 ;
 
 
+-- the monthly and yearly rollups of uraggregated
+CREATE VIEW uraggregated_monthly AS
+SELECT
+    execution_period                                                                AS execution_period,
+    min_execution_time                                                              AS min_execution_time,
+    max_execution_time                                                              AS max_execution_time,
+    machinename.machine_name                                                        AS machine_name,
+    CASE WHEN global_user_name_id IS NOT NULL THEN globalusername.global_user_name
+        ELSE machine_name || ':' || localuser.local_user
+    END                                                                             AS user_identity,
+    CASE WHEN vo_information_id IS NOT NULL THEN
+        CASE WHEN voinformation.vo_name LIKE '/%' THEN NULL
+             ELSE voinformation.vo_name
+        END
+        ELSE machine_name || ':' || projectname.project_name
+    END                                                                             AS vo_name,
+    n_jobs                                                                          AS n_jobs,
+    cputime                                                                         AS cputime,
+    walltime                                                                        AS walltime
+FROM
+    uraggregated_monthly_data
+LEFT OUTER JOIN machinename         ON (uraggregated_monthly_data.machine_name_id     = machinename.id)
+LEFT OUTER JOIN globalusername      ON (uraggregated_monthly_data.global_user_name_id = globalusername.id)
+LEFT OUTER JOIN localuser           ON (uraggregated_monthly_data.local_user_id       = localuser.id)
+LEFT OUTER JOIN voinformation       ON (uraggregated_monthly_data.vo_information_id   = voinformation.id)
+LEFT OUTER JOIN projectname         ON (uraggregated_monthly_data.project_name_id     = projectname.id)
+;
+
+
+CREATE VIEW uraggregated_yearly AS
+SELECT
+    execution_period                                                                AS execution_period,
+    min_execution_time                                                              AS min_execution_time,
+    max_execution_time                                                              AS max_execution_time,
+    machinename.machine_name                                                        AS machine_name,
+    CASE WHEN global_user_name_id IS NOT NULL THEN globalusername.global_user_name
+        ELSE machine_name || ':' || localuser.local_user
+    END                                                                             AS user_identity,
+    CASE WHEN vo_information_id IS NOT NULL THEN
+        CASE WHEN voinformation.vo_name LIKE '/%' THEN NULL
+             ELSE voinformation.vo_name
+        END
+        ELSE machine_name || ':' || projectname.project_name
+    END                                                                             AS vo_name,
+    n_jobs                                                                          AS n_jobs,
+    cputime                                                                         AS cputime,
+    walltime                                                                        AS walltime
+FROM
+    uraggregated_yearly_data
+LEFT OUTER JOIN machinename         ON (uraggregated_yearly_data.machine_name_id     = machinename.id)
+LEFT OUTER JOIN globalusername      ON (uraggregated_yearly_data.global_user_name_id = globalusername.id)
+LEFT OUTER JOIN localuser           ON (uraggregated_yearly_data.local_user_id       = localuser.id)
+LEFT OUTER JOIN voinformation       ON (uraggregated_yearly_data.vo_information_id   = voinformation.id)
+LEFT OUTER JOIN projectname         ON (uraggregated_yearly_data.project_name_id     = projectname.id)
+;
+
+
 CREATE VIEW storagerecords AS
 SELECT
         record_id                       AS record_id,
@@ -175,3 +232,33 @@ LEFT OUTER JOIN site  ON (storagedata.site_id  = site.id)
 ;
 
 
+-- the daily storage snapshots
+CREATE VIEW sraggregated AS
+SELECT
+        snapshot_date                   AS snapshot_date,
+        storagesystem.storage_system    AS storage_system,
+        storageshare.storage_share      AS storage_share,
+        storagemedia.storage_media      AS storage_media,
+        storageclass.storage_class      AS storage_class,
+        groupidentity.group_identity    AS group_identity,
+        groupidentity.group_attribute   AS group_attribute,
+        inserthost.insert_host          AS insert_host,
+        start_time                      AS start_time,
+        end_time                        AS end_time,
+        file_count                      AS file_count,
+        resource_capacity_used          AS resource_capacity_used,
+        logical_capacity_used           AS logical_capacity_used,
+        n_records                       AS n_records,
+        insert_time                     AS insert_time,
+        generate_time                   AS generate_time
+FROM
+    sraggregated_data
+LEFT OUTER JOIN storagesystem   ON (sraggregated_data.storage_system_id   = storagesystem.id)
+LEFT OUTER JOIN storageshare    ON (sraggregated_data.storage_share_id    = storageshare.id)
+LEFT OUTER JOIN storagemedia    ON (sraggregated_data.storage_media_id    = storagemedia.id)
+LEFT OUTER JOIN storageclass    ON (sraggregated_data.storage_class_id    = storageclass.id)
+LEFT OUTER JOIN groupidentity   ON (sraggregated_data.group_identity_id   = groupidentity.id)
+LEFT OUTER JOIN inserthost      ON (sraggregated_data.insert_host_id      = inserthost.id)
+;
+
+
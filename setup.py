@@ -82,6 +82,7 @@ setup(name='sgas-luts-service',
                                           'datafiles/share/postgresql/sgas-postgres-3.6.2-3.6.3-upgrade.sql',
                                           'datafiles/share/postgresql/sgas-postgres-3.6.3-3.7.0-upgrade.sql',
                                           'datafiles/share/postgresql/sgas-postgres-3.7.1-3.7.2-upgrade.sql',
+                                          'datafiles/share/postgresql/sgas-postgres-3.8.0-3.9.0-upgrade.sql',
                                           'datafiles/share/postgresql/sgas-postgres-aggregation-rebuild.sql',
                                           'datafiles/share/postgresql/sgas-postgres-cluster.sql']),
           ('/etc/',                      ['datafiles/etc/sgas.conf']),
@@ -10,10 +10,10 @@ Copyright: Nordic Data Grid Facility (2010)
 from twisted.python import log
 from twisted.web import resource, server
 
-from sgas.ext.python import json
+from sgas.database import error as dberror
 from sgas.authz import rights as authrights, ctxsetchecker
 from sgas.customqueryengine import rights
-from sgas.server import resourceutil
+from sgas.server import resourceutil, jsonstream
 from sgas.customqueryengine import querydefinition
 
 
@@ -47,7 +47,8 @@ class QueryResource(resource.Resource):
 
 
     def queryDatabase(self, query, query_args):
-        return self.db.dictquery(query, query_args)
+        # the rows are streamed, so large results are never held in memory
+        return self.db.streamQuery(query, query_args, dict_rows=True)
 
 
     def render_GET(self, request):
@@ -91,27 +92,30 @@ class QueryResource(resource.Resource):
         hostname = resourceutil.getHostname(request)
         log.msg('Accepted query request from %s' % hostname, system='sgas.QueryResource')
 
-        def gotDatabaseResult(rows):
-            payload = json.dumps(rows)
-            request.setHeader(HTTP_HEADER_CONTENT_TYPE, JSON_MIME_TYPE)
-            request.write(payload)
-            request.finish()
+        def gotDatabaseResult(n_rows):
+            log.msg('Query result: %s rows' % n_rows, system='sgas.QueryResource')
 
         def queryError(error):
-            log.msg('Queryengine error: %s' % str(error), system='sgas.QueryResource')
-            log.msg('Queryengine error args' % str(query_args), system='sgas.QueryResource')
-            request.setResponseCode(500)
-            request.write('Queryengine error (%s)' % str(error), system='sgas.QueryResource')
+            # only called if nothing has been written, so an error response can be written
+            log.msg('Queryengine error: %s' % error.getErrorMessage(), system='sgas.QueryResource')
+            log.msg('Queryengine error args: %s' % str(query_args), system='sgas.QueryResource')
+            if error.check(dberror.DatabaseUnavailableError):
+                # the database is down or too busy, which is not an error in the query
+                request.setResponseCode(503) # service unavailable
+                request.write('Database currently unavailable. Please try again later.')
+            else:
+                log.err(error, system='sgas.QueryResource')
+                request.setResponseCode(500)
+                request.write('Queryengine error (%s)' % error.getErrorMessage())
             request.finish()
 
         def resultHandlingError(error):
-            log.msg('Query result error: %s' % str(error), system='sgas.QueryResource')
-            log.msg('Query result error args' % str(query_args), system='sgas.QueryResource')
-            request.setResponseCode(500)
-            request.write('Query result error (%s)' % str(error), system='sgas.QueryResource')
-            request.finish()
+            # the response has been finished, or the connection is gone, so it can only be logged
+            log.msg('Query result error args: %s' % str(query_args), system='sgas.QueryResource')
+            log.err(error, 'Query result error', system='sgas.QueryResource')
 
-        d = self.queryDatabase(query.query,query_args)
+        producer = jsonstream.JSONArrayProducer(request, self.queryDatabase(query.query,query_args))
+        d = producer.start()
         d.addCallbacks(gotDatabaseResult, queryError)
         d.addErrback(resultHandlingError)
         return server.NOT_DONE_YET
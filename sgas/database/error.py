@@ -18,6 +18,12 @@ class DatabaseUnavailableError(SGASDatabaseError):
     """
 
 
+class DatabaseBusyError(DatabaseUnavailableError):
+    """
+    Error raised when too many requests are waiting for a database connection.
+    """
+
+
 class InvalidUsageDataError(SGASDatabaseError):
     """
     Error raised when usage record data is invalid.
@@ -0,0 +1,85 @@
+"""
+Encoding of rows into the PostgreSQL COPY text format.
+
+Used for bulk loading records into staging tables with cursor.copy_from,
+which is a lot faster than inserting the rows one by one.
+"""
+
+import re
+
+
+COPY_NULL       = '\\N'
+COPY_SEPARATOR  = '\t'
+
+# characters which must be escaped in the copy format
+COPY_SPECIAL = re.compile('[\\\\\t\n\r]')
+
+
+
+def _escapeCopy(value):
+    if COPY_SPECIAL.search(value) is None:
+        return value
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _arrayElement(value):
+    # array elements are always quoted, avoids having to figure out when it is needed
+    if value is None:
+        return 'NULL'
+    if type(value) in (list, tuple):
+        return _arrayLiteral(value)
+    value = _literal(value)
+    if '"' in value or '\\' in value:
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return '"' + value + '"'
+
+
+def _arrayLiteral(values):
+    return '{' + ','.join( [ _arrayElement(v) for v in values ] ) + '}'
+
+
+# text representation of values (before copy escaping), by type
+_LITERALS = {
+    str     : lambda v : v,
+    unicode : lambda v : v.encode('utf-8'),
+    bool    : lambda v : v and 't' or 'f',
+    int     : str,
+    long    : str,
+    float   : repr,
+    list    : _arrayLiteral,
+    tuple   : _arrayLiteral
+}
+
+
+def _literal(value):
+    try:
+        return _LITERALS[type(value)](value)
+    except KeyError:
+        if hasattr(value, 'getcomposite'):
+            return value.getcomposite()
+        return str(value)
+
+
+
+def encodeValue(value):
+    """
+    Encode a single value into copy format.
+    """
+    if value is None:
+        return COPY_NULL
+    return _escapeCopy(_literal(value))
+
+
+
+def encodeRows(rows, prefix=()):
+    """
+    Encode a list of rows into a string which can be fed to copy_from. Values
+    in prefix are put in front of every row (e.g., a batch identifier).
+    """
+    prefix = [ encodeValue(v) for v in prefix ]
+    lines = []
+    for row in rows:
+        lines.append(COPY_SEPARATOR.join(prefix + [ encodeValue(v) for v in row ]))
+    lines.append('')
+    return '\n'.join(lines)
+
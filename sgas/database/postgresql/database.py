@@ -5,44 +5,155 @@ Author: Henrik Thostrup Jensen <htj@ndgf.org>
 Copyright: Nordic Data Grid Facility (2010)
 """
 
-import types
-import decimal
+import time
+import threading
+import StringIO
 
 import psycopg2
 import psycopg2.extensions # not used, but enables tuple adaption
-import psycopg2.extras
 
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from twisted.enterprise import adbapi
 from twisted.application import service
 
 from sgas.database import error
+from sgas.database.postgresql import copyformat, dimensioncache, groupcommit, querystream, replicas, statements, typecast
 #from sgas.database.postgresql import updater
 
 
 DEFAULT_POSTGRESQL_PORT = 5432
 
-SQL_SERIALIZABLE_TRANSACTION = '''SET TRANSACTION ISOLATION LEVEL SERIALIZABLE'''
+# the connection pools, inserts, aggregation and queries each have their own
+# pool, so a burst of one kind of work cannot take the connections of another
+INGEST_POOL      = 'ingest'
+AGGREGATION_POOL = 'aggregation'
+READ_POOL        = 'read'
+POOLS = ( INGEST_POOL, AGGREGATION_POOL, READ_POOL )
+
+# connections in each pool
+DEFAULT_POOL_SIZES = { INGEST_POOL: 5, AGGREGATION_POOL: 3, READ_POOL: 5 }
+# interactions which may wait for a connection in each pool before further
+# interactions are rejected (0 is no limit)
+DEFAULT_QUEUE_LIMITS = { INGEST_POOL: 0, AGGREGATION_POOL: 0, READ_POOL: 100 }
+
+# how many times to retry an aggregation batch after a serialization failure (or deadlock)
+SERIALIZATION_RETRIES = 5
+# seconds to wait before retrying, multiplied by the attempt number
+SERIALIZATION_RETRY_DELAY = 0.5
+# seconds an aggregation transaction should take, the batch size is adjusted
+# to keep the transactions around this
+AGGREGATION_TRANSACTION_TIME = 2.0
+# seconds after which an aggregation transaction is cancelled, and retried
+# with a smaller batch
+AGGREGATION_TRANSACTION_TIMEOUT = 60
+
+
+def parseConnectInfo(connect_info):
+    # the connect info is host:port:database:user:password, with empty fields
+    # for the defaults. returns the psycopg2 connect arguments
+    args = [ e or None for e in connect_info.split(':') ]
+    host, port, database, user, password = args[:5]
+    if port is None:
+        port = DEFAULT_POSTGRESQL_PORT
+    return { 'host': host, 'port': port, 'database': database, 'user': user, 'password': password }
+
+
+
+def connector(connect_info):
+    # returns a function for creating new connections outside the pools
+    # (e.g., for listening for notifications, or rebuilding the aggregation)
+    connect_args = parseConnectInfo(connect_info)
+
+    def connect():
+        return psycopg2.connect(**connect_args)
+    return connect
+
 
 
 class _DatabasePoolProxy:
     # abstraction over a database pool object, so we can provide a sensible way
     # to replace the pool if something goes wrong.
+    # interactions run through the proxy are counted while they wait for a
+    # connection, and rejected when queue_limit are waiting already
 
-    def __init__(self, connect_info):
+    def __init__(self, connect_info, name=INGEST_POOL, size=DEFAULT_POOL_SIZES[INGEST_POOL], queue_limit=0):
 
         self.connect_info = connect_info
+        self.name = name
+        self.size = size
+        self.queue_limit = queue_limit
         self.dbpool = None
         self.reconnect()
 
+        self.lock      = threading.Lock() # the waits are recorded in the pool threads
+        self.queued    = 0
+        self.active    = 0
+        self.completed = 0
+        self.rejected  = 0
+        self.wait_total = 0.0
+        self.wait_max   = 0.0
+
 
     def _setupPool(self, connect_info):
-        args = [ e or None for e in connect_info.split(':') ]
-        host, port, database, user, password = args[:5]
-        if port is None:
-            port = DEFAULT_POSTGRESQL_PORT
-        return adbapi.ConnectionPool('psycopg2', host=host, port=port, database=database, user=user, password=password)
+        return adbapi.ConnectionPool('psycopg2', cp_min=1, cp_max=self.size, cp_openfun=typecast.registerTypecasters,
+                                     **parseConnectInfo(connect_info))
+
+
+    def runInteraction(self, interaction, *args):
+        # like ConnectionPool.runInteraction, but counted
+        if self.queue_limit and self.queued >= self.queue_limit:
+            self.rejected += 1
+            return defer.fail(error.DatabaseBusyError('Too many requests waiting for a database connection (%s pool)' % self.name))
+
+        queued_at = time.time()
+        started = []
+
+        def startInteraction(txn, *args):
+            # executed in a pool thread, once a connection is available
+            wait = time.time() - queued_at
+            self.lock.acquire()
+            try:
+                started.append(True)
+                self.queued -= 1
+                self.active += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            finally:
+                self.lock.release()
+            return interaction(txn, *args)
+
+        def interactionDone(result):
+            self.lock.acquire()
+            try:
+                if started:
+                    self.active -= 1
+                    self.completed += 1
+                else:
+                    self.queued -= 1 # e.g., the pool was closed
+            finally:
+                self.lock.release()
+            return result
+
+        self.lock.acquire()
+        try:
+            self.queued += 1
+        finally:
+            self.lock.release()
+        d = self.dbpool.runInteraction(startInteraction, *args)
+        d.addBoth(interactionDone)
+        return d
+
+
+    def getStats(self):
+        return { 'size'        : self.size,
+                 'queue_limit' : self.queue_limit,
+                 'queued'      : self.queued,
+                 'active'      : self.active,
+                 'completed'   : self.completed,
+                 'rejected'    : self.rejected,
+                 'mean_wait'   : round(self.wait_total / max(1, self.completed + self.active), 4),
+                 'max_wait'    : round(self.wait_max, 3) }
 
 
     def reconnect(self):
@@ -61,78 +172,212 @@ class PostgreSQLDatabase(service.MultiService):
 
     service = []
     
-    def __init__(self, connect_info):
+    def __init__(self, connect_info, pool_sizes=None, queue_limits=None, replica_infos=None,
+                 max_replica_lag=replicas.DEFAULT_MAX_REPLICA_LAG):
         service.MultiService.__init__(self)
-        self.pool_proxy = _DatabasePoolProxy(connect_info)
+        pool_sizes = dict(DEFAULT_POOL_SIZES, **(pool_sizes or {}))
+        queue_limits = dict(DEFAULT_QUEUE_LIMITS, **(queue_limits or {}))
+        self.pools = dict( [ (name, _DatabasePoolProxy(connect_info, name, pool_sizes[name], queue_limits[name])) for name in POOLS ] )
+        # the ingest pool, also used for the connect info of the listeners
+        self.pool_proxy = self.pools[INGEST_POOL]
+        # read only replicas, each gets a pool like the read pool
+        self.replicas = None
+        if replica_infos:
+            replica_list = [ replicas.Replica(_DatabasePoolProxy(info, 'replica:' + ':'.join(info.split(':')[:2]).rstrip(':'),
+                                                                 pool_sizes[READ_POOL], queue_limits[READ_POOL]))
+                             for info in replica_infos ]
+            self.replicas = replicas.ReplicaSet(replica_list, max_replica_lag, self.pools[READ_POOL])
+        self.dimension_cache = dimensioncache.DimensionCache()
+        self.statements = statements.StatementRegistry()
+        self.group_committer = groupcommit.GroupCommitter(self)
+        self.spool = None
+        self.updater = None
+        self.wlcg_monthly = None
 
 
     def startService(self):
         service.MultiService.startService(self)
-        return defer.DeferredList(map(lambda s: s.startService(),self.service))        
+        d = self.pool_proxy.runInteraction(self.dimension_cache.warm)
+        # the cache is filled on miss anyway, so failing to warm it is not fatal
+        d.addErrback(lambda f : log.msg('Error warming dimension cache: %s' % f.getErrorMessage(), system='sgas.PostgreSQLDatabase'))
+        if self.replicas is not None:
+            self.replicas.startService()
+        return defer.DeferredList([d] + map(lambda s: s.startService(),self.service))
 
 
     def stopService(self):
+        # the pools are closed when the reactor shuts down, which waits for the
+        # deferred returned here, so the grouped inserts are committed first
+        d = self.group_committer.flushAll()
         service.MultiService.stopService(self)
-        return defer.DeferredList(map(lambda s: s.stopService(),self.service))
+        if self.replicas is not None:
+            self.replicas.stopService()
+        return defer.DeferredList([d] + map(lambda s: s.stopService(),self.service))
 
 
     def attachService(self,service):
         self.service += [service]
 
 
-    @defer.inlineCallbacks
-    def query(self, query, query_args=None, retry=False):
+    def attachSpool(self, spool):
+        # insert resources spool their records, instead of inserting them directly
+        self.spool = spool
+        self.attachService(spool)
+
 
-        def buildValue(value):
-            if type(value) in (unicode, str, int, long, float, bool, types.NoneType):
-                return value
-            if isinstance(value, decimal.Decimal):
-                sv = str(value)
-                return int(sv) if sv.isalnum() else float(sv)
-            # bad catch-all
-            return str(value)
+    def attachWLCGMonthly(self, wlcg_monthly):
+        # the precomputed WLCG data, which the WLCG views use
+        self.wlcg_monthly = wlcg_monthly
+        self.attachService(wlcg_monthly)
 
+
+    def attachUpdater(self, updater):
+        # the aggregation updater, its status is shown by the monitor resource
+        self.updater = updater
+        self.attachService(updater)
+
+
+    def registerDimensions(self, dimensions):
+        # dimensions is a list of (arg index, table, column) tuples
+        for _, table, column in dimensions:
+            self.dimension_cache.addDimension(table, column)
+
+
+    def getPoolStats(self):
+        # connection use and queueing of each pool, and the state of the replicas
+        stats = dict( [ (name, pool_proxy.getStats()) for name, pool_proxy in self.pools.items() ] )
+        if self.replicas is not None:
+            stats.update(self.replicas.getStats())
+        return stats
+
+
+    def registerStatement(self, name, query):
+        # the query is executed as a prepared statement with the given name,
+        # plugins register their fixed queries when they are constructed
+        return self.statements.register(name, query)
+
+
+    def getStatementStats(self):
+        # call count and execution time of the registered statements
+        return self.statements.getStats()
+
+
+    def _query(self, txn, query, query_args):
+        # executed in a pool thread, so the rows are converted there as well
+        # numeric values are converted by the typecaster of the connection,
+        # other columns are only converted if they are not of a plain type
+        self.statements.execute(txn, query, query_args)
+        rows = txn.fetchall()
+        return typecast.convertRows(rows, typecast.columnConverters(txn.description))
+
+
+    def _dictquery(self, txn, query, query_args):
+        # executed in a pool thread
+        rows = self._query(txn, query, query_args)
+        names = [ column[0] for column in txn.description ]
+        return [ dict(zip(names, row)) for row in rows ]
+
+
+    def query(self, query, query_args=None, retry=False, pool=READ_POOL):
+        # queries run in the read pool, unless another pool is given (e.g., the
+        # aggregation pool for the queries of the aggregation updaters)
+        return self._runQuery(self._query, query, query_args, retry, pool)
+
+
+    def _getReplica(self, pool):
+        # reads are run on a healthy replica, if there is one
+        if pool != READ_POOL or self.replicas is None:
+            return None
+        return self.replicas.getReplica()
+
+
+    def _replicaFailed(self, replica, e):
+        # returns the pool to run the query in instead of the replica
+        if replicas.isConnectionError(e):
+            self.replicas.replicaFailed(replica, str(e).strip())
+        else:
+            log.msg('Query failed on replica %s (%s), retrying on the primary' % (replica.pool_proxy.name, str(e).strip()),
+                    system='sgas.PostgreSQLDatabase')
+        return self.pools[READ_POOL]
+
+
+    @defer.inlineCallbacks
+    def _runQuery(self, interaction, query, query_args, retry, pool, replica_failed=False):
+        replica = None if replica_failed else self._getReplica(pool)
+        pool_proxy = self.pools[pool] if replica is None else replica.pool_proxy
         try:
-            query_result = yield self.pool_proxy.dbpool.runQuery(query, query_args)
-            results = []
-            for row in query_result:
-                results.append( [ buildValue(e) for e in row ] )
+            results = yield pool_proxy.runInteraction(interaction, query, query_args)
             defer.returnValue(results)
-        except (psycopg2.InterfaceError, psycopg2.OperationalError), e:
+        except (psycopg2.InterfaceError, psycopg2.OperationalError, error.DatabaseBusyError), e:
+            if replica is not None:
+                self._replicaFailed(replica, e)
+                results = yield self._runQuery(interaction, query, query_args, retry, pool, replica_failed=True)
+                defer.returnValue(results)
+            if isinstance(e, error.DatabaseBusyError):
+                raise
             # this usually happens if the database was restarted,
             # and the existing connection to the database was closed
             if not retry:
                 log.msg('Got interface error while querying database(%s), attempting to reconnect' % str(e), system='sgas.PostgreSQLDatabase')
-                self.pool_proxy.reconnect()
-                yield self.query(query, query_args, retry=True)
+                pool_proxy.reconnect()
+                results = yield self._runQuery(interaction, query, query_args, True, pool, replica_failed)
+                defer.returnValue(results)
             if retry:
                 log.msg('Got interface error after retrying to connect, bailing out.', system='sgas.PostgreSQLDatabase')
                 raise error.DatabaseUnavailableError(str(e))
 
+    def _insertRecords(self, txn, proc, arg_list):
+        # executed in a pool thread, so it is safe to block
+        id_dict = {}
+        for args in arg_list:
+            txn.callproc(proc, args)
+            r = txn.fetchall()
+            record_id, row_id = r[0][0]
+            id_dict[record_id] = str(row_id)
+        return id_dict
+
+
+    def _insertResolvedRecords(self, txn, proc, arg_list, dimensions, pending):
+        # executed in a pool thread, so it is safe to block
+        # dimension values are replaced with their ids before calling the procedure
+        pending.clear() # in case of retry
+        lookup = self.dimension_cache.lookup
+        resolved_list = []
+        for args in arg_list:
+            args = list(args)
+            for idx, table, _ in dimensions:
+                value = args[idx]
+                if type(value) in (list, tuple):
+                    args[idx] = [ lookup(txn, table, v, pending) for v in value if v is not None ]
+                else:
+                    args[idx] = lookup(txn, table, value, pending)
+            resolved_list.append(args)
+        return self._insertRecords(txn, proc, resolved_list)
+
+
+    def _copyInsertRecords(self, txn, staging_table, columns, proc, arg_list):
+        # executed in a pool thread, so it is safe to block
+        txn.execute("SELECT nextval(%s)", (staging_table + '_batch_seq',))
+        batch_id = txn.fetchall()[0][0]
+
+        data = copyformat.encodeRows(arg_list, prefix=(batch_id,))
+        txn.copy_from(StringIO.StringIO(data), staging_table, columns=['batch_id'] + columns)
+
+        txn.callproc(proc, (batch_id,))
+        id_dict = {}
+        for record_id, row_id in txn.fetchall():
+            id_dict[record_id] = str(row_id)
+        return id_dict
+
+
     @defer.inlineCallbacks
-    def recordInserter(self, type, proc, arg_list, retry=False):
+    def _runInteraction(self, interaction, args, retry=False, pool=INGEST_POOL):
+        # the entire transaction is run in a thread from the pool,
+        # so the reactor is free to serve other requests while inserting
+        pool_proxy = self.pools[pool]
         try:
-            id_dict = {}
-            conn = adbapi.Connection(self.pool_proxy.dbpool)
-            try:
-                trans = adbapi.Transaction(self, conn)
-
-                for args in arg_list:
-                    yield trans.callproc(proc, args)
-                    r = yield trans.fetchall()
-                    record_id, row_id = r[0][0]
-                    id_dict[record_id] = str(row_id)
-
-                trans.close()
-                conn.commit()
-                log.msg('Database: %i %s records inserted' % (len(id_dict), type), system='sgas.PostgreSQLDatabase')
-                defer.returnValue(id_dict)
-            except psycopg2.InterfaceError:
-                # this usually implies that the connection is closed (can't rollback)
-                raise
-            except:
-                conn.rollback()
-                raise
+            result = yield pool_proxy.runInteraction(interaction, *args)
+            defer.returnValue(result)
 
         except psycopg2.OperationalError, e:
             if 'Connection refused' in str(e):
@@ -141,95 +386,146 @@ class PostgreSQLDatabase(service.MultiService):
         except psycopg2.InterfaceError, e:
             # this usually happens if the database was restarted,
             # and the existing connection to the database was closed
-            if not retry:
-                log.msg('Got interface error while attempting insert: %s.' % str(e), system='sgas.PostgreSQLDatabase')
-                log.msg('Attempting to reconnect.', system='sgas.PostgreSQLDatabase')
-                self.pool_proxy.reconnect()
-                yield self.insertJobUsageRecords(usagerecord_docs, retry=True)
             if retry:
                 log.msg('Got interface error after retrying to connect, bailing out.', system='sgas.PostgreSQLDatabase')
                 raise error.DatabaseUnavailableError(str(e))
 
+            log.msg('Got interface error while attempting insert: %s.' % str(e), system='sgas.PostgreSQLDatabase')
+            log.msg('Attempting to reconnect.', system='sgas.PostgreSQLDatabase')
+            pool_proxy.reconnect()
+            result = yield self._runInteraction(interaction, args, retry=True, pool=pool)
+            defer.returnValue(result)
+
+        except error.DatabaseUnavailableError:
+            # rejected as the pool is busy, or the database is down, which is
+            # expected under load and is handled by the caller (503)
+            raise
         except Exception, e:
             log.msg('Unexpected database error', system='sgas.PostgreSQLDatabase')
             log.err(e, system='sgas.PostgreSQLDatabase')
             raise
 
-    @defer.inlineCallbacks
-    def dictquery(self, query, query_args=None, retry=False):
-
-        def buildValue(value):
-            if type(value) in (unicode, str, int, long, float, bool, types.NoneType):
-                return value
-            if isinstance(value, decimal.Decimal):
-                sv = str(value)
-                return int(sv) if sv.isalnum() else float(sv)
-            # bad catch-all
-            return str(value)
-
-        def conn(conn, query, query_args):
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cur.execute(query,query_args)
-            return cur.fetchall()
 
-        try:
-            query_result = yield self.pool_proxy.dbpool.runWithConnection(conn, query, query_args)
-            results = []
-            for row in query_result:
-                results.append(dict([(k,buildValue(row[k])) for k in row]))
-            defer.returnValue(results)
-        except (psycopg2.InterfaceError, psycopg2.OperationalError), e:
-            # this usually happens if the database was restarted,
-            # and the existing connection to the database was closed
-            if not retry:
-                log.msg('Got interface error while querying database(%s), attempting to reconnect' % str(e), system='sgas.PostgreSQLDatabase')
-                self.pool_proxy.reconnect()
-                yield self.query(query, query_args, retry=True)
-            if retry:
-                log.msg('Got interface error after retrying to connect, bailing out.', system='sgas.PostgreSQLDatabase')
-                raise error.DatabaseUnavailableError(str(e))
+    def _runInsertInteraction(self, type, interaction, args, retry=False):
+
+        def logInsert(id_dict):
+            log.msg('Database: %i %s records inserted' % (len(id_dict), type), system='sgas.PostgreSQLDatabase')
+            return id_dict
+
+        d = self._runInteraction(interaction, args, retry)
+        d.addCallback(logInsert)
+        return d
+
+
+    def recordInserter(self, type, proc, arg_list, dimensions=None, retry=False):
+        # inserts records one by one, using the given stored procedure
+        # if dimensions are given, the dimension values are passed to the procedure as ids
+        # inserts from concurrent requests are grouped into one transaction
+        return self.group_committer.insert(type, proc, arg_list, dimensions)
+
+
+    def directRecordInserter(self, type, proc, arg_list, dimensions=None, retry=False):
+        # like recordInserter, but the records are inserted in their own transaction
+        if dimensions is None:
+            return self._runInsertInteraction(type, self._insertRecords, (proc, arg_list), retry)
+
+        def updateCache(id_dict):
+            # the transaction has been committed, so the new ids are valid
+            self.dimension_cache.update(pending)
+            return id_dict
+
+        pending = {}
+        d = self._runInsertInteraction(type, self._insertResolvedRecords, (proc, arg_list, dimensions, pending), retry)
+        d.addCallback(updateCache)
+        return d
+
+
+    def bulkRecordInserter(self, type, staging_table, columns, proc, arg_list, retry=False):
+        # copies all records into a staging table, and then calls the stored
+        # procedure with the batch id, which should move the records in place
+        return self._runInsertInteraction(type, self._copyInsertRecords, (staging_table, columns, proc, arg_list), retry)
+
+
+    def dictquery(self, query, query_args=None, retry=False, pool=READ_POOL):
+        return self._runQuery(self._dictquery, query, query_args, retry, pool)
+
+
+    def streamQuery(self, query, query_args=None, dict_rows=False):
+        # returns a stream of the rows of the query, which are fetched in
+        # batches from a server side cursor when the stream is started
+        replica = self._getReplica(READ_POOL)
+        if replica is None:
+            return querystream.QueryStream(self.pools[READ_POOL], query, query_args, dict_rows)
+        return querystream.QueryStream(replica.pool_proxy, query, query_args, dict_rows,
+                                       fallback=lambda e : self._replicaFailed(replica, e))
+
+
+    def runInteraction(self, interaction, *args):
+        # runs interaction(txn, *args) in a thread of the aggregation pool, in
+        # a transaction of its own (used for background updates)
+        return self._runInteraction(interaction, args, pool=AGGREGATION_POOL)
+
+
+    def _updateAggregationBatch(self, txn, aggregator, args):
+        # executed in a pool thread, so it is safe to block
+        # the aggregation functions lock the machines they update against
+        # concurrent inserts, so the default isolation level is used
+        txn.execute('SET LOCAL statement_timeout = %s', (AGGREGATION_TRANSACTION_TIMEOUT * 1000,))
+        txn.callproc(aggregator, args)
+        return txn.fetchall()[0][0]
 
 
     @defer.inlineCallbacks
-    def updateAggregator(self,aggregator,service=None,retry=False):
-        try:
-            conn = adbapi.Connection(self.pool_proxy.dbpool)
-            while True:
-                try:
-                    txn = adbapi.Transaction(self, conn)
-
-                    # the update_uraggregate function requires serializable isolation level
-                    # in order to execute correctly
-                    txn.execute(SQL_SERIALIZABLE_TRANSACTION)
-                    yield txn.callproc(aggregator)
-                    idmn = txn.fetchall()
-                    txn.close()
-                    conn.commit()
-
-                    if idmn in (None, [(None,)]): # empty array -> response when all done
-                        break
-                    else:
-                        insert_date, machine_name = idmn[0][0]
-                        log.msg('Aggregation(%s) updated: %s / %s' % (aggregator,insert_date, machine_name), system='sgas.AggregationUpdater')
-                    if service and service.stopping:
-                        break
-                except psycopg2.InterfaceError, e:
-                    # typically means we lost the connection due to a db restart
-                    if retry:
-                        log.msg('Reconnect in update failed, bailing out.', system='sgas.AggregationUpdater')
-                        raise
-                    else:
-                        log.msg('Got InterfaceError while attempting update: %s.' % str(e), system='sgas.AggregationUpdater')
-                        log.msg('Attempting reconnect.', system='sgas.AggregationUpdater')
-                        retry = True
-                        self.pool_proxy.reconnect()
-                except:
-                    conn.rollback()
+    def updateAggregatorBatch(self, aggregator, args, service=None, report=None, retried=None):
+        # calls the aggregation function with args, each call in its own transaction,
+        # until there is nothing left to update, returns the sum of the results
+        # (the number of updated pairs or added records). the last argument is
+        # the batch size, which is lowered when the transactions take longer
+        # than AGGREGATION_TRANSACTION_TIME (but never raised above the given
+        # size). report is called with the result and duration of each transaction,
+        # and retried with the reason ('timeout' or 'serialization') of each retry
+        max_batch_size = batch_size = args[-1]
+        total = 0
+        attempt = 0
+        while not (service and service.stopping):
+            t0 = time.time()
+            try:
+                n = yield self._runInteraction(self._updateAggregationBatch, (aggregator, args[:-1] + (batch_size,)),
+                                               pool=AGGREGATION_POOL)
+            except psycopg2.extensions.QueryCanceledError, e:
+                # the transaction timed out, retry with a smaller batch
+                if batch_size is None or batch_size <= 1:
                     raise
+                batch_size = batch_size // 2
+                if retried is not None:
+                    retried('timeout')
+                log.msg('Aggregation(%s) timed out, retrying with batch size %i' % (aggregator, batch_size), system='sgas.AggregationUpdater')
+                continue
+            except psycopg2.extensions.TransactionRollbackError, e:
+                # serialization failure or deadlock with concurrent transactions
+                attempt += 1
+                if attempt > SERIALIZATION_RETRIES:
+                    log.msg('Aggregation(%s) failed after %i attempts, bailing out.' % (aggregator, attempt), system='sgas.AggregationUpdater')
+                    raise
+                log.msg('Serialization failure in aggregation(%s), retrying: %s' % (aggregator, str(e).strip()), system='sgas.AggregationUpdater')
+                if retried is not None:
+                    retried('serialization')
+                yield task.deferLater(reactor, SERIALIZATION_RETRY_DELAY * attempt, lambda : None)
+                continue
+
+            attempt = 0
+            duration = time.time() - t0
+            if report is not None:
+                report(n, duration)
+            if not n:
+                break
+            total += n
+            log.msg('Aggregation(%s(%s)) updated: %i (%.2f seconds)' % (aggregator, ', '.join(map(str, args[:-1] + (batch_size,))), n, duration), system='sgas.AggregationUpdater')
+            if batch_size is not None and n == batch_size:
+                # full batch, the size is proportional to the transaction time,
+                # but at most doubled, as the time per item varies
+                target_size = int(batch_size * AGGREGATION_TRANSACTION_TIME / max(duration, 0.001))
+                batch_size = max(1, min(max_batch_size, 2 * batch_size, target_size))
+
+        defer.returnValue(total)
 
-        except Exception, e:
-            log.err(e, system='sgas.AggregationUpdater')
-            raise
-
-        finally:
-            conn.close()
@@ -0,0 +1,133 @@
+"""
+In-process cache of dimension table ids.
+
+The dimension tables (machinename, localuser, jobstatus, ...) are small and
+rarely change, so instead of looking up every value in the database for every
+record, the value -> id maps are cached here. Values not in the cache are
+resolved (and created if needed) in the insert transaction. New entries are
+only added to the cache once that transaction has been committed, so ids from
+a rolled back transaction never end up in the cache.
+"""
+
+import threading
+import collections
+
+from twisted.python import log
+
+
+# max number of entries per dimension table
+DEFAULT_CACHE_SIZE = 10000
+
+SQL_WARM    = '''SELECT %(column)s, id FROM %(table)s ORDER BY id DESC LIMIT %%s'''
+SQL_INSERT  = '''INSERT INTO %(table)s (%(column)s) VALUES (%%s) ON CONFLICT (%(column)s) DO NOTHING RETURNING id'''
+SQL_SELECT  = '''SELECT id FROM %(table)s WHERE %(column)s = %%s'''
+
+
+
+def _key(value):
+    # the database returns utf-8 strings, records contain unicode
+    if type(value) is str:
+        return value.decode('utf-8')
+    return value
+
+
+
+class DimensionCache:
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self.columns = {}
+        self.caches = {}
+        # lookups happen in the pool threads
+        self.lock = threading.Lock()
+
+
+    def addDimension(self, table, column):
+        if table in self.columns:
+            return
+        self.columns[table] = column
+        self.caches[table] = collections.OrderedDict()
+
+
+    def _add(self, table, value, id_):
+        # lock must be held
+        cache = self.caches[table]
+        cache.pop(value, None)
+        cache[value] = id_
+        if len(cache) > self.size:
+            cache.popitem(last=False)
+
+
+    def warm(self, txn):
+        # executed in a pool thread, so it is safe to block
+        entries = 0
+        for table, column in self.columns.items():
+            txn.execute(SQL_WARM % {'table': table, 'column': column}, (self.size,))
+            rows = txn.fetchall()
+            self.lock.acquire()
+            try:
+                for value, id_ in reversed(rows):
+                    self._add(table, _key(value), id_)
+            finally:
+                self.lock.release()
+            entries += len(rows)
+        log.msg('Dimension cache warmed with %i entries' % entries, system='sgas.DimensionCache')
+
+
+    def lookup(self, txn, table, value, pending):
+        """
+        Get the id of a value in a dimension table. Values which are not in the
+        cache are resolved in the given transaction and added to pending,
+        which should be passed to update() once the transaction is committed.
+        """
+        if value is None:
+            return None
+
+        key = _key(value)
+        self.lock.acquire()
+        try:
+            cache = self.caches[table]
+            id_ = cache.pop(key, None)
+            if id_ is not None:
+                cache[key] = id_ # move to most recently used
+                return id_
+        finally:
+            self.lock.release()
+
+        try:
+            return pending[(table, key)]
+        except KeyError:
+            pass
+
+        sql_args = {'table': table, 'column': self.columns[table]}
+        txn.execute(SQL_INSERT % sql_args, (value,))
+        rows = txn.fetchall()
+        if not rows:
+            # already exists (or was created by a concurrent transaction)
+            txn.execute(SQL_SELECT % sql_args, (value,))
+            rows = txn.fetchall()
+        id_ = rows[0][0]
+        pending[(table, key)] = id_
+        return id_
+
+
+    def update(self, pending):
+        """
+        Add entries resolved in a committed transaction to the cache.
+        """
+        self.lock.acquire()
+        try:
+            for (table, key), id_ in pending.items():
+                self._add(table, key, id_)
+        finally:
+            self.lock.release()
+
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            for cache in self.caches.values():
+                cache.clear()
+        finally:
+            self.lock.release()
+
@@ -0,0 +1,129 @@
+"""
+Group commit of record inserts.
+
+Registrations typically contain few records, so when many loggers register at
+the same time, most of the database time is spent on committing tiny
+transactions. The group committer collects the inserts of concurrent requests
+for a few milliseconds (or until enough records have been collected), and
+inserts them in a single transaction. Each request is inserted within its own
+savepoint, so an error in one request only fails that request.
+"""
+
+from twisted.python import log, failure
+from twisted.internet import defer, reactor
+
+
+# how long to wait for more requests, before inserting (seconds)
+GROUP_COMMIT_DELAY = 0.005
+# insert right away when this many records have been collected
+GROUP_COMMIT_MAX_RECORDS = 100
+
+SAVEPOINT           = 'SAVEPOINT group_commit'
+RELEASE_SAVEPOINT   = 'RELEASE SAVEPOINT group_commit'
+ROLLBACK_SAVEPOINT  = 'ROLLBACK TO SAVEPOINT group_commit'
+
+
+
+class _Group:
+
+    def __init__(self, type, proc, dimensions):
+        self.type = type
+        self.proc = proc
+        self.dimensions = dimensions
+        self.requests = [] # (arg_list, deferred)
+        self.n_records = 0
+        self.call = None
+
+
+
+class GroupCommitter:
+
+    def __init__(self, db, delay=GROUP_COMMIT_DELAY, max_records=GROUP_COMMIT_MAX_RECORDS):
+        self.db = db
+        self.delay = delay
+        self.max_records = max_records
+        self.groups = {}
+
+
+    def insert(self, type, proc, arg_list, dimensions=None):
+        """
+        Insert records using the given stored procedure (see
+        PostgreSQLDatabase.recordInserter). Returns a deferred, which fires
+        with the record_id -> row_id dictionary of the given records.
+        """
+        key = (type, proc, tuple(dimensions or ()))
+        group = self.groups.get(key)
+        if group is None:
+            group = _Group(type, proc, dimensions)
+            self.groups[key] = group
+
+        d = defer.Deferred()
+        group.requests.append( (arg_list, d) )
+        group.n_records += len(arg_list)
+
+        if group.n_records >= self.max_records:
+            self._flush(key)
+        elif group.call is None:
+            group.call = reactor.callLater(self.delay, self._flush, key)
+        return d
+
+
+    def flushAll(self):
+        # inserts all collected requests right away, returns a deferred which
+        # fires when the transactions are done (e.g., before shutting down)
+        return defer.DeferredList([ self._flush(key) for key in self.groups.keys() ])
+
+
+    def _flush(self, key):
+        group = self.groups.pop(key)
+        if group.call is not None and group.call.active():
+            group.call.cancel()
+
+        arg_lists = [ arg_list for arg_list, _ in group.requests ]
+        pending = {}
+
+        def insertDone(results):
+            # the transaction has been committed, so the new dimension ids are valid
+            self.db.dimension_cache.update(pending)
+            n_records = 0
+            for (ok, result), (_, d) in zip(results, group.requests):
+                if ok:
+                    n_records += len(result)
+                    d.callback(result)
+                else:
+                    d.errback(result)
+            log.msg('Database: %i %s records inserted (%i requests in one transaction)' % (n_records, group.type, len(results)),
+                    system='sgas.PostgreSQLDatabase')
+
+        def insertError(error):
+            # the transaction failed, so all requests fail
+            for _, d in group.requests:
+                d.errback(error)
+
+        d = self.db._runInteraction(self._insertGroup, (group.proc, group.dimensions, arg_lists, pending))
+        d.addCallbacks(insertDone, insertError)
+        return d
+
+
+    def _insertGroup(self, txn, proc, dimensions, arg_lists, pending):
+        # executed in a pool thread, so it is safe to block
+        pending.clear() # in case of retry
+        results = []
+        for arg_list in arg_lists:
+            request_pending = {}
+            txn.execute(SAVEPOINT)
+            try:
+                if dimensions:
+                    id_dict = self.db._insertResolvedRecords(txn, proc, arg_list, dimensions, request_pending)
+                else:
+                    id_dict = self.db._insertRecords(txn, proc, arg_list)
+            except Exception:
+                # if the connection is broken this fails as well, failing the whole group
+                txn.execute(ROLLBACK_SAVEPOINT)
+                results.append( (False, failure.Failure()) )
+            else:
+                txn.execute(RELEASE_SAVEPOINT)
+                pending.update(request_pending)
+                results.append( (True, id_dict) )
+        return results
+
@@ -0,0 +1,139 @@
+"""
+Listener for PostgreSQL notifications (LISTEN/NOTIFY).
+
+The adbapi connection pool cannot be used for listening, as the connections
+are only used from the pool threads, and notifications are only delivered when
+a connection is used. Instead the listener has its own connection, which is
+added to the reactor as a reader, so notifications are delivered as soon as
+they arrive.
+
+The connection is made and the channel is listened to in a thread, as these
+block. If the connection is lost, the listener reconnects after a while.
+"""
+
+import psycopg2
+
+from zope.interface import implementer
+
+from twisted.python import log, failure
+from twisted.internet import interfaces, reactor, threads
+
+
+# seconds to wait before reconnecting, after the connection has been lost
+RECONNECT_DELAY = 30
+
+
+
+@implementer(interfaces.IReadDescriptor)
+class NotificationListener:
+
+    def __init__(self, connect, channel, notified, connected=None):
+        # notified is called with the number of notifications received, and
+        # connected is called when (re)connected, as notifications could have
+        # been missed while not listening
+        self.connect = connect
+        self.channel = channel
+        self.notified = notified
+        self.connected = connected or (lambda : None)
+
+        self.conn = None
+        self.listening = False
+        self.stopping = False
+        self.reconnect_call = None
+
+
+    def startListening(self):
+
+        self.stopping = False
+        d = threads.deferToThread(self._listen)
+        d.addCallbacks(self._listening, self._failed)
+        return d
+
+
+    def stopListening(self):
+
+        self.stopping = True
+        if self.reconnect_call is not None:
+            self.reconnect_call.cancel()
+            self.reconnect_call = None
+        self._close()
+
+
+    def _listen(self):
+        # executed in a thread
+        conn = self.connect()
+        conn.autocommit = True
+        conn.cursor().execute('LISTEN %s' % self.channel)
+        return conn
+
+
+    def _listening(self, conn):
+
+        if self.stopping:
+            conn.close()
+            return
+        self.conn = conn
+        self.listening = True
+        reactor.addReader(self)
+        log.msg('Listening for notifications on %s' % self.channel, system='sgas.NotificationListener')
+        self.connected()
+
+
+    def _failed(self, error):
+
+        log.msg('Error listening for notifications on %s: %s' % (self.channel, error.getErrorMessage()), system='sgas.NotificationListener')
+        self._close()
+        if not self.stopping:
+            self.reconnect_call = reactor.callLater(RECONNECT_DELAY, self._reconnect)
+
+
+    def _reconnect(self):
+
+        self.reconnect_call = None
+        self.startListening()
+
+
+    def _close(self):
+
+        if self.conn is not None:
+            reactor.removeReader(self)
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass # the connection is broken, which is why it is closed
+        self.conn = None
+        self.listening = False
+
+
+    # -- IReadDescriptor
+
+    def fileno(self):
+        if self.conn is None:
+            return -1
+        return self.conn.fileno()
+
+
+    def doRead(self):
+
+        try:
+            self.conn.poll()
+        except psycopg2.Error, e:
+            self._failed(failure.Failure(e))
+            return
+
+        n_notifications = len(self.conn.notifies)
+        del self.conn.notifies[:]
+        if n_notifications:
+            self.notified(n_notifications)
+
+
+    def connectionLost(self, reason):
+        # the reactor is shutting down
+        self.conn = None
+        self.listening = False
+
+
+    def logPrefix(self):
+        return 'sgas.NotificationListener'
+
+
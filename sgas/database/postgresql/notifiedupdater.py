@@ -0,0 +1,133 @@
+"""
+Base of the services which update derived tables in the background.
+
+The database marks what must be updated, and notifies a channel (see
+sgas.database.postgresql.listener). The updater schedules an update a while
+after being notified, so changes close together are updated together, and only
+runs one update at a time: notifications during an update schedule the next
+update when it is done. Subclasses give the channel, and the update itself.
+"""
+
+from twisted.python import log
+from twisted.internet import defer, reactor
+from twisted.application import service
+
+from sgas.database.postgresql import database, listener
+
+
+# seconds to wait before updating, so changes close together are updated together
+UPDATE_DELAY = 20
+# seconds to wait before updating again, when an update has failed
+RETRY_DELAY = 120
+
+
+
+class NotifiedUpdater(service.Service):
+
+    # set by subclasses
+    notify_channel  = None
+    description     = 'derived data'
+    log_system      = 'sgas.NotifiedUpdater'
+    update_delay    = UPDATE_DELAY
+    retry_delay     = RETRY_DELAY
+
+    def __init__(self, db):
+        self.db          = db
+        self.need_update = False
+        self.updating    = False
+        self.stopping    = False
+        self.update_call = None
+        self.update_def  = None
+        self.listener    = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+        self.listener = listener.NotificationListener(database.connector(self.db.pool_proxy.connect_info),
+                                                      self.notify_channel, self.notification, self.listenerConnected)
+        self.listener.startListening()
+        # changes could have been made while not running, so an update is
+        # always scheduled when starting
+        self.scheduleUpdate(self.update_delay)
+        return defer.succeed(None)
+
+
+    def stopService(self):
+        self.stopping = True
+        service.Service.stopService(self)
+        if self.update_call is not None:
+            self.update_call.cancel()
+        if self.listener is not None:
+            self.listener.stopListening()
+        return defer.DeferredList([ d for d in (self.update_def,) if d is not None ])
+
+
+    def notification(self, n_transactions):
+        # n_transactions transactions (here or elsewhere) have notified the channel
+        self.updateNotification()
+
+
+    def listenerConnected(self):
+        # notifications could have been missed while not listening
+        self.updateNotification()
+
+
+    def updateNotification(self):
+        # the data needs to be updated. a running update schedules the next
+        # update when it is done
+        self.need_update = True
+        if not self.updating:
+            self.scheduleUpdate(self.updateDelay())
+
+
+    def updateDelay(self):
+        return self.update_delay
+
+
+    def scheduleUpdate(self, delay=None):
+        # only schedule call if no other call is planned
+        if delay is None:
+            delay = self.update_delay
+        if self.update_call is None:
+            log.msg('Scheduling update for %s in %i seconds.' % (self.description, delay), system=self.log_system)
+            self.update_call = reactor.callLater(delay, self.performUpdate, True)
+
+
+    def performUpdate(self, remove_call=False):
+        if remove_call:
+            self.update_call = None
+        if self.updating:
+            # the running update schedules this update when it is done
+            self.need_update = True
+            return defer.succeed(None)
+
+        self.updating = True
+        self.need_update = False
+
+        def updateDone(result):
+            self.updating = False
+            self.update_def = None
+            if self.need_update and not self.stopping:
+                # notified while updating
+                self.scheduleUpdate(self.updateDelay())
+            return result
+
+        def updateError(error):
+            log.msg('Error updating %s: %s' % (self.description, error.getErrorMessage()), system=self.log_system)
+            if not self.stopping:
+                self.scheduleUpdate(delay=self.retry_delay)
+
+        d = defer.maybeDeferred(self.update)
+        d.addBoth(updateDone)
+        d.addErrback(updateError)
+        if self.updating:
+            self.update_def = d
+        return d
+
+
+    def update(self):
+        """
+        Performs the update, returns a deferred which fires when done.
+        """
+        raise NotImplementedError('update not implemented in %s' % self.__class__.__name__)
+
@@ -0,0 +1,197 @@
+"""
+Streaming of query results.
+
+Large query results are not fetched all at once, but through a server side
+cursor in batches of STREAM_BATCH_SIZE rows. The rows are read in a pool
+thread and delivered to the reactor one batch at a time. The next batch is
+not fetched until the delivery of the previous one has been acknowledged,
+so a consumer which is paused (e.g., a slow HTTP client) also pauses the
+reading, and only a batch or two are ever kept in memory.
+
+A paused stream keeps a connection of the pool, and a transaction open, so
+a stream which stays paused for more than STREAM_MAX_PAUSE seconds (e.g., a
+client which has stopped reading) is stopped, and fails with
+QueryStreamTimeout, so the consumer can drop its connection.
+
+The cursor is declared with DECLARE ... NO SCROLL CURSOR and read with FETCH
+FORWARD, which is what psycopg2 does for its named cursors, but works with
+the transaction objects of the Twisted connection pool.
+"""
+
+import itertools
+
+import psycopg2
+
+from twisted.python import log
+from twisted.internet import defer, reactor, threads
+
+from sgas.database import error
+from sgas.database.postgresql import typecast
+
+
+STREAM_BATCH_SIZE = 1000
+# seconds a stream may stay paused, before it is stopped and its connection
+# to the database released
+STREAM_MAX_PAUSE = 60
+
+_cursor_ids = itertools.count(1)
+
+
+
+class QueryStreamStopped(Exception):
+    """
+    Raised in the pool thread when the stream has been stopped, in order to
+    roll back the transaction.
+    """
+
+
+
+class QueryStreamTimeout(Exception):
+    """
+    The stream was stopped, as it stayed paused for too long.
+    """
+
+
+
+class QueryStream:
+    """
+    The rows of a query, fetched from a server side cursor.
+
+    start(deliver) starts the query, deliver is called in the reactor with a
+    list of rows for each batch. The deferred returned from start fires with
+    the number of delivered rows when all rows have been delivered, or
+    errbacks if the query fails. The stream can be paused and resumed between
+    the batches, and stopped.
+
+    If fallback is given, it is called with the error if the query fails
+    before anything has been delivered, and should return the pool proxy to
+    run the query in instead (used when the query is run on a replica).
+    """
+    def __init__(self, pool_proxy, query, query_args=None, dict_rows=False, batch_size=STREAM_BATCH_SIZE, fallback=None):
+        self.pool_proxy = pool_proxy
+        self.fallback = fallback
+        self.query = query
+        self.query_args = query_args
+        self.dict_rows = dict_rows
+        self.batch_size = batch_size
+
+        self.deliver = None
+        self.paused = None # deferred which fires on resume
+        self.pause_timeout = None
+        self.timed_out = False
+        self.stopped = False
+        self.clock = reactor
+        self.rows = 0
+        self.batches = 0
+
+
+    def start(self, deliver):
+        self.deliver = deliver
+        # a stream which is paused while the reactor is stopped, would keep
+        # its pool thread waiting, and with that the shutdown of the pool
+        trigger = reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+        def streamDone(result):
+            reactor.removeSystemEventTrigger(trigger)
+            return result
+
+        def streamStopped(failure):
+            failure.trap(QueryStreamStopped)
+            if self.timed_out:
+                raise QueryStreamTimeout('Query stream paused for more than %i seconds' % STREAM_MAX_PAUSE)
+
+        d = self._runStream()
+        d.addBoth(streamDone)
+        d.addErrback(streamStopped)
+        d.addCallback(lambda _ : self.rows)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _runStream(self, retry=False):
+        try:
+            yield self.pool_proxy.runInteraction(self._streamRows)
+        except (psycopg2.InterfaceError, psycopg2.OperationalError, error.DatabaseBusyError), e:
+            if self.fallback is not None and not self.batches:
+                self.pool_proxy = self.fallback(e)
+                self.fallback = None
+                yield self._runStream(retry)
+                return
+            if isinstance(e, error.DatabaseBusyError):
+                raise
+            # this usually happens if the database was restarted, the query
+            # can only be retried if nothing has been delivered yet
+            if retry or self.batches:
+                log.msg('Got interface error while streaming query, bailing out.', system='sgas.PostgreSQLDatabase')
+                raise error.DatabaseUnavailableError(str(e))
+            log.msg('Got interface error while streaming query(%s), attempting to reconnect' % str(e), system='sgas.PostgreSQLDatabase')
+            self.pool_proxy.reconnect()
+            yield self._runStream(retry=True)
+
+
+    def pause(self):
+        if self.paused is None and not self.stopped:
+            self.paused = defer.Deferred()
+            self.pause_timeout = self.clock.callLater(STREAM_MAX_PAUSE, self._pauseTimedOut)
+
+
+    def _pauseTimedOut(self):
+        self.pause_timeout = None
+        self.timed_out = True
+        log.msg('Query stream paused for more than %i seconds, stopping it' % STREAM_MAX_PAUSE, system='sgas.PostgreSQLDatabase')
+        self.stop()
+
+
+    def resume(self):
+        if self.pause_timeout is not None:
+            self.pause_timeout.cancel()
+            self.pause_timeout = None
+        if self.paused is not None:
+            d, self.paused = self.paused, None
+            d.callback(True)
+
+
+    def stop(self):
+        self.stopped = True
+        self.resume()
+
+
+    def _deliverBatch(self, rows):
+        # called in the reactor, returns when the next batch can be fetched
+        if not self.stopped:
+            self.rows += len(rows)
+            self.batches += 1
+            self.deliver(rows)
+        if self.paused is not None:
+            return self.paused
+        return not self.stopped
+
+
+    def _streamRows(self, txn):
+        # executed in a pool thread, blocks while the stream is paused
+        cursor_name = 'sgas_stream_%i' % _cursor_ids.next()
+        # no string formatting, the query may contain escaped %'s
+        txn.execute('DECLARE ' + cursor_name + ' NO SCROLL CURSOR FOR ' + self.query, self.query_args)
+        fetch = 'FETCH FORWARD %i FROM %s' % (self.batch_size, cursor_name)
+
+        converters = names = None
+        while True:
+            txn.execute(fetch)
+            rows = txn.fetchall()
+            if converters is None:
+                # the description of the cursor is only known after the first fetch
+                converters = typecast.columnConverters(txn.description)
+                names = [ column[0] for column in txn.description ]
+            rows = typecast.convertRows(rows, converters)
+            if self.dict_rows:
+                rows = [ dict(zip(names, row)) for row in rows ]
+
+            if rows:
+                proceed = threads.blockingCallFromThread(reactor, self._deliverBatch, rows)
+                if not proceed or self.stopped:
+                    log.msg('Query stream stopped after %i rows' % self.rows, system='sgas.PostgreSQLDatabase')
+                    raise QueryStreamStopped()
+            if len(rows) < self.batch_size:
+                break
+
+        txn.execute('CLOSE ' + cursor_name)
@@ -0,0 +1,168 @@
+"""
+Rebuild of the aggregation table.
+
+The aggregation table is rebuilt into a shadow table, one insert date
+(partition) at a time, by several connections in parallel. Each partition is
+built and checkpointed in a single transaction, so a rebuild which has been
+interrupted is resumed by starting it again. When all partitions have been
+built, the shadow table is swapped in atomically.
+
+SGAS can keep running while the aggregation is rebuilt. Pairs which are
+updated while the rebuild is running, are updated again after the swap.
+
+The work is done by the rebuild_uraggregate functions in the database, this
+module drives them. The rebuild blocks, so it should be run in a thread
+when used from the server. The connections are created with the function
+given to the Rebuilder (see database.connector).
+"""
+
+import time
+import threading
+
+
+# number of connections building partitions
+REBUILD_WORKERS = 4
+# seconds between progress reports
+REPORT_INTERVAL = 30
+
+
+
+def abort(connect):
+
+    conn = connect()
+    try:
+        conn.cursor().callproc('rebuild_uraggregate_abort')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+
+class Rebuilder:
+
+    def __init__(self, connect, workers=REBUILD_WORKERS, report=None, report_interval=REPORT_INTERVAL):
+        if workers < 1:
+            raise ValueError('A rebuild needs at least one worker, got %s' % workers)
+        self.connect = connect
+        self.workers = workers
+        self.report = report or (lambda msg : None)
+        self.report_interval = report_interval
+
+        self.stopping = False
+        self.errors = []
+        self.lock = threading.Lock()
+
+        self.n_partitions   = 0
+        self.done           = 0
+        self.n_records      = 0
+        self.n_rows         = 0
+        self.start_time     = None
+        self.last_report    = None
+
+
+    def rebuild(self):
+        """
+        Rebuilds the aggregation table, resuming a rebuild in progress, and
+        swaps the rebuilt table in. Returns the number of pairs marked for
+        update after the swap, or None if the rebuild was stopped.
+        """
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.callproc('rebuild_uraggregate_start')
+            self.n_partitions = cur.fetchall()[0][0]
+            conn.commit()
+
+            self.report('Rebuilding aggregation table: %i partitions to build, %i workers' % (self.n_partitions, self.workers))
+            self.start_time = self.last_report = time.time()
+            self._runWorkers()
+
+            if self.errors:
+                raise self.errors[0]
+            if self.stopping:
+                self.report('Aggregation rebuild stopped after %i partitions, start the rebuild again to resume it' % self.done)
+                return None
+            self._reportProgress(final=True)
+
+            t0 = time.time()
+            cur.callproc('rebuild_uraggregate_swap')
+            n_pairs = cur.fetchall()[0][0]
+            conn.commit()
+            cur.execute('ANALYZE uraggregated_data')
+            conn.commit()
+            self.report('Rebuilt aggregation table swapped in (%.1f seconds), %i pairs marked for update' % (time.time() - t0, n_pairs))
+            return n_pairs
+        finally:
+            conn.close()
+
+
+    def stop(self):
+        # partitions being built are finished, so the rebuild can be resumed
+        self.stopping = True
+
+
+    def _runWorkers(self):
+
+        threads = [ threading.Thread(target=self._worker) for _ in range(self.workers) ]
+        for t in threads:
+            t.start()
+        try:
+            # join with a timeout, otherwise KeyboardInterrupt is not delivered
+            while [ t for t in threads if t.isAlive() ]:
+                for t in threads:
+                    t.join(1)
+        except KeyboardInterrupt:
+            self.stop()
+            for t in threads:
+                t.join()
+
+
+    def _worker(self):
+        # executed in its own thread, with its own connection
+        try:
+            conn = self.connect()
+            try:
+                cur = conn.cursor()
+                while not self.stopping:
+                    cur.callproc('rebuild_uraggregate_partition')
+                    rows = cur.fetchall()
+                    conn.commit()
+                    if not rows:
+                        break
+                    insert_date, n_records, n_rows = rows[0]
+                    self._partitionDone(n_records, n_rows)
+            finally:
+                conn.close()
+        except Exception, e:
+            self.errors.append(e)
+            self.stopping = True
+
+
+    def _partitionDone(self, n_records, n_rows):
+
+        self.lock.acquire()
+        try:
+            self.done      += 1
+            self.n_records += n_records
+            self.n_rows    += n_rows
+            if time.time() - self.last_report >= self.report_interval:
+                self._reportProgress()
+        finally:
+            self.lock.release()
+
+
+    def _reportProgress(self, final=False):
+
+        now = time.time()
+        self.last_report = now
+        elapsed = max(now - self.start_time, 0.001)
+        rate = self.n_records / elapsed
+        if final:
+            self.report('Built %i partitions in %.1f seconds: %i records (%.0f records/s), %i aggregated rows' % \
+                        (self.done, elapsed, self.n_records, rate, self.n_rows))
+        else:
+            left = self.n_partitions - self.done
+            eta = elapsed / self.done * left if self.done else 0
+            self.report('Built %i/%i partitions: %i records (%.0f records/s, %.1f partitions/s), about %i seconds left' % \
+                        (self.done, self.n_partitions, self.n_records, rate, self.done / elapsed, eta))
+
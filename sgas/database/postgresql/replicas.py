@@ -0,0 +1,237 @@
+"""
+Read-only replicas of the database.
+
+Queries (the query engines, views and monitor) can be run on hot standby
+replicas of the database, instead of the primary. Each replica has its own
+connection pool, and the queries are spread over the healthy replicas in turn.
+
+The replicas are checked every REPLICA_CHECK_INTERVAL seconds. A replica is
+healthy when it can be queried, and its replication lag is below the
+configured limit. The lag is the time since the last replayed transaction
+(pg_last_xact_replay_timestamp), unless the replica has replayed the WAL up
+to the position of the primary (fetched just before the replicas are
+checked), in which case it is up to date (the primary may just not have had
+any transactions lately). Comparing with what the replica has received is
+not enough, as a replica which has lost its connection to the primary soon
+replays all it has received, and so would never lag. The state of the WAL
+receiver (pg_stat_wal_receiver) is only visible to privileged users, so it
+is not used. A replica which fails a query is taken out
+of use until the next successful check, and its connections are replaced
+(a pool which fails to connect has no connections to replace, so this is only
+done when the replica was in use).
+
+When no replica is healthy, the queries are run on the primary. Inserts and
+aggregation always use the primary.
+"""
+
+import itertools
+
+import psycopg2
+
+from twisted.python import log
+from twisted.internet import defer, task
+from twisted.application import service
+
+from sgas.database import error
+
+
+# seconds between checks of the replicas
+REPLICA_CHECK_INTERVAL = 10
+# replication lag (in seconds) above which a replica is not used
+DEFAULT_MAX_REPLICA_LAG = 60
+
+QUERY_SERVER_VERSION = "SELECT current_setting('server_version_num')::integer"
+
+# the wal functions were renamed in PostgreSQL 10
+QUERY_PRIMARY_POSITION        = 'SELECT pg_current_wal_flush_lsn()::text'
+QUERY_PRIMARY_POSITION_PRE_10 = 'SELECT pg_current_xlog_location()::text'
+QUERY_REPLICATION_STATE = '''
+    SELECT pg_is_in_recovery(), pg_last_wal_replay_lsn()::text,
+           extract(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8'''
+QUERY_REPLICATION_STATE_PRE_10 = '''
+    SELECT pg_is_in_recovery(), pg_last_xlog_replay_location()::text,
+           extract(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8'''
+
+
+
+def isConnectionError(e):
+    # true if the error means that the connection to the replica is lost, or
+    # that the replica is shutting down, rather than that the query failed
+    # (e.g., was cancelled because of a conflict with recovery)
+    if isinstance(e, psycopg2.InterfaceError):
+        return True
+    if isinstance(e, psycopg2.OperationalError):
+        if e.pgcode is None:
+            # errors without a code are from libpq, e.g., a lost connection
+            return type(e) is psycopg2.OperationalError
+        return e.pgcode.startswith('08') or e.pgcode.startswith('57P')
+    return False
+
+
+
+def parseWALPosition(position):
+    # a wal position (lsn) is written as two hexadecimal numbers, e.g., 16/B374D848
+    high, low = position.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+
+def replicationLag(in_recovery, replay_position, replay_lag, primary_position):
+    """
+    Returns the replication lag in seconds of a replica, from its replication
+    state, and the wal position of the primary (None if unknown). Returns None
+    if the lag is unknown, i.e., no transaction has been replayed.
+    """
+    if not in_recovery:
+        return 0.0
+    if primary_position is not None and replay_position is not None and \
+       parseWALPosition(replay_position) >= parseWALPosition(primary_position):
+        return 0.0
+    return replay_lag
+
+
+
+def _serverVersion(txn):
+    txn.execute(QUERY_SERVER_VERSION)
+    return txn.fetchall()[0][0]
+
+
+
+class Replica:
+
+    def __init__(self, pool_proxy):
+        self.pool_proxy = pool_proxy
+        self.healthy = False # until checked
+        self.lag = None
+        self.state_query = None
+        self.failures = 0
+        self.last_error = None
+
+
+    def _checkLag(self, txn, primary_position):
+        # executed in a pool thread
+        if self.state_query is None:
+            self.state_query = _serverVersion(txn) >= 100000 and QUERY_REPLICATION_STATE or QUERY_REPLICATION_STATE_PRE_10
+        txn.execute(self.state_query)
+        in_recovery, replay_position, replay_lag = txn.fetchall()[0]
+        return replicationLag(in_recovery, replay_position, replay_lag, primary_position)
+
+
+    def getStats(self):
+        stats = self.pool_proxy.getStats()
+        stats['healthy']    = self.healthy
+        stats['lag']        = self.lag
+        stats['failures']   = self.failures
+        stats['last_error'] = self.last_error
+        return stats
+
+
+
+class ReplicaSet(service.Service):
+
+    def __init__(self, replicas, max_lag=DEFAULT_MAX_REPLICA_LAG, primary=None):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.primary = primary # pool proxy for the wal position of the primary
+        self.position_query = None
+        self.cycle = itertools.cycle(replicas)
+        self.check_call = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+        self.check_call = task.LoopingCall(self.checkReplicas)
+        self.check_call.start(REPLICA_CHECK_INTERVAL)
+        return defer.succeed(None)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.check_call is not None and self.check_call.running:
+            self.check_call.stop()
+        return defer.succeed(None)
+
+
+    def getReplica(self):
+        """
+        Returns the next healthy replica, or None if no replica is healthy.
+        """
+        for _ in range(len(self.replicas)):
+            replica = self.cycle.next()
+            if replica.healthy:
+                return replica
+        return None
+
+
+    def replicaFailed(self, replica, reason):
+        # a query on the replica failed, it is not used until checked again
+        replica.failures += 1
+        replica.last_error = reason
+        if replica.healthy:
+            replica.healthy = False
+            log.msg('Query failed on replica %s, using the primary until it recovers: %s' % (replica.pool_proxy.name, reason),
+                    system='sgas.ReplicaSet')
+            replica.pool_proxy.reconnect()
+
+
+    def _primaryPosition(self, txn):
+        # executed in a pool thread
+        if self.position_query is None:
+            self.position_query = _serverVersion(txn) >= 100000 and QUERY_PRIMARY_POSITION or QUERY_PRIMARY_POSITION_PRE_10
+        txn.execute(self.position_query)
+        return txn.fetchall()[0][0]
+
+
+    @defer.inlineCallbacks
+    def getPrimaryPosition(self):
+        # None if unknown, the lag of the replicas is then from the replay timestamp only
+        if self.primary is None:
+            defer.returnValue(None)
+        try:
+            position = yield self.primary.runInteraction(self._primaryPosition)
+            defer.returnValue(position)
+        except Exception, e:
+            log.msg('Could not get the wal position of the primary: %s' % str(e).strip(), system='sgas.ReplicaSet')
+            defer.returnValue(None)
+
+
+    @defer.inlineCallbacks
+    def checkReplica(self, replica, primary_position=None):
+        try:
+            lag = yield replica.pool_proxy.runInteraction(replica._checkLag, primary_position)
+        except error.DatabaseBusyError:
+            return # the replica is busy with queries, which is not a reason not to use it
+        except Exception, e:
+            # the connection may be gone, e.g., if the replica was restarted
+            if replica.healthy or replica.last_error is None:
+                log.msg('Replica %s is unavailable: %s' % (replica.pool_proxy.name, str(e).strip()), system='sgas.ReplicaSet')
+            if replica.healthy:
+                replica.pool_proxy.reconnect()
+            replica.lag = None
+            replica.healthy = False
+            replica.last_error = str(e).strip()
+            return
+
+        replica.lag = lag
+        healthy = lag is not None and lag <= self.max_lag
+        if healthy != replica.healthy:
+            if healthy:
+                log.msg('Replica %s is in use (lag %s seconds)' % (replica.pool_proxy.name, lag), system='sgas.ReplicaSet')
+            else:
+                log.msg('Replica %s is lagging (%s seconds), using the primary' % (replica.pool_proxy.name, lag), system='sgas.ReplicaSet')
+        replica.healthy = healthy
+        if healthy:
+            replica.last_error = None
+
+
+    @defer.inlineCallbacks
+    def checkReplicas(self):
+        # the position of the primary is fetched first, so replicas which are
+        # up to date have replayed at least that far when checked
+        primary_position = yield self.getPrimaryPosition()
+        yield defer.DeferredList([ self.checkReplica(replica, primary_position) for replica in self.replicas ])
+
+
+    def getStats(self):
+        return dict( [ (replica.pool_proxy.name, replica.getStats()) for replica in self.replicas ] )
+
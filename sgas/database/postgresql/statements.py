@@ -0,0 +1,211 @@
+"""
+Registry of prepared statements.
+
+Queries which are run often with the same text (the monitor status, the
+machine view and administrator manifest queries, the WLCG query, ...) are
+registered here by the plugins using them, when they are constructed. When
+such a query is run, it is executed as a prepared statement, which is
+prepared (parsed and analyzed by PostgreSQL) once per connection, the first
+time it is used on the connection. As prepared statements belong to the
+connection, they are prepared again on the new connections after a reconnect.
+
+The placeholders of the queries (%s or %(name)s) are turned into the $n
+parameters of the prepared statement, so the queries and arguments are the
+same as for the query methods of the database. The arguments are cast to the
+parameter types of the prepared statement, as e.g. lists are passed as text
+arrays, which are not coerced to other array types. If a query cannot be prepared
+(e.g., because the type of a parameter cannot be determined), it is run as a
+plain query instead.
+
+The number of calls and the time spent executing each statement are counted,
+so the statistics can be shown by the monitor.
+"""
+
+import re
+import time
+import weakref
+import threading
+
+import psycopg2
+
+from twisted.python import log
+
+
+PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+QUERY_PARAMETER_TYPES = 'SELECT parameter_types::text[] FROM pg_prepared_statements WHERE name = %s'
+
+
+
+class StatementError(Exception):
+    """
+    Raised when a statement is registered with a name already used by
+    another query.
+    """
+
+
+
+def convertPlaceholders(query):
+    """
+    Converts the placeholders of query into the parameters of a prepared
+    statement. Returns the text of the statement, and the names of the named
+    placeholders in parameter order (None if the placeholders are positional),
+    and the number of parameters.
+    """
+    names = []
+    positional = [ 0 ]
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) is None:
+            positional[0] += 1
+            return '$%i' % positional[0]
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return '$%i' % (names.index(name) + 1)
+
+    text = PLACEHOLDER.sub(replace, query).strip().rstrip(';')
+    if names and positional[0]:
+        raise StatementError('Query mixes named and positional placeholders')
+    if names:
+        return text, names, len(names)
+    return text, None, positional[0]
+
+
+
+class Statement:
+
+    def __init__(self, name, query):
+        self.name = name
+        self.query = query
+        self.text, self.arg_names, self.n_params = convertPlaceholders(query)
+        self.execute_query = None # set when the parameter types are known
+
+        self.preparable = True
+        self.calls = 0
+        self.prepares = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+    def setParameterTypes(self, parameter_types):
+        execute_query = 'EXECUTE %s' % self.name
+        if parameter_types:
+            execute_query += ' (%s)' % ', '.join( [ '%%s::%s' % pt for pt in parameter_types ] )
+        self.execute_query = execute_query
+
+
+    def executeArgs(self, query_args):
+        if self.arg_names is not None:
+            return [ query_args[name] for name in self.arg_names ]
+        return query_args
+
+
+    def getStats(self):
+        return { 'calls'      : self.calls,
+                 'prepares'   : self.prepares,
+                 'total_time' : round(self.total_time, 3),
+                 'mean_time'  : round(self.total_time / max(1, self.calls), 4),
+                 'max_time'   : round(self.max_time, 3),
+                 'prepared'   : self.preparable }
+
+
+
+class StatementRegistry:
+
+    def __init__(self):
+        self.statements = {} # query -> statement
+        self.names = {}      # name -> statement
+        # the names of the statements prepared on each connection, the
+        # entries go away with the connections
+        self.prepared = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock() # statistics are updated from the pool threads
+
+
+    def register(self, name, query):
+        """
+        Registers a query as a prepared statement with the given name.
+        Registering the same query again (e.g., by several views) is allowed.
+        """
+        statement = self.names.get(name)
+        if statement is not None:
+            if statement.query != query:
+                raise StatementError('Statement name %s already registered for another query' % name)
+            return name
+
+        statement = Statement(name, query)
+        self.names[name] = statement
+        self.statements.setdefault(query, statement)
+        return name
+
+
+    def execute(self, txn, query, query_args=None):
+        """
+        Executes query in the transaction (in a pool thread). Registered
+        queries are executed as prepared statements, other queries as they are.
+        """
+        statement = self.statements.get(query)
+        if statement is None:
+            txn.execute(query, query_args)
+            return
+
+        t0 = time.time()
+        if statement.preparable and self._prepare(txn, statement):
+            txn.execute(statement.execute_query, statement.executeArgs(query_args))
+        else:
+            txn.execute(query, query_args)
+        dt = time.time() - t0
+
+        self.lock.acquire()
+        try:
+            statement.calls += 1
+            statement.total_time += dt
+            statement.max_time = max(statement.max_time, dt)
+        finally:
+            self.lock.release()
+
+
+    def _prepare(self, txn, statement):
+        # prepares the statement on the connection of the transaction, if
+        # it is not already, returns false if the statement cannot be prepared
+        conn = txn.connection # the connection of the cursor
+        self.lock.acquire()
+        try:
+            prepared = self.prepared.setdefault(conn, set())
+        finally:
+            self.lock.release()
+        if statement.name in prepared:
+            return True
+
+        # a failing prepare would abort the transaction
+        txn.execute('SAVEPOINT sgas_prepare')
+        try:
+            txn.execute('PREPARE %s AS %s' % (statement.name, statement.text))
+        except psycopg2.ProgrammingError, e:
+            txn.execute('ROLLBACK TO SAVEPOINT sgas_prepare')
+            statement.preparable = False
+            log.msg('Could not prepare statement %s, running it as a plain query: %s' % (statement.name, str(e).strip()),
+                    system='sgas.PostgreSQLDatabase')
+            return False
+        txn.execute('RELEASE SAVEPOINT sgas_prepare')
+        if statement.execute_query is None:
+            txn.execute(QUERY_PARAMETER_TYPES, (statement.name,))
+            statement.setParameterTypes(txn.fetchall()[0][0])
+
+        prepared.add(statement.name)
+        self.lock.acquire()
+        try:
+            statement.prepares += 1
+        finally:
+            self.lock.release()
+        return True
+
+
+    def getStats(self):
+        """
+        Returns the call statistics of the registered statements by name.
+        """
+        return dict( [ (name, statement.getStats()) for name, statement in self.names.items() ] )
+
@@ -0,0 +1,97 @@
+"""
+Conversion of query results into plain Python values.
+
+The views and the query engines work with plain values (str, int, float,
+...), which are also what is serialized to JSON. Numeric values are converted
+into int or float, and dates are kept as the ISO strings PostgreSQL sends, by
+typecasters which are registered on the connections of the pool when they are
+opened (see registerTypecasters), so no Decimal or date objects are made.
+Values of other types without a plain representation (timestamps, intervals,
+arrays, ...) are turned into strings.
+
+Which columns must be converted is decided once per result, from the type oids
+in the cursor description (see columnConverters). Results where no column must
+be converted, which is the common case, are returned as they are.
+"""
+
+import types
+
+import psycopg2.extensions
+
+
+NUMERIC_OID = 1700
+DATE_OID    = 1082
+
+# oids of the types psycopg2 returns as plain values: bool, int8, int2, int4,
+# oid, float4, float8, char, name, text, bpchar, varchar, and numeric and date
+# (with the typecasters below)
+PLAIN_OIDS = frozenset([ 16, 20, 21, 23, 26, 700, 701, 18, 19, 25, 1042, 1043, NUMERIC_OID, DATE_OID ])
+
+PLAIN_TYPES = (unicode, str, int, long, float, bool, types.NoneType)
+
+
+
+def castNumeric(value, cur):
+    # integral values become int, the rest float
+    if value is None:
+        return None
+    return int(value) if value.isdigit() else float(value)
+
+
+def castDate(value, cur):
+    # the ISO date string, which is what str() of a date gives
+    return value
+
+
+NUMERIC = psycopg2.extensions.new_type((NUMERIC_OID,), 'SGAS_NUMERIC', castNumeric)
+DATE    = psycopg2.extensions.new_type((DATE_OID,), 'SGAS_DATE', castDate)
+
+
+
+def registerTypecasters(conn):
+    """
+    Registers the typecasters on a connection, used as cp_openfun of the pool.
+    """
+    psycopg2.extensions.register_type(NUMERIC, conn)
+    psycopg2.extensions.register_type(DATE, conn)
+    # the dates are passed on as sent, so they must be sent in ISO format
+    cur = conn.cursor()
+    cur.execute("SET DateStyle = 'ISO'")
+    cur.close()
+    conn.commit()
+
+
+
+def buildValue(value):
+    # values of other types than the plain ones are turned into strings
+    if type(value) in PLAIN_TYPES:
+        return value
+    return str(value)
+
+
+
+def columnConverters(description):
+    """
+    Returns the (column index, converter) pairs of the columns of a result
+    which must be converted, from the cursor description.
+    """
+    return [ (idx, buildValue) for idx, column in enumerate(description or ()) if column[1] not in PLAIN_OIDS ]
+
+
+
+def convertRows(rows, converters):
+    """
+    Converts the columns of the rows in converters. The rows are returned as
+    they are, if there is nothing to convert.
+    """
+    if not converters:
+        return rows
+
+    converted = []
+    for row in rows:
+        row = list(row)
+        for idx, convert in converters:
+            row[idx] = convert(row[idx])
+        converted.append(row)
+    return converted
+
@@ -0,0 +1,354 @@
+"""
+Write-behind spool for record registration.
+
+When the spool is enabled, the insert arguments of accepted records are
+appended to a local journal, and the registration is acknowledged as soon as
+the journal has been synced to disk. A drainer then inserts the spooled records
+into the database in large batches. This decouples the registration latency
+from the database latency, and means that registrations are not rejected
+when the database is slow or restarting.
+
+Journal entries are framed with their length and a crc32 checksum, so a
+partially written entry (from a crash) can be detected and discarded. Syncing
+is done in groups, i.e., all entries appended while a sync is in progress are
+synced together by the next sync. The offset up to which the journal has been
+inserted is kept in a checkpoint file. Entries can be inserted more than once
+after a crash, but this is harmless, as inserting an existing record is a no-op.
+"""
+
+import os
+import zlib
+import struct
+import cPickle as pickle
+
+import psycopg2
+
+from twisted.python import log
+from twisted.internet import defer, reactor, threads
+from twisted.application import service
+
+from sgas.database import error
+from sgas.database.postgresql import replicas
+
+
+JOURNAL_FILE    = 'journal'
+CHECKPOINT_FILE = 'checkpoint'
+REJECTED_FILE   = 'rejected'
+
+# length and crc32 of the entry data
+FRAME_HEADER = struct.Struct('!II')
+
+# max number of records inserted in one batch by the drainer
+DRAIN_BATCH_SIZE = 5000
+# seconds to wait before trying again, when the database is unavailable
+DRAIN_RETRY_DELAY = 10
+# number of times a batch is tried, when it fails with an operational error
+# which is not a lost connection (e.g., a deadlock or a cancelled statement),
+# before it is handled like a batch with a bad record
+DRAIN_MAX_ATTEMPTS = 3
+
+# errors which means that the database cannot be reached, inserting is
+# retried until it can (lost connections are checked by isRetryError)
+RETRY_ERRORS = (error.DatabaseUnavailableError, psycopg2.InterfaceError)
+
+
+
+def isRetryError(e):
+    return isinstance(e, RETRY_ERRORS) or replicas.isConnectionError(e)
+
+
+
+class RecordSpool(service.Service):
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        self.handlers = {}
+
+        self.fd = None
+        self.write_offset  = 0 # end of journal
+        self.synced_offset = 0 # entries up to here are on disk
+        self.read_offset   = 0 # entries up to here have been inserted
+        self.single_until  = 0 # insert entries one by one up to here (after an error)
+        self.failed_attempts = 0 # of the batch at read_offset
+
+        self.sync_waiting = []
+        self.syncing      = False
+        self.draining     = None
+        self.drain_call   = None
+        self.stopping     = False
+
+
+    def _path(self, filename):
+        return os.path.join(self.spool_dir, filename)
+
+
+    def registerHandler(self, plugin_id, handler):
+        """
+        Register the insert function for records from a plugin. The handler is
+        called with a list of insert arguments, and must return a deferred.
+        """
+        self.handlers[plugin_id] = handler
+
+
+    def startService(self):
+        service.Service.startService(self)
+        if not os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir)
+
+        self.fd = os.open(self._path(JOURNAL_FILE), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0600)
+        self.read_offset = self._readCheckpoint()
+        self.write_offset = self._recover()
+        self.synced_offset = self.write_offset
+
+        if self.write_offset > self.read_offset:
+            log.msg('Spool contains %i bytes of records, which will be inserted' % (self.write_offset - self.read_offset), system='sgas.RecordSpool')
+        self.scheduleDrain(0)
+        return defer.succeed(None)
+
+
+    def stopService(self):
+        self.stopping = True
+        service.Service.stopService(self)
+        if self.drain_call is not None:
+            self.drain_call.cancel()
+            self.drain_call = None
+
+        def close(_):
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+        # wait for the current insert to finish
+        d = defer.Deferred()
+        if self.draining is not None:
+            self.draining.addBoth(lambda _ : d.callback(None))
+        else:
+            d.callback(None)
+        d.addCallback(close)
+        return d
+
+
+    # -- checkpoint and recovery
+
+    def _readCheckpoint(self):
+        try:
+            return int(open(self._path(CHECKPOINT_FILE)).read())
+        except (IOError, ValueError):
+            return 0
+
+
+    def _writeCheckpoint(self, offset):
+        # no fsync, if the checkpoint is lost some records are just inserted again
+        tmp_path = self._path(CHECKPOINT_FILE + '.tmp')
+        f = open(tmp_path, 'w')
+        f.write(str(offset))
+        f.close()
+        os.rename(tmp_path, self._path(CHECKPOINT_FILE))
+        self.read_offset = offset
+
+
+    def _recover(self):
+        # find the end of the last complete entry, and discard anything after
+        # it (an entry which was being written when the server stopped)
+        size = os.fstat(self.fd).st_size
+        if self.read_offset > size:
+            # journal was truncated, but the checkpoint was not reset
+            self._writeCheckpoint(0)
+
+        f = open(self._path(JOURNAL_FILE), 'rb')
+        try:
+            f.seek(self.read_offset)
+            offset = self.read_offset
+            while True:
+                entry = self._readFrame(f)
+                if entry is None:
+                    break
+                offset += len(entry) + FRAME_HEADER.size
+        finally:
+            f.close()
+
+        if offset < size:
+            log.msg('Discarding %i bytes of incomplete data at end of spool journal' % (size - offset), system='sgas.RecordSpool')
+            os.ftruncate(self.fd, offset)
+        return offset
+
+
+    def _readFrame(self, f):
+        # returns the data of the next entry, or None if there are no more complete entries
+        header = f.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return None
+        length, crc = FRAME_HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+            return None
+        return data
+
+
+    # -- appending
+
+    def append(self, plugin_id, arg_list):
+        """
+        Append the insert arguments of some records to the journal. Returns a
+        deferred, which fires when the records have been synced to disk.
+        """
+        data = pickle.dumps( (plugin_id, arg_list), pickle.HIGHEST_PROTOCOL)
+        frame = FRAME_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+        written = 0
+        while written < len(frame):
+            written += os.write(self.fd, frame[written:])
+        self.write_offset += len(frame)
+
+        d = defer.Deferred()
+        self.sync_waiting.append(d)
+        self._sync()
+        return d
+
+
+    def _sync(self):
+        # syncs all appended entries, while a sync is in progress new entries
+        # wait, and are synced together by the next sync
+        if self.syncing or not self.sync_waiting:
+            return
+
+        self.syncing = True
+        waiting, self.sync_waiting = self.sync_waiting, []
+        offset = self.write_offset
+
+        def synced(_):
+            self.syncing = False
+            self.synced_offset = offset
+            for d in waiting:
+                d.callback(None)
+            self._sync()
+            self.scheduleDrain(0)
+
+        def syncFailed(failure):
+            self.syncing = False
+            log.msg('Error syncing spool journal: %s' % failure.getErrorMessage(), system='sgas.RecordSpool')
+            for d in waiting:
+                d.errback(failure)
+            self._sync()
+
+        d = threads.deferToThread(os.fsync, self.fd)
+        d.addCallbacks(synced, syncFailed)
+
+
+    # -- draining
+
+    def scheduleDrain(self, delay):
+        if self.drain_call is None and self.draining is None and not self.stopping:
+            self.drain_call = reactor.callLater(delay, self._startDrain)
+
+
+    def _startDrain(self):
+        self.drain_call = None
+
+        def drainDone(retry):
+            self.draining = None
+            if retry:
+                self.scheduleDrain(DRAIN_RETRY_DELAY)
+
+        def drainError(failure):
+            self.draining = None
+            log.err(failure, system='sgas.RecordSpool')
+
+        self.draining = self._drain()
+        self.draining.addCallbacks(drainDone, drainError)
+
+
+    def _readEntries(self):
+        # read consecutive entries from the same plugin, returns (plugin_id, arg_list, end offset)
+        max_entries = 1 if self.read_offset < self.single_until else None
+        plugin_id = None
+        arg_list = []
+        offset = self.read_offset
+        n_entries = 0
+
+        f = open(self._path(JOURNAL_FILE), 'rb')
+        try:
+            f.seek(offset)
+            while offset < self.synced_offset and len(arg_list) < DRAIN_BATCH_SIZE:
+                data = self._readFrame(f)
+                if data is None:
+                    break
+                entry_plugin_id, entry_args = pickle.loads(data)
+                if plugin_id is not None and entry_plugin_id != plugin_id:
+                    break
+                plugin_id = entry_plugin_id
+                arg_list += entry_args
+                offset += len(data) + FRAME_HEADER.size
+                n_entries += 1
+                if n_entries == max_entries:
+                    break
+        finally:
+            f.close()
+
+        return plugin_id, arg_list, offset
+
+
+    def _reject(self, start_offset, end_offset, reason):
+        # move entries which cannot be inserted out of the way, so they do
+        # not block the spool
+        log.msg('Rejecting spooled records: %s. Records have been saved to %s' % (reason, self._path(REJECTED_FILE)), system='sgas.RecordSpool')
+        f = open(self._path(JOURNAL_FILE), 'rb')
+        try:
+            f.seek(start_offset)
+            data = f.read(end_offset - start_offset)
+        finally:
+            f.close()
+        rf = open(self._path(REJECTED_FILE), 'ab')
+        rf.write(data)
+        rf.close()
+
+
+    @defer.inlineCallbacks
+    def _drain(self):
+        # inserts spooled records until the journal is empty
+        # returns True if draining should be retried later
+
+        while not self.stopping and self.read_offset < self.synced_offset:
+            start_offset = self.read_offset
+            plugin_id, arg_list, end_offset = self._readEntries()
+            if end_offset == start_offset:
+                break
+
+            handler = self.handlers.get(plugin_id)
+            if handler is None:
+                self._reject(start_offset, end_offset, 'No handler for plugin %s' % plugin_id)
+                self._writeCheckpoint(end_offset)
+                continue
+
+            try:
+                yield handler(arg_list)
+            except Exception, e:
+                if isRetryError(e):
+                    log.msg('Database unavailable, retrying spool insert in %i seconds (%s)' % (DRAIN_RETRY_DELAY, str(e)), system='sgas.RecordSpool')
+                    defer.returnValue(True)
+                if isinstance(e, psycopg2.OperationalError):
+                    self.failed_attempts += 1
+                    if self.failed_attempts < DRAIN_MAX_ATTEMPTS:
+                        log.msg('Error inserting spooled records (%s), retrying in %i seconds' % (str(e).strip(), DRAIN_RETRY_DELAY), system='sgas.RecordSpool')
+                        defer.returnValue(True)
+                self.failed_attempts = 0
+                if self.read_offset >= self.single_until:
+                    # some record in the batch is bad, insert one entry at a time to find it
+                    log.msg('Error inserting spooled records (%s), inserting entries one by one' % str(e), system='sgas.RecordSpool')
+                    self.single_until = end_offset
+                    continue
+                self._reject(start_offset, end_offset, str(e))
+                self._writeCheckpoint(end_offset)
+                continue
+
+            self.failed_attempts = 0
+            self._writeCheckpoint(end_offset)
+            log.msg('Inserted %i spooled %s records' % (len(arg_list), plugin_id), system='sgas.RecordSpool')
+
+        # everything has been inserted, start over with an empty journal
+        if self.read_offset > 0 and self.read_offset == self.write_offset and not self.syncing and not self.sync_waiting:
+            os.ftruncate(self.fd, 0)
+            self.write_offset = self.synced_offset = self.single_until = 0
+            self._writeCheckpoint(0)
+
+        defer.returnValue(False)
+
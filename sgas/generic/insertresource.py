@@ -73,9 +73,10 @@ class GenericInsertResource(resource.Resource):
         # hostname is used for logging / provenance in the usage records
         hostname = resourceutil.getHostname(request)
 
+        # the body is handed over as a file object, so subclasses can parse
+        # it incrementally instead of reading it into memory in one go
         request.content.seek(0)
-        data = request.content.read()
-        d = self.insertRecords(data, subject, hostname)
+        d = self.insertRecords(request.content, subject, hostname)
         d.addCallbacks(insertDone, insertError)
         return server.NOT_DONE_YET
 
@@ -21,20 +21,31 @@ HTTP_HEADER_CONTENT_TYPE   = 'content-type'
 
 REGISTRATION_EPOCH = 'registration_epoch'
 
+# the last registration is read from the aggregated tables, like it is for
+# usage records, so a storage registration is only seen when the storage
+# aggregation updater has added it (usually within UPDATE_DELAY, 20 seconds)
 STATUS_QUERY = """
 SELECT extract(EPOCH from (current_timestamp - greatest(ur.last_registration, sr.last_registration)))::integer AS registration_epoch FROM 
-  (SELECT max(insert_time) AS last_registration FROM storagerecords WHERE storage_system = %(resource)s AND insert_host = %(inserthost)s ) AS ur,
+  (SELECT max(insert_time) AS last_registration FROM sraggregated WHERE storage_system = %(resource)s AND insert_host = %(inserthost)s ) AS ur,
   (SELECT max(generate_time) AS last_registration FROM uraggregated WHERE machine_name = %(resource)s AND insert_host = %(inserthost)s ) AS sr
 ;
 """
 
 STATUS_QUERY_RESOURCE_ONLY = """
 SELECT extract(EPOCH from (current_timestamp - greatest(ur.last_registration, sr.last_registration)))::integer AS registration_epoch FROM 
-  (SELECT max(insert_time) AS last_registration FROM storagerecords WHERE storage_system = %(resource)s ) AS ur,
+  (SELECT max(insert_time) AS last_registration FROM sraggregated WHERE storage_system = %(resource)s ) AS ur,
   (SELECT max(generate_time) AS last_registration FROM uraggregated WHERE machine_name = %(resource)s ) AS sr
 ;
 """
 
+# child resource with the status of the aggregation, host names cannot contain
+# underscores, so it cannot be mistaken for a machine
+AGGREGATION_RESOURCE = '_aggregation'
+# child resource with the call statistics of the prepared statements
+STATEMENTS_RESOURCE = '_statements'
+# child resource with the use of the database connection pools
+POOLS_RESOURCE = '_pools'
+
 ACTION_MONITOR          = 'monitor'
 
 class MonitorResource(resource.Resource):
@@ -52,6 +63,8 @@ class MonitorResource(resource.Resource):
         authorizer.rights.addActions(ACTION_MONITOR)
         authorizer.rights.addOptions(ACTION_MONITOR,[])
         authorizer.rights.addContexts(ACTION_MONITOR,[])
+        db.registerStatement('monitor_status', STATUS_QUERY)
+        db.registerStatement('monitor_status_resource', STATUS_QUERY_RESOURCE_ONLY)
 
 
     def queryStatus(self, resource_name, insert_host=None):
@@ -75,6 +88,13 @@ class MonitorResource(resource.Resource):
         if not len(request.postpath) in (1,2):
             return self.renderErrorPage('Invalid machine specification', request)
 
+        if request.postpath == [ AGGREGATION_RESOURCE ]:
+            return self.renderAggregationStatus(request)
+        if request.postpath == [ STATEMENTS_RESOURCE ]:
+            return self.renderStatementStats(request)
+        if request.postpath == [ POOLS_RESOURCE ]:
+            return self.renderPoolStats(request)
+
         machine_name = request.postpath[0]
         insert_host = None
         if len(request.postpath) == 2:
@@ -108,6 +128,36 @@ class MonitorResource(resource.Resource):
             request.finish()
 
 
+    def renderAggregationStatus(self, request):
+
+        updater = getattr(self.db, 'updater', None)
+        if updater is None:
+            request.setResponseCode(404)
+            return 'Aggregation is not updated by this server'
+
+        def renderStatus(status):
+            request.setHeader(HTTP_HEADER_CONTENT_TYPE, JSON_MIME_TYPE)
+            request.write(json.dumps(status))
+            request.finish()
+
+        d = updater.getStatus()
+        d.addCallback(renderStatus)
+        d.addErrback(self.renderErrorPage, request)
+        return server.NOT_DONE_YET
+
+
+    def renderStatementStats(self, request):
+
+        request.setHeader(HTTP_HEADER_CONTENT_TYPE, JSON_MIME_TYPE)
+        return json.dumps(self.db.getStatementStats())
+
+
+    def renderPoolStats(self, request):
+
+        request.setHeader(HTTP_HEADER_CONTENT_TYPE, JSON_MIME_TYPE)
+        return json.dumps(self.db.getPoolStats())
+
+
     def renderErrorPage(self, error, request):
 
         if isinstance(error, failure.Failure):
@@ -0,0 +1,114 @@
+"""
+Pool of worker processes for parsing records.
+
+Parsing and converting record documents is CPU bound, and doing it in the
+reactor thread both limits the server to a single core and blocks the
+reactor while a large batch is parsed. The parser pool hands the parsing
+over to a number of worker processes and returns a deferred for the result.
+
+The worker processes are forked when the pool is created, which should
+happen while the server is being setup, i.e., before the reactor and its
+thread pools have been started.
+
+A worker process which dies (e.g., killed when running out of memory on a
+huge batch) is replaced by the pool, but its job is lost without a result.
+So a parse which has not finished after PARSE_TIMEOUT seconds fails. The
+pool waits for lost jobs when joined, so a pool which has had a parse time
+out is terminated when stopped, instead of waiting for the outstanding jobs.
+"""
+
+import signal
+import multiprocessing
+
+from twisted.python import log
+from twisted.internet import defer, reactor, threads
+from twisted.application import service
+
+
+# seconds a parse may take before it fails, in case the worker has died
+PARSE_TIMEOUT = 120
+
+
+
+class ParserError(Exception):
+    """
+    Raised when parsing in a worker process fails.
+    """
+
+
+
+def _initWorker():
+    # executed in a worker process when it is started. workers which replace
+    # dead ones are forked from the running server, and would inherit the
+    # signal handlers of the reactor, and so not exit when the pool is
+    # terminated. interrupts are handled by the server
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+
+def _runParser(parse_func, args):
+    # executed in a worker process
+    # exceptions are converted into messages, as they are not always picklable
+    # (and python 2 multiprocessing does not have error callbacks)
+    try:
+        return True, parse_func(*args)
+    except Exception, e:
+        return False, '%s: %s' % (e.__class__.__name__, str(e))
+
+
+
+class ParserPool(service.Service):
+
+    def __init__(self, workers, timeout=PARSE_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self.timed_out = 0
+        self.pool = multiprocessing.Pool(workers, _initWorker)
+        log.msg('Parser pool with %i workers created' % workers, system='sgas.ParserPool')
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.timed_out:
+            # a job may have been lost, which would never be done
+            self.pool.terminate()
+            return defer.succeed(None)
+        self.pool.close()
+        # join blocks until the outstanding jobs are done
+        return threads.deferToThread(self.pool.join)
+
+
+    def parse(self, parse_func, *args):
+        """
+        Run parse_func(*args) in a worker process. parse_func must be a module
+        level function, and its arguments and result must be picklable.
+        Returns a deferred, which fires with the result of parse_func, or
+        fails with ParserError if the function raised an exception, or did
+        not finish within the timeout of the pool.
+        """
+        d = defer.Deferred()
+
+        def parseDone(result):
+            # called in the result handler thread of the pool
+            reactor.callFromThread(fireResult, result)
+
+        def fireResult(result):
+            if d.called:
+                return # timed out already
+            timeout_call.cancel()
+            ok, value = result
+            if ok:
+                d.callback(value)
+            else:
+                d.errback(ParserError(value))
+
+        def parseTimeout():
+            self.timed_out += 1
+            log.msg('Parsing did not finish within %i seconds, the worker may have died' % self.timeout, system='sgas.ParserPool')
+            d.errback(ParserError('Parsing did not finish within %i seconds' % self.timeout))
+
+        timeout_call = reactor.callLater(self.timeout, parseTimeout)
+        self.pool.apply_async(_runParser, (parse_func, args), callback=parseDone)
+        return d
+
@@ -0,0 +1,202 @@
+"""
+Declarative specification of how record XML elements are converted into
+insert arguments.
+
+A record spec is a list of fields. Each field describes how an element (given
+by its tag) is turned into one or more insert arguments. The spec is compiled
+against the argument list of the record type into a dictionary from tag to
+handler, and the handlers write their values directly into the argument slots.
+This avoids both a long if/elif chain on the tag and building an intermediate
+dictionary for each record.
+"""
+
+from twisted.python import log
+
+
+
+def _tagName(tag):
+    # element tags are strings, but the element modules use QNames
+    return getattr(tag, 'text', tag)
+
+
+
+class Value:
+    """
+    The text of the element (converted with parse, if given) is put into arg.
+    """
+    def __init__(self, tag, arg, parse=None):
+        self.tag = tag
+        self.arg = arg
+        self.parse = parse
+
+    def compile(self, arg_index, system):
+        idx = arg_index[self.arg]
+        parse = self.parse
+        if parse is None:
+            def handler(element, args):
+                args[idx] = element.text
+        else:
+            def handler(element, args):
+                args[idx] = parse(element.text)
+        return handler
+
+
+
+class Sum(Value):
+    """
+    Like Value, but the values of repeated elements are added together.
+    """
+    def compile(self, arg_index, system):
+        idx = arg_index[self.arg]
+        parse = self.parse
+        def handler(element, args):
+            value = parse(element.text)
+            if args[idx] is None:
+                args[idx] = value
+            elif value is not None:
+                args[idx] += value
+        return handler
+
+
+
+class Append(Value):
+    """
+    The (parsed) values of repeated elements are collected in a list.
+    """
+    def compile(self, arg_index, system):
+        idx = arg_index[self.arg]
+        parse = self.parse or (lambda value : value)
+        def handler(element, args):
+            if args[idx] is None:
+                args[idx] = [ parse(element.text) ]
+            else:
+                args[idx].append(parse(element.text))
+        return handler
+
+
+
+class Custom:
+    """
+    The element and the current value of arg is given to convert, and the
+    result is put into arg. Used for elements which are more complicated than
+    a single value.
+    """
+    def __init__(self, tag, arg, convert):
+        self.tag = tag
+        self.arg = arg
+        self.convert = convert
+
+    def compile(self, arg_index, system):
+        idx = arg_index[self.arg]
+        convert = self.convert
+        def handler(element, args):
+            args[idx] = convert(element, args[idx])
+        return handler
+
+
+
+class Attributes:
+    """
+    Attributes of the element, given as (attribute, arg, parse) tuples.
+    Missing attributes are ignored.
+    """
+    def __init__(self, tag, attributes):
+        self.tag = tag
+        self.attributes = attributes
+
+    def compile(self, arg_index, system):
+        attributes = [ (_tagName(attr), arg_index[arg], parse) for attr, arg, parse in self.attributes ]
+        def handler(element, args):
+            for attr, idx, parse in attributes:
+                value = element.get(attr)
+                if value is not None:
+                    args[idx] = parse(value) if parse else value
+        return handler
+
+
+
+class Container:
+    """
+    An element with sub elements, which are described by their own fields.
+    The attributes of the container itself can be given as in Attributes.
+    """
+    def __init__(self, tag, fields, attributes=()):
+        self.tag = tag
+        self.fields = fields
+        self.attributes = attributes
+
+    def compile(self, arg_index, system):
+        dispatch = compileFields(self.fields, arg_index, system)
+        attr_handler = Attributes(self.tag, self.attributes).compile(arg_index, system)
+        name = _tagName(self.tag)
+        def handler(element, args):
+            if self.attributes:
+                attr_handler(element, args)
+            for subele in element:
+                sub_handler = dispatch.get(subele.tag)
+                if sub_handler is None:
+                    log.msg('Unhandled %s sub element: %s' % (name, subele.tag), system=system)
+                else:
+                    sub_handler(subele, args)
+        return handler
+
+
+
+class Ignore:
+    """
+    The element is accepted but not used. If a message is given, it is logged.
+    """
+    def __init__(self, tag, message=None):
+        self.tag = tag
+        self.message = message
+
+    def compile(self, arg_index, system):
+        message = self.message
+        def handler(element, args):
+            if message is not None:
+                log.msg(message, system=system)
+        return handler
+
+
+
+def compileFields(fields, arg_index, system):
+    """
+    Compile a list of fields into a dictionary from tag to handler.
+    """
+    dispatch = {}
+    for field in fields:
+        dispatch[_tagName(field.tag)] = field.compile(arg_index, system)
+    return dispatch
+
+
+
+class RecordParser:
+    """
+    Parser for a record element, compiled from a record spec and the argument
+    list of the record type.
+    """
+    def __init__(self, record_tag, fields, arg_list, system):
+        self.record_tag = _tagName(record_tag)
+        self.n_args = len(arg_list)
+        self.system = system
+        arg_index = dict( [ (arg, idx) for idx, arg in enumerate(arg_list) ] )
+        self.dispatch = compileFields(fields, arg_index, system)
+
+
+    def parse(self, element):
+        """
+        Convert a record element into a list of arguments. Arguments for which
+        there are no elements are None.
+        """
+        assert element.tag == self.record_tag
+
+        args = [ None ] * self.n_args
+        dispatch = self.dispatch
+        for subele in element:
+            handler = dispatch.get(subele.tag)
+            if handler is None:
+                log.msg('Unhandled record element: %s' % subele.tag, system=self.system)
+            else:
+                handler(subele, args)
+        return args
+
@@ -0,0 +1,139 @@
+"""
+Parsing of values in usage and storage records.
+
+Datetimes and durations are by far the most common values in records, and
+parsing them with the generic isodate functions is quite expensive. Loggers
+almost always use the forms YYYY-MM-DDTHH:MM:SSZ and PT<n>S, so these are
+parsed directly, falling back to isodate for anything else. The results are
+memoized, as many values are shared between the records in a batch.
+"""
+
+import time
+import datetime
+
+from twisted.python import log
+
+from sgas.ext import isodate
+
+
+# date constants
+ISO_TIME_FORMAT   = "%Y-%m-%dT%H:%M:%SZ" # if we want to convert back some time
+JSON_DATETIME_FORMAT = "%Y %m %d %H:%M:%S"
+
+# max number of memoized values (per value type)
+MEMO_SIZE = 4096
+
+_datetime_memo = {}
+_duration_memo = {}
+
+
+
+def parseBoolean(value):
+    if value == '1' or value.lower() == 'true':
+        return True
+    elif value == '0' or value.lower() == 'false':
+        return False
+    else:
+        log.msg('Failed to parse value %s into boolean' % value, system='sgas.UsageRecord')
+        return None
+
+
+def parseInt(value):
+    try:
+        return int(value)
+    except ValueError:
+        log.msg("Failed to parse float: %s" % value, system='sgas.UsageRecord')
+        return None
+
+
+def parseFloat(value):
+    try:
+        return float(value)
+    except ValueError:
+        log.msg("Failed to parse float: %s" % value, system='sgas.UsageRecord')
+        return None
+
+
+
+def _memoize(memo, value, result):
+    # the memo is simply emptied when full, values are typically repeated
+    # within a batch, so this works as well as an lru
+    if len(memo) >= MEMO_SIZE:
+        memo.clear()
+    memo[value] = result
+    return result
+
+
+def _fastISODuration(value):
+    # PT<n>S or PT<n>.<fraction>S, returns None for anything else
+    if len(value) < 4 or value[:2] != 'PT' or value[-1] != 'S':
+        return None
+    seconds = value[2:-1]
+    if seconds.isdigit():
+        return int(seconds)
+    integer, dot, fraction = seconds.partition('.')
+    # more than 6 decimals can round up to the next second in isodate
+    if dot and integer.isdigit() and fraction.isdigit() and len(fraction) <= 6:
+        return int(integer)
+    return None
+
+
+def parseISODuration(value):
+    try:
+        return _duration_memo[value]
+    except KeyError:
+        pass
+
+    seconds = _fastISODuration(value)
+    if seconds is not None:
+        return _memoize(_duration_memo, value, seconds)
+
+    try:
+        td = isodate.parse_duration(value)
+        seconds = (td.days * 3600*24) + td.seconds # screw microseconds
+        return _memoize(_duration_memo, value, seconds)
+    except ValueError:
+        log.msg("Failed to parse duration: %s" % value, system='sgas.UsageRecord')
+        return None
+
+
+def _fastISODateTime(value):
+    # YYYY-MM-DDTHH:MM:SSZ, returns None for anything else
+    if len(value) != 20 or value[19] != 'Z' or value[10] != 'T' or \
+       value[4] != '-' or value[7] != '-' or value[13] != ':' or value[16] != ':':
+        return None
+    digits = value[0:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19]
+    if not digits.isdigit():
+        return None
+    year = int(value[0:4])
+    if year < 1900:
+        return None
+    try:
+        # validates the date and time
+        datetime.datetime(year, int(value[5:7]), int(value[8:10]),
+                          int(value[11:13]), int(value[14:16]), int(value[17:19]))
+    except ValueError:
+        return None
+    return str(value[0:4] + ' ' + value[5:7] + ' ' + value[8:10] + ' ' + value[11:19])
+
+
+def parseISODateTime(value):
+    try:
+        return _datetime_memo[value]
+    except KeyError:
+        pass
+
+    json_dt = _fastISODateTime(value)
+    if json_dt is not None:
+        return _memoize(_datetime_memo, value, json_dt)
+
+    try:
+        dt = isodate.parse_datetime(value)
+        return _memoize(_datetime_memo, value, time.strftime(JSON_DATETIME_FORMAT, dt.utctimetuple()))
+    except ValueError, e:
+        log.msg("Failed to parse datetime value: %s (%s)" % (value, str(e)), system='sgas.UsageRecord')
+        return None
+    except isodate.ISO8601Error, e:
+        log.msg("Failed to parse ISO datetime value: %s (%s)" % (value, str(e)), system='sgas.UsageRecord')
+        return None
+
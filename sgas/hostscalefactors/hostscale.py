@@ -51,7 +51,7 @@ class HostScaleFactorUpdater(service.Service):
     @defer.inlineCallbacks
     def updateScaleFactors(self):
         try:
-            yield self.pool_proxy.dbpool.runInteraction(self.issueUpdateStatements)
+            yield self.pool_proxy.runInteraction(self.issueUpdateStatements)
             log.msg("Host scale factors updated (%i entries)" % len(self.scale_factors), system='sgas.HostScaleFactorUpdate')
         except Exception, e:
             log.msg('Error updating host scale factors. Message: %s' % str(e), system='sgas.HostScaleFactorUpdate')
@@ -3,11 +3,22 @@ Query builder SGAS queryengine.
 
 Used for creating SQL query from a set of query arguments.
 
+Queries which do not need daily resolution are answered from the monthly or
+yearly rollups of the aggregation table, when the requested period is aligned
+to months or years, as the result is then the same as from the daily
+aggregation.
+
 Author: Henrik Thostrup Jensen <htj@ndgf.org>
 Copyright: Nordic Data Grid Facility (2010)
 """
 
 
+# views answering the queries, and their execution time column
+DAILY   = ('uraggregated',         'execution_time')
+MONTHLY = ('uraggregated_monthly', 'execution_period')
+YEARLY  = ('uraggregated_yearly',  'execution_period')
+
+
 
 def buildQuery(query_args):
 
@@ -20,7 +31,8 @@ def buildQuery(query_args):
 
     assert time_resolution in ['day', 'month', 'collapse'], 'Invalid time resolution specified'
 
-    date_extract, date_grouping = _getStartEndDatesAndGrouping(query_args)
+    view, time_column = _getView(start_date, end_date, time_resolution)
+    date_extract, date_grouping = _getStartEndDatesAndGrouping(query_args, time_column)
 
     query_args = [] # RENAME me!
 
@@ -28,8 +40,8 @@ def buildQuery(query_args):
     query += date_extract
 
     query += "sum(n_jobs), sum(cputime), sum(walltime) "
-    query += "FROM uraggregated "
-    query += "WHERE execution_time >= %s AND execution_time < %s "
+    query += "FROM %s " % view
+    query += "WHERE %s >= %%s AND %s < %%s " % (time_column, time_column)
     query_args.append(start_date)
     query_args.append(end_date)
 
@@ -57,7 +69,23 @@ def buildQuery(query_args):
 
 
 
-def _getStartEndDatesAndGrouping(query_args):
+def _getView(start_date, end_date, time_resolution):
+    # the coarsest aggregation which gives the same result as the daily one
+    if time_resolution == 'day':
+        return DAILY
+
+    # the dates are iso dates, possibly with a time
+    start, end = str(start_date)[:10], str(end_date)[:10]
+
+    if time_resolution == 'collapse' and start.endswith('-01-01') and end.endswith('-01-01'):
+        return YEARLY
+    if start.endswith('-01') and end.endswith('-01'):
+        return MONTHLY
+    return DAILY
+
+
+
+def _getStartEndDatesAndGrouping(query_args, time_column='execution_time'):
 
     time_resolution = query_args.get('time_resolution')
 
@@ -77,9 +105,14 @@ def _getStartEndDatesAndGrouping(query_args):
                 "date_part('day', (date_part('year', execution_time) || '-' || date_part('month', execution_time) || '-01') ::date  + '1 month'::interval - '1 day'::interval), "
                 # last line for getting the last day of the month
         group = "date_part('year', execution_time) || '-' || date_part('month', execution_time),"
+        dates = dates.replace('execution_time', time_column)
+        group = group.replace('execution_time', time_column)
 
     elif time_resolution == 'collapse':
-        dates = "min(execution_time), max(execution_time), "
+        if time_column == 'execution_time':
+            dates = "min(execution_time), max(execution_time), "
+        else:
+            dates = "min(min_execution_time), max(max_execution_time), "
         group = ''
 
     return dates, group
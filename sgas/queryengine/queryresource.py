@@ -10,9 +10,9 @@ Copyright: Nordic Data Grid Facility (2010)
 from twisted.python import log
 from twisted.web import resource, server
 
-from sgas.ext.python import json
+from sgas.database import error as dberror
 from sgas.authz import rights, ctxsetchecker
-from sgas.server import resourceutil
+from sgas.server import resourceutil, jsonstream
 from sgas.queryengine import parser as queryparser, builder as querybuilder, rowrp as queryrowrp
 
 
@@ -44,9 +44,9 @@ class QueryResource(resource.Resource):
 
 
     def queryDatabase(self, query_args):
+        # the rows are streamed, so large results are never held in memory
         query, query_args = querybuilder.buildQuery(query_args)
-        d = self.db.query(query, query_args)
-        return d
+        return self.db.streamQuery(query, query_args)
 
 
     def render_GET(self, request):
@@ -68,28 +68,30 @@ class QueryResource(resource.Resource):
         hostname = resourceutil.getHostname(request)
         log.msg('Accepted query request from %s' % hostname, system='sgas.QueryResource')
 
-        def gotDatabaseResult(rows):
-            records = queryrowrp.buildDictRecords(rows, query_args)
-            payload = json.dumps(records)
-            request.setHeader(HTTP_HEADER_CONTENT_TYPE, JSON_MIME_TYPE)
-            request.write(payload)
-            request.finish()
+        def gotDatabaseResult(n_rows):
+            log.msg('Query result: %s rows' % n_rows, system='sgas.QueryResource')
 
         def queryError(error):
-            log.msg('Queryengine error: %s' % str(error), system='sgas.QueryResource')
-            log.msg('Queryengine error args' % str(query_args), system='sgas.QueryResource')
-            request.setResponseCode(500)
-            request.write('Queryengine error (%s)' % str(error), system='sgas.QueryResource')
+            # only called if nothing has been written, so an error response can be written
+            log.msg('Queryengine error: %s' % error.getErrorMessage(), system='sgas.QueryResource')
+            log.msg('Queryengine error args: %s' % str(query_args), system='sgas.QueryResource')
+            if error.check(dberror.DatabaseUnavailableError):
+                # the database is down or too busy, which is not an error in the query
+                request.setResponseCode(503) # service unavailable
+                request.write('Database currently unavailable. Please try again later.')
+            else:
+                log.err(error, system='sgas.QueryResource')
+                request.setResponseCode(500)
+                request.write('Queryengine error (%s)' % error.getErrorMessage())
             request.finish()
 
         def resultHandlingError(error):
-            log.msg('Query result error: %s' % str(error), system='sgas.QueryResource')
-            log.msg('Query result error args' % str(query_args), system='sgas.QueryResource')
-            request.setResponseCode(500)
-            request.write('Query result error (%s)' % str(error), system='sgas.QueryResource')
-            request.finish()
+            # the response has been finished, or the connection is gone, so it can only be logged
+            log.msg('Query result error args: %s' % str(query_args), system='sgas.QueryResource')
+            log.err(error, 'Query result error', system='sgas.QueryResource')
 
-        d = self.queryDatabase(query_args)
+        producer = jsonstream.JSONArrayProducer(request, self.queryDatabase(query_args), queryrowrp.buildDictRecord)
+        d = producer.start()
         d.addCallbacks(gotDatabaseResult, queryError)
         d.addErrback(resultHandlingError)
         return server.NOT_DONE_YET
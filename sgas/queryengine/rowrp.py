@@ -8,31 +8,19 @@ Copyright: Nordic Data Grid Facility (2010)
 """
 
 
-def buildDictRecords(rows, query_args):
+# this enables us to more flexible in the future (and vo_name was optional in earlier releases)
+COLUMNS = ( 'machine_name', 'user_identity', 'vo_name', 'start_date', 'end_date', 'n_jobs', 'cpu_time', 'wall_time' )
+
 
-    records = []
 
-    mapping = {}
+def buildDictRecord(row):
 
-    i = 0
+    assert len(row) == len(COLUMNS), 'Rows structure assertion failed (%i/%i)' % (len(row), len(COLUMNS))
+    return dict(zip(COLUMNS, row))
 
-    # this enables us to more flexible in the future (and vo_name was optional in earlier releases)
-    mapping[i] = 'machine_name'   ; i += 1
-    mapping[i] = 'user_identity'  ; i += 1
-    mapping[i] = 'vo_name'        ; i += 1
-    mapping[i] = 'start_date'     ; i += 1
-    mapping[i] = 'end_date'       ; i += 1
-    mapping[i] = 'n_jobs'         ; i += 1
-    mapping[i] = 'cpu_time'       ; i += 1
-    mapping[i] = 'wall_time'      ; i += 1
 
-    for row in rows:
-        assert len(row) == i, 'Rows structure assertion failed (%i/%i)' % (len(row), i)
 
-        d = {}
-        for j in range(0,i):
-            d[mapping[j]] = row[j]
-        records.append(d)
+def buildDictRecords(rows, query_args):
 
-    return records
+    return [ buildDictRecord(row) for row in rows ]
 
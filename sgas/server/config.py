@@ -16,12 +16,25 @@ from sgas.ext.python import ConfigDict
 # configuration defaults
 DEFAULT_AUTHZ_FILE            = '/etc/sgas.authz'
 DEFAULT_HOSTNAME_CHECK_DEPTH  = '2'
+DEFAULT_PARSER_WORKERS        = '0'
+DEFAULT_AGGREGATION_BATCH_SIZE = '100'
+DEFAULT_AGGREGATION_WORKERS   = '1'
 
 # server options
 SERVER_BLOCK         = 'server'
 DB                   = 'db'
 AUTHZ_FILE           = 'authzfile'
 HOSTNAME_CHECK_DEPTH = 'check_depth'
+PARSER_WORKERS       = 'parser_workers'
+SPOOL_DIR            = 'spool_dir'
+AGGREGATION_BATCH_SIZE = 'aggregation_batch_size'
+AGGREGATION_WORKERS  = 'aggregation_workers'
+# size and queue limit of each database connection pool (ingest, aggregation, read)
+DB_POOL_SIZE         = 'db_%s_pool_size'
+DB_QUEUE_LIMIT       = 'db_%s_queue_limit'
+# read only replicas (hot standbys) to run queries on, and their maximum lag in seconds
+DB_REPLICAS          = 'db_replicas'
+DB_REPLICA_MAX_LAG   = 'db_replica_max_lag'
 
 # the following are no longer used, but are used to issue warnings
 HOSTKEY              = 'hostkey'
@@ -53,6 +66,9 @@ def readConfig(filename):
     cfg.add_section(SERVER_BLOCK)
     cfg.set(SERVER_BLOCK, AUTHZ_FILE,           DEFAULT_AUTHZ_FILE)
     cfg.set(SERVER_BLOCK, HOSTNAME_CHECK_DEPTH, DEFAULT_HOSTNAME_CHECK_DEPTH)
+    cfg.set(SERVER_BLOCK, PARSER_WORKERS,       DEFAULT_PARSER_WORKERS)
+    cfg.set(SERVER_BLOCK, AGGREGATION_BATCH_SIZE, DEFAULT_AGGREGATION_BATCH_SIZE)
+    cfg.set(SERVER_BLOCK, AGGREGATION_WORKERS,  DEFAULT_AGGREGATION_WORKERS)
 
     fp = open(filename)
     proxy_fp = MultiLineFileReader(fp)
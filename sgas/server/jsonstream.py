@@ -0,0 +1,124 @@
+"""
+Incremental JSON encoding of query results.
+
+Writes the rows of a query stream (see sgas.database.postgresql.querystream)
+to a request as a JSON array, one batch at a time, instead of serializing the
+entire result before writing it. The output is the same as json.dumps of the
+list of all rows.
+
+The producer is registered as a streaming producer on the request, so when
+the send buffer of the connection fills up, the stream (and with that the
+reading from the database) is paused until the client has caught up, and it
+is stopped if the client goes away.
+"""
+
+from zope.interface import implementer
+
+from twisted.python import log
+from twisted.internet import interfaces
+
+from sgas.ext.python import json
+
+
+JSON_MIME_TYPE = 'application/json'
+HTTP_HEADER_CONTENT_TYPE = 'content-type'
+
+ARRAY_START     = '['
+ARRAY_SEPARATOR = ', ' # the item separator used by json.dumps
+ARRAY_END       = ']'
+
+
+
+@implementer(interfaces.IPushProducer)
+class JSONArrayProducer:
+    """
+    Writes the rows of a stream to a request as a JSON array. If build_record
+    is given, each row is passed through it before being encoded.
+    """
+    def __init__(self, request, stream, build_record=None):
+        self.request = request
+        self.stream = stream
+        self.build_record = build_record
+        self.encode = json.JSONEncoder().encode
+
+        self.started = False # if anything has been written
+        self.disconnected = False
+
+
+    def start(self):
+        """
+        Starts the stream. The returned deferred fires with the number of rows
+        when the response has been finished. If the query fails before
+        anything has been written, the deferred errbacks, so that an error
+        response can be written, otherwise the connection is closed.
+        """
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addErrback(self._connectionLost)
+
+        d = self.stream.start(self.writeRows)
+        d.addCallbacks(self._streamDone, self._streamFailed)
+        return d
+
+
+    def writeRows(self, rows):
+        if self.disconnected:
+            return
+        if self.build_record is not None:
+            rows = [ self.build_record(row) for row in rows ]
+
+        # the batch is encoded as an array in one call, which is a lot faster
+        # than encoding the rows one by one, and the brackets are stripped
+        chunk = self.encode(rows)[1:-1]
+        if self.started:
+            self.request.write(ARRAY_SEPARATOR + chunk)
+        else:
+            self._startArray()
+            self.request.write(ARRAY_START + chunk)
+
+
+    def _startArray(self):
+        # the header is only set once the query has succeeded, as an error
+        # response is written if it fails
+        self.started = True
+        self.request.setHeader(HTTP_HEADER_CONTENT_TYPE, JSON_MIME_TYPE)
+
+
+    def _streamDone(self, n_rows):
+        self.request.unregisterProducer()
+        if not self.disconnected:
+            if not self.started:
+                self._startArray()
+                self.request.write(ARRAY_START)
+            self.request.write(ARRAY_END)
+            self.request.finish()
+        return n_rows
+
+
+    def _streamFailed(self, failure):
+        self.request.unregisterProducer()
+        if not self.started:
+            return failure
+        # the status has been sent, so the error cannot be reported to the
+        # client, other than by not completing the response
+        log.msg('Error while streaming query result: %s' % failure.getErrorMessage(), system='sgas.JSONArrayProducer')
+        if not self.disconnected:
+            self.request.transport.loseConnection()
+
+
+    def _connectionLost(self, failure):
+        self.disconnected = True
+        self.stream.stop()
+
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        self.stream.pause()
+
+
+    def resumeProducing(self):
+        self.stream.resume()
+
+
+    def stopProducing(self):
+        self.stream.stop()
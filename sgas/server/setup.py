@@ -9,7 +9,9 @@ from twisted.web import resource, server
 from sgas import __version__
 from sgas.authz import engine
 from sgas.server import config, messages, topresource, loadclass
-from sgas.database.postgresql import database as pgdatabase, hostscale
+from sgas.database import spool
+from sgas.database.postgresql import database as pgdatabase, hostscale, replicas
+from sgas.viewengine import viewresource
 
 
 
@@ -89,7 +91,43 @@ def createSGASServer(config_file=DEFAULT_CONFIG_FILE, no_authz=False, port=None)
     db_url = cfg.get(config.SERVER_BLOCK, config.DB)
     if db_url.startswith('http'):
         raise ConfigurationError('CouchDB no longer supported. Please upgrade to PostgreSQL')
-    db = pgdatabase.PostgreSQLDatabase(db_url)
+    # unless configured, the aggregation pool has a connection for each
+    # aggregation worker, and for the storage and WLCG updaters
+    pool_sizes = { pgdatabase.AGGREGATION_POOL: max(pgdatabase.DEFAULT_POOL_SIZES[pgdatabase.AGGREGATION_POOL],
+                                                    cfg.getint(config.SERVER_BLOCK, config.AGGREGATION_WORKERS) + 2) }
+    queue_limits = {}
+    for pool in pgdatabase.POOLS:
+        try:
+            if cfg.has_option(config.SERVER_BLOCK, config.DB_POOL_SIZE % pool):
+                pool_sizes[pool] = cfg.getint(config.SERVER_BLOCK, config.DB_POOL_SIZE % pool)
+            if cfg.has_option(config.SERVER_BLOCK, config.DB_QUEUE_LIMIT % pool):
+                queue_limits[pool] = cfg.getint(config.SERVER_BLOCK, config.DB_QUEUE_LIMIT % pool)
+        except ValueError: # in case casting goes wrong
+            raise ConfigurationError('Configured size or queue limit of the %s pool is invalid' % pool)
+        if pool_sizes.get(pool, 1) < 1 or queue_limits.get(pool, 0) < 0:
+            raise ConfigurationError('Configured size or queue limit of the %s pool is invalid' % pool)
+    # replicas are given like the db option, separated by commas or whitespace
+    replica_infos = []
+    if cfg.has_option(config.SERVER_BLOCK, config.DB_REPLICAS):
+        replica_infos = cfg.get(config.SERVER_BLOCK, config.DB_REPLICAS).replace(',', ' ').split()
+    max_replica_lag = replicas.DEFAULT_MAX_REPLICA_LAG
+    if cfg.has_option(config.SERVER_BLOCK, config.DB_REPLICA_MAX_LAG):
+        try:
+            max_replica_lag = cfg.getint(config.SERVER_BLOCK, config.DB_REPLICA_MAX_LAG)
+        except ValueError: # in case casting goes wrong
+            raise ConfigurationError('Configured maximum replica lag is invalid')
+        if max_replica_lag < 0:
+            raise ConfigurationError('Configured maximum replica lag is invalid')
+    db = pgdatabase.PostgreSQLDatabase(db_url, pool_sizes, queue_limits, replica_infos, max_replica_lag)
+
+    # write-behind spool for registrations (must be attached before the site is created)
+    if cfg.has_option(config.SERVER_BLOCK, config.SPOOL_DIR):
+        db.attachSpool(spool.RecordSpool(cfg.get(config.SERVER_BLOCK, config.SPOOL_DIR)))
+
+    # precomputed monthly data for the WLCG views (must be attached before the site is created)
+    if cfg.has_option(viewresource.PLUGIN_CFG_BLOCK, viewresource.WLCG_CONFIG_FILE):
+        from sgas.viewengine import wlcgmonthly
+        db.attachWLCGMonthly(wlcgmonthly.WLCGMonthly(db, cfg.get(viewresource.PLUGIN_CFG_BLOCK, viewresource.WLCG_CONFIG_FILE)))
 
     # hs.setServiceParent(db)
 
@@ -6,8 +6,13 @@ Author: Henrik Thostrup Jensen
 Copyright: NorduNET / Nordic Data Grid Facility (2010, 2011)
 """
 
+import time
+
 from twisted.python import log
 
+from sgas.generic import recordspec
+from sgas.storagerecord import srelements as sr, srsplitter, srparser, srspec
+
 
 
 ARG_LIST = [
@@ -34,6 +39,15 @@ ARG_LIST = [
     'insert_time'
 ]
 
+RECORD_ID_IDX       = ARG_LIST.index('record_id')
+STORAGE_SYSTEM_IDX  = ARG_LIST.index('storage_system')
+INSERT_IDENTITY_IDX = ARG_LIST.index('insert_identity')
+INSERT_HOSTNAME_IDX = ARG_LIST.index('insert_hostname')
+INSERT_TIME_IDX     = ARG_LIST.index('insert_time')
+
+# compiled parser, converts storage record elements directly into insert arguments
+RECORD_PARSER = recordspec.RecordParser(sr.STORAGE_USAGE_RECORD, srspec.FIELDS, ARG_LIST, 'sgas.StorageRecord')
+
 
 
 def createInsertArguments(storagerecord_docs, insert_identity=None, insert_hostname=None):
@@ -51,3 +65,23 @@ def createInsertArguments(storagerecord_docs, insert_identity=None, insert_hostn
 
     return args
 
+
+
+def parseInsertArguments(storagerecord_data, insert_identity=None, insert_hostname=None, insert_time=None):
+    """
+    Split, parse and convert a storage record document into insert arguments.
+    """
+    if insert_time is not None:
+        insert_time = time.strftime(srparser.JSON_DATETIME_FORMAT, insert_time)
+
+    arg_list = []
+
+    for sr_element in srsplitter.splitSRDocument(storagerecord_data):
+        args = RECORD_PARSER.parse(sr_element)
+        args[INSERT_IDENTITY_IDX] = insert_identity
+        args[INSERT_HOSTNAME_IDX] = insert_hostname
+        args[INSERT_TIME_IDX]     = insert_time
+        arg_list.append(args)
+
+    return arg_list
+
@@ -10,67 +10,10 @@ import time
 
 from twisted.python import log
 
-from sgas.ext import isodate
+from sgas.generic.valueparser import JSON_DATETIME_FORMAT, parseInt, parseISODateTime # re-exported
 from sgas.storagerecord import srelements as sr
 
 
-# date constants
-ISO_TIME_FORMAT   = "%Y-%m-%dT%H:%M:%SZ" # if we want to convert back some time
-JSON_DATETIME_FORMAT = "%Y %m %d %H:%M:%S"
-
-
-# These should be moved an independant module for reuse
-
-
-def parseBoolean(value):
-    if value == '1' or value.lower() == 'true':
-        return True
-    elif value == '0' or value.lower() == 'false':
-        return False
-    else:
-        log.msg('Failed to parse value %s into boolean' % value, system='sgas.UsageRecord')
-        return None
-
-
-def parseInt(value):
-    try:
-        return int(value)
-    except ValueError:
-        log.msg("Failed to parse float: %s" % value, system='sgas.UsageRecord')
-        return None
-
-
-def parseFloat(value):
-    try:
-        return float(value)
-    except ValueError:
-        log.msg("Failed to parse float: %s" % value, system='sgas.UsageRecord')
-        return None
-
-
-def parseISODuration(value):
-    try:
-        td = isodate.parse_duration(value)
-        return (td.days * 3600*24) + td.seconds # screw microseconds
-    except ValueError:
-        log.msg("Failed to parse duration: %s" % value, system='sgas.UsageRecord')
-        return None
-
-
-def parseISODateTime(value):
-    try:
-        dt = isodate.parse_datetime(value)
-        return time.strftime(JSON_DATETIME_FORMAT, dt.utctimetuple())
-    except ValueError, e:
-        log.msg("Failed to parse datetime value: %s (%s)" % (value, str(e)), system='sgas.UsageRecord')
-        return None
-    except isodate.ISO8601Error, e:
-        log.msg("Failed to parse ISO datetime value: %s (%s)" % (value, str(e)), system='sgas.UsageRecord')
-        return None
-
-
-# ---
-
 
 def xmlToDict(sr_doc, insert_identity=None, insert_hostname=None, insert_time=None):
     # Convert a storage usage record xml element into a dictionaries
@@ -0,0 +1,43 @@
+"""
+Storage record spec. Describes how the elements of a storage usage record are
+converted into insert arguments (see sgas.generic.recordspec).
+
+The result is the same as srparser.xmlToDict followed by
+srconverter.createInsertArguments, but without the intermediate dictionary.
+"""
+
+from sgas.generic.recordspec import Value, Custom, Attributes, Container
+from sgas.storagerecord import srelements as sr
+from sgas.storagerecord.srparser import parseInt, parseISODateTime
+
+
+
+def parseGroupAttribute(element, group_attributes):
+    group_attribute = [ element.get(sr.ATTRIBUTE_TYPE), element.text ]
+    return (group_attributes or []) + [ group_attribute ]
+
+
+
+FIELDS = [
+    Attributes(sr.RECORD_IDENTITY, [ (sr.RECORD_ID,   'record_id',    None),
+                                     (sr.CREATE_TIME, 'create_time',  parseISODateTime) ]),
+    Value(sr.STORAGE_SYSTEM,            'storage_system'),
+    Value(sr.STORAGE_SHARE,             'storage_share'),
+    Value(sr.STORAGE_MEDIA,             'storage_media'),
+    Value(sr.STORAGE_CLASS,             'storage_class'),
+    Value(sr.SITE,                      'site'),
+    Value(sr.FILE_COUNT,                'file_count',               parseInt),
+    Value(sr.DIRECTORY_PATH,            'directory_path'),
+    Container(sr.SUBJECT_IDENTITY, [
+        Value(sr.LOCAL_USER,            'local_user'),
+        Value(sr.LOCAL_GROUP,           'local_group'),
+        Value(sr.USER_IDENTITY,         'user_identity'),
+        Value(sr.GROUP,                 'group'),
+        Custom(sr.GROUP_ATTRIBUTE,      'group_attribute',          parseGroupAttribute)
+    ]),
+    Value(sr.START_TIME,                'start_time',               parseISODateTime),
+    Value(sr.END_TIME,                  'end_time',                 parseISODateTime),
+    Value(sr.RESOURCE_CAPACITY_USED,    'resource_capacity_used',   parseInt),
+    Value(sr.LOGICAL_CAPACITY_USED,     'logical_capacity_used',    parseInt)
+]
+
@@ -25,7 +25,10 @@ def splitSRDocument(sr_data):
     storage_records = []
 
     try:
-        tree  = ET.fromstring(sr_data)
+        if hasattr(sr_data, 'read'):
+            tree = ET.parse(sr_data).getroot()
+        else:
+            tree = ET.fromstring(sr_data)
     except Exception, e:
         raise ParseError("Error parsing storage record data (%s)" % str(e))
 
@@ -18,7 +18,7 @@ import psycopg2.extensions # not used, but enables tuple adaption
 from sgas.authz import rights, ctxinsertchecker
 from sgas.generic.insertresource import GenericInsertResource
 from sgas.database import error as dberror
-from sgas.storagerecord import srsplitter, srparser, srconverter
+from sgas.storagerecord import srconverter, updater
 
 ACTION_STORAGE_INSERT   = 'storageinsert'
 CTX_STORAGE_SYSTEM  = 'storage_system'
@@ -43,6 +43,12 @@ class StorageUsageRecordInsertResource(GenericInsertResource):
         authorizer.rights.addOptions(ACTION_STORAGE_INSERT,[ rights.OPTION_ALL ])
         authorizer.rights.addContexts(ACTION_STORAGE_INSERT,[ CTX_STORAGE_SYSTEM ])
 
+        self.updater = updater.StorageAggregationUpdater(db)
+        db.attachService(self.updater)
+
+        if db.spool is not None:
+            db.spool.registerHandler(self.PLUGIN_ID, lambda arg_list : self.insertStorageUsageArguments(db, arg_list))
+
     def insertRecords(self, data, subject, hostname):
         return self._insertStorageUsageRecords(data, self.db, self.authorizer, subject, hostname)
 
@@ -50,27 +56,34 @@ class StorageUsageRecordInsertResource(GenericInsertResource):
         
         insert_time = time.gmtime()
 
-        sr_docs = []
+        arg_list = srconverter.parseInsertArguments(storagerecord_data, insert_identity, insert_hostname, insert_time)
 
-        for sr_element in srsplitter.splitSRDocument(storagerecord_data):
-            sr_doc = srparser.xmlToDict(sr_element,
-                                    insert_identity=insert_identity,
-                                    insert_hostname=insert_hostname,
-                                    insert_time=insert_time)
-            sr_docs.append(sr_doc)
-
-        storage_systems = set( [ doc.get('storage_system') for doc in sr_docs ] )
+        storage_systems = set( [ args[srconverter.STORAGE_SYSTEM_IDX] for args in arg_list ] )
         ctx = [ ('storage_system', ss) for ss in storage_systems ]
 
         if authorizer.isAllowed(insert_identity, ACTION_STORAGE_INSERT, ctx):
-            return self.insertStorageUsageRecords(db, sr_docs)
+            if db.spool is not None:
+                return self.spoolStorageUsageArguments(db.spool, arg_list)
+            return self.insertStorageUsageArguments(db, arg_list)
         else:
             MSG = 'Subject %s is not allowed to perform insertion for storage systems: %s' % (insert_identity, ','.join(storage_systems))
             return defer.fail(dberror.SecurityError(MSG))
         
         
+    def spoolStorageUsageArguments(self, spool, arg_list):
+
+        # the records are inserted later, so there are no row ids yet
+        d = spool.append(self.PLUGIN_ID, arg_list)
+        d.addCallback(lambda _ : dict( [ (args[srconverter.RECORD_ID_IDX], None) for args in arg_list ] ))
+        return d
+
     def insertStorageUsageRecords(self, db, storagerecord_docs, retry=False):
         
         arg_list = srconverter.createInsertArguments(storagerecord_docs)
-               
-        return db.recordInserter('storage usage', 'srcreate', arg_list)
+        return self.insertStorageUsageArguments(db, arg_list)
+
+    def insertStorageUsageArguments(self, db, arg_list):
+
+        r = db.recordInserter('storage usage', 'srcreate', arg_list)
+        self.updater.updateNotification()
+        return r
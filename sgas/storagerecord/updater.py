@@ -0,0 +1,48 @@
+"""
+Storage aggregation table updater.
+
+Keeps the daily storage snapshots (sraggregated_data) up to date, like
+sgas.usagerecord.updater does for the usage record aggregation. srcreate marks
+the (snapshot date, storage system) pairs of the inserted records for update
+and notifies the sgas_storage_aggregation channel. The updater then recomputes
+the marked pairs with update_sraggregate, one batch per transaction.
+
+Storage records are periodic snapshots, which are not as numerous as usage
+records, so a fixed delay is used before updating.
+"""
+
+from sgas.database.postgresql import notifiedupdater
+
+
+# number of (snapshot date, storage system) pairs recomputed per transaction
+AGGREGATION_BATCH_SIZE = 50
+# seconds to wait before updating, so inserts close together are updated together
+UPDATE_DELAY = 20
+# seconds to wait before updating again, when an update has failed
+RETRY_DELAY = 120
+
+# channel notified by srcreate
+NOTIFY_CHANNEL = 'sgas_storage_aggregation'
+
+
+
+class StorageAggregationUpdater(notifiedupdater.NotifiedUpdater):
+
+    notify_channel  = NOTIFY_CHANNEL
+    description     = 'storage aggregation'
+    log_system      = 'sgas.StorageAggregationUpdater'
+    update_delay    = UPDATE_DELAY
+    retry_delay     = RETRY_DELAY
+
+    def __init__(self, db, batch_size=AGGREGATION_BATCH_SIZE):
+        notifiedupdater.NotifiedUpdater.__init__(self, db)
+        self.batch_size = batch_size
+
+
+    def update(self):
+        # recomputes the marked pairs until there are no more, returns the
+        # number of recomputed pairs. update_sraggregate claims the pairs in
+        # their own statement, and locks against concurrent updaters, so
+        # serializable isolation is not needed
+        return self.db.updateAggregatorBatch('update_sraggregate', (self.batch_size,), self)
+
@@ -18,9 +18,11 @@ import psycopg2
 import psycopg2.extensions # not used, but enables tuple adaption
 
 from sgas.authz import rights, ctxinsertchecker
+from sgas.server import config
+from sgas.generic import parserpool
 from sgas.generic.insertresource import GenericInsertResource
 from sgas.database import error as dberror
-from sgas.usagerecord import ursplitter, urparser, urconverter
+from sgas.usagerecord import urconverter
 
 from sgas.usagerecord import updater
 
@@ -29,6 +31,31 @@ ACTION_INSERT           = 'insert' # backwards compat
 ACTION_JOB_INSERT       = 'jobinsert'
 CTX_MACHINE_NAME        = 'machine_name'
 
+# batches with at least this many records are copied into the database in bulk.
+# by itself, the bulk insertion is faster for any batch size (bench_bulkinsert
+# gives about 2.5x the records/s of urcreate_ids for batches of 10 records, and 2x
+# for 1000 records), but smaller batches are inserted with urcreate_ids, so
+# concurrent registrations of a few records are grouped into one transaction
+# (see groupcommit), instead of each doing a COPY and commit of their own
+BULK_INSERT_THRESHOLD   = 100
+# request bodies larger than this (in bytes) are not handed to the parser workers,
+# as that needs the whole body in memory, but parsed incrementally in the server
+PARSER_POOL_MAX_SIZE    = 4 * 1024 * 1024
+
+
+
+def dataSize(data):
+    # size of a request body, which is either a string or a file object
+    if not hasattr(data, 'read'):
+        return len(data)
+    position = data.tell()
+    data.seek(0, 2)
+    size = data.tell()
+    data.seek(position)
+    return size
+
+
+
 class JobInsertChecker(ctxinsertchecker.InsertChecker):
 
     CONTEXT_KEY = CTX_MACHINE_NAME
@@ -52,8 +79,20 @@ class JobUsageRecordInsertResource(GenericInsertResource):
         authorizer.rights.addOptions(ACTION_JOB_INSERT,[ rights.OPTION_ALL ])
         authorizer.rights.addContexts(ACTION_JOB_INSERT,[ CTX_MACHINE_NAME ])
         
-        self.updater = updater.AggregationUpdater(db)
-        db.attachService(self.updater)
+        self.updater = updater.AggregationUpdater(db, cfg.getint(config.SERVER_BLOCK, config.AGGREGATION_BATCH_SIZE),
+                                                  cfg.getint(config.SERVER_BLOCK, config.AGGREGATION_WORKERS))
+        db.attachUpdater(self.updater)
+        db.registerDimensions(urconverter.DIMENSION_ARGS)
+
+        # parse in worker processes, if configured
+        self.parser_pool = None
+        workers = cfg.getint(config.SERVER_BLOCK, config.PARSER_WORKERS)
+        if workers > 0:
+            self.parser_pool = parserpool.ParserPool(workers)
+            db.attachService(self.parser_pool)
+
+        if db.spool is not None:
+            db.spool.registerHandler(self.PLUGIN_ID, lambda arg_list : self.insertJobUsageArguments(db, arg_list))
 
     def insertRecords(self, data, subject, hostname):
         return self._insertJobUsageRecords(data, self.db, self.authorizer, subject, hostname)
@@ -63,33 +102,49 @@ class JobUsageRecordInsertResource(GenericInsertResource):
         # parse ur data
         insert_time = time.gmtime()
 
-        ur_docs = []
+        if self.parser_pool is None or dataSize(usagerecord_data) > PARSER_POOL_MAX_SIZE:
+            arg_list = urconverter.parseInsertArguments(usagerecord_data, insert_identity, insert_hostname, insert_time)
+            return self._checkAndInsert(arg_list, db, authorizer, insert_identity)
 
-        for ur_element in ursplitter.splitURDocument(usagerecord_data):
-            ur_doc = urparser.xmlToDict(ur_element,
-                                    insert_identity=insert_identity,
-                                    insert_hostname=insert_hostname,
-                                    insert_time=insert_time)
+        # the worker processes need the data as a string
+        if hasattr(usagerecord_data, 'read'):
+            usagerecord_data = usagerecord_data.read()
+        d = self.parser_pool.parse(urconverter.parseInsertArguments, usagerecord_data, insert_identity, insert_hostname, insert_time)
+        d.addCallback(self._checkAndInsert, db, authorizer, insert_identity)
+        return d
 
-            if 'machine_name' not in ur_doc:
-                raise Exception("UR %s from %s / %s has no machine_name" % (ur_doc['record_id'], insert_hostname, ur_doc['end_time']))
-
-            ur_docs.append(ur_doc)
+    def _checkAndInsert(self, arg_list, db, authorizer, insert_identity):
 
         # check authz
-        machine_names = set( [ doc.get(CTX_MACHINE_NAME) for doc in ur_docs ] )
+        machine_names = set( [ args[urconverter.MACHINE_NAME_IDX] for args in arg_list ] )
         ctx = [ (CTX_MACHINE_NAME, mn) for mn in machine_names ]
 
         if authorizer.isAllowed(insert_identity, ACTION_JOB_INSERT, ctx):
-            return self.insertJobUsageRecords(db,ur_docs)
+            if db.spool is not None:
+                return self.spoolJobUsageArguments(db.spool, arg_list)
+            return self.insertJobUsageArguments(db, arg_list)
         else:
             MSG = 'Subject %s is not allowed to perform insertion for machines: %s' % (insert_identity, ','.join(machine_names))
             return defer.fail(dberror.SecurityError(MSG))
 
+    def spoolJobUsageArguments(self, spool, arg_list):
+
+        # the records are inserted later, so there are no row ids yet
+        d = spool.append(self.PLUGIN_ID, arg_list)
+        d.addCallback(lambda _ : dict( [ (args[urconverter.RECORD_ID_IDX], None) for args in arg_list ] ))
+        return d
+
     def insertJobUsageRecords(self, db, usagerecord_docs, retry=False):
 
         arg_list = urconverter.createInsertArguments(usagerecord_docs)
-        
-        r = db.recordInserter('usage', 'urcreate', arg_list)
+        return self.insertJobUsageArguments(db, arg_list)
+
+    def insertJobUsageArguments(self, db, arg_list):
+
+        if len(arg_list) >= BULK_INSERT_THRESHOLD:
+            arg_list = urconverter.removeDuplicateArguments(arg_list)
+            r = db.bulkRecordInserter('usage', urconverter.STAGING_TABLE, urconverter.STAGING_COLUMNS, 'urcreate_bulk', arg_list)
+        else:
+            r = db.recordInserter('usage', 'urcreate_ids', arg_list, dimensions=urconverter.DIMENSION_ARGS)
         self.updater.updateNotification()
-        return r        
+        return r
@@ -38,8 +38,12 @@ class SgasMemory(object):
         return self
     
     def getquoted(self):
-        res = "'(%s,%s,%s)'::sgas_memory" % (adapt(self.amount * self.unit), self.metric, self.type)
+        res = "'%s'::sgas_memory" % self.getcomposite()
         return res
+
+    def getcomposite(self):
+        # composite literal, also used when copying records into the database
+        return "(%s,%s,%s)" % (adapt(self.amount * self.unit), self.metric, self.type)
                
     def parseUnit(self,unit):
         if unit in self.units:
@@ -6,96 +6,479 @@ the aggregation table in PostgreSQL. As this operation can take some time,
 the operation cannot be done in insertion, and must hence be done
 asyncrhronously and a bit clever.
 
-Originally it was planned to use the NOTIFY/LISTEN functionality in PostgreSQL,
-but I could not make it work using adbapi (and it appears other have this
-problem as well).
+The insert functions in the database NOTIFY the sgas_aggregation channel, so
+records inserted by other SGAS servers or tools are also aggregated. As this
+does not work using adbapi, the updater listens on a connection of its own
+(see sgas.database.postgresql.listener). The delay before updating adapts to
+the insert rate and the backlog of inserts waiting to be aggregated.
+
+The progress of the updates, and statistics on the transactions, retries and
+the lag of the aggregation, are kept for monitoring (see getStatus).
 
 Author: Henrik Thostrup Jensen <htj@ndgf.org>
 Copyright: Nordic Data Grid Facility (2010)
 """
 
-import psycopg2
+import math
+import time
+import bisect
 
 from twisted.python import log
-from twisted.internet import defer, reactor
-from twisted.application import service
-from twisted.enterprise import adbapi
+from twisted.internet import defer, reactor, threads
+
+from sgas.database.postgresql import database, rebuild as aggrebuild, notifiedupdater
+
+
+# number of (insert date, machine) pairs updated per transaction
+AGGREGATION_BATCH_SIZE = 100
+# number of new records added to the aggregation per transaction
+DELTA_BATCH_SIZE = 10000
+# number of months of a machine rolled up per transaction
+ROLLUP_BATCH_SIZE = 12
+# number of machines updated in parallel
+AGGREGATION_WORKERS = 1
+# seconds to wait before updating again, when some machines could not be updated
+RETRY_DELAY = 120
+
+# channel notified by the insert functions
+NOTIFY_CHANNEL = 'sgas_aggregation'
+# seconds to wait before updating, when not listening for notifications
+UPDATE_DELAY = 20
+# bounds of the delay when listening, the minimum lets a burst of inserts
+# be aggregated together
+MIN_UPDATE_DELAY = 2
+MAX_UPDATE_DELAY = 120
+# max fraction of the time spent updating, when inserts keep coming
+UPDATE_DUTY_CYCLE = 0.5
+# seconds over which the insert rate is averaged
+INSERT_RATE_WINDOW = 60.0
+# seconds between progress reports while updating
+REPORT_INTERVAL = 30
+
+# upper bounds (seconds) of the buckets of the duration histograms, for the
+# transactions of each phase and for complete updates
+TRANSACTION_DURATION_BUCKETS = (0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60)
+UPDATE_DURATION_BUCKETS = (1, 10, 60, 300, 900, 3600)
+
+# the work waiting for the updater: pairs to recompute, records to add, and months to roll up
+QUERY_BACKLOG = '''SELECT (SELECT count(*) FROM uraggregated_update),
+                          (SELECT count(*) FROM uraggregated_delta),
+                          (SELECT count(*) FROM uraggregated_rollup_update)'''
+# the backlog, and the insert date of the oldest record waiting to be aggregated
+QUERY_STATUS = '''SELECT (SELECT count(*) FROM uraggregated_update),
+                         (SELECT count(*) FROM uraggregated_delta),
+                         (SELECT count(*) FROM uraggregated_rollup_update),
+                         least((SELECT min(insert_time) FROM uraggregated_update),
+                               (SELECT min(insert_time) FROM uraggregated_delta))'''
+# machines with pending updates, the machine with the oldest update first
+QUERY_PENDING_MACHINES = '''SELECT machine_name_id FROM uraggregated_update
+                            GROUP BY machine_name_id ORDER BY min(insert_time)'''
+# machines with new records, which have not been added to the aggregation
+QUERY_DELTA_MACHINES = '''SELECT machine_name_id FROM uraggregated_delta
+                          GROUP BY machine_name_id ORDER BY min(insert_time)'''
+# machines with months where the monthly and yearly rollups must be updated
+QUERY_ROLLUP_MACHINES = '''SELECT machine_name_id FROM uraggregated_rollup_update
+                           GROUP BY machine_name_id ORDER BY min(execution_period)'''
+
+
+
+class AggregationProgress:
+    # progress of the updates, for reporting. an update has three phases,
+    # which are counted in pairs, records, and months
+    PHASES = ('pairs', 'records', 'months')
+
+    def __init__(self, report_interval=REPORT_INTERVAL):
+        self.report_interval = report_interval
+        self.phase              = None
+        self.start_time         = None
+        self.last_report        = None
+        self.last_run_duration  = None
+        self.last_run_finished  = None
+        self.backlog    = dict.fromkeys(self.PHASES, 0)
+        self.done       = dict.fromkeys(self.PHASES, 0)
+        self.duration   = dict.fromkeys(self.PHASES, 0.0)
+        self.phase_start = None
+
+
+    def start(self, backlog, now=None):
+        self.start_time = self.last_report = now or time.time()
+        self.backlog = dict(zip(self.PHASES, backlog))
+        self.done = dict.fromkeys(self.PHASES, 0)
+        self.duration = dict.fromkeys(self.PHASES, 0.0)
+
+
+    def startPhase(self, phase, now=None):
+        self.phase = phase
+        self.phase_start = now or time.time()
+
+
+    def endPhase(self, now=None):
+        self.duration[self.phase] = (now or time.time()) - self.phase_start
+        self.phase = None
+
+
+    def batchDone(self, phase, n, now=None):
+        # called after each transaction
+        now = now or time.time()
+        self.done[phase] += n
+        self.duration[phase] = now - self.phase_start
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            log.msg('Aggregation update in progress: %s' % self.summary(), system='sgas.AggregationUpdater')
+
+
+    def finish(self, now=None):
+        now = now or time.time()
+        self.last_run_duration = now - self.start_time
+        self.last_run_finished = now
+        self.start_time = None
+        log.msg('Aggregation updated in %.1f seconds: %s' % (self.last_run_duration, self.summary()), system='sgas.AggregationUpdater')
+
+
+    def remaining(self, phase):
+        # the work can have grown since the update started, but that is not counted
+        return max(0, self.backlog[phase] - self.done[phase])
+
+
+    def rate(self, phase):
+        if not self.duration[phase]:
+            return 0.0
+        return self.done[phase] / self.duration[phase]
+
+
+    def summary(self):
+        return ', '.join([ '%i %s (%.0f/s, %i remaining)' % (self.done[p], p, self.rate(p), self.remaining(p)) for p in self.PHASES ])
+
+
+    def getProgress(self):
+        progress = { 'updating'          : self.start_time is not None,
+                     'phase'             : self.phase,
+                     'last_run_duration' : self.last_run_duration,
+                     'last_run_finished' : self.last_run_finished }
+        for p in self.PHASES:
+            progress[p + '_done']       = self.done[p]
+            progress[p + '_remaining']  = self.remaining(p)
+            progress[p + '_per_second'] = self.rate(p)
+        return progress
+
+
+
+class DurationHistogram:
+    # counts of durations in fixed buckets, the last bucket is unbounded
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts  = [0] * (len(buckets) + 1)
+        self.count   = 0
+        self.total   = 0.0
+        self.max     = 0.0
+
+
+    def add(self, duration):
+        self.counts[bisect.bisect_left(self.buckets, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+
+    def getHistogram(self):
+        # the buckets are given as (upper bound, count), where null is unbounded
+        return { 'count'   : self.count,
+                 'sum'     : self.total,
+                 'max'     : self.max,
+                 'buckets' : zip(list(self.buckets) + [None], self.counts) }
+
+
+
+class AggregationStats:
+    # statistics of the updates since the updater was started, for monitoring.
+    # the aggregation is caught up, when an update has finished without
+    # failing machines, as everything pending when it started is then
+    # aggregated
+
+    def __init__(self, now=None):
+        self.started = now or time.time()
+        self.transaction_durations = dict( (p, DurationHistogram(TRANSACTION_DURATION_BUCKETS)) for p in AggregationProgress.PHASES )
+        self.update_durations = DurationHistogram(UPDATE_DURATION_BUCKETS)
+        self.retries    = { 'serialization': 0, 'timeout': 0 }
+        self.failures   = 0
+        self.last_catch_up = None
 
 
-class AggregationUpdater(service.Service):
+    def transactionDone(self, phase, duration):
+        self.transaction_durations[phase].add(duration)
 
-    def __init__(self, db):
-        self.db          = db
 
-        self.need_update = False
-        self.updating    = False
-        self.stopping    = False
-        self.update_call = None
-        self.update_def  = None
-        
+    def transactionRetried(self, reason):
+        self.retries[reason] += 1
 
-    def startService(self):
-        service.Service.startService(self)
-        # we might have been shutdown while some updates where pending,
-        # or some records could have been inserted outside SGAS, so we
-        # always schedule an update when starting
-        self.scheduleUpdate()
-        return defer.succeed(None)
+
+    def machineFailed(self):
+        self.failures += 1
+
+
+    def updateDone(self, start_time, duration, complete):
+        self.update_durations.add(duration)
+        if complete:
+            self.caughtUp(start_time)
+
+
+    def caughtUp(self, now=None):
+        self.last_catch_up = max(self.last_catch_up, now or time.time())
+
+
+    def lag(self, now=None):
+        # seconds since the last catch-up. before the first catch-up, the
+        # time since starting is used, as the aggregation is at least that
+        # much behind
+        return (now or time.time()) - (self.last_catch_up or self.started)
+
+
+    def getStats(self, now=None):
+        stats = { 'last_catch_up'           : self.last_catch_up,
+                  'seconds_since_catch_up'  : self.lag(now),
+                  'serialization_retries'   : self.retries['serialization'],
+                  'timeout_retries'         : self.retries['timeout'],
+                  'failed_machines'         : self.failures,
+                  'update_durations'        : self.update_durations.getHistogram() }
+        stats['transaction_durations'] = dict( (p, h.getHistogram()) for p, h in self.transaction_durations.items() )
+        return stats
+
+
+
+class AggregationUpdater(notifiedupdater.NotifiedUpdater):
+
+    notify_channel  = NOTIFY_CHANNEL
+    description     = 'aggregated table'
+    log_system      = 'sgas.AggregationUpdater'
+    update_delay    = UPDATE_DELAY
+    retry_delay     = RETRY_DELAY
+
+    def __init__(self, db, batch_size=AGGREGATION_BATCH_SIZE, workers=AGGREGATION_WORKERS, delta_batch_size=DELTA_BATCH_SIZE,
+                 rollup_batch_size=ROLLUP_BATCH_SIZE):
+        notifiedupdater.NotifiedUpdater.__init__(self, db)
+        self.batch_size  = batch_size
+        self.workers     = workers
+        self.delta_batch_size  = delta_batch_size
+        self.rollup_batch_size = rollup_batch_size
+
+        self.rebuilder   = None
+        self.rebuild_def = None
+
+        # insert transactions notified, but not aggregated yet
+        self.backlog     = 0
+        # insert transactions per second, exponentially decaying average
+        self.insert_rate = 0.0
+        self.insert_time = None
+        # time per insert transaction of the last update
+        self.update_cost = None
+        self.progress    = AggregationProgress()
+        self.stats       = AggregationStats()
+        # set when a machine could not be updated, the update is then incomplete
+        self.update_failed = False
 
 
     def stopService(self):
-        self.stopping = True
-        service.Service.stopService(self)
-        if self.update_call is not None:
-            self.update_call.cancel()
-        if self.update_def is not None:
-            return self.update_def
-        else:
-            return defer.succeed(None)
+        if self.rebuilder is not None:
+            # the rebuild is resumed when started again
+            self.rebuilder.stop()
+        d = notifiedupdater.NotifiedUpdater.stopService(self)
+        return defer.DeferredList([ d ] + [ d for d in (self.rebuild_def,) if d is not None ])
+
+
+    def notification(self, n_transactions, now=None):
+        # records have been inserted by n_transactions transactions (here or
+        # elsewhere), as notified by the database
+        now = now or reactor.seconds()
+        if self.insert_time is not None:
+            self.insert_rate *= math.exp(-(now - self.insert_time) / INSERT_RATE_WINDOW)
+        self.insert_rate += n_transactions / INSERT_RATE_WINDOW
+        self.insert_time = now
+        self.backlog += n_transactions
+        self.updateNotification()
 
 
-    def updateNotification(self):
-        # the database need to be updated, schedule call
-        self.need_update = True
-        self.scheduleUpdate()
+    def updateDelay(self):
+        # the time until the aggregation should be updated. without
+        # notifications the old fixed delay is used. otherwise the delay is
+        # set so that the updater is busy at most UPDATE_DUTY_CYCLE of the
+        # time: an update is expected to take the time per transaction of the
+        # last update, times the backlog and the transactions coming in during
+        # the minimum delay. sporadic inserts are aggregated after the minimum
+        # delay, while a high insert rate or a large backlog gives fewer and
+        # larger updates
+        if self.listener is None or not self.listener.listening:
+            return UPDATE_DELAY
+        if self.update_cost is None:
+            return MIN_UPDATE_DELAY
+        pending = self.backlog + self.insert_rate * MIN_UPDATE_DELAY
+        delay = self.update_cost * pending * (1 - UPDATE_DUTY_CYCLE) / UPDATE_DUTY_CYCLE
+        return max(MIN_UPDATE_DELAY, min(MAX_UPDATE_DELAY, delay))
 
 
-    def scheduleUpdate(self, delay=20):
-        # only schedule call if no other call is planned
-        if self.update_call is None:
-            log.msg('Scheduling update for aggregated table in %i seconds.' % delay, system='sgas.AggregationUpdater')
-            self.update_call = reactor.callLater(delay, self.performUpdate, True)
+    @defer.inlineCallbacks
+    def update(self):
+        # will update the parts of the aggregated data table which has been
+        # specified to need an update in the update table, and then add the
+        # new records to the aggregated data. finally the monthly and yearly
+        # rollups of the changed months are updated. returns the number of
+        # updated pairs, added records, and rolled up months. all database
+        # work is done in pool threads, one transaction at a time, so the
+        # reactor keeps serving requests while updating
+        self.update_failed = False
+        backlog, self.backlog = self.backlog, 0
+        start_time = reactor.seconds()
+        start_clock = time.time()
+        complete = False
+        try:
+            rows = yield self.db.query(QUERY_BACKLOG, pool=database.AGGREGATION_POOL)
+            self.progress.start(rows[0] if rows else (0, 0, 0))
+            results = []
+            for phase, updatePhase in zip(AggregationProgress.PHASES, (self.updatePairs, self.updateDelta, self.updateRollups)):
+                self.progress.startPhase(phase)
+                n = yield updatePhase()
+                self.progress.endPhase()
+                results.append(n)
+            complete = not (self.update_failed or self.stopping)
+        finally:
+            if self.progress.start_time is not None:
+                self.progress.finish()
+            self.stats.updateDone(start_clock, time.time() - start_clock, complete)
+            if backlog:
+                self.update_cost = (reactor.seconds() - start_time) / backlog
+        defer.returnValue(tuple(results))
+
 
+    def updatePairs(self):
+        # recomputes the (insert date, machine) pairs in the update table,
+        # these are the pairs where records have been replaced
+        return self.updateMachines(QUERY_PENDING_MACHINES, 'update_uraggregate_machine', self.batch_size)
 
-    def performUpdate(self, remove_call=False):
-        if remove_call:
-            self.update_call = None
-        if self.updating:
-            # if an update is running, defer this update to (much) later
-            self.scheduleUpdate(delay=120)
+
+    def updateDelta(self):
+        # adds the new records to the aggregated rows, this is done after
+        # the recomputation, as the records of pairs waiting to be
+        # recomputed are left for the recomputation
+        return self.updateMachines(QUERY_DELTA_MACHINES, 'update_uraggregate_delta', self.delta_batch_size)
+
+
+    def updateRollups(self):
+        # recomputes the months of the monthly and yearly rollups, where the
+        # aggregated rows have been changed by the updates above
+        return self.updateMachines(QUERY_ROLLUP_MACHINES, 'update_uraggregate_rollup', self.rollup_batch_size)
+
+
+    @defer.inlineCallbacks
+    def updateMachines(self, query, aggregator, batch_size):
+        # updates the aggregation with several workers, each working on one
+        # machine at a time. returns the sum of the aggregator results
+        rows = yield self.db.query(query, pool=database.AGGREGATION_POOL)
+        machines = [ row[0] for row in rows ]
+        updated = []
+        skipped = []
+
+        @defer.inlineCallbacks
+        def worker():
+            # machines are taken from the shared list, so a machine is only updated by one worker
+            while machines and not self.stopping:
+                machine_name_id = machines.pop(0)
+                try:
+                    # the machine functions lock the machine against concurrent inserts
+                    n = yield self.db.updateAggregatorBatch(aggregator, (machine_name_id, batch_size), self,
+                                                            report=self.reportBatch, retried=self.reportRetry)
+                except Exception, e:
+                    log.msg('Error updating aggregation for machine id %i: %s' % (machine_name_id, str(e)), system='sgas.AggregationUpdater')
+                    self.stats.machineFailed()
+                    self.update_failed = True
+                    skipped.append(machine_name_id)
+                    continue
+                if n == 0:
+                    # updated by someone else in the meantime
+                    skipped.append(machine_name_id)
+                else:
+                    updated.append(n)
+
+        n_workers = min(self.workers, len(machines))
+        yield defer.DeferredList([ worker() for _ in range(n_workers) ])
+
+        if skipped and not self.stopping:
+            log.msg('Aggregation for %i machines could not be updated, retrying later' % len(skipped), system='sgas.AggregationUpdater')
+            self.scheduleUpdate(delay=RETRY_DELAY)
+        if updated:
+            log.msg('Aggregation(%s) updated for %i machines (%i, %i workers)' % (aggregator, len(updated), sum(updated), n_workers), system='sgas.AggregationUpdater')
+        defer.returnValue(sum(updated))
+
+
+    def reportBatch(self, n, duration):
+        # called after each aggregation transaction
+        self.stats.transactionDone(self.progress.phase, duration)
+        self.progress.batchDone(self.progress.phase, n)
+
+
+    def reportRetry(self, reason):
+        # called when an aggregation transaction is retried
+        self.stats.transactionRetried(reason)
+
+
+    def getProgress(self):
+        # progress of the current (or last) update, and the backlog
+        progress = self.progress.getProgress()
+        progress['pending_transactions'] = self.backlog
+        progress['insert_rate'] = self.insert_rate
+        return progress
+
+
+    @defer.inlineCallbacks
+    def getStatus(self):
+        # the backlog of the aggregation in the database, the progress of the
+        # updates, and the statistics, for monitoring. the backlog is read from
+        # the primary, as a lagging replica could show the aggregation caught up
+        rows = yield self.db.query(QUERY_STATUS, pool=database.AGGREGATION_POOL)
+        pending_pairs, pending_records, pending_months, oldest_insert_date = rows[0]
+
+        status = self.getProgress()
+        status.update(self.stats.getStats())
+        if not (pending_pairs or pending_records or pending_months or self.updating):
+            # nothing to aggregate, so the aggregation is up to date. the
+            # catch-up is only recorded by the updates, so reading the status
+            # does not change it
+            status['seconds_since_catch_up'] = 0
+        status['pending_pairs']       = pending_pairs
+        status['pending_records']     = pending_records
+        status['pending_months']      = pending_months
+        status['oldest_pending_insert_date'] = oldest_insert_date
+        defer.returnValue(status)
+
+
+    def rebuild(self, workers=aggrebuild.REBUILD_WORKERS):
+        # rebuilds the aggregation table into a shadow table, which is
+        # swapped in when done. updates continue while rebuilding. a rebuild
+        # which was interrupted (e.g., by stopping the service) is resumed
+        if self.rebuilder is not None:
+            log.msg('Aggregation rebuild already running', system='sgas.AggregationUpdater')
             return defer.succeed(None)
-        else:
-            d = self.updateAggregator()
-            self.update_def = d
-            return d
 
-    # -- end scheduling logic
+        def report(msg):
+            log.msg(msg, system='sgas.AggregationUpdater')
 
-    # @defer.inlineCallbacks
-    def updateAggregator(self):
-        # will update the parts of the aggregated data table which has been
-        # specified to need an update in the update table
-        self.updating = True
-        self.db.updateAggregator('update_uraggregate',self)
-        self.updating = False
+        def rebuildFinished(result):
+            self.rebuilder = None
+            self.rebuild_def = None
+            return result
 
+        def rebuildDone(n_pairs):
+            if n_pairs is not None and not self.stopping:
+                # pairs changed during the rebuild are marked for update
+                self.scheduleUpdate(delay=0)
+            return n_pairs
 
-    def rebuild(self):
-        # will perform a full rebuild of the data in the aggegration table
-        # note that this is can be a fairly heavy operation often taking
-        # several minutes (increasing the work_mem parameter can often lower
-        # the time required)
+        def rebuildError(error):
+            log.err(error, system='sgas.AggregationUpdater')
 
-        # not quite there yet
-        pass
+        self.rebuilder = aggrebuild.Rebuilder(database.connector(self.db.pool_proxy.connect_info), workers, report)
+        d = threads.deferToThread(self.rebuilder.rebuild)
+        d.addBoth(rebuildFinished)
+        d.addCallbacks(rebuildDone, rebuildError)
+        self.rebuild_def = d
+        return d
 
@@ -6,8 +6,13 @@ Author: Henrik Thostrup Jensen
 Copyright: Nordic Data Grid Facility (2010)
 """
 
+import time
+
 from twisted.python import log
 
+from sgas.generic import recordspec
+from sgas.usagerecord import urelements as ur, ursplitter, urparser, urspec
+
 
 
 ARG_LIST = [
@@ -49,6 +54,81 @@ ARG_LIST = [
     'memory'
 ]
 
+# staging table and columns (in ARG_LIST order) used for bulk insertion
+STAGING_TABLE = 'usagedata_staging'
+
+STAGING_COLUMNS = [
+    'record_id',
+    'create_time',
+    'global_job_id',
+    'local_job_id',
+    'local_user',
+    'global_user_name',
+    'vo_type',
+    'vo_issuer',
+    'vo_name',
+    'vo_attributes',
+    'machine_name',
+    'job_name',
+    'charge',
+    'status',
+    'queue',
+    'host',
+    'node_count',
+    'processors',
+    'project_name',
+    'submit_host',
+    'start_time',
+    'end_time',
+    'submit_time',
+    'cpu_duration',
+    'wall_duration',
+    'user_time',
+    'kernel_time',
+    'major_page_faults',
+    'runtime_environments',
+    'exit_code',
+    'downloads',
+    'uploads',
+    'insert_host',
+    'insert_identity',
+    'insert_time',
+    'memory'
+]
+
+RECORD_ID_IDX       = ARG_LIST.index('record_id')
+GLOBAL_JOB_ID_IDX   = ARG_LIST.index('global_job_id')
+MACHINE_NAME_IDX    = ARG_LIST.index('machine_name')
+LOCAL_JOB_ID_IDX    = ARG_LIST.index('local_job_id')
+CREATE_TIME_IDX     = ARG_LIST.index('create_time')
+END_TIME_IDX        = ARG_LIST.index('end_time')
+CHARGE_IDX          = ARG_LIST.index('charge')
+EXIT_CODE_IDX       = ARG_LIST.index('exit_code')
+HOST_IDX            = ARG_LIST.index('host')
+NODE_COUNT_IDX      = ARG_LIST.index('node_count')
+PROCESSORS_IDX      = ARG_LIST.index('processors')
+INSERT_IDENTITY_IDX = ARG_LIST.index('insert_identity')
+INSERT_HOSTNAME_IDX = ARG_LIST.index('insert_hostname')
+INSERT_TIME_IDX     = ARG_LIST.index('insert_time')
+
+# arguments which are dimension values: (index, table, column)
+# urcreate_ids takes the ids of these instead of the values, which allows the
+# server to resolve them using its dimension cache (vo information is always
+# resolved by urcreate_ids, as it is not a single value)
+DIMENSION_ARGS = [
+    (ARG_LIST.index('local_user_id'),           'localuser',            'local_user'),
+    (ARG_LIST.index('global_user_name'),        'globalusername',       'global_user_name'),
+    (ARG_LIST.index('machine_name'),            'machinename',          'machine_name'),
+    (ARG_LIST.index('status'),                  'jobstatus',            'status'),
+    (ARG_LIST.index('queue'),                   'jobqueue',             'queue'),
+    (ARG_LIST.index('host'),                    'host',                 'host'),
+    (ARG_LIST.index('project_name'),            'projectname',          'project_name'),
+    (ARG_LIST.index('submit_host'),             'submithost',           'submit_host'),
+    (ARG_LIST.index('runtime_environments'),    'runtimeenvironment',   'runtime_environment'),
+    (ARG_LIST.index('insert_hostname'),         'inserthost',           'insert_host'),
+    (ARG_LIST.index('insert_identity'),         'insertidentity',       'insert_identity')
+]
+
 
 
 def createInsertArguments(usagerecord_docs, insert_identity=None, insert_hostname=None):
@@ -116,3 +196,101 @@ def createInsertArguments(usagerecord_docs, insert_identity=None, insert_hostnam
 
     return args
 
+
+
+
+# compiled parser, converts usage record elements directly into insert arguments
+RECORD_PARSER = recordspec.RecordParser(ur.JOB_USAGE_RECORD, urspec.FIELDS, ARG_LIST, 'sgas.UsageRecord')
+
+
+
+def fixInsertArguments(args):
+    """
+    Apply the same corrections to the insert arguments of a record, as
+    createInsertArguments does on usage record dictionaries.
+    """
+    # hack for dealing with bad local job ids (see createInsertArguments)
+    lji = args[LOCAL_JOB_ID_IDX]
+    if lji is not None and (len(lji) > 40 or lji.startswith('/')):
+        args[LOCAL_JOB_ID_IDX] = None
+        old_record_id = args[RECORD_ID_IDX]
+        if args[GLOBAL_JOB_ID_IDX] is not None:
+            args[RECORD_ID_IDX] = args[GLOBAL_JOB_ID_IDX]
+        else:
+            args[RECORD_ID_IDX] = (args[MACHINE_NAME_IDX] or '') + ':' + (args[CREATE_TIME_IDX] or '')
+        log.msg('HEURISTIC IN USE. Removed LocalJobId and rewrote recordId from %s to %s' % (old_record_id, args[RECORD_ID_IDX]))
+
+    if args[CHARGE_IDX] is not None:
+        args[CHARGE_IDX] = int(args[CHARGE_IDX])
+
+    if args[EXIT_CODE_IDX] is not None:
+        args[EXIT_CODE_IDX] = args[EXIT_CODE_IDX] & 0377
+
+    host = args[HOST_IDX]
+    if host is not None and len(host) > 2700:
+        args[HOST_IDX] = host[:2699] + '$'
+
+    # backwards logger compatability (see urparser.xmlToDict)
+    if args[PROCESSORS_IDX] is None and args[NODE_COUNT_IDX] is not None:
+        args[PROCESSORS_IDX] = args[NODE_COUNT_IDX]
+        args[NODE_COUNT_IDX] = None
+
+    return args
+
+
+
+def parseInsertArguments(usagerecord_data, insert_identity=None, insert_hostname=None, insert_time=None):
+    """
+    Split, parse and convert a usage record document into insert arguments.
+    This is all the CPU heavy work of an insert, and is what the parser
+    workers run (so the result must be picklable).
+    """
+    if insert_time is not None:
+        insert_time = time.strftime(urparser.JSON_DATETIME_FORMAT, insert_time)
+
+    arg_list = []
+
+    # usagerecord_data can be a string or a file-like object, the splitter
+    # clears each element after it has been converted
+    for ur_element in ursplitter.iterURDocument(usagerecord_data):
+        args = RECORD_PARSER.parse(ur_element)
+        args[INSERT_IDENTITY_IDX] = insert_identity
+        args[INSERT_HOSTNAME_IDX] = insert_hostname
+        args[INSERT_TIME_IDX]     = insert_time
+
+        if args[MACHINE_NAME_IDX] is None:
+            raise Exception("UR %s from %s / %s has no machine_name" % (args[RECORD_ID_IDX], insert_hostname, args[END_TIME_IDX]))
+
+        arg_list.append(fixInsertArguments(args))
+
+    return arg_list
+
+
+
+def removeDuplicateArguments(arg_list):
+    """
+    Remove records with the same record id from a list of insert arguments.
+
+    The same rule as in urcreate is used, i.e., a later record replaces an
+    earlier one, unless it has the same global job id as the earlier one, or its
+    global job id is the same as its record id. This gives the same result as
+    inserting the records one by one, and is needed for bulk insertion, which
+    cannot handle duplicates within a batch.
+    """
+    positions = {}
+    unique_args = []
+
+    for args in arg_list:
+        record_id = args[RECORD_ID_IDX]
+        if record_id in positions:
+            pos = positions[record_id]
+            global_job_id = args[GLOBAL_JOB_ID_IDX]
+            # comparisons with null are false in sql, so a null global job id replaces
+            if global_job_id is not None and global_job_id in (unique_args[pos][GLOBAL_JOB_ID_IDX], record_id):
+                continue
+            unique_args[pos] = args
+        else:
+            positions[record_id] = len(unique_args)
+            unique_args.append(args)
+
+    return unique_args
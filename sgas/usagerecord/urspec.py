@@ -0,0 +1,120 @@
+"""
+Usage record spec. Describes how the elements of a job usage record are
+converted into insert arguments (see sgas.generic.recordspec).
+
+The result is the same as urparser.xmlToDict followed by
+urconverter.createInsertArguments, but without the intermediate dictionary.
+"""
+
+from sgas.generic.recordspec import Value, Sum, Append, Custom, Attributes, Container, Ignore
+from sgas.usagerecord import urelements as ur
+from sgas.usagerecord.urparser import parseBoolean, parseInt, parseFloat, parseISODuration, parseISODateTime
+from sgas.usagerecord.memory import SgasMemory
+
+
+
+def _stringify(value):
+    return unicode(value) if value is not None else None
+
+
+def _subElementValues(element, tags):
+    # values of the sub elements with the given tags (tag -> (key, parse))
+    values = {}
+    for subele in element:
+        try:
+            key, parse = tags[subele.tag]
+        except KeyError:
+            continue
+        values[key] = parse(subele.text) if parse else subele.text
+    return values
+
+
+
+VO_ATTRIBUTE_TAGS = {
+    ur.VO_GROUP.text            : ('group', None),
+    ur.VO_ROLE.text             : ('role',  None)
+}
+
+def parseVOAttribute(element, vo_attributes):
+    attr = _subElementValues(element, VO_ATTRIBUTE_TAGS)
+    vo_attribute = [ _stringify(attr.get('group')), _stringify(attr.get('role')) ]
+    return (vo_attributes or []) + [ vo_attribute ]
+
+
+def parseMemory(element, memory):
+    attrib = element.attrib
+    sgas_memory = SgasMemory(parseInt(element.text), attrib.get(ur.MEMORY_STORAGE_UNIT),
+                             attrib.get(ur.MEMORY_METRIC), attrib.get(ur.MEMORY_TYPE))
+    return (memory or []) + [ sgas_memory ]
+
+
+TRANSFER_TAGS = {
+    ur.TRANSFER_URL.text                    : ('url',           None),
+    ur.TRANSFER_SIZE.text                   : ('size',          parseInt),
+    ur.TRANSFER_START_TIME.text             : ('start_time',    parseISODateTime),
+    ur.TRANSFER_END_TIME.text               : ('end_time',      parseISODateTime),
+    ur.TRANSFER_BYPASS_CACHE.text           : ('bypass_cache',  parseBoolean),
+    ur.TRANSFER_RETRIEVED_FROM_CACHE.text   : ('from_cache',    parseBoolean)
+}
+
+DOWNLOAD_FIELDS = ('url', 'size', 'start_time', 'end_time', 'bypass_cache', 'from_cache')
+UPLOAD_FIELDS   = ('url', 'size', 'start_time', 'end_time')
+
+def parseDownload(element, downloads):
+    dl = _subElementValues(element, TRANSFER_TAGS)
+    return (downloads or []) + [ [ _stringify(dl.get(f)) for f in DOWNLOAD_FIELDS ] ]
+
+
+def parseUpload(element, uploads):
+    ul = _subElementValues(element, TRANSFER_TAGS)
+    return (uploads or []) + [ [ _stringify(ul.get(f)) for f in UPLOAD_FIELDS ] ]
+
+
+
+FIELDS = [
+    Attributes(ur.RECORD_IDENTITY, [ (ur.RECORD_ID,   'record_id',    None),
+                                     (ur.CREATE_TIME, 'create_time',  parseISODateTime) ]),
+    Container(ur.JOB_IDENTITY, [
+        Value(ur.GLOBAL_JOB_ID,     'global_job_id'),
+        Value(ur.LOCAL_JOB_ID,      'local_job_id')
+    ]),
+    Container(ur.USER_IDENTITY, [
+        Value(ur.LOCAL_USER_ID,     'local_user_id'),
+        Value(ur.GLOBAL_USER_NAME,  'global_user_name'),
+        Container(ur.VO, [
+            Value(ur.VO_NAME,       'vo_name'),
+            Value(ur.VO_ISSUER,     'vo_issuer'),
+            Custom(ur.VO_ATTRIBUTE, 'vo_attributes', parseVOAttribute)
+        ], attributes=[ (ur.VO_TYPE, 'vo_type', None) ])
+    ]),
+    Value(ur.JOB_NAME,              'job_name'),
+    Value(ur.STATUS,                'status'),
+    Value(ur.CHARGE,                'charge',               parseFloat),
+    Value(ur.WALL_DURATION,         'wall_duration',        parseISODuration),
+    Sum(ur.CPU_DURATION,            'cpu_duration',         parseISODuration),
+    Value(ur.NODE_COUNT,            'node_count',           parseInt),
+    Value(ur.PROCESSORS,            'processors',           parseInt),
+    Value(ur.START_TIME,            'start_time',           parseISODateTime),
+    Value(ur.END_TIME,              'end_time',             parseISODateTime),
+    Value(ur.PROJECT_NAME,          'project_name'),
+    Value(ur.SUBMIT_HOST,           'submit_host'),
+    Value(ur.MACHINE_NAME,          'machine_name'),
+    Value(ur.HOST,                  'host'),
+    Value(ur.QUEUE,                 'queue'),
+    Value(ur.SUBMIT_TIME,           'submit_time',          parseISODateTime),
+    Ignore(ur.KSI2K_WALL_DURATION,  'Got ksi2k wall duration element, ignoring (deprecated)'),
+    Ignore(ur.KSI2K_CPU_DURATION,   'Got ksi2k cpu duration element, ignoring (deprecated)'),
+    Value(ur.USER_TIME,             'user_time',            parseISODuration),
+    Value(ur.KERNEL_TIME,           'kernel_time',          parseISODuration),
+    Value(ur.EXIT_CODE,             'exit_code',            parseInt),
+    Value(ur.MAJOR_PAGE_FAULTS,     'major_page_faults',    parseInt),
+    Append(ur.SGAS_RUNTIME_ENVIRONMENT, 'runtime_environments'),
+    Append(ur.ARC_RUNTIME_ENVIRONMENT,  'runtime_environments'),
+    Custom(ur.MEMORY,               'memory',               parseMemory),
+    Ignore(ur.LOGGER_NAME),
+    Container(ur.FILE_TRANSFERS, [
+        Custom(ur.FILE_DOWNLOAD,    'downloads',            parseDownload),
+        Custom(ur.FILE_UPLOAD,      'uploads',              parseUpload)
+    ])
+]
+
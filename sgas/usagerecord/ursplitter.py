@@ -7,6 +7,8 @@ Copyright: Nordic Data Grid Facility (2010)
 """
 
 
+import StringIO
+
 from xml.etree import cElementTree as ET
 
 from sgas.usagerecord import urelements as ur
@@ -43,3 +45,49 @@ def splitURDocument(ur_data):
 
     return usage_records
 
+
+
+def iterURDocument(ur_source):
+    """
+    Incremental version of splitURDocument.
+
+    Takes either a string or a file-like object (e.g., request.content) and
+    yields each JobUsageRecord element as soon as it has been parsed. When the
+    consumer asks for the next element, the previous one is cleared and removed
+    from the tree, so memory usage depends on the record size, not the number
+    of records in the document.
+    """
+    if not hasattr(ur_source, 'read'):
+        ur_source = StringIO.StringIO(ur_source)
+
+    root = None
+    depth = 0
+
+    try:
+        for event, element in ET.iterparse(ur_source, events=('start', 'end')):
+
+            if event == 'start':
+                if depth == 0:
+                    if not element.tag in (ur.USAGE_RECORDS, ur.JOB_USAGE_RECORD):
+                        raise ParseError("Top element is not UsageRecords or JobUsageRecord")
+                    root = element
+                elif depth == 1 and root.tag == ur.USAGE_RECORDS:
+                    if not element.tag == ur.JOB_USAGE_RECORD:
+                        raise ParseError("Subelement in UsageRecords doc not a JobUsageRecord")
+                depth += 1
+                continue
+
+            # end event
+            depth -= 1
+            if depth == 1 and root.tag == ur.USAGE_RECORDS:
+                yield element
+                # consumer is done with the element, get rid of it
+                element.clear()
+                root.clear()
+            elif depth == 0 and root.tag == ur.JOB_USAGE_RECORD:
+                yield element
+                element.clear()
+
+    except ET.ParseError, e:
+        raise ParseError("Error parsing ur document (%s)" % str(e))
+
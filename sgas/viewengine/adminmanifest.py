@@ -43,7 +43,7 @@ SELECT DISTINCT machine_name FROM uraggregated WHERE (insert_time = current_date
 """
 
 MACHINES_SR_INSERTED_RECENT = """
-SELECT DISTINCT storage_system FROM storagerecords WHERE insert_time AT TIME ZONE 'UTC' > current_timestamp - interval '24 hours';
+SELECT DISTINCT storage_system FROM sraggregated WHERE insert_time AT TIME ZONE 'UTC' > current_timestamp - interval '24 hours';
 """
 
 STALE_MACHINES_TWO_MONTHS = """
@@ -56,6 +56,16 @@ SELECT DISTINCT machine_name FROM uraggregated WHERE insert_time > current_date
 class AdminManifestResource(baseview.BaseView):
 
 
+    def __init__(self, urdb, authorizer, manifest):
+
+        baseview.BaseView.__init__(self, urdb, authorizer, manifest)
+        urdb.registerStatement('adminmanifest_db_stats', DB_STATS_QUERY)
+        urdb.registerStatement('adminmanifest_inserts_per_day', INSERTS_PER_DAY)
+        urdb.registerStatement('adminmanifest_machines_ur_recent', MACHINES_UR_INSERTED_RECENT)
+        urdb.registerStatement('adminmanifest_machines_sr_recent', MACHINES_SR_INSERTED_RECENT)
+        urdb.registerStatement('adminmanifest_stale_machines', STALE_MACHINES_TWO_MONTHS)
+
+
     def render_GET(self, request):
         subject = resourceutil.getSubject(request)
 
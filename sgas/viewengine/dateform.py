@@ -95,6 +95,51 @@ def dayDelta(start_date, end_date):
 
 
 
+# month periods, used for the precomputed monthly data (see wlcgmonthly)
+
+
+def _parseDate(date):
+    return datetime.date(int(date[0:4]), int(date[5:7]), int(date[8:10]))
+
+
+
+def monthEnd(period):
+    # last day of the month of period (the first day of the month)
+    period = _parseDate(str(period))
+    return str(period.replace(day=calendar.monthrange(period.year, period.month)[1]))
+
+
+
+def monthPeriods(start_date, end_date):
+    # the months (as the first day) of the date range, None if the date
+    # range does not start and end at the ends of months
+    start, end = _parseDate(start_date), _parseDate(end_date)
+    if start.day != 1 or str(end) != monthEnd(end.replace(day=1)) or end < start:
+        return None
+
+    periods = []
+    period = start
+    while period < end:
+        periods.append(str(period))
+        period = _parseDate(monthEnd(period)) + datetime.timedelta(days=1)
+    return periods
+
+
+
+def monthRuns(periods, covered):
+    # the runs of consecutive months in periods which are not covered, as (start date, end date) tuples
+    runs = []
+    for period in periods:
+        if period in covered:
+            continue
+        if runs and str(_parseDate(runs[-1][1]) + datetime.timedelta(days=1)) == period:
+            runs[-1] = (runs[-1][0], monthEnd(period))
+        else:
+            runs.append( (period, monthEnd(period)) )
+    return runs
+
+
+
 def generateMonthFormOptions():
 
     # generate year-month options for entire last year and all months this year
@@ -78,6 +78,17 @@ LIMIT 20;
 class MachineListView(baseview.BaseView):
 
 
+    def __init__(self, urdb, authorizer, manifest):
+
+        baseview.BaseView.__init__(self, urdb, authorizer, manifest)
+        # the machine views are created per request, so their queries are registered here
+        urdb.registerStatement('machineview_list', QUERY_MACHINE_LIST)
+        urdb.registerStatement('machineview_manifest', QUERY_MACHINE_MANIFEST)
+        urdb.registerStatement('machineview_jobs_per_day', QUERY_EXECUTED_JOBS_PER_DAY)
+        urdb.registerStatement('machineview_top_projects', QUERY_TOP10_PROJECTS)
+        urdb.registerStatement('machineview_top_users', QUERY_TOP20_USERS)
+
+
     def getChild(self, path, request):
         return MachineView(self.urdb, self.authorizer, self.manifest, path)
 
@@ -0,0 +1,260 @@
+"""
+Precomputed monthly WLCG data. Part of SGAS viewengine.
+
+The WLCG views process the result of the WLCG query (from wlcgsgas) for the
+date range of every request: the HS06 / KSI2K scaled times are added, as
+given by the WLCG configuration file. As this is the same for every request,
+it is done once per month here, and kept in the wlcg_monthly table.
+
+update_uraggregate_rollup marks the months where the monthly rollup has
+changed in wlcg_monthly_update, and notifies the sgas_wlcg_monthly channel.
+The marked months are then recomputed, one month per transaction. The
+configuration file is checked every CONFIG_CHECK_INTERVAL seconds, and when it
+has changed, all months are recomputed. The months are kept with the digest of
+the configuration they were computed with (wlcg_monthly_period).
+
+The views get the records of a date range with retrieveRecords. Months which
+have been computed with the current configuration, and are not marked for
+update, are looked up in wlcg_monthly. Other months, and date ranges which are
+not whole months, are queried and processed like the views used to.
+
+The tier split is still done by the views, after collapsing the records, as
+the split of the collapsed records need not be the collapsed split records.
+"""
+
+import json
+import hashlib
+import StringIO
+
+from wlcgsgas import query as wlcgquery, dataprocess
+
+from twisted.python import log
+from twisted.internet import defer, task
+
+from sgas.database.postgresql import notifiedupdater, copyformat, typecast
+from sgas.viewengine import dateform
+
+
+# number of months recomputed per transaction
+MONTHS_PER_TRANSACTION = 1
+# seconds to wait before updating, so rollups close together are updated together
+UPDATE_DELAY = 20
+# seconds to wait before updating again, when an update has failed
+RETRY_DELAY = 120
+# seconds between checks for changes of the configuration file
+CONFIG_CHECK_INTERVAL = 60
+
+# channel notified by update_uraggregate_rollup
+NOTIFY_CHANNEL = 'sgas_wlcg_monthly'
+
+# record fields, and the wlcg_monthly columns they are kept in
+RECORD_FIELDS = ( dataprocess.HOST, dataprocess.VO_NAME, dataprocess.VO_GROUP, dataprocess.VO_ROLE,
+                  dataprocess.USER, dataprocess.N_JOBS, dataprocess.CPU_TIME, dataprocess.WALL_TIME,
+                  dataprocess.KSI2K_CPU_TIME, dataprocess.KSI2K_WALL_TIME, dataprocess.HS06_CPU_TIME, dataprocess.HS06_WALL_TIME )
+RECORD_COLUMNS = [ 'machine_name', 'vo_name', 'vo_group', 'vo_role',
+                   'user_identity', 'n_jobs', 'cputime', 'walltime',
+                   'ksi2k_cputime', 'ksi2k_walltime', 'hs06_cputime', 'hs06_walltime' ]
+
+# months which are computed with the configuration, and not marked for update
+QUERY_COVERED_MONTHS = '''SELECT execution_period FROM wlcg_monthly_period
+                          WHERE execution_period >= %s AND execution_period <= %s AND config_digest = %s AND
+                                execution_period NOT IN (SELECT execution_period FROM wlcg_monthly_update)'''
+QUERY_RECORDS       = '''SELECT execution_period, %s FROM wlcg_monthly
+                         WHERE execution_period = ANY (%%s::date[])''' % ', '.join(RECORD_COLUMNS)
+
+# marks the months which are not computed with the configuration
+MARK_MONTHS = '''INSERT INTO wlcg_monthly_update (execution_period)
+                 SELECT execution_period FROM uraggregated_monthly_data
+                 UNION
+                 SELECT execution_period FROM wlcg_monthly_period
+                 EXCEPT
+                 SELECT execution_period FROM wlcg_monthly_period WHERE config_digest = %s
+                 ON CONFLICT DO NOTHING'''
+
+# serializes the recomputation, when several servers use the database
+LOCK_MONTHS   = "SELECT pg_advisory_xact_lock(hashtext('wlcg_monthly'))"
+CLAIM_MONTHS  = '''DELETE FROM wlcg_monthly_update WHERE execution_period IN
+                       (SELECT execution_period FROM wlcg_monthly_update ORDER BY execution_period LIMIT %s)
+                   RETURNING execution_period'''
+DELETE_MONTH  = 'DELETE FROM wlcg_monthly WHERE execution_period = %s'
+UPSERT_PERIOD = '''INSERT INTO wlcg_monthly_period (execution_period, config_digest, generate_time) VALUES (%s, %s, now())
+                   ON CONFLICT (execution_period) DO UPDATE
+                   SET config_digest = EXCLUDED.config_digest, generate_time = EXCLUDED.generate_time'''
+
+
+
+class WLCGConfig:
+
+    def __init__(self, config_file):
+        data = open(config_file).read()
+        wlcg_config = json.loads(data)
+        self.tier_mapping = wlcg_config['tier-mapping']
+        self.tier_shares  = wlcg_config['tier-ratio']
+        self.hepspec06    = wlcg_config['hepspec06']
+        self.default_tier = str(wlcg_config['default-tier'])
+        self.digest       = hashlib.sha1(data).hexdigest()
+
+
+    def processRows(self, rows):
+        # turns the rows of the wlcg query into records, with the scaled times
+        records = dataprocess.rowsToDicts(rows)
+        return dataprocess.addMissingScaleValues(records, self.hepspec06)
+
+
+    def tierSplit(self, records):
+        return dataprocess.tierMergeSplit(records, self.tier_mapping, self.tier_shares, self.default_tier)
+
+
+
+class WLCGMonthly(notifiedupdater.NotifiedUpdater):
+
+    notify_channel  = NOTIFY_CHANNEL
+    description     = 'WLCG monthly data'
+    log_system      = 'sgas.WLCGMonthly'
+    update_delay    = UPDATE_DELAY
+    retry_delay     = RETRY_DELAY
+
+    def __init__(self, db, config_file):
+        notifiedupdater.NotifiedUpdater.__init__(self, db)
+        self.config_file = config_file
+        self.config      = WLCGConfig(config_file)
+
+        db.registerStatement('wlcg_query', wlcgquery.WLCG_QUERY)
+        db.registerStatement('wlcg_covered_months', QUERY_COVERED_MONTHS)
+        db.registerStatement('wlcg_records', QUERY_RECORDS)
+
+        self.config_check = None
+
+
+    def startService(self):
+        d = notifiedupdater.NotifiedUpdater.startService(self)
+        self.config_check = task.LoopingCall(self.checkConfig)
+        self.config_check.start(CONFIG_CHECK_INTERVAL, now=False)
+        # months could have been rolled up, or the configuration changed, while not running
+        self.markMonths()
+        return d
+
+
+    def stopService(self):
+        if self.config_check is not None and self.config_check.running:
+            self.config_check.stop()
+        return notifiedupdater.NotifiedUpdater.stopService(self)
+
+
+    # -- lookup
+
+    @defer.inlineCallbacks
+    def retrieveRecords(self, start_date, end_date):
+        """
+        Returns the records of the date range, with the scaled times.
+        """
+        config = self.config
+        periods = dateform.monthPeriods(start_date, end_date)
+        if periods is None:
+            records = yield self.queryRecords(start_date, end_date, config)
+            defer.returnValue(records)
+
+        rows = yield self.db.query(QUERY_COVERED_MONTHS, (periods[0], periods[-1], config.digest))
+        covered = set( [ str(row[0]) for row in rows ] )
+
+        records = []
+        if covered:
+            rows = yield self.db.query(QUERY_RECORDS, (sorted(covered),))
+            records += [ self.buildRecord(row) for row in rows ]
+        # months which are not computed, or must be recomputed, are queried
+        for run_start, run_end in dateform.monthRuns(periods, covered):
+            run_records = yield self.queryRecords(run_start, run_end, config)
+            records += run_records
+
+        defer.returnValue(records)
+
+
+    @defer.inlineCallbacks
+    def queryRecords(self, start_date, end_date, config):
+        rows = yield self.db.query(wlcgquery.WLCG_QUERY, (start_date, end_date))
+        defer.returnValue(config.processRows(rows))
+
+
+    def buildRecord(self, row):
+        period = str(row[0])
+        record = dict(zip(RECORD_FIELDS, row[1:]))
+        record[dataprocess.YEAR]  = int(period[0:4])
+        record[dataprocess.MONTH] = int(period[5:7])
+        return record
+
+
+    # -- configuration
+
+    def checkConfig(self):
+        # recomputes the months, when the configuration file has changed
+        try:
+            config = WLCGConfig(self.config_file)
+        except (IOError, ValueError, KeyError), e:
+            log.msg('Error reading WLCG configuration file %s: %s' % (self.config_file, str(e)), system='sgas.WLCGMonthly')
+            return
+        if config.digest == self.config.digest:
+            return
+        log.msg('WLCG configuration file %s changed, recomputing monthly data.' % self.config_file, system='sgas.WLCGMonthly')
+        self.config = config
+        return self.markMonths()
+
+
+    def _markMonths(self, txn, digest):
+        txn.execute(MARK_MONTHS, (digest,))
+        return txn.rowcount
+
+
+    def markMonths(self):
+        # marks the months which are not computed with the current configuration
+
+        def marked(n_months):
+            if n_months:
+                log.msg('Marked %i months for update of WLCG monthly data.' % n_months, system='sgas.WLCGMonthly')
+                self.updateNotification()
+
+        def markError(error):
+            log.msg('Error marking months for WLCG monthly data: %s' % error.getErrorMessage(), system='sgas.WLCGMonthly')
+
+        d = self.db.runInteraction(self._markMonths, self.config.digest)
+        d.addCallbacks(marked, markError)
+        return d
+
+
+    # -- updating
+
+    @defer.inlineCallbacks
+    def update(self):
+        # recomputes the marked months until there are no more, returns the
+        # number of recomputed months
+        total = 0
+        while not self.stopping:
+            n = yield self.db.runInteraction(self._recomputeMonths, MONTHS_PER_TRANSACTION, self.config)
+            if not n:
+                break
+            total += n
+        defer.returnValue(total)
+
+
+    def _recomputeMonths(self, txn, max_months, config):
+        # executed in a pool thread, so it is safe to block
+        # the marks are claimed in their own statement, so the wlcg query sees
+        # the rollups of every mark claimed. marks made by rollups after this
+        # wait for the transaction, and then mark the month again
+        txn.execute(LOCK_MONTHS)
+        txn.execute(CLAIM_MONTHS, (max_months,))
+        periods = [ str(row[0]) for row in txn.fetchall() ]
+
+        for period in periods:
+            self.db.statements.execute(txn, wlcgquery.WLCG_QUERY, (period, dateform.monthEnd(period)))
+            # converted like PostgreSQLDatabase.query, so the rows are processed the same way
+            rows = typecast.convertRows(txn.fetchall(), typecast.columnConverters(txn.description))
+            records = config.processRows(rows)
+
+            txn.execute(DELETE_MONTH, (period,))
+            data = copyformat.encodeRows([ [ r.get(f) for f in RECORD_FIELDS ] for r in records ], prefix=(period,))
+            txn.copy_from(StringIO.StringIO(data), 'wlcg_monthly', columns=['execution_period'] + RECORD_COLUMNS)
+            txn.execute(UPSERT_PERIOD, (period, config.digest))
+            log.msg('WLCG monthly data for %s computed: %i records' % (period[0:7], len(records)), system='sgas.WLCGMonthly')
+
+        return len(periods)
+
@@ -7,10 +7,10 @@ Copyright: Nordic Data Grid Facility (2011), Nordic e-Infrastructure Collaborati
 """
 
 import time
-import json
 
-from wlcgsgas import query as wlcgquery, dataprocess
+from wlcgsgas import dataprocess
 
+from twisted.internet import defer
 from twisted.web import server
 
 from sgas.server import resourceutil, config
@@ -58,18 +58,21 @@ class WLCGView(baseview.BaseView):
 
         baseview.BaseView.__init__(self, urdb, authorizer, manifest)
 
+        # the processed WLCG data, shared by the views (created with the database services)
+        self.monthly = urdb.wlcg_monthly
+
         self.subview = {
-            't1summary': ('WLCG T1 Summary', WLCGT1SummaryView(self.urdb, self.authorizer, self.manifest, 't1summary')),
-            'machine'   : ('WLCG machine view', WLCGMachineView(self.urdb, self.authorizer, self.manifest, 'machine')),
-            'vooversight': ('WLCG VO oversight view', WLCGVOOversightView(self.urdb, self.authorizer, self.manifest, 'vooversight')),
-            'machinepermonth'   : ('WLCG machine per month view', WLCGMachinePerMonthView(self.urdb, self.authorizer, self.manifest, 'machinepermonth')),
-            'vo'        : ('WLCG VO view',      WLCGVOView(self.urdb, self.authorizer, self.manifest, 'vo')),
-            'user'      : ('WLCG User view',    WLCGUserView(self.urdb, self.authorizer, self.manifest, 'user')),
-            'tier'      : ('WLCG tier view',    WLCGTierView(self.urdb, self.authorizer, self.manifest, 'tier')),
-            'fulltier'  : ('WLCG full tier view', WLCGFullTierView(self.urdb, self.authorizer, self.manifest, 'fulltier')),
-            'tiersplit' : ('WLCG tier-machine split view', WLCGTierMachineSplitView(self.urdb, self.authorizer, self.manifest, 'tiersplit')),
-            'oversight' : ('WLCG Oversight view', WLCGOversightView(self.urdb, self.authorizer, self.manifest, 'oversight')),
-            'storage'   : ('WLCG Storage view', WLCGStorageView(self.urdb, self.authorizer, self.manifest, 'storage'))
+            't1summary': ('WLCG T1 Summary', WLCGT1SummaryView(self.urdb, self.authorizer, self.manifest, 't1summary', self.monthly)),
+            'machine'   : ('WLCG machine view', WLCGMachineView(self.urdb, self.authorizer, self.manifest, 'machine', self.monthly)),
+            'vooversight': ('WLCG VO oversight view', WLCGVOOversightView(self.urdb, self.authorizer, self.manifest, 'vooversight', self.monthly)),
+            'machinepermonth'   : ('WLCG machine per month view', WLCGMachinePerMonthView(self.urdb, self.authorizer, self.manifest, 'machinepermonth', self.monthly)),
+            'vo'        : ('WLCG VO view',      WLCGVOView(self.urdb, self.authorizer, self.manifest, 'vo', self.monthly)),
+            'user'      : ('WLCG User view',    WLCGUserView(self.urdb, self.authorizer, self.manifest, 'user', self.monthly)),
+            'tier'      : ('WLCG tier view',    WLCGTierView(self.urdb, self.authorizer, self.manifest, 'tier', self.monthly)),
+            'fulltier'  : ('WLCG full tier view', WLCGFullTierView(self.urdb, self.authorizer, self.manifest, 'fulltier', self.monthly)),
+            'tiersplit' : ('WLCG tier-machine split view', WLCGTierMachineSplitView(self.urdb, self.authorizer, self.manifest, 'tiersplit', self.monthly)),
+            'oversight' : ('WLCG Oversight view', WLCGOversightView(self.urdb, self.authorizer, self.manifest, 'oversight', self.monthly)),
+            'storage'   : ('WLCG Storage view', WLCGStorageView(self.urdb, self.authorizer, self.manifest, 'storage', self.monthly))
         }
 
     def getChild(self, path, request):
@@ -110,16 +113,11 @@ class WLCGBaseView(baseview.BaseView):
     viewgroup = 'pub'
     sort = staticmethod(sorted)
 
-    def __init__(self, urdb, authorizer, mfst, path):
+    def __init__(self, urdb, authorizer, mfst, path, monthly):
         self.path = path
+        self.monthly = monthly
         baseview.BaseView.__init__(self, urdb, authorizer, mfst)
 
-        wlcg_config = json.load(open(mfst.getProperty('wlcg_config_file')))
-        self.tier_mapping = wlcg_config['tier-mapping']
-        self.tier_shares  = wlcg_config['tier-ratio']
-        self.hepspec06  = wlcg_config['hepspec06']
-        self.default_tier = str(wlcg_config['default-tier'])
-
 
     def render_GET(self, request):
         subject = resourceutil.getSubject(request)
@@ -140,11 +138,11 @@ class WLCGBaseView(baseview.BaseView):
 
     def retrieveWLCGData(self, start_date, end_date):
 
-        d = self.urdb.query(wlcgquery.WLCG_QUERY, (start_date, end_date))
+        d = self.monthly.retrieveRecords(start_date, end_date)
         return d
 
 
-    def renderWLCGViewPage(self, wlcg_data, request, start_date, end_date, t_query_start):
+    def renderWLCGViewPage(self, wlcg_records, request, start_date, end_date, t_query_start):
 
         t_query = time.time() - t_query_start
 
@@ -153,11 +151,10 @@ class WLCGBaseView(baseview.BaseView):
         # massage data
         #print "L1", len(wlcg_data)
         t_dataprocess_start = time.time()
-        wlcg_records = dataprocess.rowsToDicts(wlcg_data)
-        wlcg_records = dataprocess.addMissingScaleValues(wlcg_records, self.hepspec06)
+        # the records are scaled already (see sgas.viewengine.wlcgmonthly)
         wlcg_records = dataprocess.collapseFields(wlcg_records, self.collapse)
         if self.tier_based:
-            wlcg_records = dataprocess.tierMergeSplit(wlcg_records, self.tier_mapping, self.tier_shares, self.default_tier)
+            wlcg_records = self.monthly.config.tierSplit(wlcg_records)
             if not self.split:
                 wlcg_records = dataprocess.collapseFields(wlcg_records, ( dataprocess.HOST, ) )
         # information on ops vo does not add any value
@@ -352,16 +349,11 @@ class WLCGOversightView(baseview.BaseView):
     # This view is rather different than the others, so it is its own class
     collapse = [ dataprocess.YEAR, dataprocess.MONTH, dataprocess.VO_GROUP, dataprocess.USER ]
 
-    def __init__(self, urdb, authorizer, mfst, path):
+    def __init__(self, urdb, authorizer, mfst, path, monthly):
         self.path = path
+        self.monthly = monthly
         baseview.BaseView.__init__(self, urdb, authorizer, mfst)
 
-        wlcg_config = json.load(open(mfst.getProperty('wlcg_config_file')))
-        self.tier_mapping = wlcg_config['tier-mapping']
-        self.tier_shares  = wlcg_config['tier-ratio']
-        self.default_tier = wlcg_config['default-tier']
-        self.hepspec06  = wlcg_config['hepspec06']
-
 
     def render_GET(self, request):
         subject = resourceutil.getSubject(request)
@@ -393,24 +385,22 @@ class WLCGOversightView(baseview.BaseView):
 
     def retrieveWLCGData(self, start_date, end_date):
 
-        d = self.urdb.query(wlcgquery.WLCG_QUERY, (start_date, end_date))
+        d = self.monthly.retrieveRecords(start_date, end_date)
         return d
 
 
-    def renderWLCGViewPage(self, wlcg_data, request, start_date, end_date, unit, t_query_start):
+    def renderWLCGViewPage(self, wlcg_records, request, start_date, end_date, unit, t_query_start):
 
         t_query = time.time() - t_query_start
         days = dateform.dayDelta(start_date, end_date)
         t_dataprocess_start = time.time()
 
-        wlcg_records = dataprocess.rowsToDicts(wlcg_data)
         # information on ops and dteam vo does not add any value
         wlcg_records = [ rec for rec in wlcg_records if rec[dataprocess.VO_NAME] not in ('dteam', 'ops') ]
 
-        # massage data
-        wlcg_records = dataprocess.addMissingScaleValues(wlcg_records, self.hepspec06)
+        # massage data, the records are scaled already
         wlcg_records = dataprocess.collapseFields(wlcg_records, self.collapse)
-        wlcg_records = dataprocess.tierMergeSplit(wlcg_records, self.tier_mapping, self.tier_shares, self.default_tier)
+        wlcg_records = self.monthly.config.tierSplit(wlcg_records)
         # role must be collapsed after split in order for the tier split to function
         wlcg_records = dataprocess.collapseFields(wlcg_records, [ dataprocess.VO_ROLE ] )
 
@@ -438,7 +428,7 @@ class WLCGOversightView(baseview.BaseView):
             vo_tiers.add(vt)
 
         TOTAL = 'Total'
-        TIER_TOTAL = self.default_tier.split('-')[0].upper()
+        TIER_TOTAL = self.monthly.config.default_tier.split('-')[0].upper()
 
         # calculate total per site
         site_totals = dataprocess.collapseFields(wlcg_records, ( dataprocess.VO_NAME, ) )
@@ -553,11 +543,17 @@ class WLCGT1SummaryView(baseview.BaseView):
 
     collapse = [ dataprocess.YEAR, dataprocess.MONTH, dataprocess.VO_GROUP, dataprocess.USER ]
 
-    # Make a storage query that can be UNIONized with a WLCG_QUERY; Storage
-    # number will be stored in 'n_jobs'
+    # Make a storage query with the columns of a WLCG_QUERY, so the rows can
+    # be made into records the same way; Storage number will be stored in
+    # 'n_jobs'. The storage is taken from the daily storage snapshots of the
+    # last day in the date range with snapshots. This is the last snapshot of
+    # that day for every storage system, share, media, class and group, not
+    # only the records with the latest end time in the range (as the storage
+    # records were queried before). The end date of the range is included as
+    # a whole day.
     storage_query = """
-    SELECT extract(YEAR FROM end_time)::integer  AS year,
-           extract(MONTH FROM end_time)::integer AS month,
+    SELECT extract(YEAR FROM snapshot_date)::integer  AS year,
+           extract(MONTH FROM snapshot_date)::integer AS month,
            'STORAGE' as machine_name,
            CASE WHEN group_identity LIKE 'atlas-%%' THEN
                'atlas'
@@ -572,22 +568,17 @@ class WLCGT1SummaryView(baseview.BaseView):
            0 AS walltime,
            0 AS cputime_scaled,
            0 AS walltime_scaled
-     FROM storagerecords
-     WHERE end_time = (SELECT max(end_time) FROM storagerecords WHERE end_time >= %s AND end_time <= %s) AND
+     FROM sraggregated
+     WHERE snapshot_date = (SELECT max(snapshot_date) FROM sraggregated_data WHERE snapshot_date >= %s AND snapshot_date <= %s) AND
            group_identity NOT IN ('atlas-no', 'atlas-dk')
-     GROUP BY end_time, storage_media, vo_name"""
+     GROUP BY snapshot_date, storage_media, vo_name"""
 
 
-    def __init__(self, urdb, authorizer, mfst, path):
+    def __init__(self, urdb, authorizer, mfst, path, monthly):
         self.path = path
+        self.monthly = monthly
         baseview.BaseView.__init__(self, urdb, authorizer, mfst)
 
-        wlcg_config = json.load(open(mfst.getProperty('wlcg_config_file')))
-        self.tier_mapping = wlcg_config['tier-mapping']
-        self.tier_shares  = wlcg_config['tier-ratio']
-        self.hepspec06  = wlcg_config['hepspec06']
-        self.default_tier = wlcg_config['default-tier']
-        
         cfg = config.readConfig("/etc/sgas.conf") 
         self.db_url = cfg.get(config.SERVER_BLOCK, config.DB)
 
@@ -621,12 +612,13 @@ class WLCGT1SummaryView(baseview.BaseView):
         return server.NOT_DONE_YET
 
 
+    @defer.inlineCallbacks
     def retrieveWLCGData(self, start_date, end_date):
 
-        query = self.storage_query + ' UNION ' + wlcgquery.WLCG_QUERY
-
-        d = self.urdb.query(query, (start_date, end_date, start_date, end_date))
-        return d
+        # the computing records are scaled already
+        comp_records = yield self.monthly.retrieveRecords(start_date, end_date)
+        storage_rows = yield self.urdb.query(self.storage_query, (start_date, end_date))
+        defer.returnValue( (comp_records, dataprocess.rowsToDicts(storage_rows)) )
 
 
     def renderWLCGViewPage(self, wlcg_data, request, start_date, end_date, unit, t_query_start):
@@ -635,22 +627,13 @@ class WLCGT1SummaryView(baseview.BaseView):
         days = dateform.dayDelta(start_date, end_date)
         t_dataprocess_start = time.time()
 
-        wlcg_records = dataprocess.rowsToDicts(wlcg_data)
-        wlcg_records = [ r for r in wlcg_records if r[dataprocess.VO_NAME] in ('alice', 'atlas') ]
-
-        # Separate the records into computing and storage
-        comp_records = []
-        storage_records = []
-        for r in wlcg_records:
-            if r[dataprocess.HOST] == 'STORAGE':
-                storage_records.append(r)
-            else:
-                comp_records.append(r)
+        comp_records, storage_records = wlcg_data
+        comp_records = [ r for r in comp_records if r[dataprocess.VO_NAME] in ('alice', 'atlas') ]
+        storage_records = [ r for r in storage_records if r[dataprocess.VO_NAME] in ('alice', 'atlas') ]
 
         # massage data
-        comp_records = dataprocess.addMissingScaleValues(comp_records, self.hepspec06)
         comp_records = dataprocess.collapseFields(comp_records, self.collapse)
-        comp_records = dataprocess.tierMergeSplit(comp_records, self.tier_mapping, self.tier_shares, self.default_tier)
+        comp_records = self.monthly.config.tierSplit(comp_records)
 
         # Collapse the fields that couldn't be collapsed before the tier-splitting.
         comp_records = [ r for r in comp_records if r['tier'] == u'NDGF-T1' ]
@@ -726,31 +709,31 @@ class WLCGT1SummaryView(baseview.BaseView):
 
 class WLCGStorageView(baseview.BaseView):
 
+    # The storage at the date is the snapshot of each storage system, share,
+    # media, class and group from the first day on or after the date, where
+    # the snapshot overlaps the date. Only groups found in dcache.ndgf.org are
+    # shown.
     WLCG_STORAGE_QUERY = """
-        SELECT storage_share, group_identity, storage_media, (sum(r) / 1099511627776)::integer FROM (
+        SELECT storage_share, group_identity, storage_media, (sum(resource_capacity_used) / 1099511627776)::integer FROM (
             SELECT
-                DISTINCT ON (t.sample, storage_system, ss.storage_share, storage_media, storage_class, sg.group_identity)
-                ss.storage_share, sg.group_identity, storage_media, COALESCE(resource_capacity_used, 0) as r
-            FROM
-                (SELECT %(timestamp)s::timestamp  AS sample) AS t
-                CROSS JOIN (SELECT DISTINCT storage_share  FROM storagerecords WHERE start_time <= %(timestamp)s AND end_time >= %(timestamp)s) AS ss
-                CROSS JOIN (SELECT DISTINCT group_identity FROM storagerecords WHERE storage_system = 'dcache.ndgf.org' AND start_time <= %(timestamp)s AND end_time >= %(timestamp)s) AS sg
-                LEFT OUTER JOIN storagerecords ON (start_time <= t.sample AND end_time >= t.sample AND
-                                                   ss.storage_share = storagerecords.storage_share AND
-                                                   sg.group_identity = storagerecords.group_identity)
-            WHERE resource_capacity_used IS NOT NULL
-            ORDER BY t.sample, storage_system, ss.storage_share, storage_media, storage_class, sg.group_identity, end_time DESC) as s
-        GROUP BY s.storage_share, s.group_identity, storage_media
-        ORDER BY s.storage_share, s.group_identity, storage_media;
+                DISTINCT ON (storage_system, storage_share, storage_media, storage_class, group_identity)
+                storage_system, storage_share, storage_media, group_identity, resource_capacity_used
+            FROM sraggregated
+            WHERE snapshot_date >= %(timestamp)s::date AND start_time < %(timestamp)s::date + 1 AND end_time >= %(timestamp)s AND
+                  storage_share IS NOT NULL AND group_identity IS NOT NULL
+            ORDER BY storage_system, storage_share, storage_media, storage_class, group_identity, snapshot_date, end_time DESC) AS s
+        WHERE group_identity IN (SELECT DISTINCT group_identity FROM sraggregated
+                                 WHERE storage_system = 'dcache.ndgf.org' AND snapshot_date >= %(timestamp)s::date AND
+                                       start_time < %(timestamp)s::date + 1 AND end_time >= %(timestamp)s)
+        GROUP BY storage_share, group_identity, storage_media
+        ORDER BY storage_share, group_identity, storage_media;
     """
 
-    def __init__(self, urdb, authorizer, mfst, path):
+    def __init__(self, urdb, authorizer, mfst, path, monthly):
         self.path = path
+        self.monthly = monthly
         baseview.BaseView.__init__(self, urdb, authorizer, mfst)
 
-        wlcg_config = json.load(open(mfst.getProperty('wlcg_config_file')))
-        self.default_tier = wlcg_config['default-tier']
-
     def render_GET(self, request):
         subject = resourceutil.getSubject(request)
 
@@ -816,7 +799,7 @@ class WLCGStorageView(baseview.BaseView):
         groups = set( [ rec['group'] for rec in records ] )
 
         TOTAL = 'Total'
-        TIER_TOTAL = self.default_tier.split('-')[0].upper()
+        TIER_TOTAL = self.monthly.config.default_tier.split('-')[0].upper()
 
         # calculate totals per site / group
         site_group_totals = {}
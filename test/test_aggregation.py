@@ -0,0 +1,386 @@
+#
+# Aggregation update tests
+#
+
+import time
+
+import psycopg2.extensions
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from sgas.database.postgresql import database
+from sgas.usagerecord import updater
+
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+
+    def time(self):
+        return self.now
+
+
+
+class FakeDatabase(database.PostgreSQLDatabase):
+    # the results of the aggregation batches are scripted, exceptions are raised
+    # a result can be given with the seconds the transaction takes
+
+    def __init__(self, results, clock=None):
+        database.PostgreSQLDatabase.__init__(self, 'localhost::sgas-test:sgas::')
+        self.results = list(results)
+        self.calls = []
+        self.clock = clock or FakeClock()
+
+
+    def _runInteraction(self, interaction, args, retry=False, pool=None):
+        self.calls.append(args[:2])
+        result = self.results.pop(0)
+        if isinstance(result, tuple):
+            result, duration = result
+            self.clock.now += duration
+        if isinstance(result, Exception):
+            return defer.fail(result)
+        return defer.succeed(result)
+
+
+
+class AggregationBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.retry_delay = database.SERIALIZATION_RETRY_DELAY
+        database.SERIALIZATION_RETRY_DELAY = 0
+        self.clock = FakeClock()
+        database.time = self.clock
+
+
+    def tearDown(self):
+        database.SERIALIZATION_RETRY_DELAY = self.retry_delay
+        database.time = time
+
+
+    @defer.inlineCallbacks
+    def testBatches(self):
+
+        db = FakeDatabase( [ 100, 100, 42, 0 ] )
+        n_pairs = yield db.updateAggregatorBatch('update_uraggregate_batch', (100,))
+        self.failUnlessEqual(n_pairs, 242)
+        self.failUnlessEqual(db.calls, [ ('update_uraggregate_batch', (100,)) ] * 4)
+        self.failUnlessEqual(db.results, [])
+
+
+    @defer.inlineCallbacks
+    def testSerializationRetry(self):
+
+        conflict = psycopg2.extensions.TransactionRollbackError('could not serialize access')
+        db = FakeDatabase( [ 10, conflict, conflict, 10, 0 ] )
+        retries = []
+        n_pairs = yield db.updateAggregatorBatch('update_uraggregate_batch', (10,), retried=retries.append)
+        self.failUnlessEqual(n_pairs, 20)
+        self.failUnlessEqual(retries, [ 'serialization', 'serialization' ])
+        self.failUnlessEqual(db.results, [])
+
+
+    @defer.inlineCallbacks
+    def testSerializationRetryGivesUp(self):
+
+        conflict = psycopg2.extensions.TransactionRollbackError('could not serialize access')
+        db = FakeDatabase( [ conflict ] * (database.SERIALIZATION_RETRIES + 1) )
+        d = db.updateAggregatorBatch('update_uraggregate_batch', (10,))
+        yield self.failUnlessFailure(d, psycopg2.extensions.TransactionRollbackError)
+
+
+    @defer.inlineCallbacks
+    def testBatchSizeAdjusted(self):
+
+        # slow transactions give smaller batches, fast ones larger up to the given size
+        db = FakeDatabase( [ (100, 10.0), (20, 2.0), (20, 0.5), (40, 0.5), (80, 1.0), (30, 1.0), (0, 0.1) ], self.clock )
+        reports = []
+        n_pairs = yield db.updateAggregatorBatch('update_uraggregate_batch', (100,), report=lambda n, dt : reports.append( (n, dt) ))
+        self.failUnlessEqual(n_pairs, 290)
+        self.failUnlessEqual([ args[0] for _, args in db.calls ], [ 100, 20, 20, 40, 80, 100, 100 ])
+        self.failUnlessEqual(reports[0], (100, 10.0))
+        self.failUnlessEqual(len(reports), 7)
+
+
+    @defer.inlineCallbacks
+    def testTransactionTimeout(self):
+
+        timeout = psycopg2.extensions.QueryCanceledError('canceling statement due to statement timeout')
+        db = FakeDatabase( [ timeout, timeout, 25, 0 ], self.clock )
+        retries = []
+        n_pairs = yield db.updateAggregatorBatch('update_uraggregate_batch', (100,), retried=retries.append)
+        self.failUnlessEqual(n_pairs, 25)
+        self.failUnlessEqual(retries, [ 'timeout', 'timeout' ])
+        self.failUnlessEqual([ args[0] for _, args in db.calls ], [ 100, 50, 25, 50 ])
+
+        db = FakeDatabase( [ timeout ], self.clock )
+        d = db.updateAggregatorBatch('update_uraggregate_machine', (3, 1))
+        yield self.failUnlessFailure(d, psycopg2.extensions.QueryCanceledError)
+
+
+
+class AggregationUpdaterTest(unittest.TestCase):
+
+    def testUpdatingFlag(self):
+
+        class SlowDatabase:
+            def query(self, query, pool=None):
+                if query == updater.QUERY_PENDING_MACHINES:
+                    return defer.succeed( [ (3,) ] )
+                return defer.succeed( [] )
+
+            def updateAggregatorBatch(self, aggregator, args, service, report=None, retried=None):
+                self.args = (aggregator, args)
+                self.d = defer.Deferred()
+                return self.d
+
+        db = SlowDatabase()
+        agg_updater = updater.AggregationUpdater(db, batch_size=20)
+        agg_updater.performUpdate()
+        # a single worker updates the machines one by one, with the machines locked
+        self.failUnlessEqual(db.args, ('update_uraggregate_machine', (3, 20)))
+        # the flag must stay set until the update has finished
+        self.failUnless(agg_updater.updating)
+
+        db.d.callback(20)
+        self.failIf(agg_updater.updating)
+        self.failUnlessEqual(agg_updater.update_def, None)
+
+
+
+    def testWorkers(self):
+
+        class MachineDatabase:
+            # machine 3 is updated by someone else, machine 4 fails
+            def __init__(self):
+                self.running = {}
+                self.max_running = 0
+
+            def query(self, query, pool=None):
+                if query in (updater.QUERY_BACKLOG, updater.QUERY_DELTA_MACHINES, updater.QUERY_ROLLUP_MACHINES):
+                    return defer.succeed( [] )
+                return defer.succeed( [ (1,), (2,), (3,), (4,), (5,) ] )
+
+            def updateAggregatorBatch(self, aggregator, args, service, report=None, retried=None):
+                machine_name_id, batch_size = args
+                if machine_name_id == 4:
+                    return defer.fail(ValueError('Bad machine'))
+                d = defer.Deferred()
+                self.running[machine_name_id] = (d, 0 if machine_name_id == 3 else 10 * machine_name_id)
+                self.max_running = max(self.max_running, len(self.running))
+                return d
+
+            def finish(self):
+                for machine_name_id in sorted(self.running):
+                    d, n_pairs = self.running.pop(machine_name_id)
+                    d.callback(n_pairs)
+
+        db = MachineDatabase()
+        agg_updater = updater.AggregationUpdater(db, batch_size=20, workers=2)
+        retries = []
+        agg_updater.scheduleUpdate = lambda delay : retries.append(delay)
+
+        d = agg_updater.performUpdate()
+        results = []
+        d.addCallback(results.append)
+        while db.running:
+            db.finish()
+
+        self.failUnlessEqual(results, [ (10 + 20 + 50, 0, 0) ])
+        self.failUnlessEqual(db.max_running, 2)
+        self.failIf(agg_updater.updating)
+        # the skipped machines are retried later
+        self.failUnlessEqual(retries, [ updater.RETRY_DELAY ])
+
+
+    def testDelta(self):
+
+        class DeltaDatabase:
+            # machine 7 has new records, which are added after the recomputation,
+            # and the changed months are rolled up afterwards
+            def __init__(self):
+                self.calls = []
+
+            def query(self, query, pool=None):
+                self.calls.append(query)
+                if query in (updater.QUERY_PENDING_MACHINES, updater.QUERY_DELTA_MACHINES, updater.QUERY_ROLLUP_MACHINES):
+                    return defer.succeed( [ (7,) ] )
+                if query == updater.QUERY_BACKLOG:
+                    return defer.succeed( [ (5, 40, 2) ] )
+                return defer.succeed( [] )
+
+            def updateAggregatorBatch(self, aggregator, args, service, report=None, retried=None):
+                self.calls.append( (aggregator, args) )
+                results = { 'update_uraggregate_machine': 5, 'update_uraggregate_delta': 30, 'update_uraggregate_rollup': 2 }
+                report(results[aggregator], 0.1)
+                return defer.succeed(results[aggregator])
+
+        db = DeltaDatabase()
+        agg_updater = updater.AggregationUpdater(db, batch_size=20, delta_batch_size=1000, rollup_batch_size=6)
+        results = []
+        agg_updater.performUpdate().addCallback(results.append)
+
+        self.failUnlessEqual(results, [ (5, 30, 2) ])
+        self.failUnlessEqual(db.calls, [ updater.QUERY_BACKLOG,
+                                         updater.QUERY_PENDING_MACHINES,
+                                         ('update_uraggregate_machine', (7, 20)),
+                                         updater.QUERY_DELTA_MACHINES,
+                                         ('update_uraggregate_delta', (7, 1000)),
+                                         updater.QUERY_ROLLUP_MACHINES,
+                                         ('update_uraggregate_rollup', (7, 6)) ])
+        self.failIf(agg_updater.updating)
+
+        progress = agg_updater.getProgress()
+        self.failIf(progress['updating'])
+        self.failUnlessEqual( [ (progress[p + '_done'], progress[p + '_remaining']) for p in updater.AggregationProgress.PHASES ],
+                              [ (5, 0), (30, 10), (2, 0) ] )
+        self.failIfEqual(progress['last_run_duration'], None)
+
+
+    def testAdaptiveDelay(self):
+
+        class Listener:
+            listening = True
+
+        agg_updater = updater.AggregationUpdater(None)
+        delays = []
+        agg_updater.scheduleUpdate = lambda delay : delays.append(delay)
+
+        # without notifications the fixed delay is used
+        agg_updater.updateNotification()
+        agg_updater.listener = Listener()
+        # no updates yet, so the cost of an update is unknown
+        agg_updater.notification(1, now=1000)
+        self.failUnlessEqual(delays, [ updater.UPDATE_DELAY, updater.MIN_UPDATE_DELAY ])
+
+        # sporadic inserts are aggregated quickly, a backlog gives a longer delay
+        agg_updater.update_cost = 0.1
+        agg_updater.notification(1, now=1000)
+        agg_updater.backlog = 600
+        agg_updater.notification(1, now=1000)
+        short, long = delays[2:]
+        self.failUnlessEqual(short, updater.MIN_UPDATE_DELAY)
+        self.failUnlessApproximates(long, 0.1 * (601 + agg_updater.insert_rate * updater.MIN_UPDATE_DELAY), 0.001)
+
+        # a high insert rate gives a longer delay, but never longer than the max
+        agg_updater.backlog = 0
+        agg_updater.notification(100000, now=1001)
+        self.failUnlessEqual(delays[-1], updater.MAX_UPDATE_DELAY)
+
+        # the insert rate decays when the inserts stop
+        rate = agg_updater.insert_rate
+        agg_updater.notification(1, now=1001 + updater.INSERT_RATE_WINDOW)
+        self.failUnless(agg_updater.insert_rate < rate / 2)
+
+
+    def testNotificationWhileUpdating(self):
+
+        class SlowDatabase:
+            def query(self, query, pool=None):
+                if query == updater.QUERY_PENDING_MACHINES:
+                    return defer.succeed( [ (3,) ] )
+                return defer.succeed( [] )
+
+            def updateAggregatorBatch(self, aggregator, args, service, report=None, retried=None):
+                self.d = defer.Deferred()
+                return self.d
+
+        db = SlowDatabase()
+        agg_updater = updater.AggregationUpdater(db)
+        delays = []
+        agg_updater.scheduleUpdate = lambda delay : delays.append(delay)
+
+        agg_updater.performUpdate()
+        agg_updater.notification(5)
+        agg_updater.performUpdate()
+        # the update is scheduled when the running update is done
+        self.failUnlessEqual(delays, [])
+        self.failUnlessEqual(agg_updater.backlog, 5)
+
+        db.d.callback(10)
+        self.failUnlessEqual(delays, [ updater.UPDATE_DELAY ])
+
+
+    def testStats(self):
+
+        class StatsDatabase:
+            # machine 4 fails in the first update
+            def __init__(self):
+                self.failing = [ 4 ]
+
+            def query(self, query, pool=None):
+                if query == updater.QUERY_PENDING_MACHINES:
+                    return defer.succeed( [ (2,) ] )
+                if query == updater.QUERY_DELTA_MACHINES:
+                    return defer.succeed( [ (3,), (4,) ] )
+                if query == updater.QUERY_STATUS:
+                    return defer.succeed( [ (0, 0, 0, None) ] )
+                return defer.succeed( [] )
+
+            def updateAggregatorBatch(self, aggregator, args, service, report=None, retried=None):
+                if args[0] in self.failing:
+                    self.failing.remove(args[0])
+                    return defer.fail(ValueError('Bad machine'))
+                if aggregator == 'update_uraggregate_machine':
+                    retried('serialization')
+                    report(5, 0.05)
+                    return defer.succeed(5)
+                report(10, 3.0)
+                return defer.succeed(10)
+
+        agg_updater = updater.AggregationUpdater(StatsDatabase())
+        agg_updater.scheduleUpdate = lambda delay : None
+        agg_updater.stats.started = time.time() - 100
+
+        agg_updater.performUpdate()
+        stats = agg_updater.stats.getStats()
+        self.failUnlessEqual( (stats['serialization_retries'], stats['timeout_retries'], stats['failed_machines']), (1, 0, 1) )
+        self.failUnlessEqual(stats['transaction_durations']['pairs']['buckets'][:2], [ (0.01, 0), (0.1, 1) ])
+        self.failUnlessEqual(stats['transaction_durations']['records']['count'], 1)
+        self.failUnlessEqual(stats['transaction_durations']['records']['max'], 3.0)
+        self.failUnlessEqual(stats['update_durations']['count'], 1)
+        # a machine failed, so the aggregation has not caught up
+        self.failUnlessEqual(stats['last_catch_up'], None)
+        self.failUnless(stats['seconds_since_catch_up'] >= 100)
+
+        agg_updater.performUpdate()
+        stats = agg_updater.stats.getStats()
+        self.failIfEqual(stats['last_catch_up'], None)
+        self.failUnless(stats['seconds_since_catch_up'] < 100)
+        self.failUnlessEqual(stats['transaction_durations']['records']['count'], 3)
+
+
+    @defer.inlineCallbacks
+    def testStatus(self):
+
+        class StatusDatabase:
+            def __init__(self):
+                self.status = (120, 4000, 3, '2010-05-04')
+
+            def query(self, query, pool=None):
+                assert query == updater.QUERY_STATUS
+                self.pool = pool
+                return defer.succeed( [ self.status ] )
+
+        db = StatusDatabase()
+        agg_updater = updater.AggregationUpdater(db)
+        agg_updater.stats.started = time.time() - 100
+
+        status = yield agg_updater.getStatus()
+        self.failUnlessEqual( [ status[k] for k in ('pending_pairs', 'pending_records', 'pending_months', 'oldest_pending_insert_date') ],
+                              [ 120, 4000, 3, '2010-05-04' ] )
+        self.failUnless(status['seconds_since_catch_up'] >= 100)
+        self.failUnless('transaction_durations' in status and 'pairs_done' in status)
+        # never read from a replica
+        self.failUnlessEqual(db.pool, database.AGGREGATION_POOL)
+
+        # without a backlog, the aggregation is caught up
+        db.status = (0, 0, 0, None)
+        status = yield agg_updater.getStatus()
+        self.failUnlessEqual(status['seconds_since_catch_up'], 0)
+        # reading the status has no side effects
+        self.failUnlessEqual(agg_updater.stats.last_catch_up, None)
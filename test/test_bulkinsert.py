@@ -0,0 +1,63 @@
+#
+# Bulk insert tests (copy encoding and duplicate removal)
+#
+
+from twisted.trial import unittest
+
+from sgas.database.postgresql import copyformat
+from sgas.usagerecord import urconverter
+
+
+
+class CopyFormatTest(unittest.TestCase):
+
+    def testScalarValues(self):
+
+        self.failUnlessEqual(copyformat.encodeValue(None), '\\N')
+        self.failUnlessEqual(copyformat.encodeValue(True), 't')
+        self.failUnlessEqual(copyformat.encodeValue(42), '42')
+        self.failUnlessEqual(copyformat.encodeValue(u'tab\there'), 'tab\\there')
+        self.failUnlessEqual(copyformat.encodeValue('back\\slash\n'), 'back\\\\slash\\n')
+        self.failUnlessEqual(copyformat.encodeValue(u'\u00e6'), '\xc3\xa6')
+
+
+    def testArrayValues(self):
+
+        self.failUnlessEqual(copyformat.encodeValue([u'a', None]), '{"a",NULL}')
+        self.failUnlessEqual(copyformat.encodeValue([[u'atlas', None], [u'atlas/no', u'pro"d']]),
+                             '{{"atlas",NULL},{"atlas/no","pro\\\\"d"}}')
+
+
+    def testRows(self):
+
+        rows = copyformat.encodeRows([ ['a', None], ['b', 2] ], prefix=(7,))
+        self.failUnlessEqual(rows, '7\ta\t\\N\n7\tb\t2\n')
+
+
+
+class DuplicateRemovalTest(unittest.TestCase):
+
+    def _args(self, record_id, global_job_id, job_name):
+        args = [ None ] * len(urconverter.ARG_LIST)
+        args[urconverter.ARG_LIST.index('record_id')] = record_id
+        args[urconverter.ARG_LIST.index('global_job_id')] = global_job_id
+        args[urconverter.ARG_LIST.index('job_name')] = job_name
+        return args
+
+
+    def testDuplicateRules(self):
+
+        first = self._args('r1', 'g1', 'first')
+        other = self._args('r2', 'g2', 'other')
+
+        # same global job id, first record is kept
+        self.failUnlessEqual(urconverter.removeDuplicateArguments([first, other, self._args('r1', 'g1', 'second')]),
+                             [first, other])
+        # global job id same as record id (minimal record), first record is kept
+        self.failUnlessEqual(urconverter.removeDuplicateArguments([first, self._args('r1', 'r1', 'second')]),
+                             [first])
+        # different global job id, the record is replaced
+        replacement = self._args('r1', 'g3', 'second')
+        self.failUnlessEqual(urconverter.removeDuplicateArguments([first, other, replacement]),
+                             [replacement, other])
+
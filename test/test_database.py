@@ -246,6 +246,10 @@ class PostgreSQLTestCase(GenericDatabaseTest, QueryDatabaseTest, StorageRecordTe
         delete_stms = \
         "TRUNCATE uraggregated_data;"       + \
         "TRUNCATE uraggregated_update;"     + \
+        "TRUNCATE uraggregated_delta;"      + \
+        "TRUNCATE uraggregated_monthly_data;" + \
+        "TRUNCATE uraggregated_yearly_data;"  + \
+        "TRUNCATE uraggregated_rollup_update;" + \
         "TRUNCATE usagedata      CASCADE;"  + \
         "TRUNCATE globalusername CASCADE;"  + \
         "TRUNCATE insertidentity CASCADE;"  + \
@@ -260,7 +264,11 @@ class PostgreSQLTestCase(GenericDatabaseTest, QueryDatabaseTest, StorageRecordTe
 
         yield self.db.insertJobUsageRecords(ursampledata.UR1)
 
-        rows = yield self.postgres_dbpool.runQuery('SELECT * from uraggregated_update')
+        # new records are added to the aggregation, without recomputing anything
+        update_rows = yield self.postgres_dbpool.runQuery('SELECT * from uraggregated_update')
+        self.failUnlessEqual(len(update_rows), 0)
+
+        rows = yield self.postgres_dbpool.runQuery('SELECT insert_time, machine_name_id from uraggregated_delta')
         mid_rows = yield self.postgres_dbpool.runQuery("SELECT id from machinename WHERE machine_name = %s", (ursampledata.UR1_MACHINE_NAME,))
 
         self.failUnlessEqual(len(rows), 1)
@@ -283,6 +291,18 @@ class PostgreSQLTestCase(GenericDatabaseTest, QueryDatabaseTest, StorageRecordTe
 
         rows = yield self.postgres_dbpool.runQuery('SELECT * from uraggregated_update')
         self.failUnlessEqual(len(rows), 0)
+        rows = yield self.postgres_dbpool.runQuery('SELECT * from uraggregated_delta')
+        self.failUnlessEqual(len(rows), 0)
+
+        # the rollups are updated as well
+        rows = yield self.postgres_dbpool.runQuery('SELECT * from uraggregated_rollup_update')
+        self.failUnlessEqual(len(rows), 0)
+        totals = 'SELECT sum(n_jobs), sum(cputime), sum(walltime) FROM %s'
+        daily   = yield self.postgres_dbpool.runQuery(totals % 'uraggregated')
+        monthly = yield self.postgres_dbpool.runQuery(totals % 'uraggregated_monthly')
+        yearly  = yield self.postgres_dbpool.runQuery(totals % 'uraggregated_yearly')
+        self.failUnlessEqual(monthly, daily)
+        self.failUnlessEqual(yearly, daily)
 
 
     @defer.inlineCallbacks
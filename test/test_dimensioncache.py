@@ -0,0 +1,83 @@
+#
+# Dimension cache tests
+#
+
+from twisted.trial import unittest
+
+from sgas.database.postgresql import dimensioncache
+
+
+
+class FakeTransaction:
+    # dimension table in memory, just enough for the cache queries
+
+    def __init__(self, rows):
+        self.rows = dict(rows)
+        self.result = []
+        self.queries = 0
+
+
+    def execute(self, query, args):
+        self.queries += 1
+        if query.startswith('SELECT machine_name, id'):
+            self.result = sorted(self.rows.items(), key=lambda r : r[1], reverse=True)[:args[0]]
+        elif query.startswith('INSERT'):
+            if args[0] in self.rows:
+                self.result = []
+            else:
+                self.rows[args[0]] = len(self.rows) + 1
+                self.result = [ (self.rows[args[0]],) ]
+        else:
+            self.result = [ (self.rows[args[0]],) ]
+
+
+    def fetchall(self):
+        return self.result
+
+
+
+class DimensionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = dimensioncache.DimensionCache(size=2)
+        self.cache.addDimension('machinename', 'machine_name')
+        self.txn = FakeTransaction( [ ('m1', 1), ('m2', 2), ('m3', 3) ] )
+
+
+    def testWarm(self):
+
+        self.cache.warm(self.txn)
+        # only the newest entries fit in the cache
+        self.failUnlessEqual(self.cache.caches['machinename'].items(), [ (u'm2', 2), (u'm3', 3) ])
+
+        self.txn.queries = 0
+        self.failUnlessEqual(self.cache.lookup(self.txn, 'machinename', u'm3', {}), 3)
+        self.failUnlessEqual(self.txn.queries, 0)
+
+
+    def testMiss(self):
+
+        pending = {}
+        self.failUnlessEqual(self.cache.lookup(self.txn, 'machinename', u'm1', pending), 1)
+        self.failUnlessEqual(self.cache.lookup(self.txn, 'machinename', u'm4', pending), 4)
+        self.failUnlessEqual(self.cache.lookup(self.txn, 'machinename', None, pending), None)
+        self.failUnlessEqual(self.txn.queries, 3)
+
+        # nothing is cached until the transaction is committed
+        self.failUnlessEqual(len(self.cache.caches['machinename']), 0)
+        self.failUnlessEqual(self.cache.lookup(self.txn, 'machinename', u'm4', pending), 4)
+        self.failUnlessEqual(self.txn.queries, 3)
+
+        self.cache.update(pending)
+        self.failUnlessEqual(self.cache.lookup(self.txn, 'machinename', u'm4', {}), 4)
+        self.failUnlessEqual(self.txn.queries, 3)
+
+
+    def testEviction(self):
+
+        self.cache.update( { ('machinename', u'm1'): 1, ('machinename', u'm2'): 2 } )
+        # use m1, so m2 is the least recently used
+        self.cache.lookup(self.txn, 'machinename', u'm1', {})
+        self.cache.update( { ('machinename', u'm3'): 3 } )
+        self.failUnlessEqual(sorted(self.cache.caches['machinename'].keys()), [ u'm1', u'm3' ])
+
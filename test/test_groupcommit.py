@@ -0,0 +1,146 @@
+#
+# Group commit tests
+#
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from sgas.database.postgresql import database, groupcommit
+
+
+
+class FakeTransaction:
+
+    def __init__(self):
+        self.queries = []
+
+
+    def execute(self, query):
+        self.queries.append(query)
+
+
+
+class FakeDatabase:
+    # runs interactions right away, records with a None id fail
+
+    def __init__(self):
+        self.transactions = []
+        self.dimension_cache = self
+
+
+    def update(self, pending):
+        pass
+
+
+    def _runInteraction(self, interaction, args):
+        txn = FakeTransaction()
+        self.transactions.append(txn)
+        return defer.maybeDeferred(interaction, txn, *args)
+
+
+    def _insertRecords(self, txn, proc, arg_list):
+        id_dict = {}
+        for record_id in arg_list:
+            if record_id is None:
+                raise ValueError('Bad record')
+            id_dict[record_id] = len(id_dict) + 1
+        return id_dict
+
+
+
+class GroupCommitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase()
+        self.committer = groupcommit.GroupCommitter(self.db, max_records=4)
+
+
+    @defer.inlineCallbacks
+    def testGroup(self):
+
+        d1 = self.committer.insert('usage', 'urcreate', [ 'r1', 'r2' ])
+        d2 = self.committer.insert('usage', 'urcreate', [ 'r3' ])
+        self.failUnlessEqual(self.db.transactions, [])
+        d3 = self.committer.insert('usage', 'urcreate', [ 'r4' ])
+
+        r1 = yield d1
+        r2 = yield d2
+        r3 = yield d3
+        self.failUnlessEqual(r1, { 'r1': 1, 'r2': 2 })
+        self.failUnlessEqual(r2, { 'r3': 1 })
+        self.failUnlessEqual(r3, { 'r4': 1 })
+        # all requests in one transaction
+        self.failUnlessEqual(len(self.db.transactions), 1)
+        self.failUnlessEqual(self.committer.groups, {})
+
+
+    @defer.inlineCallbacks
+    def testFailedRequest(self):
+
+        d1 = self.committer.insert('usage', 'urcreate', [ 'r1' ])
+        d2 = self.committer.insert('usage', 'urcreate', [ None ])
+        d3 = self.committer.insert('usage', 'urcreate', [ 'r3' ])
+        self.committer.flushAll()
+
+        r1 = yield d1
+        r3 = yield d3
+        self.failUnlessEqual(r1, { 'r1': 1 })
+        self.failUnlessEqual(r3, { 'r3': 1 })
+        yield self.failUnlessFailure(d2, ValueError)
+
+        self.failUnlessEqual(self.db.transactions[0].queries,
+                             [ groupcommit.SAVEPOINT, groupcommit.RELEASE_SAVEPOINT,
+                               groupcommit.SAVEPOINT, groupcommit.ROLLBACK_SAVEPOINT,
+                               groupcommit.SAVEPOINT, groupcommit.RELEASE_SAVEPOINT ])
+
+
+    def testFlushAll(self):
+
+        # the transactions are left running
+        running = []
+        self.db._runInteraction = lambda interaction, args : running.append(defer.Deferred()) or running[-1]
+
+        d1 = self.committer.insert('usage',   'urcreate', [ 'r1' ])
+        d2 = self.committer.insert('storage', 'srcreate', [ 's1' ])
+        flushed = self.committer.flushAll()
+        self.failUnlessEqual(len(running), 2)
+        self.failIf(flushed.called)
+
+        running[0].callback( [ (True, { 'r1': 1 }) ] )
+        self.failIf(flushed.called)
+        running[1].callback( [ (True, { 's1': 1 }) ] )
+        self.failUnless(flushed.called)
+        return defer.gatherResults([ d1, d2 ])
+
+
+    @defer.inlineCallbacks
+    def testSeparateProcedures(self):
+
+        d1 = self.committer.insert('usage',   'urcreate', [ 'r1' ])
+        d2 = self.committer.insert('storage', 'srcreate', [ 's1' ])
+        self.committer.flushAll()
+
+        yield d1
+        yield d2
+        self.failUnlessEqual(len(self.db.transactions), 2)
+
+
+
+class ShutdownTest(unittest.TestCase):
+
+    def testStopWaitsForGroups(self):
+
+        db = database.PostgreSQLDatabase('localhost::sgas:sgas::')
+        for pool_proxy in db.pools.values():
+            pool_proxy.dbpool.close()
+
+        running = defer.Deferred()
+        db._runInteraction = lambda interaction, args : running
+        d = db.recordInserter('usage', 'urcreate', [ 'r1' ])
+
+        # the pools are closed when the deferred has fired
+        stopped = db.stopService()
+        self.failIf(stopped.called)
+        running.callback( [ (True, { 'r1': 1 }) ] )
+        self.failUnless(stopped.called)
+        return d
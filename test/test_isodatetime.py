@@ -4,11 +4,13 @@
 # Author: Henrik Thostrup Jensen <htj@ndgf.org>
 # Copyright: Nordic Data Grid Facility (2009)
 
+import time
 import datetime
 
 from twisted.trial import unittest
 
 from sgas.ext import isodate
+from sgas.generic import valueparser
 from sgas.usagerecord import urparser
 
 
@@ -82,3 +84,33 @@ class ISODurationTest(unittest.TestCase):
             self.failUnlessEqual(ss, DURATION_SECONDS)
 
 
+
+
+class FastPathTest(unittest.TestCase):
+
+    # the fast paths in valueparser must give the same result as isodate
+
+    def testDateTimes(self):
+
+        for dts in [ '2009-11-12T20:31:27Z', '2012-02-29T00:00:00Z', '1999-12-31T23:59:59Z',
+                     '2009-11-12T20:31:27+02:00', '2009-11-12T20:31:27', '2009-11-12T20:31:27.5Z' ]:
+            dt = isodate.parse_datetime(dts)
+            self.failUnlessEqual(valueparser.parseISODateTime(dts), time.strftime(valueparser.JSON_DATETIME_FORMAT, dt.utctimetuple()))
+            # memoized
+            self.failUnlessEqual(valueparser.parseISODateTime(dts), valueparser.parseISODateTime(dts))
+
+        self.failUnlessEqual(valueparser._fastISODateTime('2009-11-12T20:31:27+02:00'), None)
+        self.failUnlessEqual(valueparser._fastISODateTime('2009-02-30T20:31:27Z'), None)
+        self.failUnlessEqual(valueparser.parseISODateTime('2009-02-30T20:31:27Z'), None)
+
+
+    def testDurations(self):
+
+        for tds in [ 'PT86401S', 'PT234.1S', 'PT0.999999S', 'PT0S', 'P0Y0M1DT0H0M1S', 'PT1H', 'PT5.9999999S' ]:
+            td = isodate.parse_duration(tds)
+            self.failUnlessEqual(valueparser.parseISODuration(tds), (td.days * 3600*24) + td.seconds)
+
+        self.failUnlessEqual(valueparser._fastISODuration('PT234.1S'), 234)
+        self.failUnlessEqual(valueparser._fastISODuration('PT1H'), None)
+        self.failUnlessEqual(valueparser._fastISODuration('-PT5S'), None)
+
@@ -0,0 +1,158 @@
+#
+# Incremental JSON encoding tests
+#
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from sgas.ext.python import json
+from sgas.server import jsonstream
+
+
+
+class FakeStream:
+
+    def __init__(self):
+        self.deliver = None
+        self.done = defer.Deferred()
+        self.calls = []
+
+
+    def start(self, deliver):
+        self.deliver = deliver
+        return self.done
+
+
+    def pause(self):
+        self.calls.append('pause')
+
+
+    def resume(self):
+        self.calls.append('resume')
+
+
+    def stop(self):
+        self.calls.append('stop')
+
+
+
+class FakeRequest:
+
+    def __init__(self):
+        self.written = []
+        self.headers = {}
+        self.producer = None
+        self.finished = False
+        self.connection_lost = defer.Deferred()
+
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+    def notifyFinish(self):
+        return self.connection_lost
+
+
+    def setHeader(self, name, value):
+        self.headers[name] = value
+
+
+    def write(self, data):
+        self.written.append(data)
+
+
+    def finish(self):
+        self.finished = True
+
+
+
+class JSONArrayProducerTest(unittest.TestCase):
+
+    def testEncoding(self):
+
+        rows = [ { 'machine_name': 'host%i' % i, 'n_jobs': i, 'cpu_time': i / 3.0 } for i in range(5) ]
+
+        request = FakeRequest()
+        stream = FakeStream()
+        d = jsonstream.JSONArrayProducer(request, stream).start()
+        self.failUnlessEqual(request.producer is not None, True)
+
+        stream.deliver(rows[:2])
+        stream.deliver(rows[2:])
+        stream.done.callback(5)
+
+        self.failUnlessEqual(''.join(request.written), json.dumps(rows))
+        self.failUnlessEqual(request.headers, { 'content-type': 'application/json' })
+        self.failUnlessEqual(request.finished, True)
+        self.failUnlessEqual(request.producer, None)
+        return d
+
+
+    def testEmptyResult(self):
+
+        request = FakeRequest()
+        stream = FakeStream()
+        jsonstream.JSONArrayProducer(request, stream).start()
+        stream.done.callback(0)
+
+        self.failUnlessEqual(''.join(request.written), '[]')
+        self.failUnlessEqual(request.finished, True)
+
+
+    def testBuildRecord(self):
+
+        request = FakeRequest()
+        stream = FakeStream()
+        jsonstream.JSONArrayProducer(request, stream, lambda row : { 'n' : row[0] }).start()
+        stream.deliver([ (1,), (2,) ])
+        stream.done.callback(2)
+
+        self.failUnlessEqual(json.loads(''.join(request.written)), [ { 'n': 1 }, { 'n': 2 } ])
+
+
+    def testProducer(self):
+
+        request = FakeRequest()
+        stream = FakeStream()
+        jsonstream.JSONArrayProducer(request, stream).start()
+
+        request.producer.pauseProducing()
+        request.producer.resumeProducing()
+        request.producer.stopProducing()
+        self.failUnlessEqual(stream.calls, [ 'pause', 'resume', 'stop' ])
+
+
+    def testConnectionLost(self):
+
+        request = FakeRequest()
+        stream = FakeStream()
+        jsonstream.JSONArrayProducer(request, stream).start()
+
+        stream.deliver([ { 'n': 1 } ])
+        request.connection_lost.errback(Exception('connection lost'))
+        self.failUnlessEqual(stream.calls, [ 'stop' ])
+
+        # nothing is written after the connection has been lost
+        stream.deliver([ { 'n': 2 } ])
+        stream.done.callback(1)
+        self.failUnlessEqual(request.written, [ '[{"n": 1}' ])
+        self.failUnlessEqual(request.finished, False)
+
+
+    def testErrorBeforeWrite(self):
+
+        request = FakeRequest()
+        stream = FakeStream()
+        d = jsonstream.JSONArrayProducer(request, stream).start()
+        stream.done.errback(ValueError('query failed'))
+
+        # nothing has been written, so the error is passed on
+        self.failUnlessEqual(request.written, [])
+        self.failUnlessEqual(request.headers, {})
+        return self.assertFailure(d, ValueError)
+
@@ -0,0 +1,124 @@
+#
+# Notification listener tests
+#
+
+import os
+
+import psycopg2
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from sgas.database.postgresql import listener
+
+
+
+class FakeConnection:
+    # a notification is a line written to a pipe, like the socket of a real connection
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.notifies = []
+        self.executed = []
+        self.autocommit = False
+        self.closed = False
+
+
+    def cursor(self):
+        return self
+
+
+    def execute(self, query):
+        self.executed.append( (query, self.autocommit) )
+
+
+    def fileno(self):
+        return self.read_fd
+
+
+    def notify(self, data):
+        os.write(self.write_fd, data)
+
+
+    def poll(self):
+        data = os.read(self.read_fd, 1024)
+        if 'X' in data:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.notifies += [ (1, 'channel') ] * data.count('\n')
+
+
+    def close(self):
+        self.closed = True
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+
+class ListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reconnect_delay = listener.RECONNECT_DELAY
+        listener.RECONNECT_DELAY = 0
+        self.connections = []
+        self.notifications = []
+        self.waiting = None
+        self.listener = listener.NotificationListener(self.connect, 'sgas_aggregation', self.notified, self.connected)
+
+
+    def tearDown(self):
+        listener.RECONNECT_DELAY = self.reconnect_delay
+        self.listener.stopListening()
+
+
+    def connect(self):
+        conn = FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+
+    def wait(self):
+        self.waiting = defer.Deferred()
+        return self.waiting
+
+
+    def notified(self, n_notifications):
+        self.notifications.append(n_notifications)
+        self.waiting.callback(None)
+
+
+    def connected(self):
+        if self.waiting is not None:
+            self.waiting.callback(None)
+
+
+    @defer.inlineCallbacks
+    def testNotifications(self):
+
+        yield self.listener.startListening()
+        conn = self.connections[0]
+        self.failUnlessEqual(conn.executed, [ ('LISTEN sgas_aggregation', True) ])
+        self.failUnless(self.listener.listening)
+
+        d = self.wait()
+        conn.notify('\n\n\n')
+        yield d
+        self.failUnlessEqual(self.notifications, [ 3 ])
+        self.failUnlessEqual(conn.notifies, [])
+
+
+    @defer.inlineCallbacks
+    def testReconnect(self):
+
+        yield self.listener.startListening()
+        d = self.wait()
+        self.connections[0].notify('X')
+        yield d
+        self.failUnless(self.connections[0].closed)
+        self.failUnlessEqual(len(self.connections), 2)
+        self.failUnless(self.listener.listening)
+
+        d = self.wait()
+        self.connections[1].notify('\n')
+        yield d
+        self.failUnlessEqual(self.notifications, [ 1 ])
+
@@ -0,0 +1,77 @@
+#
+# Parser pool tests
+#
+
+import os
+import time
+import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from sgas.generic import parserpool
+from sgas.usagerecord import urconverter, jobinsertresource
+
+from test import ursampledata
+
+
+
+class ParserPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = parserpool.ParserPool(1)
+
+
+    def tearDown(self):
+        return self.pool.stopService()
+
+
+    @defer.inlineCallbacks
+    def testParse(self):
+
+        insert_time = time.gmtime()
+        arg_list = yield self.pool.parse(urconverter.parseInsertArguments, ursampledata.CUR, '/CN=test', 'test.example.org', insert_time)
+        expected = urconverter.parseInsertArguments(ursampledata.CUR, '/CN=test', 'test.example.org', insert_time)
+
+        self.failUnlessEqual(len(arg_list), 2)
+        self.failUnlessEqual(arg_list, expected)
+
+
+    @defer.inlineCallbacks
+    def testParseError(self):
+
+        try:
+            yield self.pool.parse(urconverter.parseInsertArguments, '<bad xml', None, None, None)
+            self.fail('Parsing bad xml should fail')
+        except parserpool.ParserError, e:
+            self.failUnless(str(e).startswith('ParseError'), str(e))
+
+
+    @defer.inlineCallbacks
+    def testWorkerDied(self):
+
+        # the pool replaces the worker, but the job is lost
+        self.pool.timeout = 1
+        try:
+            yield self.pool.parse(os._exit, 1)
+            self.fail('Parsing in a worker which dies should fail')
+        except parserpool.ParserError, e:
+            self.failUnless('did not finish' in str(e), str(e))
+
+        # the new worker parses
+        arg_list = yield self.pool.parse(urconverter.parseInsertArguments, ursampledata.CUR, '/CN=test', 'test.example.org', time.gmtime())
+        self.failUnlessEqual(len(arg_list), 2)
+
+
+
+class DataSizeTest(unittest.TestCase):
+
+    def testDataSize(self):
+
+        self.failUnlessEqual(jobinsertresource.dataSize(ursampledata.CUR), len(ursampledata.CUR))
+
+        # the read position of a request body is kept
+        content = StringIO.StringIO(ursampledata.CUR)
+        content.read(10)
+        self.failUnlessEqual(jobinsertresource.dataSize(content), len(ursampledata.CUR))
+        self.failUnlessEqual(content.tell(), 10)
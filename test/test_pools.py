@@ -0,0 +1,127 @@
+#
+# Database connection pool tests
+#
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from sgas.database import error
+from sgas.database.postgresql import database
+
+
+
+class FakeConnectionPool:
+    # runs the interactions when start is called, as the pool threads would
+
+    def __init__(self):
+        self.waiting = []
+
+
+    def runInteraction(self, interaction, *args):
+        d = defer.Deferred()
+        self.waiting.append( (d, interaction, args) )
+        return d
+
+
+    def start(self):
+        d, interaction, args = self.waiting.pop(0)
+        result = interaction('txn', *args)
+        return d, result
+
+
+
+class FakePoolProxy(database._DatabasePoolProxy):
+
+    def _setupPool(self, connect_info):
+        return FakeConnectionPool()
+
+
+
+class PoolProxyTest(unittest.TestCase):
+
+    def testQueueing(self):
+
+        pool_proxy = FakePoolProxy('localhost::sgas:sgas::', database.READ_POOL, 2, 3)
+
+        results = []
+        for i in range(3):
+            d = pool_proxy.runInteraction(lambda txn, i : i, i)
+            d.addCallback(results.append)
+        self.failUnlessEqual(pool_proxy.getStats()['queued'], 3)
+
+        # the queue is full
+        d = pool_proxy.runInteraction(lambda txn : None)
+        self.failUnlessFailure(d, error.DatabaseBusyError)
+        self.failUnlessEqual(pool_proxy.getStats()['rejected'], 1)
+
+        d, result = pool_proxy.dbpool.start()
+        stats = pool_proxy.getStats()
+        self.failUnlessEqual( (stats['queued'], stats['active'], stats['completed']), (2, 1, 0) )
+
+        d.callback(result)
+        stats = pool_proxy.getStats()
+        self.failUnlessEqual( (stats['queued'], stats['active'], stats['completed']), (2, 0, 1) )
+        self.failUnlessEqual(results, [ 0 ])
+
+        # there is room in the queue again
+        pool_proxy.runInteraction(lambda txn : None)
+        self.failUnlessEqual(pool_proxy.getStats()['queued'], 3)
+
+
+    def testNotStarted(self):
+
+        pool_proxy = FakePoolProxy('localhost::sgas:sgas::', database.INGEST_POOL, 2, 0)
+
+        d = pool_proxy.runInteraction(lambda txn : None)
+        # e.g., the pool is closed before the interaction is started
+        pool_proxy.dbpool.waiting[0][0].errback(Exception('pool closed'))
+        self.failUnlessFailure(d, Exception)
+
+        stats = pool_proxy.getStats()
+        self.failUnlessEqual( (stats['queued'], stats['active'], stats['completed']), (0, 0, 0) )
+
+
+    def testPoolSizes(self):
+
+        db = database.PostgreSQLDatabase('localhost::sgas:sgas::', { database.READ_POOL: 8 }, { database.INGEST_POOL: 50 })
+        try:
+            stats = db.getPoolStats()
+            self.failUnlessEqual(sorted(stats.keys()), sorted(database.POOLS))
+            self.failUnlessEqual(stats[database.READ_POOL]['size'], 8)
+            self.failUnlessEqual(stats[database.INGEST_POOL]['size'], database.DEFAULT_POOL_SIZES[database.INGEST_POOL])
+            self.failUnlessEqual(stats[database.INGEST_POOL]['queue_limit'], 50)
+            self.failUnlessEqual(db.pool_proxy, db.pools[database.INGEST_POOL])
+        finally:
+            for pool_proxy in db.pools.values():
+                pool_proxy.dbpool.close()
+
+
+
+    def testBusyNotLogged(self):
+
+        db = database.PostgreSQLDatabase('localhost::sgas:sgas::', queue_limits={ database.INGEST_POOL: 1 })
+        for pool_proxy in db.pools.values():
+            pool_proxy.dbpool.close()
+        db.pools[database.INGEST_POOL].dbpool = FakeConnectionPool()
+
+        # the first interaction fills the queue, so the second is rejected
+        db._runInteraction(lambda txn : None, ())
+        d = db._runInteraction(lambda txn : None, ())
+        self.failUnlessFailure(d, error.DatabaseBusyError)
+
+        # e.g., the database is down while reconnecting
+        db.pools[database.INGEST_POOL].runInteraction = lambda interaction, *args : defer.fail(error.DatabaseUnavailableError('down'))
+        d2 = db._runInteraction(lambda txn : None, ())
+        self.failUnlessFailure(d2, error.DatabaseUnavailableError)
+
+        # the rejections are expected under load, so they are not logged as errors
+        self.failUnlessEqual(self.flushLoggedErrors(), [])
+        return defer.gatherResults([ d, d2 ])
+
+
+    def testConnectInfo(self):
+
+        self.failUnlessEqual(database.parseConnectInfo('localhost::sgas:sgas::'),
+                             { 'host': 'localhost', 'port': database.DEFAULT_POSTGRESQL_PORT, 'database': 'sgas',
+                               'user': 'sgas', 'password': None })
+        self.failUnlessEqual(database.parseConnectInfo('db.example.org:5433:sgas-db:sgas:secret')['port'], '5433')
@@ -0,0 +1,66 @@
+#
+# Query builder tests
+#
+
+import datetime
+
+from twisted.trial import unittest
+
+from sgas.queryengine import builder
+
+
+
+def queryArgs(start_date, end_date, time_resolution, **kwargs):
+    args = { 'start_date': start_date, 'end_date': end_date, 'time_resolution': time_resolution }
+    args.update(kwargs)
+    return args
+
+
+
+class QueryBuilderTest(unittest.TestCase):
+
+    def testDailyResolution(self):
+
+        query, args = builder.buildQuery(queryArgs('2009-01-01', '2010-01-01', 'day'))
+        self.failUnless('FROM uraggregated WHERE execution_time >= %s AND execution_time < %s' in query)
+        self.failUnlessEqual(args, [ '2009-01-01', '2010-01-01' ])
+
+
+    def testMonthlyRollup(self):
+
+        query, args = builder.buildQuery(queryArgs('2009-03-01', '2010-07-01', 'month', machine_name=['host1']))
+        self.failUnless('FROM uraggregated_monthly WHERE execution_period >= %s AND execution_period < %s' in query)
+        self.failIf('execution_time' in query)
+        self.failUnlessEqual(args, [ '2009-03-01', '2010-07-01', ('host1',) ])
+
+        # collapsing months which are not whole years
+        query, args = builder.buildQuery(queryArgs('2009-03-01', '2010-01-01', 'collapse'))
+        self.failUnless('FROM uraggregated_monthly ' in query)
+        self.failUnless('min(min_execution_time), max(max_execution_time)' in query)
+
+
+    def testYearlyRollup(self):
+
+        query, args = builder.buildQuery(queryArgs('2007-01-01', '2010-01-01', 'collapse', vo_name='atlas'))
+        self.failUnless('FROM uraggregated_yearly WHERE execution_period >= %s AND execution_period < %s' in query)
+        self.failUnless('min(min_execution_time), max(max_execution_time)' in query)
+        self.failUnlessEqual(args, [ '2007-01-01', '2010-01-01', 'atlas' ])
+
+        # whole years with monthly resolution
+        query, args = builder.buildQuery(queryArgs('2007-01-01', '2010-01-01', 'month'))
+        self.failUnless('FROM uraggregated_monthly ' in query)
+
+
+    def testUnalignedDates(self):
+
+        for start_date, end_date in [ ('2009-03-02', '2010-01-01'), ('2009-03-01', '2010-01-15') ]:
+            for time_resolution in [ 'month', 'collapse' ]:
+                query, args = builder.buildQuery(queryArgs(start_date, end_date, time_resolution))
+                self.failUnless('FROM uraggregated WHERE execution_time >= %s' in query)
+
+
+    def testDateObjects(self):
+
+        query, args = builder.buildQuery(queryArgs(datetime.date(2009, 1, 1), datetime.date(2010, 1, 1), 'collapse'))
+        self.failUnless('FROM uraggregated_yearly ' in query)
+
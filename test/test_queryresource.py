@@ -0,0 +1,157 @@
+#
+# Query resource error handling tests
+#
+
+import ConfigParser
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.web.http_headers import Headers
+
+from sgas.authz import rights
+from sgas.database import error as dberror
+from sgas.queryengine import queryresource
+from sgas.customqueryengine import customqueryresource
+
+
+
+class FakeAuthorizer:
+
+    def __init__(self):
+        self.rights = rights.Rights()
+
+
+    def addChecker(self, action, checker):
+        pass
+
+
+    def isAllowed(self, subject, action, context=None):
+        return True
+
+
+
+class FailingStream:
+
+    def __init__(self, error):
+        self.error = error
+
+
+    def start(self, deliver):
+        return defer.fail(self.error)
+
+
+    def pause(self):
+        pass
+
+
+    def resume(self):
+        pass
+
+
+    def stop(self):
+        pass
+
+
+
+class FakeDatabase:
+
+    def __init__(self, error):
+        self.error = error
+
+
+    def streamQuery(self, query, query_args, dict_rows=False):
+        return FailingStream(self.error)
+
+
+
+class FakeRequest:
+
+    def __init__(self, postpath, args):
+        self.postpath = postpath
+        self.args = args
+        self.requestHeaders = Headers()
+        self.responseCode = 200
+        self.written = []
+        self.finished = False
+
+
+    def getClientIP(self):
+        return '192.0.2.1'
+
+
+    def getClient(self):
+        return 'client.example.org'
+
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+
+    def unregisterProducer(self):
+        pass
+
+
+    def notifyFinish(self):
+        return defer.Deferred()
+
+
+    def setResponseCode(self, code):
+        self.responseCode = code
+
+
+    def setHeader(self, name, value):
+        pass
+
+
+    def write(self, data):
+        self.written.append(data)
+
+
+    def finish(self):
+        self.finished = True
+
+
+
+class QueryResourceTest(unittest.TestCase):
+
+    def render(self, resource, postpath, args, error):
+        resource.db = FakeDatabase(error)
+        request = FakeRequest(postpath, args)
+        resource.render_GET(request)
+        return request
+
+
+    def testBusy(self):
+
+        resource = queryresource.QueryResource(None, None, FakeAuthorizer())
+        request = self.render(resource, [], {}, dberror.DatabaseBusyError('Too many requests waiting'))
+
+        self.failUnlessEqual(request.responseCode, 503)
+        self.failUnless(request.finished)
+        # expected under load, so not logged as an error
+        self.failUnlessEqual(self.flushLoggedErrors(), [])
+
+
+    def testError(self):
+
+        resource = queryresource.QueryResource(None, None, FakeAuthorizer())
+        request = self.render(resource, [], {}, ValueError('Bad query'))
+
+        self.failUnlessEqual(request.responseCode, 500)
+        self.failUnlessEqual(''.join(request.written), 'Queryengine error (Bad query)')
+        self.failUnless(request.finished)
+        self.failUnlessEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+
+    def testCustomQueryBusy(self):
+
+        cfg = ConfigParser.SafeConfigParser()
+        cfg.add_section('query:jobs')
+        cfg.set('query:jobs', 'query', 'SELECT count(*) FROM usagerecords')
+        resource = customqueryresource.QueryResource(cfg, None, FakeAuthorizer())
+        request = self.render(resource, [ 'jobs' ], {}, dberror.DatabaseBusyError('Too many requests waiting'))
+
+        self.failUnlessEqual(request.responseCode, 503)
+        self.failUnless(request.finished)
+        self.failUnlessEqual(self.flushLoggedErrors(), [])
+
@@ -0,0 +1,69 @@
+#
+# Query stream tests
+#
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from sgas.database.postgresql import querystream
+
+
+
+class FakePoolProxy:
+    # the stream interaction is left waiting, like a pool thread would
+
+    def __init__(self):
+        self.interaction = defer.Deferred()
+
+
+    def runInteraction(self, interaction, *args):
+        return self.interaction
+
+
+
+class QueryStreamTest(unittest.TestCase):
+
+    def createStream(self):
+        pool_proxy = FakePoolProxy()
+        stream = querystream.QueryStream(pool_proxy, 'SELECT 1')
+        stream.clock = task.Clock()
+        return pool_proxy, stream
+
+
+    def testPauseTimeout(self):
+
+        pool_proxy, stream = self.createStream()
+        d = stream.start(lambda rows : None)
+
+        stream.pause()
+        stream.clock.advance(querystream.STREAM_MAX_PAUSE - 1)
+        self.failIf(stream.stopped)
+        stream.clock.advance(1)
+        self.failUnless(stream.stopped)
+        self.failUnlessEqual(stream.paused, None) # the pool thread is released
+
+        # the pool thread rolls back, and the stream fails, so the response is not completed
+        pool_proxy.interaction.errback(querystream.QueryStreamStopped())
+        return self.failUnlessFailure(d, querystream.QueryStreamTimeout)
+
+
+    def testResume(self):
+
+        pool_proxy, stream = self.createStream()
+        d = stream.start(lambda rows : None)
+
+        # the time paused is counted from each pause
+        for _ in range(3):
+            stream.pause()
+            stream.clock.advance(querystream.STREAM_MAX_PAUSE - 1)
+            stream.resume()
+        stream.clock.advance(querystream.STREAM_MAX_PAUSE)
+        self.failIf(stream.stopped)
+        self.failIf(stream.clock.getDelayedCalls())
+
+        # stopped by the consumer, which is not an error
+        stream.stop()
+        pool_proxy.interaction.errback(querystream.QueryStreamStopped())
+        d.addCallback(self.failUnlessEqual, 0)
+        return d
+
@@ -0,0 +1,124 @@
+#
+# Aggregation rebuild tests
+#
+
+import threading
+
+from twisted.trial import unittest
+
+from sgas.database.postgresql import rebuild
+
+
+
+class FakeDatabase:
+    # hands out partitions to the connections, like rebuild_uraggregate_partition
+
+    def __init__(self, n_partitions, fail_at=None):
+        self.partitions = range(n_partitions)
+        self.fail_at = fail_at
+        self.built = []
+        self.calls = []
+        self.lock = threading.Lock()
+
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+
+class FakeConnection:
+
+    def __init__(self, db):
+        self.db = db
+        self.result = None
+
+
+    def cursor(self):
+        return self
+
+
+    def callproc(self, proc, args=()):
+        db = self.db
+        db.lock.acquire()
+        try:
+            db.calls.append(proc)
+            if proc == 'rebuild_uraggregate_start':
+                self.result = [ (len(db.partitions),) ]
+            elif proc == 'rebuild_uraggregate_partition':
+                if not db.partitions:
+                    self.result = []
+                    return
+                partition = db.partitions.pop(0)
+                if partition == db.fail_at:
+                    raise ValueError('Partition failed')
+                db.built.append(partition)
+                self.result = [ (partition, 100, 10) ]
+            elif proc == 'rebuild_uraggregate_swap':
+                self.result = [ (3,) ]
+        finally:
+            db.lock.release()
+
+
+    def execute(self, query, args=None):
+        self.db.calls.append(query)
+
+
+    def fetchall(self):
+        return self.result
+
+
+    def commit(self):
+        pass
+
+
+    def close(self):
+        pass
+
+
+
+class RebuildTest(unittest.TestCase):
+
+    def testRebuild(self):
+
+        db = FakeDatabase(20)
+        messages = []
+        rebuilder = rebuild.Rebuilder(db.connect, workers=3, report=messages.append, report_interval=0)
+        n_pairs = rebuilder.rebuild()
+
+        self.failUnlessEqual(n_pairs, 3)
+        self.failUnlessEqual(sorted(db.built), range(20))
+        self.failUnlessEqual( (rebuilder.done, rebuilder.n_records, rebuilder.n_rows), (20, 2000, 200) )
+        self.failUnlessEqual(db.calls[-2:], [ 'rebuild_uraggregate_swap', 'ANALYZE uraggregated_data' ])
+        # start, a progress report per partition, the final report, and the swap
+        self.failUnlessEqual(len(messages), 1 + 20 + 1 + 1)
+
+
+    def testStop(self):
+
+        db = FakeDatabase(20)
+        rebuilder = rebuild.Rebuilder(db.connect, workers=1)
+        partitionDone = rebuilder._partitionDone
+        def stopAfterFive(n_records, n_rows):
+            partitionDone(n_records, n_rows)
+            if rebuilder.done == 5:
+                rebuilder.stop()
+        rebuilder._partitionDone = stopAfterFive
+
+        self.failUnlessEqual(rebuilder.rebuild(), None)
+        self.failUnlessEqual(db.built, range(5))
+        self.failIf('rebuild_uraggregate_swap' in db.calls)
+
+
+    def testWorkerError(self):
+
+        db = FakeDatabase(20, fail_at=7)
+        rebuilder = rebuild.Rebuilder(db.connect, workers=2)
+        self.failUnlessRaises(ValueError, rebuilder.rebuild)
+        self.failIf('rebuild_uraggregate_swap' in db.calls)
+
+
+
+    def testNoWorkers(self):
+
+        db = FakeDatabase(20)
+        self.failUnlessRaises(ValueError, rebuild.Rebuilder, db.connect, workers=0)
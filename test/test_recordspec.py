@@ -0,0 +1,68 @@
+#
+# Record spec (compiled parser) tests
+#
+
+import time
+
+from twisted.trial import unittest
+
+from sgas.usagerecord import ursplitter, urparser, urconverter
+from sgas.storagerecord import srsplitter, srparser, srconverter
+
+from test import ursampledata, srsampledata
+
+
+
+def comparable(arg_list):
+    # memory objects do not compare by value
+    return [ [ [ m.getcomposite() for m in a ] if type(a) is list and a and hasattr(a[0], 'getcomposite') else a
+               for a in args ] for args in arg_list ]
+
+
+
+class UsageRecordSpecTest(unittest.TestCase):
+
+    def _compare(self, ur_data):
+
+        insert_time = time.gmtime()
+        docs = [ urparser.xmlToDict(e, '/CN=test', 'test.example.org', insert_time) for e in ursplitter.splitURDocument(ur_data) ]
+        expected = urconverter.createInsertArguments(docs)
+        arg_list = urconverter.parseInsertArguments(ur_data, '/CN=test', 'test.example.org', insert_time)
+        self.failUnlessEqual(comparable(arg_list), comparable(expected))
+        return arg_list
+
+
+    def testSameAsDictParser(self):
+
+        for ur_data in (ursampledata.UR1, ursampledata.UR2, ursampledata.CUR, ursampledata.URT,
+                        ursampledata.UR_LONGHOST, ursampledata.UR_BAD_EXIT_CODE):
+            self._compare(ur_data)
+
+
+    def testBadLocalJobId(self):
+
+        arg_list = self._compare(ursampledata.UR_BAD_LOCAL_JOB_ID)
+        self.failUnlessEqual(arg_list[0][urconverter.RECORD_ID_IDX], ursampledata.UR_BAD_LOCAL_JOB_ID_GLOBAL_JOB_ID)
+        self.failUnlessEqual(arg_list[0][urconverter.LOCAL_JOB_ID_IDX], None)
+
+
+    def testTransfersAndVO(self):
+
+        args = self._compare(ursampledata.URT)[0]
+        self.failUnlessEqual(args[urconverter.RECORD_ID_IDX], ursampledata.URT_ID)
+        self.failUnless(args[urconverter.ARG_LIST.index('vo_attributes')])
+        self.failUnless(args[urconverter.ARG_LIST.index('downloads')])
+
+
+
+class StorageRecordSpecTest(unittest.TestCase):
+
+    def testSameAsDictParser(self):
+
+        insert_time = time.gmtime()
+        for sr_data in (srsampledata.SR_0, srsampledata.SR_1, srsampledata.SRS):
+            docs = [ srparser.xmlToDict(e, '/CN=test', 'test.example.org', insert_time) for e in srsplitter.splitSRDocument(sr_data) ]
+            expected = srconverter.createInsertArguments(docs)
+            arg_list = srconverter.parseInsertArguments(sr_data, '/CN=test', 'test.example.org', insert_time)
+            self.failUnlessEqual(arg_list, expected)
+
@@ -0,0 +1,220 @@
+#
+# Read only replica tests
+#
+
+import psycopg2
+import psycopg2.errors
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from sgas.database import error
+from sgas.database.postgresql import database, replicas
+
+
+
+class FakeTransaction:
+
+    def __init__(self, row, version):
+        self.row = row
+        self.version = version
+        self.query = None
+        self.description = [ ('result', 701, None, None, None, None, None) ]
+
+
+    def execute(self, query, args=None):
+        self.query = query
+
+
+    def fetchall(self):
+        if self.query == replicas.QUERY_SERVER_VERSION:
+            return [ (self.version,) ]
+        return [ self.row ]
+
+
+
+class FakePoolProxy:
+    # runs the interactions right away, or fails them with the given error
+
+    def __init__(self, name, row=(None,), version=160002):
+        self.name = name
+        self.row = row
+        self.version = version
+        self.error = None
+        self.interactions = 0
+        self.reconnects = 0
+
+
+    def runInteraction(self, interaction, *args):
+        self.interactions += 1
+        if self.error is not None:
+            return defer.fail(self.error)
+        return defer.succeed(interaction(FakeTransaction(self.row, self.version), *args))
+
+
+    def reconnect(self):
+        self.reconnects += 1
+
+
+    def getStats(self):
+        return { 'size': 1 }
+
+
+
+class ReplicaSetTest(unittest.TestCase):
+
+    def testGetReplica(self):
+
+        r1, r2, r3 = [ replicas.Replica(FakePoolProxy('replica:r%i' % i)) for i in range(3) ]
+        replica_set = replicas.ReplicaSet([ r1, r2, r3 ])
+        self.failUnlessEqual(replica_set.getReplica(), None) # none checked yet
+
+        r1.healthy = r3.healthy = True
+        self.failUnlessEqual([ replica_set.getReplica() for _ in range(4) ], [ r1, r3, r1, r3 ])
+
+        replica_set.replicaFailed(r1, 'server closed the connection unexpectedly')
+        self.failUnlessEqual([ replica_set.getReplica() for _ in range(2) ], [ r3, r3 ])
+        self.failUnlessEqual( (r1.healthy, r1.failures, r1.pool_proxy.reconnects), (False, 1, 1) )
+
+
+    @defer.inlineCallbacks
+    def testCheckReplica(self):
+
+        # in recovery, replayed position, seconds since the last replayed transaction
+        replica = replicas.Replica(FakePoolProxy('replica:r1', (True, '0/3000000', 0.5)))
+        replica_set = replicas.ReplicaSet([ replica ], max_lag=10)
+
+        yield replica_set.checkReplica(replica)
+        self.failUnlessEqual( (replica.healthy, replica.lag), (True, 0.5) )
+        self.failUnlessEqual(replica.state_query, replicas.QUERY_REPLICATION_STATE)
+
+        replica.pool_proxy.row = (True, '0/3000000', 30.0)
+        yield replica_set.checkReplica(replica)
+        self.failUnlessEqual( (replica.healthy, replica.lag), (False, 30.0) )
+
+        # replayed as far as the primary, there has just not been any transactions lately
+        yield replica_set.checkReplica(replica, '0/3000000')
+        self.failUnlessEqual( (replica.healthy, replica.lag), (True, 0.0) )
+
+        replica.pool_proxy.row = (True, '0/3000000', 2.0)
+        yield replica_set.checkReplica(replica)
+        self.failUnless(replica.healthy)
+
+        # a busy replica is not a failed one
+        replica.pool_proxy.error = error.DatabaseBusyError('busy')
+        yield replica_set.checkReplica(replica)
+        self.failUnless(replica.healthy)
+
+        replica.pool_proxy.error = psycopg2.OperationalError('could not connect to server')
+        yield replica_set.checkReplica(replica)
+        self.failUnlessEqual( (replica.healthy, replica.lag, replica.pool_proxy.reconnects), (False, None, 1) )
+
+        # the pool is only replaced when the replica goes from healthy to failed
+        yield replica_set.checkReplica(replica)
+        self.failUnlessEqual(replica.pool_proxy.reconnects, 1)
+
+
+    @defer.inlineCallbacks
+    def testDisconnectedReceiver(self):
+
+        # the replica has replayed all it received before losing the primary,
+        # while the primary has gone on
+        primary = FakePoolProxy('read', ('1/A0000000',))
+        replica = replicas.Replica(FakePoolProxy('replica:r1', (True, '0/FF000028', 300.0)))
+        replica.healthy = True
+        replica_set = replicas.ReplicaSet([ replica ], max_lag=60, primary=primary)
+
+        yield replica_set.checkReplicas()
+        self.failUnlessEqual( (replica.healthy, replica.lag), (False, 300.0) )
+
+        # reconnected, and caught up
+        replica.pool_proxy.row = (True, '1/A0000100', 300.0)
+        yield replica_set.checkReplicas()
+        self.failUnlessEqual( (replica.healthy, replica.lag), (True, 0.0) )
+
+        # without the position of the primary, only the replay time is used
+        primary.error = error.DatabaseBusyError('busy')
+        yield replica_set.checkReplicas()
+        self.failUnlessEqual( (replica.healthy, replica.lag), (False, 300.0) )
+
+
+    def testReplicationLag(self):
+
+        self.failUnlessEqual(replicas.parseWALPosition('16/B374D848'), (0x16 << 32) + 0xB374D848)
+        self.failUnlessEqual(replicas.replicationLag(False, None, None, None), 0.0) # not a replica
+        self.failUnlessEqual(replicas.replicationLag(True, '0/3000000', None, '0/3000060'), None)
+        self.failUnlessEqual(replicas.replicationLag(True, '0/3000060', None, '0/3000060'), 0.0)
+        self.failUnlessEqual(replicas.replicationLag(True, '0/3000060', 7.5, None), 7.5)
+
+
+    def testConnectionError(self):
+
+        self.failUnless(replicas.isConnectionError(psycopg2.InterfaceError('connection already closed')))
+        self.failUnless(replicas.isConnectionError(psycopg2.OperationalError('server closed the connection unexpectedly')))
+        # e.g., a query cancelled because of a conflict with recovery
+        self.failIf(replicas.isConnectionError(psycopg2.errors.SerializationFailure('conflict with recovery')))
+        self.failIf(replicas.isConnectionError(error.DatabaseBusyError('busy')))
+
+
+
+class ReadRoutingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = database.PostgreSQLDatabase('localhost::sgas:sgas::', replica_infos=[ 'replica1:5433:sgas:sgas:' ])
+        for pool_proxy in self.db.pools.values() + [ r.pool_proxy for r in self.db.replicas.replicas ]:
+            pool_proxy.dbpool.close()
+
+        self.replica = self.db.replicas.replicas[0]
+        self.replica.pool_proxy = FakePoolProxy('replica:replica1:5433')
+        self.replica.healthy = True
+        for pool in database.POOLS:
+            self.db.pools[pool] = FakePoolProxy(pool)
+
+
+    @defer.inlineCallbacks
+    def testRouting(self):
+
+        self.failUnlessEqual(self.db.getPoolStats().keys().count('replica:replica1:5433'), 1)
+
+        yield self.db.query('SELECT 1')
+        yield self.db.dictquery('SELECT 1')
+        self.failUnlessEqual(self.replica.pool_proxy.interactions, 2)
+        self.failUnlessEqual(self.db.pools[database.READ_POOL].interactions, 0)
+
+        # other pools never use the replicas
+        yield self.db.query('SELECT 1', pool=database.AGGREGATION_POOL)
+        self.failUnlessEqual(self.replica.pool_proxy.interactions, 2)
+        self.failUnlessEqual(self.db.pools[database.AGGREGATION_POOL].interactions, 1)
+
+        stream = self.db.streamQuery('SELECT 1')
+        self.failUnlessEqual(stream.pool_proxy, self.replica.pool_proxy)
+
+
+    @defer.inlineCallbacks
+    def testFallback(self):
+
+        # a failed query is retried on the primary, but the replica stays in use
+        self.replica.pool_proxy.error = psycopg2.errors.SerializationFailure('conflict with recovery')
+        yield self.db.query('SELECT 1')
+        self.failUnlessEqual(self.db.pools[database.READ_POOL].interactions, 1)
+        self.failUnless(self.replica.healthy)
+
+        # as is a query on a busy replica
+        self.replica.pool_proxy.error = error.DatabaseBusyError('busy')
+        yield self.db.query('SELECT 1')
+        self.failUnlessEqual(self.db.pools[database.READ_POOL].interactions, 2)
+        self.failUnless(self.replica.healthy)
+
+        # a lost replica is taken out of use
+        self.replica.pool_proxy.error = psycopg2.OperationalError('server closed the connection unexpectedly')
+        yield self.db.query('SELECT 1')
+        self.failUnlessEqual(self.db.pools[database.READ_POOL].interactions, 3)
+        self.failIf(self.replica.healthy)
+
+        yield self.db.query('SELECT 1')
+        self.failUnlessEqual(self.replica.pool_proxy.interactions, 3)
+        self.failUnlessEqual(self.db.pools[database.READ_POOL].interactions, 4)
+
+        stream = self.db.streamQuery('SELECT 1')
+        self.failUnlessEqual(stream.pool_proxy, self.db.pools[database.READ_POOL])
+
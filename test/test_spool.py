@@ -0,0 +1,158 @@
+#
+# Record spool tests
+#
+
+import os
+
+import psycopg2
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+
+from sgas.database import spool, error
+
+
+
+def wait(seconds=0.05):
+    d = defer.Deferred()
+    reactor.callLater(seconds, d.callback, None)
+    return d
+
+
+
+class RecordSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = self.mktemp()
+        self.inserted = []
+        self.fail_with = None
+        self.spool = self._createSpool()
+        return self.spool.startService()
+
+
+    def tearDown(self):
+        return self.spool.stopService()
+
+
+    def _createSpool(self):
+        s = spool.RecordSpool(self.spool_dir)
+        s.registerHandler('ur', self._insert)
+        return s
+
+
+    def _insert(self, arg_list):
+        if self.fail_with is not None:
+            return defer.fail(self.fail_with(arg_list))
+        self.inserted.append(arg_list)
+        return defer.succeed({})
+
+
+    @defer.inlineCallbacks
+    def testAppendAndDrain(self):
+
+        yield defer.gatherResults( [ self.spool.append('ur', [ [ 'r%i' % i, i ] ]) for i in range(5) ] )
+        yield wait()
+
+        # entries appended together are inserted in one batch
+        self.failUnlessEqual(sum(self.inserted, []), [ [ 'r%i' % i, i ] for i in range(5) ])
+        self.failUnless(len(self.inserted) < 5)
+        # journal is truncated once everything has been inserted
+        self.failUnlessEqual(os.path.getsize(os.path.join(self.spool_dir, spool.JOURNAL_FILE)), 0)
+
+
+    @defer.inlineCallbacks
+    def testRetryWhenUnavailable(self):
+
+        self.fail_with = lambda _ : error.DatabaseUnavailableError('down')
+        yield self.spool.append('ur', [ [ 'r1' ] ])
+        yield wait()
+        self.failUnlessEqual(self.inserted, [])
+        self.failIfEqual(self.spool.drain_call, None)
+
+        # spool survives a restart
+        yield self.spool.stopService()
+        self.fail_with = None
+        self.spool = self._createSpool()
+        yield self.spool.startService()
+        yield wait()
+        self.failUnlessEqual(self.inserted, [ [ [ 'r1' ] ] ])
+
+
+    @defer.inlineCallbacks
+    def testIncompleteEntryDiscarded(self):
+
+        self.fail_with = lambda _ : error.DatabaseUnavailableError('down')
+        yield self.spool.append('ur', [ [ 'r1' ] ])
+        yield self.spool.stopService()
+
+        # simulate a crash while writing an entry
+        f = open(os.path.join(self.spool_dir, spool.JOURNAL_FILE), 'ab')
+        f.write(spool.FRAME_HEADER.pack(100, 0) + 'partial')
+        f.close()
+
+        self.fail_with = None
+        self.spool = self._createSpool()
+        yield self.spool.startService()
+        yield wait()
+        self.failUnlessEqual(self.inserted, [ [ [ 'r1' ] ] ])
+
+
+    @defer.inlineCallbacks
+    def testBadEntryRejected(self):
+
+        self.fail_with = lambda _ : error.DatabaseUnavailableError('down')
+        yield defer.gatherResults( [ self.spool.append('ur', [ [ r ] ]) for r in ('r1', 'bad', 'r2') ] )
+        yield self.spool.stopService()
+
+        def insert(arg_list):
+            if [ 'bad' ] in arg_list:
+                return defer.fail(ValueError('bad record'))
+            self.inserted.append(arg_list)
+            return defer.succeed({})
+
+        self.spool = spool.RecordSpool(self.spool_dir)
+        self.spool.registerHandler('ur', insert)
+        yield self.spool.startService()
+        yield wait()
+
+        self.failUnlessEqual(self.inserted, [ [ [ 'r1' ] ], [ [ 'r2' ] ] ])
+        self.failUnless(os.path.getsize(os.path.join(self.spool_dir, spool.REJECTED_FILE)) > 0)
+
+
+
+    @defer.inlineCallbacks
+    def testFailingBatchRetryLimited(self):
+
+        self.patch(spool, 'DRAIN_RETRY_DELAY', 0)
+        attempts = []
+        def insert(arg_list):
+            attempts.append(arg_list)
+            return defer.fail(psycopg2.extensions.TransactionRollbackError('deadlock detected'))
+        self.spool.registerHandler('ur', insert)
+
+        yield self.spool.append('ur', [ [ 'r1' ] ])
+        yield wait()
+
+        # the batch is tried a few times, then one entry at a time, and is then rejected
+        self.failUnlessEqual(len(attempts), 2 * spool.DRAIN_MAX_ATTEMPTS)
+        self.failUnless(os.path.getsize(os.path.join(self.spool_dir, spool.REJECTED_FILE)) > 0)
+        self.failUnlessEqual(self.spool.drain_call, None)
+
+
+    @defer.inlineCallbacks
+    def testDeadlockRetried(self):
+
+        self.patch(spool, 'DRAIN_RETRY_DELAY', 0)
+        failures = [ 'deadlock detected' ] * (spool.DRAIN_MAX_ATTEMPTS - 1)
+        def insert(arg_list):
+            if failures:
+                return defer.fail(psycopg2.extensions.TransactionRollbackError(failures.pop()))
+            self.inserted.append(arg_list)
+            return defer.succeed({})
+        self.spool.registerHandler('ur', insert)
+
+        yield self.spool.append('ur', [ [ 'r1' ] ])
+        yield wait()
+
+        self.failUnlessEqual(self.inserted, [ [ [ 'r1' ] ] ])
+        self.failIf(os.path.exists(os.path.join(self.spool_dir, spool.REJECTED_FILE)))
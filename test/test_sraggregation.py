@@ -0,0 +1,63 @@
+#
+# Storage aggregation update tests
+#
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from sgas.storagerecord import updater
+
+
+
+class SlowDatabase:
+
+    def __init__(self):
+        self.calls = []
+        self.d = None
+
+
+    def updateAggregatorBatch(self, aggregator, args, service):
+        self.calls.append( (aggregator, args) )
+        self.d = defer.Deferred()
+        return self.d
+
+
+
+class StorageAggregationUpdaterTest(unittest.TestCase):
+
+    def testUpdate(self):
+
+        db = SlowDatabase()
+        sr_updater = updater.StorageAggregationUpdater(db, batch_size=10)
+        delays = []
+        sr_updater.scheduleUpdate = lambda delay=updater.UPDATE_DELAY : delays.append(delay)
+
+        results = []
+        sr_updater.performUpdate().addCallback(results.append)
+        self.failUnlessEqual(db.calls, [ ('update_sraggregate', (10,)) ])
+        self.failUnless(sr_updater.updating)
+
+        # inserts while updating are updated when the update is done
+        sr_updater.updateNotification()
+        sr_updater.performUpdate()
+        self.failUnlessEqual(len(db.calls), 1)
+        self.failUnlessEqual(delays, [])
+
+        db.d.callback(3)
+        self.failUnlessEqual(results, [ 3 ])
+        self.failIf(sr_updater.updating)
+        self.failUnlessEqual(delays, [ updater.UPDATE_DELAY ])
+
+
+    def testUpdateError(self):
+
+        db = SlowDatabase()
+        sr_updater = updater.StorageAggregationUpdater(db)
+        delays = []
+        sr_updater.scheduleUpdate = lambda delay=updater.UPDATE_DELAY : delays.append(delay)
+
+        sr_updater.performUpdate()
+        db.d.errback(ValueError('Update failed'))
+        self.failIf(sr_updater.updating)
+        self.failUnlessEqual(delays, [ updater.RETRY_DELAY ])
+
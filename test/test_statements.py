@@ -0,0 +1,106 @@
+#
+# Prepared statement registry tests
+#
+
+import psycopg2
+
+from twisted.trial import unittest
+
+from sgas.database.postgresql import statements
+
+
+
+class FakeConnection:
+    pass
+
+
+
+class FakeTransaction:
+
+    def __init__(self, connection, parameter_types=None, fail_prepare=False):
+        self.connection = connection
+        self.parameter_types = parameter_types or []
+        self.fail_prepare = fail_prepare
+        self.executed = []
+
+
+    def execute(self, query, args=None):
+        self.executed.append( (query, args) )
+        if query.startswith('PREPARE') and self.fail_prepare:
+            raise psycopg2.ProgrammingError('could not determine data type of parameter $1')
+
+
+    def fetchall(self):
+        return [ (self.parameter_types,) ]
+
+
+
+class StatementTest(unittest.TestCase):
+
+    def testConvertPlaceholders(self):
+
+        text, names, n = statements.convertPlaceholders('SELECT a FROM t WHERE b = %s AND c = %s;\n')
+        self.failUnlessEqual(text, 'SELECT a FROM t WHERE b = $1 AND c = $2')
+        self.failUnlessEqual( (names, n), (None, 2) )
+
+        text, names, n = statements.convertPlaceholders("SELECT a FROM t WHERE b = %(x)s AND c LIKE 'y%%' AND d > %(z)s AND e < %(x)s")
+        self.failUnlessEqual(text, "SELECT a FROM t WHERE b = $1 AND c LIKE 'y%' AND d > $2 AND e < $1")
+        self.failUnlessEqual( (names, n), (['x', 'z'], 2) )
+
+        self.failUnlessRaises(statements.StatementError, statements.convertPlaceholders, 'SELECT %s, %(x)s')
+
+
+    def testRegister(self):
+
+        registry = statements.StatementRegistry()
+        registry.register('q1', 'SELECT 1')
+        registry.register('q1', 'SELECT 1') # same query again is fine
+        self.failUnlessRaises(statements.StatementError, registry.register, 'q1', 'SELECT 2')
+
+
+    def testExecute(self):
+
+        registry = statements.StatementRegistry()
+        registry.register('q1', 'SELECT a FROM t WHERE b = %(b)s AND c = ANY(%(c)s::date[])')
+        query = 'SELECT a FROM t WHERE b = %(b)s AND c = ANY(%(c)s::date[])'
+
+        conn = FakeConnection()
+        txn = FakeTransaction(conn, [ 'character varying', 'date[]' ])
+        registry.execute(txn, query, { 'b': 'x', 'c': [ '2011-01-01' ] })
+        self.failUnlessEqual(txn.executed[1], ('PREPARE q1 AS SELECT a FROM t WHERE b = $1 AND c = ANY($2::date[])', None))
+        self.failUnlessEqual(txn.executed[-1], ('EXECUTE q1 (%s::character varying, %s::date[])', [ 'x', [ '2011-01-01' ] ]))
+
+        # prepared once per connection
+        txn = FakeTransaction(conn)
+        registry.execute(txn, query, { 'b': 'y', 'c': [] })
+        self.failUnlessEqual(txn.executed, [ ('EXECUTE q1 (%s::character varying, %s::date[])', [ 'y', [] ]) ])
+
+        txn = FakeTransaction(FakeConnection())
+        registry.execute(txn, query, { 'b': 'y', 'c': [] })
+        self.failUnlessEqual(len([ q for q, _ in txn.executed if q.startswith('PREPARE') ]), 1)
+
+        stats = registry.getStats()['q1']
+        self.failUnlessEqual( (stats['calls'], stats['prepares'], stats['prepared']), (3, 2, True) )
+
+        # unregistered queries are executed as they are
+        txn = FakeTransaction(conn)
+        registry.execute(txn, 'SELECT 2', None)
+        self.failUnlessEqual(txn.executed, [ ('SELECT 2', None) ])
+
+
+    def testPrepareFailure(self):
+
+        registry = statements.StatementRegistry()
+        query = 'SELECT %s IS NULL'
+        registry.register('q1', query)
+
+        txn = FakeTransaction(FakeConnection(), fail_prepare=True)
+        registry.execute(txn, query, (None,))
+        self.failUnlessEqual(txn.executed[-2:], [ ('ROLLBACK TO SAVEPOINT sgas_prepare', None), (query, (None,)) ])
+
+        # not attempted again
+        txn = FakeTransaction(FakeConnection())
+        registry.execute(txn, query, (None,))
+        self.failUnlessEqual(txn.executed, [ (query, (None,)) ])
+        self.failUnlessEqual(registry.getStats()['q1']['prepared'], False)
+
@@ -0,0 +1,50 @@
+#
+# Query result conversion tests
+#
+
+import datetime
+
+from twisted.trial import unittest
+
+from sgas.database.postgresql import typecast
+
+
+
+class TypecastTest(unittest.TestCase):
+
+    def testCastNumeric(self):
+
+        self.failUnlessEqual(typecast.castNumeric(None, None), None)
+        value = typecast.castNumeric('42', None)
+        self.failUnlessEqual(value, 42)
+        self.failUnlessEqual(type(value), int)
+        value = typecast.castNumeric('3.50', None)
+        self.failUnlessEqual(value, 3.5)
+        self.failUnlessEqual(type(value), float)
+        self.failUnlessEqual(typecast.castNumeric('-7', None), -7.0)
+        self.failUnlessEqual(typecast.castNumeric('123456789012345678901234', None), 123456789012345678901234L)
+
+
+    def testColumnConverters(self):
+
+        # (name, type_code, ...) like cursor.description
+        description = [ ('machine_name', 1043), ('n_jobs', 23), ('cputime', 1700),
+                        ('execution_time', 1082), ('runtime_environments', 1015) ]
+        converters = typecast.columnConverters(description)
+        self.failUnlessEqual([ idx for idx, _ in converters ], [ 4 ])
+
+        self.failUnlessEqual(typecast.columnConverters(None), [])
+
+
+    def testConvertRows(self):
+
+        rows = [ ('host1', 2, 3.5), ('host2', 4, 7.0) ]
+        # the rows are returned as they are, when there is nothing to convert
+        self.failUnless(typecast.convertRows(rows, []) is rows)
+
+        rows = [ ('host1', datetime.datetime(2011, 1, 2, 10, 30), None),
+                 ('host2', datetime.datetime(2011, 2, 3, 11, 0), [ 'ENV/A' ]) ]
+        converters = [ (1, typecast.buildValue), (2, typecast.buildValue) ]
+        self.failUnlessEqual(typecast.convertRows(rows, converters),
+                             [ [ 'host1', '2011-01-02 10:30:00', None ], [ 'host2', '2011-02-03 11:00:00', "['ENV/A']" ] ])
+
@@ -0,0 +1,60 @@
+#
+# Usage record splitter tests
+#
+
+import StringIO
+
+from twisted.trial import unittest
+
+from sgas.usagerecord import ursplitter, urparser
+
+from test import ursampledata
+
+
+
+class URSplitterTest(unittest.TestCase):
+
+    def _recordIds(self, source):
+        record_ids = []
+        for ur_element in ursplitter.iterURDocument(source):
+            ur_doc = urparser.xmlToDict(ur_element)
+            record_ids.append(ur_doc['record_id'])
+        return record_ids
+
+
+    def testSingleRecord(self):
+
+        record_ids = self._recordIds(ursampledata.UR1)
+        self.failUnlessEqual(record_ids, [ ursampledata.UR1_ID ])
+
+
+    def testCompoundRecord(self):
+
+        record_ids = self._recordIds(StringIO.StringIO(ursampledata.CUR))
+        self.failUnlessEqual(record_ids, ursampledata.CUR_IDS)
+
+
+    def testSameAsSplit(self):
+
+        split_docs = [ urparser.xmlToDict(e) for e in ursplitter.splitURDocument(ursampledata.CUR) ]
+        iter_docs  = [ urparser.xmlToDict(e) for e in ursplitter.iterURDocument(ursampledata.CUR) ]
+        self.failUnlessEqual(split_docs, iter_docs)
+
+
+    def testElementsCleared(self):
+
+        elements = list(ursplitter.iterURDocument(ursampledata.CUR))
+        self.failUnlessEqual(len(elements), 2)
+        for element in elements:
+            self.failUnlessEqual(len(element), 0)
+
+
+    def testInvalidDocuments(self):
+
+        bad_docs = [ '<ur:JobUsageRecord xmlns:ur="http://schema.ogf.org/urf/2003/09/urf">',
+                     '<foo/>',
+                     '<ur:UsageRecords xmlns:ur="http://schema.ogf.org/urf/2003/09/urf"><foo/></ur:UsageRecords>' ]
+
+        for doc in bad_docs:
+            self.failUnlessRaises(ursplitter.ParseError, list, ursplitter.iterURDocument(doc))
+
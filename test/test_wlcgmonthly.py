@@ -0,0 +1,123 @@
+#
+# WLCG monthly data tests
+#
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from sgas.viewengine import dateform
+
+try:
+    from sgas.viewengine import wlcgmonthly
+except ImportError:
+    wlcgmonthly = None # wlcgsgas is not installed
+
+
+
+class FakeConfig:
+
+    digest = 'digest'
+
+    def processRows(self, rows):
+        return [ { 'rows': tuple(rows) } ]
+
+
+
+class FakeDatabase:
+
+    def __init__(self, covered):
+        self.covered = covered
+        self.queries = []
+
+
+    def query(self, query, query_args=None):
+        self.queries.append( (query, query_args) )
+        if query == wlcgmonthly.QUERY_COVERED_MONTHS:
+            return defer.succeed([ [ period ] for period in self.covered ])
+        elif query == wlcgmonthly.QUERY_RECORDS:
+            row = [ None ] * len(wlcgmonthly.RECORD_COLUMNS)
+            return defer.succeed([ [ period, 'host1.example.org' ] + row[1:] for period in query_args[0] ])
+        else:
+            return defer.succeed([ query_args ])
+
+
+
+class MonthPeriodsTest(unittest.TestCase):
+
+    def testMonthEnd(self):
+
+        self.failUnlessEqual(dateform.monthEnd('2011-01-01'), '2011-01-31')
+        self.failUnlessEqual(dateform.monthEnd('2012-02-01'), '2012-02-29')
+
+
+    def testMonthPeriods(self):
+
+        self.failUnlessEqual(dateform.monthPeriods('2011-01-01', '2011-01-31'), [ '2011-01-01' ])
+        self.failUnlessEqual(dateform.monthPeriods('2011-11-01', '2012-02-29'),
+                             [ '2011-11-01', '2011-12-01', '2012-01-01', '2012-02-01' ])
+        # not whole months
+        self.failUnlessEqual(dateform.monthPeriods('2011-01-02', '2011-01-31'), None)
+        self.failUnlessEqual(dateform.monthPeriods('2011-01-01', '2011-02-27'), None)
+        self.failUnlessEqual(dateform.monthPeriods('2011-02-01', '2011-01-31'), None)
+
+
+    def testMonthRuns(self):
+
+        periods = [ '2011-01-01', '2011-02-01', '2011-03-01', '2011-04-01', '2011-05-01' ]
+        self.failUnlessEqual(dateform.monthRuns(periods, set(periods)), [])
+        self.failUnlessEqual(dateform.monthRuns(periods, set([ '2011-03-01' ])),
+                             [ ('2011-01-01', '2011-02-28'), ('2011-04-01', '2011-05-31') ])
+        self.failUnlessEqual(dateform.monthRuns(periods, set()), [ ('2011-01-01', '2011-05-31') ])
+
+
+
+class WLCGMonthlyTest(unittest.TestCase):
+
+    if wlcgmonthly is None:
+        skip = 'wlcgsgas is not installed'
+
+
+    def createMonthly(self, db):
+        monthly = wlcgmonthly.WLCGMonthly.__new__(wlcgmonthly.WLCGMonthly)
+        monthly.db = db
+        monthly.config = FakeConfig()
+        return monthly
+
+
+    @defer.inlineCallbacks
+    def testRetrieveRecords(self):
+
+        db = FakeDatabase([ '2011-02-01' ])
+        monthly = self.createMonthly(db)
+
+        records = yield monthly.retrieveRecords('2011-01-01', '2011-03-31')
+
+        # the computed month is looked up, the others are queried
+        queries = [ q for q, _ in db.queries ]
+        self.failUnlessEqual(queries, [ wlcgmonthly.QUERY_COVERED_MONTHS, wlcgmonthly.QUERY_RECORDS,
+                                        wlcgmonthly.wlcgquery.WLCG_QUERY, wlcgmonthly.wlcgquery.WLCG_QUERY ])
+        self.failUnlessEqual(db.queries[0][1], ('2011-01-01', '2011-03-01', 'digest'))
+        self.failUnlessEqual(db.queries[2][1], ('2011-01-01', '2011-01-31'))
+        self.failUnlessEqual(db.queries[3][1], ('2011-03-01', '2011-03-31'))
+
+        self.failUnlessEqual(len(records), 3)
+        looked_up = records[0]
+        self.failUnlessEqual(looked_up[wlcgmonthly.dataprocess.YEAR], 2011)
+        self.failUnlessEqual(looked_up[wlcgmonthly.dataprocess.MONTH], 2)
+        self.failUnlessEqual(looked_up[wlcgmonthly.dataprocess.HOST], 'host1.example.org')
+        # the tier split is done by the views, after collapsing
+        self.failIf(wlcgmonthly.dataprocess.TIER in looked_up)
+        self.failUnlessEqual(records[1], { 'rows': (('2011-01-01', '2011-01-31'),) })
+
+
+    @defer.inlineCallbacks
+    def testRetrieveRecordsPartialMonth(self):
+
+        db = FakeDatabase([ '2011-01-01' ])
+        monthly = self.createMonthly(db)
+
+        # date ranges which are not whole months are always queried
+        records = yield monthly.retrieveRecords('2011-01-10', '2011-01-31')
+        self.failUnlessEqual(db.queries, [ (wlcgmonthly.wlcgquery.WLCG_QUERY, ('2011-01-10', '2011-01-31')) ])
+        self.failUnlessEqual(records, [ { 'rows': (('2011-01-10', '2011-01-31'),) } ])
+